@@ -0,0 +1,186 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+Benchmarks for signing and verifying with the host key types
+L{twisted.conch.ssh.keys.Key} supports, which is what a key exchange costs the
+server (one signature) and the client (one verification) beyond the
+Diffie-Hellman exchange itself.
+
+RSA keys are also timed signing with each of the hashes SSH uses for them,
+without blinding, and as L{keys.Key.sign} used to sign, handing the padded
+digest straight to PyCrypto.  ECDSA and Ed25519 keys cannot sign, so only
+verification is timed for them, with the keys and signatures of
+L{twisted.conch.test.keydata}.
+"""
+
+from sys import stdout
+from pprint import pprint
+from time import time
+
+from Crypto.PublicKey import RSA, DSA
+from Crypto.Util.number import long_to_bytes
+
+from twisted.python import randbytes
+from twisted.python.usage import Options
+
+from twisted.conch.ssh import keys
+from twisted.conch.test import keydata
+
+
+# The public elliptic curve keys of each type, whose signatures of 'data' are
+# in keydata.ellipticCurveSignatures.
+_ellipticCurveKeys = {
+    'nistp256': keydata.publicECDSA_openssh,
+    'nistp384': keydata.publicECDSA384_openssh,
+    'nistp521': keydata.publicECDSA521_openssh,
+    'ed25519': keydata.publicEd25519_openssh}
+
+
+class KeysBenchmark(Options):
+    """
+    Options for configuring the execution parameters of a benchmark run.
+    """
+
+    optParameters = [
+        ('types', 't',
+         'rsa2048,rsa4096,dsa1024,nistp256,nistp384,nistp521,ed25519',
+         'Comma separated key types to time'),
+        ('duration', 'd', '1.0',
+         'Number of seconds to spend on each operation of each key type')]
+
+    def postOptions(self):
+        self['types'] = self['types'].split(',')
+        self['duration'] = float(self['duration'])
+
+
+
+def _generate(keyType):
+    """
+    Return a new private L{keys.Key} of C{keyType}, C{'rsa'} or C{'dsa'}
+    followed by a number of bits.
+    """
+    if keyType.startswith('rsa'):
+        return keys.Key(RSA.generate(int(keyType[3:]),
+                                     randbytes.secureRandom))
+    else:
+        return keys.Key(DSA.generate(int(keyType[3:]),
+                                     randbytes.secureRandom))
+
+
+
+def _rate(duration, function, *args):
+    """
+    Call C{function} for about C{duration} seconds and return how many times
+    a second it ran.
+    """
+    count = 0
+    start = time()
+    end = start + duration
+    while True:
+        function(*args)
+        count += 1
+        now = time()
+        if now >= end:
+            return count / (now - start)
+
+
+
+def _legacyRSASign(privateKey, data):
+    """
+    Sign C{data} with C{privateKey}, an RSA L{keys.Key}, as
+    L{keys.Key.sign} did before it blinded and checked its signatures.
+    """
+    digest = keys.pkcs1Digest(data, privateKey.keyObject.size() / 8)
+    signature = privateKey.keyObject.sign(digest, '')[0]
+    return keys.common.NS('ssh-rsa') + keys.common.NS(
+        long_to_bytes(signature))
+
+
+
+def _rsaSignRates(privateKey, data, duration):
+    """
+    Time signing C{data} with C{privateKey}, an RSA L{keys.Key}, with each
+    signature type, without blinding, and as it used to be signed.
+
+    @return: a dictionary mapping unicode descriptions of each way of
+        signing to how many signatures a second it makes.
+    """
+    rates = {}
+    for signatureType in ['ssh-rsa', 'rsa-sha2-256', 'rsa-sha2-512']:
+        rates[unicode(signatureType)] = _rate(
+            duration, privateKey.sign, data, signatureType)
+    privateKey.rsaBlinding = False
+    try:
+        rates[u'ssh-rsa unblinded'] = _rate(duration, privateKey.sign, data)
+    finally:
+        del privateKey.rsaBlinding
+    rates[u'ssh-rsa legacy'] = _rate(
+        duration, _legacyRSASign, privateKey, data)
+    return rates
+
+
+
+def benchmark(keyType, duration=1.0):
+    """
+    Time signing and verifying with a new key of C{keyType}, or only
+    verifying with the elliptic curve key of C{keyType}.
+
+    Verifications are timed twice: with a new public key object each time,
+    as for the host key of a server a client connects to once, and with the
+    same one, as for a known host or an authorized user key kept in a
+    L{keys.KeyCache}.
+
+    @return: a dictionary mapping the unicode strings C{u'verifiesPerSecond'}
+        and C{u'cachedVerifiesPerSecond'} to the rates of each operation;
+        for RSA and DSA keys, also C{u'signsPerSecond'} to the rate of
+        signatures and C{u'handshakeMilliseconds'} to the time one signature
+        and one verification by a new public key take together, and for RSA
+        keys C{u'rsaSignsPerSecond'} to the rates from L{_rsaSignRates}.
+    """
+    if keyType in _ellipticCurveKeys:
+        privateKey = None
+        publicKey = keys.Key.fromString(_ellipticCurveKeys[keyType])
+        data = 'data'
+        signature = keydata.ellipticCurveSignatures[
+            _ellipticCurveKeys[keyType]]
+    else:
+        privateKey = _generate(keyType)
+        publicKey = privateKey.public()
+        data = randbytes.secureRandom(20)
+        signature = privateKey.sign(data)
+    blob = publicKey.blob()
+    assert publicKey.verify(signature, data)
+    verifies = _rate(duration, lambda: keys.Key.fromString(blob).verify(
+            signature, data))
+    cachedVerifies = _rate(duration, publicKey.verify, signature, data)
+    results = {
+        u'verifiesPerSecond': verifies,
+        u'cachedVerifiesPerSecond': cachedVerifies}
+    if privateKey is None:
+        return results
+    signs = _rate(duration, privateKey.sign, data)
+    results[u'signsPerSecond'] = signs
+    results[u'handshakeMilliseconds'] = 1000 * (1 / signs + 1 / verifies)
+    if privateKey.type() == 'RSA':
+        assert _legacyRSASign(privateKey, data) == signature
+        results[u'rsaSignsPerSecond'] = _rsaSignRates(
+            privateKey, data, duration)
+    return results
+
+
+
+def main(args=None):
+    """
+    Perform a single benchmark run and print the results.
+    """
+    options = KeysBenchmark()
+    options.parseOptions(args)
+    results = {}
+    for keyType in options['types']:
+        results[keyType] = benchmark(keyType, options['duration'])
+    pprint(results, stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,436 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+Benchmarks for SFTP over a complete SSH connection: an in-process
+L{SSHFactory<twisted.conch.ssh.factory.SSHFactory>} serving either the Unix
+SFTP backend from a temporary directory or the in-memory backend of
+L{twisted.conch.memory}, which keeps the disk out of the measurement, and a
+L{FileTransferClient<twisted.conch.ssh.filetransfer.FileTransferClient>}
+connected to it over TCP on the loopback interface.
+
+This measures the throughput of downloads and uploads for several request
+sizes and pipelining depths, the rate of stat and directory listing
+operations, and the rate of complete handshakes (key exchange and password
+authentication), and writes the results as JSON.
+"""
+
+import os, sys, shutil, tempfile
+from time import time
+
+try:
+    import json
+except ImportError:
+    json = None
+
+from zope.interface import implements
+
+from twisted import version
+from twisted.python.usage import Options, UsageError
+from twisted.python import components, log
+from twisted.internet import defer, protocol, reactor
+from twisted.cred import portal, checkers
+
+from twisted.conch import avatar, unix, memory
+from twisted.conch.interfaces import IConchUser
+from twisted.conch.ssh import (factory, keys, transport, userauth,
+                               connection, channel, common, filetransfer,
+                               session)
+
+
+class SFTPBenchmark(Options):
+    """
+    Options for configuring the execution parameters of a benchmark run.
+    """
+
+    optParameters = [
+        ('backend', 'b', 'unix', 'The SFTP backend to serve: unix or memory'),
+        ('size', 's', '16', 'Size, in MiB, of the file transferred'),
+        ('request-sizes', 'r', '8192,32768,131072',
+         'Comma separated sizes, in bytes, of each READ and WRITE request'),
+        ('depths', 'd', '1,4,16',
+         'Comma separated numbers of requests kept outstanding at once'),
+        ('operations', 'o', '2000', 'Number of stat operations at each depth'),
+        ('entries', 'e', '1000', 'Number of entries in the listed directory'),
+        ('listings', 'l', '20', 'Number of times the directory is listed'),
+        ('handshakes', 'n', '20', 'Number of connections to make'),
+        ('key-size', 'k', '1024', 'Size, in bits, of the RSA host key'),
+        ('output', 'O', None, 'Write the results to this file, not stdout')]
+
+    def postOptions(self):
+        if json is None:
+            raise UsageError("The json module is required")
+        if self['backend'] not in ('unix', 'memory'):
+            raise UsageError("Unknown backend %r" % (self['backend'],))
+        for name in ('size', 'operations', 'entries', 'listings',
+                     'handshakes', 'key-size'):
+            self[name] = int(self[name])
+        for name in ('request-sizes', 'depths'):
+            self[name] = [int(value) for value in self[name].split(',')]
+
+
+
+class BenchmarkAvatar(avatar.ConchUser):
+    """
+    A user whose SFTP requests are served from C{homeDir}, without switching
+    credentials.
+    """
+
+    def __init__(self, homeDir):
+        avatar.ConchUser.__init__(self)
+        self.homeDir = homeDir
+        self.channelLookup['session'] = session.SSHSession
+        self.subsystemLookup['sftp'] = filetransfer.FileTransferServer
+
+
+    def getHomeDir(self):
+        return self.homeDir
+
+
+    def _runAsUser(self, f, *args, **kw):
+        try:
+            f = iter(f)
+        except TypeError:
+            f = [(f, args, kw)]
+        for i in f:
+            func = i[0]
+            args = len(i) > 1 and i[1] or ()
+            kw = len(i) > 2 and i[2] or {}
+            r = func(*args, **kw)
+        return r
+
+components.registerAdapter(unix.SFTPServerForUnixConchUser, BenchmarkAvatar,
+                           filetransfer.ISFTPServer)
+
+
+
+class BenchmarkRealm:
+    """
+    A realm giving every user a L{BenchmarkAvatar} for the same directory.
+    """
+    implements(portal.IRealm)
+
+    def __init__(self, homeDir):
+        self.homeDir = homeDir
+
+
+    def requestAvatar(self, avatarId, mind, *interfaces):
+        return IConchUser, BenchmarkAvatar(self.homeDir), lambda: None
+
+
+
+class BenchmarkClientTransport(transport.SSHClientTransport):
+    """
+    A client transport which accepts any host key and logs in with the
+    benchmark's password, firing C{factory.ready} with the connection
+    service once it has started.
+    """
+
+    def verifyHostKey(self, pubKey, fingerprint):
+        return defer.succeed(True)
+
+
+    def connectionSecure(self):
+        self.requestService(PasswordUserAuth(
+                'benchmark', BenchmarkConnection(self.factory.ready)))
+
+
+
+class PasswordUserAuth(userauth.SSHUserAuthClient):
+    """
+    Authenticate with the benchmark's password only.
+    """
+
+    def getPassword(self, prompt=None):
+        return defer.succeed('benchmark')
+
+
+    def getPublicKey(self):
+        return None
+
+
+
+class BenchmarkConnection(connection.SSHConnection):
+    """
+    A connection service which fires a L{Deferred} once it has started.
+    """
+
+    def __init__(self, ready):
+        connection.SSHConnection.__init__(self)
+        self.ready = ready
+
+
+    def serviceStarted(self):
+        connection.SSHConnection.serviceStarted(self)
+        self.ready.callback(self)
+
+
+
+class SFTPChannel(channel.SSHChannel):
+    """
+    A session channel running the I{sftp} subsystem, which fires C{ready}
+    with a L{filetransfer.FileTransferClient} once the subsystem starts.
+    """
+
+    name = 'session'
+
+    def __init__(self, ready, *args, **kw):
+        channel.SSHChannel.__init__(self, *args, **kw)
+        self.ready = ready
+
+
+    def channelOpen(self, specificData):
+        d = self.conn.sendRequest(self, 'subsystem', common.NS('sftp'),
+                                  wantReply=True)
+        d.addCallback(self._cbSubsystem)
+        d.addErrback(self.ready.errback)
+
+
+    def openFailed(self, reason):
+        self.ready.errback(reason)
+
+
+    def _cbSubsystem(self, result):
+        client = filetransfer.FileTransferClient()
+        client.makeConnection(self)
+        self.dataReceived = client.dataReceived
+        self.ready.callback(client)
+
+
+
+def connect(port):
+    """
+    Connect and log in to the benchmark server on C{port}.
+
+    @return: a L{Deferred} firing with the L{BenchmarkConnection}.
+    """
+    clientFactory = protocol.ClientFactory()
+    clientFactory.protocol = BenchmarkClientTransport
+    clientFactory.ready = defer.Deferred()
+    reactor.connectTCP('127.0.0.1', port, clientFactory)
+    return clientFactory.ready
+
+
+
+def openSFTP(conn):
+    """
+    Start the I{sftp} subsystem on C{conn}.
+
+    @return: a L{Deferred} firing with a L{filetransfer.FileTransferClient}.
+    """
+    ready = defer.Deferred()
+    conn.openChannel(SFTPChannel(ready, conn=conn))
+    return ready
+
+
+
+def makeBackend(backend, homeDir):
+    """
+    Create the realm serving C{backend}, and an L{filetransfer.ISFTPServer}
+    for the same files to set up the benchmark's files with.
+    """
+    if backend == 'memory':
+        filesystem = memory.MemoryFilesystem()
+        return (memory.MemorySFTPRealm(filesystem),
+                memory.MemorySFTPServer(filesystem))
+    return (BenchmarkRealm(homeDir),
+            unix.SFTPServerForUnixConchUser(BenchmarkAvatar(homeDir)))
+
+
+
+def startServer(realm, keySize):
+    """
+    Listen on an ephemeral loopback port with an SSH server for C{realm}.
+
+    @return: the listening port.
+    """
+    from Crypto.PublicKey import RSA
+    hostKey = keys.Key(RSA.generate(keySize))
+    checker = checkers.InMemoryUsernamePasswordDatabaseDontUse(
+        benchmark='benchmark')
+    serverFactory = factory.SSHFactory()
+    serverFactory.portal = portal.Portal(realm, [checker])
+    serverFactory.publicKeys = {'ssh-rsa': hostKey.public()}
+    serverFactory.privateKeys = {'ssh-rsa': hostKey}
+    return reactor.listenTCP(0, serverFactory, interface='127.0.0.1')
+
+
+
+def _megabytesPerSecond(size, duration):
+    return size / duration / 1e6
+
+
+
+@defer.inlineCallbacks
+def _transfer(client, transferClass, remotePath, flags, localFile,
+              requestSize, depth):
+    """
+    Copy between C{remotePath} and C{localFile} with C{transferClass}.
+
+    @return: a L{Deferred} firing with the number of seconds taken.
+    """
+    remoteFile = yield client.openFile(remotePath, flags, {})
+    start = time()
+    yield transferClass(remoteFile, localFile, requestSize, depth).start()
+    yield remoteFile.close()
+    defer.returnValue(time() - start)
+
+
+
+@defer.inlineCallbacks
+def benchmarkTransfers(client, server, localDir, size, requestSizes, depths):
+    """
+    Time downloading and uploading a file of C{size} bytes with each request
+    size and depth.
+    """
+    f = server.openFile('source', filetransfer.FXF_WRITE |
+                        filetransfer.FXF_CREAT | filetransfer.FXF_TRUNC, {})
+    for offset in range(0, size, 1024 * 1024):
+        f.writeChunk(offset, os.urandom(min(1024 * 1024, size - offset)))
+    f.close()
+    local = file(os.path.join(localDir, 'local'), 'w+b')
+    gets, puts = [], []
+    for requestSize in requestSizes:
+        for depth in depths:
+            local.seek(0)
+            local.truncate()
+            duration = yield _transfer(
+                client, filetransfer.PipelinedGet, 'source',
+                filetransfer.FXF_READ, local, requestSize, depth)
+            gets.append({u'requestSize': requestSize, u'depth': depth,
+                         u'megabytesPerSecond':
+                             _megabytesPerSecond(size, duration)})
+            duration = yield _transfer(
+                client, filetransfer.PipelinedPut, 'upload',
+                filetransfer.FXF_WRITE | filetransfer.FXF_CREAT |
+                filetransfer.FXF_TRUNC, local, requestSize, depth)
+            puts.append({u'requestSize': requestSize, u'depth': depth,
+                         u'megabytesPerSecond':
+                             _megabytesPerSecond(size, duration)})
+    local.close()
+    defer.returnValue((gets, puts))
+
+
+
+@defer.inlineCallbacks
+def benchmarkStat(client, operations, depths):
+    """
+    Time C{operations} stat requests with each number of them outstanding.
+    """
+    results = []
+    for depth in depths:
+        semaphore = defer.DeferredSemaphore(depth)
+        start = time()
+        yield defer.gatherResults([
+                semaphore.run(client.getAttrs, 'source')
+                for i in xrange(operations)])
+        results.append({u'depth': depth, u'operationsPerSecond':
+                            operations / (time() - start)})
+    defer.returnValue(results)
+
+
+
+@defer.inlineCallbacks
+def benchmarkListing(client, server, entries, listings):
+    """
+    Time listing a directory of C{entries} files C{listings} times.
+    """
+    server.makeDirectory('listing', {})
+    for i in xrange(entries):
+        server.openFile('listing/file%06d' % (i,), filetransfer.FXF_WRITE |
+                        filetransfer.FXF_CREAT, {}).close()
+    seen = []
+    start = time()
+    for i in xrange(listings):
+        yield client.listDirectory(
+            'listing', lambda batch: seen.extend(batch))
+    duration = time() - start
+    assert len(seen) == entries * listings
+    defer.returnValue({u'entries': entries,
+                       u'operationsPerSecond': listings / duration,
+                       u'entriesPerSecond': len(seen) / duration})
+
+
+
+@defer.inlineCallbacks
+def benchmarkHandshakes(port, handshakes):
+    """
+    Time C{handshakes} connections, one after another, from connecting to
+    the start of the connection service.
+    """
+    start = time()
+    for i in xrange(handshakes):
+        conn = yield connect(port)
+        conn.transport.loseConnection()
+    defer.returnValue({u'count': handshakes,
+                       u'perSecond': handshakes / (time() - start)})
+
+
+
+@defer.inlineCallbacks
+def benchmark(options):
+    """
+    Run every benchmark with the given L{SFTPBenchmark} options.
+
+    @return: a L{Deferred} firing with a dictionary of results.
+    """
+    localDir = tempfile.mkdtemp()
+    homeDir = os.path.join(localDir, 'home')
+    os.mkdir(homeDir)
+    realm, server = makeBackend(options['backend'], homeDir)
+    port = startServer(realm, options['key-size'])
+    try:
+        portNumber = port.getHost().port
+        conn = yield connect(portNumber)
+        client = yield openSFTP(conn)
+        gets, puts = yield benchmarkTransfers(
+            client, server, localDir, options['size'] * 1024 * 1024,
+            options['request-sizes'], options['depths'])
+        stat = yield benchmarkStat(client, options['operations'],
+                                   options['depths'])
+        listing = yield benchmarkListing(client, server, options['entries'],
+                                         options['listings'])
+        conn.transport.loseConnection()
+        handshakes = yield benchmarkHandshakes(portNumber,
+                                               options['handshakes'])
+    finally:
+        yield port.stopListening()
+        shutil.rmtree(localDir)
+    defer.returnValue({
+            u'backend': unicode(options['backend']),
+            u'python': unicode(sys.version.split()[0]),
+            u'twisted': unicode(version.short()),
+            u'fileBytes': options['size'] * 1024 * 1024,
+            u'get': gets,
+            u'put': puts,
+            u'stat': stat,
+            u'readdir': listing,
+            u'handshakes': handshakes})
+
+
+
+def main(args=None):
+    """
+    Perform a single benchmark run and write the results as JSON.
+    """
+    options = SFTPBenchmark()
+    options.parseOptions(args)
+    results = []
+    d = benchmark(options)
+    d.addCallbacks(results.append, log.err)
+    d.addBoth(lambda ignored: reactor.stop())
+    reactor.run()
+    if not results:
+        raise SystemExit(1)
+    if options['output'] is None:
+        output = sys.stdout
+    else:
+        output = file(options['output'], 'w')
+    json.dump(results[0], output, indent=2, sort_keys=True)
+    output.write('\n')
+    if output is not sys.stdout:
+        output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+Benchmarks for decoding and encoding SFTP directory listings with
+L{twisted.conch.ssh.filetransfer}, comparing the L{SFTPAttrs
+<twisted.conch.ssh.filetransfer.SFTPAttrs>} parser with the dictionary based,
+slice-per-field parser it replaced.
+"""
+
+import struct
+from sys import stdout
+from pprint import pprint
+from time import time
+
+from twisted.python.usage import Options
+
+from twisted.internet.defer import Deferred
+from twisted.conch.ssh.common import NS, getNS
+from twisted.conch.ssh import filetransfer
+
+
+class AttributesBenchmark(Options):
+    """
+    Options for configuring the execution parameters of a benchmark run.
+    """
+
+    optFlags = [
+        ('legacy', 'l',
+         'Also time the legacy decoder.  It copies the rest of the packet for '
+         'each field, so it takes minutes for the default listing size.')]
+
+    optParameters = [
+        ('entries', 'n', '100000',
+         'Number of entries in the directory listing'),
+        ('repeat', 'r', '3',
+         'Number of times to run each benchmark; the fastest run is kept')]
+
+    def postOptions(self):
+        self['entries'] = int(self['entries'])
+        self['repeat'] = int(self['repeat'])
+
+
+
+def _listing(entries):
+    """
+    Build the entries of a directory listing, much like the ones
+    L{twisted.conch.unix} sends.
+    """
+    result = []
+    for i in xrange(entries):
+        name = 'file%06d.txt' % (i,)
+        attrs = {'size': i * 37, 'uid': 1000, 'gid': 1000,
+                 'permissions': 0100644, 'atime': 1300000000 + i,
+                 'mtime': 1300000000 + i}
+        result.append((name, '-rw-r--r--    1 user user %s' % (name,), attrs))
+    return result
+
+
+
+def _namePacket(listing):
+    """
+    Encode C{listing} as the body of an FXP_NAME packet with request ID 1.
+    """
+    return struct.pack('!LL', 1, len(listing)) + ''.join([
+            NS(name) + NS(longname) + filetransfer._packAttributes(attrs)
+            for (name, longname, attrs) in listing])
+
+
+
+def _legacyParseAttributes(data):
+    """
+    The attribute parser L{filetransfer.FileTransferBase} used before
+    L{filetransfer.SFTPAttrs}, kept for comparison.
+    """
+    flags ,= struct.unpack('!L', data[:4])
+    attrs = {}
+    data = data[4:]
+    if flags & filetransfer.FILEXFER_ATTR_SIZE:
+        size ,= struct.unpack('!Q', data[:8])
+        attrs['size'] = size
+        data = data[8:]
+    if flags & filetransfer.FILEXFER_ATTR_OWNERGROUP:
+        uid, gid = struct.unpack('!2L', data[:8])
+        attrs['uid'] = uid
+        attrs['gid'] = gid
+        data = data[8:]
+    if flags & filetransfer.FILEXFER_ATTR_PERMISSIONS:
+        perms ,= struct.unpack('!L', data[:4])
+        attrs['permissions'] = perms
+        data = data[4:]
+    if flags & filetransfer.FILEXFER_ATTR_ACMODTIME:
+        atime, mtime = struct.unpack('!2L', data[:8])
+        attrs['atime'] = atime
+        attrs['mtime'] = mtime
+        data = data[8:]
+    if flags & filetransfer.FILEXFER_ATTR_EXTENDED:
+        extended_count ,= struct.unpack('!L', data[:4])
+        data = data[4:]
+        for i in xrange(extended_count):
+            extended_type, data = getNS(data)
+            extended_data, data = getNS(data)
+            attrs['ext_%s' % extended_type] = extended_data
+    return attrs, data
+
+
+
+def _legacyPacketNAME(data):
+    """
+    The FXP_NAME decoder L{filetransfer.FileTransferClient} used before
+    L{filetransfer.SFTPAttrs}, kept for comparison.
+    """
+    data = data[4:]
+    count, = struct.unpack('!L', data[:4])
+    data = data[4:]
+    files = []
+    for i in range(count):
+        filename, data = getNS(data)
+        longname, data = getNS(data)
+        attrs, data = _legacyParseAttributes(data)
+        files.append((filename, longname, attrs))
+    return files
+
+
+
+def _decode(packet):
+    """
+    Decode C{packet} with L{filetransfer.FileTransferClient.packet_NAME}.
+    """
+    client = filetransfer.FileTransferClient()
+    d = client.openRequests[1] = Deferred()
+    result = []
+    d.addCallback(result.append)
+    client.packet_NAME(packet)
+    return result[0]
+
+
+
+def _time(repeat, function, *args):
+    best = None
+    for i in range(repeat):
+        start = time()
+        function(*args)
+        duration = time() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+
+def benchmark(entries=100000, repeat=3, legacy=False):
+    """
+    Time decoding an FXP_NAME packet of C{entries} entries and encoding the
+    attributes of its entries.
+
+    @param legacy: whether to also time the legacy decoder.
+
+    @return: a dictionary mapping the unicode strings C{u'decode'},
+        C{u'encode'} and, if requested, C{u'legacyDecode'} to the fastest
+        time, in seconds, each took, C{u'entries'} to C{entries} and
+        C{u'packetBytes'} to the size of the packet.
+    """
+    listing = _listing(entries)
+    packet = _namePacket(listing)
+    decoded = _decode(packet)
+    assert decoded == listing
+    attributes = [attrs for (name, longname, attrs) in decoded]
+    def encode():
+        for attrs in attributes:
+            filetransfer._packAttributes(attrs)
+    result = {
+        u'entries': entries,
+        u'packetBytes': len(packet),
+        u'decode': _time(repeat, _decode, packet),
+        u'encode': _time(repeat, encode)}
+    if legacy:
+        assert _legacyPacketNAME(packet) == listing
+        result[u'legacyDecode'] = _time(repeat, _legacyPacketNAME, packet)
+    return result
+
+
+
+def main(args=None):
+    """
+    Perform a single benchmark run and print the results.
+    """
+    options = AttributesBenchmark()
+    options.parseOptions(args)
+    pprint(benchmark(options['entries'], options['repeat'],
+                     options['legacy']), stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+# -*- test-case-name: twisted.conch.test.test_compat -*-
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+Compatibility with Python 2.6, which conch still supports.
+"""
+
+_missing = object()
+
+
+
+class _OrderedDict(dict):
+    """
+    A dictionary which remembers the order its keys were first inserted in,
+    for Python 2.6, which lacks C{collections.OrderedDict}.
+
+    Setting, deleting, C{setdefault}, C{update}, C{pop}, C{popitem},
+    C{clear} and iteration keep the order; C{copy} returns a plain,
+    unordered dictionary.  The order is kept in a circular
+    doubly linked list of C{[previous, next, key]} links, so each of them
+    takes constant time.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self._root = root = []
+        root[:] = [root, root, None]
+        self._links = {}
+
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            root = self._root
+            last = root[0]
+            last[1] = root[0] = self._links[key] = [last, root, key]
+        dict.__setitem__(self, key, value)
+
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        previous, next, key = self._links.pop(key)
+        previous[1] = next
+        next[0] = previous
+
+
+    def __iter__(self):
+        root = self._root
+        link = root[1]
+        while link is not root:
+            yield link[2]
+            link = link[1]
+
+    iterkeys = __iter__
+
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+
+    def iteritems(self):
+        for key in self:
+            yield (key, self[key])
+
+
+    def keys(self):
+        return list(self)
+
+
+    def values(self):
+        return list(self.itervalues())
+
+
+    def items(self):
+        return list(self.iteritems())
+
+
+    def pop(self, key, default=_missing):
+        if key in self:
+            value = dict.__getitem__(self, key)
+            del self[key]
+            return value
+        if default is _missing:
+            raise KeyError(key)
+        return default
+
+
+    def popitem(self, last=True):
+        """
+        Remove and return the C{(key, value)} pair inserted last, or first
+        if C{last} is false.
+        """
+        if not self:
+            raise KeyError('dictionary is empty')
+        if last:
+            key = self._root[0][2]
+        else:
+            key = self._root[1][2]
+        return key, self.pop(key)
+
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+
+    def update(self, other):
+        if hasattr(other, 'keys'):
+            other = [(key, other[key]) for key in other.keys()]
+        for key, value in other:
+            self[key] = value
+
+
+    def clear(self):
+        dict.clear(self)
+        self._links.clear()
+        self._root[:] = [self._root, self._root, None]
+
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.items())
+
+
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = _OrderedDict
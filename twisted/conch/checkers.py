@@ -6,7 +6,7 @@
 Provide L{ICredentialsChecker} implementations to be used in Conch protocols.
 """
 
-import os, base64, binascii, errno
+import base64, binascii, errno
 try:
     import pwd
 except ImportError:
@@ -34,11 +34,12 @@ except ImportError:
 from zope.interface import implements, providedBy
 
 from twisted.conch import error
-from twisted.conch.ssh import keys
+from twisted.conch._compat import OrderedDict
+from twisted.conch.ssh import common, keys
 from twisted.cred.checkers import ICredentialsChecker
 from twisted.cred.credentials import IUsernamePassword, ISSHPrivateKey
 from twisted.cred.error import UnauthorizedLogin, UnhandledCredentials
-from twisted.internet import defer
+from twisted.internet import defer, threads
 from twisted.python import failure, reflect, log
 from twisted.python.util import runAsEffectiveUser
 from twisted.python.filepath import FilePath
@@ -87,21 +88,53 @@ class UNIXPasswordDatabase:
     A checker which validates users out of the UNIX password databases, or
     databases of a compatible format.
 
+    By default passwords are checked on the calling thread.  Given
+    C{maxThreads}, the checker instead hashes passwords, and runs the lookups
+    listed in C{threadedLookups}, in the reactor's thread pool, with at most
+    C{maxThreads} checks running at once.  Logins beyond that wait their
+    turn; once C{maxQueued} are waiting, or C{maxPerSource} are running or
+    waiting for the same client host, further logins are refused outright.
+    The client host is read from the C{peerHost} attribute of the
+    credentials, which L{twisted.conch.ssh.userauth.SSHUserAuthServer} sets.
+
     @ivar _getByNameFunctions: a C{list} of functions which are called in order
         to valid a user.  The default value is such that the /etc/passwd
         database will be tried first, followed by the /etc/shadow database.
+    @ivar threadedLookups: the lookup functions which may be run in a thread.
+        L{_shadowGetByName} is not one of them, as it changes the effective
+        user of the whole process.
+    @ivar active: the number of checks currently running in threads.
+    @ivar queued: the number of checks waiting for a thread.
+    @ivar verified: the number of checks completed in threads.
+    @ivar refused: the number of logins refused because of the limits.
     """
     credentialInterfaces = IUsernamePassword,
     implements(ICredentialsChecker)
 
+    threadedLookups = (_pwdGetByName,)
+
+    _deferToThread = staticmethod(threads.deferToThread)
+
 
-    def __init__(self, getByNameFunctions=None):
+    def __init__(self, getByNameFunctions=None, maxThreads=0, maxQueued=64,
+                 maxPerSource=4):
         if getByNameFunctions is None:
             getByNameFunctions = [_pwdGetByName, _shadowGetByName]
         self._getByNameFunctions = getByNameFunctions
+        self.maxThreads = maxThreads
+        self.maxQueued = maxQueued
+        self.maxPerSource = maxPerSource
+        if maxThreads:
+            self._semaphore = defer.DeferredSemaphore(maxThreads)
+        else:
+            self._semaphore = None
+        self._sources = {}
+        self.active = self.queued = self.verified = self.refused = 0
 
 
     def requestAvatarId(self, credentials):
+        if self._semaphore is not None:
+            return self._requestAvatarIdInThread(credentials)
         for func in self._getByNameFunctions:
             try:
                 pwnam = func(credentials.username)
@@ -118,6 +151,194 @@ class UNIXPasswordDatabase:
         return defer.fail(UnauthorizedLogin("unable to verify password"))
 
 
+    def _requestAvatarIdInThread(self, credentials):
+        """
+        Admit a check within the configured limits and run it in the thread
+        pool once one of the C{maxThreads} slots is free.
+        """
+        source = getattr(credentials, 'peerHost', None)
+        if self.queued >= self.maxQueued:
+            self.refused += 1
+            return defer.fail(UnauthorizedLogin("too many logins pending"))
+        if source is not None:
+            if self._sources.get(source, 0) >= self.maxPerSource:
+                self.refused += 1
+                return defer.fail(UnauthorizedLogin(
+                    "too many logins pending from %s" % (source,)))
+            self._sources[source] = self._sources.get(source, 0) + 1
+        self.queued += 1
+        d = self._semaphore.acquire()
+        d.addCallback(self._cbAcquired, credentials)
+        d.addBoth(self._checked, source)
+        return d
+
+
+    def _cbAcquired(self, semaphore, credentials):
+        self.queued -= 1
+        self.active += 1
+        d = self._verifyInThread(credentials)
+        d.addBoth(self._released)
+        return d
+
+
+    def _released(self, result):
+        self.active -= 1
+        self.verified += 1
+        self._semaphore.release()
+        return result
+
+
+    def _checked(self, result, source):
+        if source is not None:
+            count = self._sources[source] - 1
+            if count:
+                self._sources[source] = count
+            else:
+                del self._sources[source]
+        return result
+
+
+    @defer.inlineCallbacks
+    def _verifyInThread(self, credentials):
+        """
+        Check C{credentials} as L{requestAvatarId} does, hashing the password
+        and running the C{threadedLookups} in threads.
+        """
+        for func in self._getByNameFunctions:
+            try:
+                if func in self.threadedLookups:
+                    pwnam = yield self._deferToThread(
+                        func, credentials.username)
+                else:
+                    pwnam = func(credentials.username)
+            except KeyError:
+                raise UnauthorizedLogin("invalid username")
+            if pwnam is not None:
+                crypted = pwnam[1]
+                if crypted == '':
+                    continue
+                matched = yield self._deferToThread(
+                    verifyCryptedPassword, crypted, credentials.password)
+                if matched:
+                    defer.returnValue(credentials.username)
+        raise UnauthorizedLogin("unable to verify password")
+
+
+
+class AuthorizedKeysCache:
+    """
+    A bounded cache of parsed I{authorized_keys} files.
+
+    Each file is indexed by the decoded key blobs it lists, so checking a key
+    is a single dictionary lookup.  An entry is tagged with the device, inode,
+    modification time and size of the file it was built from and is rebuilt
+    as soon as any of those change; the least recently used files are
+    forgotten once more than C{maxFiles} are cached.
+
+    @ivar maxFiles: the maximum number of files to keep parsed.
+    @ivar hits: the number of lookups answered from an up to date entry.
+    @ivar misses: the number of lookups of files which were not cached.
+    @ivar reloads: the number of entries rebuilt because their file changed.
+    @ivar evictions: the number of entries dropped to stay within
+        C{maxFiles}.
+    """
+
+    def __init__(self, maxFiles=1024):
+        self.maxFiles = maxFiles
+        self.hits = self.misses = self.reloads = self.evictions = 0
+        self._entries = OrderedDict()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def getKeys(self, filepath, uid, gid):
+        """
+        Return the keys listed in an I{authorized_keys} file.
+
+        Files which cannot be read by the current effective user are read
+        again as the user with C{uid} and C{gid}.
+
+        @param filepath: the file to read.
+        @type filepath: L{FilePath}
+
+        @return: a C{dict} mapping each decoded key blob in the file to the
+            line which lists it; empty if the file does not exist.
+        """
+        path = filepath.path
+        signature = self._stat(filepath, uid, gid)
+        if signature is None:
+            self._entries.pop(path, None)
+            return {}
+        entry = self._entries.pop(path, None)
+        if entry is not None and entry[0] == signature:
+            self.hits += 1
+        else:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.reloads += 1
+            entry = (signature, self._parse(filepath, uid, gid))
+        self._entries[path] = entry
+        while len(self._entries) > self.maxFiles:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry[1]
+
+
+    def clear(self):
+        """
+        Forget every parsed file.
+        """
+        self._entries.clear()
+
+
+    def _stat(self, filepath, uid, gid):
+        """
+        Return the identity of the current contents of C{filepath}, or
+        C{None} if it does not exist.
+        """
+        try:
+            try:
+                filepath.restat()
+            except OSError, e:
+                if e.errno != errno.EACCES:
+                    raise
+                runAsEffectiveUser(uid, gid, filepath.restat)
+        except OSError:
+            return None
+        st = filepath.statinfo
+        return (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+
+
+    def _parse(self, filepath, uid, gid):
+        """
+        Read C{filepath} and index the keys it lists by their decoded blob.
+        """
+        try:
+            f = filepath.open()
+        except IOError, e:
+            if e.errno == errno.EACCES:
+                f = runAsEffectiveUser(uid, gid, filepath.open)
+            else:
+                raise
+        authorized = {}
+        try:
+            for l in f:
+                l2 = l.split()
+                if len(l2) < 2:
+                    continue
+                try:
+                    blob = base64.decodestring(l2[1])
+                except binascii.Error:
+                    continue
+                authorized.setdefault(blob, l)
+        finally:
+            f.close()
+        return authorized
+
+
 
 class SSHPublicKeyDatabase:
     """
@@ -130,6 +351,11 @@ class SSHPublicKeyDatabase:
 
     _userdb = pwd
 
+    # Parsed authorized_keys files, shared by every checker in the process so
+    # that the probe and the signed request of a login, and the logins of
+    # other users, do not each read and decode the files again.
+    authorizedKeysCache = AuthorizedKeysCache()
+
     def requestAvatarId(self, credentials):
         d = defer.maybeDeferred(self.checkKey, credentials)
         d.addCallback(self._cbRequestAvatarId, credentials)
@@ -163,8 +389,15 @@ class SSHPublicKeyDatabase:
             return failure.Failure(error.ValidPublicKey())
         else:
             try:
-                pubKey = keys.Key.fromString(credentials.blob)
-                if pubKey.verify(credentials.signature, credentials.sigData):
+                # userauth hands over the key it already parsed.
+                pubKey = getattr(credentials, 'publicKey', None)
+                if pubKey is None:
+                    pubKey = keys.Key.fromString(credentials.blob)
+                # The signature must also be made with the algorithm the
+                # request names (RFC 8332 section 3.2).
+                if (pubKey.verify(credentials.signature, credentials.sigData)
+                    and credentials.signature.startswith(
+                        common.NS(credentials.algName))):
                     return credentials.username
             except: # any error should be treated as a failed login
                 log.err()
@@ -198,30 +431,18 @@ class SSHPublicKeyDatabase:
         """
         Retrieve files containing authorized keys and check against user
         credentials.
+
+        The parsed contents of each file are kept in L{authorizedKeysCache},
+        so a file is only read again once it has changed on disk.
         """
-        uid, gid = os.geteuid(), os.getegid()
         ouid, ogid = self._userdb.getpwnam(credentials.username)[2:4]
         for filepath in self.getAuthorizedKeysFiles(credentials):
-            if not filepath.exists():
-                continue
-            try:
-                lines = filepath.open()
-            except IOError, e:
-                if e.errno == errno.EACCES:
-                    lines = runAsEffectiveUser(ouid, ogid, filepath.open)
-                else:
-                    raise
-            for l in lines:
-                l2 = l.split()
-                if len(l2) < 2:
-                    continue
-                try:
-                    if base64.decodestring(l2[1]) == credentials.blob:
-                        return True
-                except binascii.Error:
-                    continue
+            authorized = self.authorizedKeysCache.getKeys(filepath, ouid, ogid)
+            if credentials.blob in authorized:
+                return True
         return False
 
+
     def _ebRequestAvatarId(self, f):
         if not f.check(UnauthorizedLogin):
             log.msg(f)
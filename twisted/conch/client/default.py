@@ -15,18 +15,29 @@ from twisted.python import log
 from twisted.python.filepath import FilePath
 
 from twisted.conch.error import ConchError
-from twisted.conch.ssh import common, keys, userauth
+from twisted.conch.ssh import keys, userauth
 from twisted.internet import defer, protocol, reactor
 
-from twisted.conch.client.knownhosts import KnownHostsFile, ConsoleUI
+from twisted.conch.client.knownhosts import ConsoleUI, getSharedKnownHostsFile
 
 from twisted.conch.client import agent
 
-import os, sys, base64, getpass
+import os, sys, getpass
 
 # This name is bound so that the unit tests can use 'patch' to override it.
 _open = open
 
+
+def _getKnownHostsFile(path):
+    """
+    Return the shared L{KnownHostsFile} for the known hosts file C{path},
+    indexed in a file next to it so that later runs need not parse it.
+
+    @type path: L{FilePath}
+    """
+    return getSharedKnownHostsFile(path, path.siblingExtension('.index'))
+
+
 def verifyHostKey(transport, host, pubKey, fingerprint):
     """
     Verify a host's key.
@@ -69,7 +80,7 @@ def verifyHostKey(transport, host, pubKey, fingerprint):
     """
     actualHost = transport.factory.options['host']
     actualKey = keys.Key.fromString(pubKey)
-    kh = KnownHostsFile.fromPath(FilePath(
+    kh = _getKnownHostsFile(FilePath(
             transport.factory.options['known-hosts']
             or os.path.expanduser("~/.ssh/known_hosts")
             ))
@@ -81,36 +92,21 @@ def verifyHostKey(transport, host, pubKey, fingerprint):
 def isInKnownHosts(host, pubKey, options):
     """checks to see if host is in the known_hosts file for the user.
     returns 0 if it isn't, 1 if it is and is the same, 2 if it's changed.
-    """
-    keyType = common.getNS(pubKey)[0]
-    retVal = 0
 
+    Only the keys of the same type as C{pubKey} listed for C{host} are
+    compared with it.  The file is looked up through
+    L{getSharedKnownHostsFile}, like L{verifyHostKey} does.
+    """
     if not options['known-hosts'] and not os.path.exists(os.path.expanduser('~/.ssh/')):
         print 'Creating ~/.ssh directory...'
         os.mkdir(os.path.expanduser('~/.ssh'))
     kh_file = options['known-hosts'] or '~/.ssh/known_hosts'
     try:
-        known_hosts = open(os.path.expanduser(kh_file))
-    except IOError:
+        key = keys.Key.fromString(pubKey)
+    except keys.BadKeyError:
         return 0
-    for line in known_hosts.xreadlines():
-        split = line.split()
-        if len(split) < 3:
-            continue
-        hosts, hostKeyType, encodedKey = split[:3]
-        if host not in hosts.split(','): # incorrect host
-            continue
-        if hostKeyType != keyType: # incorrect type of key
-            continue
-        try:
-            decodedKey = base64.decodestring(encodedKey)
-        except:
-            continue
-        if decodedKey == pubKey:
-            return 1
-        else:
-            retVal = 2
-    return retVal
+    kh = _getKnownHostsFile(FilePath(os.path.expanduser(kh_file)))
+    return kh._hostKeyStatus(host, key)
 
 
 
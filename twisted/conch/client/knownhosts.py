@@ -10,6 +10,8 @@ An implementation of the OpenSSH known_hosts database.
 
 from binascii import Error as DecodeError, b2a_base64
 import hmac
+import marshal
+import os
 import sys
 
 from zope.interface import implements
@@ -24,9 +26,11 @@ else:
 from twisted.internet import defer
 
 from twisted.python import log
+from twisted.python.runtime import platform
 from twisted.conch.interfaces import IKnownHostEntry
 from twisted.conch.error import HostKeyChanged, UserRejectedKey, InvalidEntry
 from twisted.conch.ssh.keys import Key, BadKeyError
+from twisted.conch._compat import OrderedDict
 
 
 def _b64encode(s):
@@ -37,13 +41,13 @@ def _b64encode(s):
 
 
 
-def _extractCommon(string):
+def _splitCommon(string):
     """
-    Extract common elements of base64 keys from an entry in a hosts file.
+    Split an entry in a hosts file into its common elements, without decoding
+    its key.
 
-    @return: a 4-tuple of hostname data (L{str}), ssh key type (L{str}), key
-    (L{Key}), and comment (L{str} or L{None}).  The hostname data is simply the
-    beginning of the line up to the first occurrence of whitespace.
+    @return: a 4-tuple of hostname data (L{str}), ssh key type (L{str}),
+    base64-encoded key (L{str}), and comment (L{str} or L{None}).
     """
     elements = string.split(None, 2)
     if len(elements) != 3:
@@ -56,6 +60,19 @@ def _extractCommon(string):
     else:
         keyString = splitkey[0]
         comment = None
+    return hostnames, keyType, keyString, comment
+
+
+
+def _extractCommon(string):
+    """
+    Extract common elements of base64 keys from an entry in a hosts file.
+
+    @return: a 4-tuple of hostname data (L{str}), ssh key type (L{str}), key
+    (L{Key}), and comment (L{str} or L{None}).  The hostname data is simply the
+    beginning of the line up to the first occurrence of whitespace.
+    """
+    hostnames, keyType, keyString, comment = _splitCommon(string)
     key = Key.fromString(keyString.decode('base64'))
     return hostnames, keyType, key, comment
 
@@ -66,22 +83,56 @@ class _BaseEntry(object):
     Abstract base of both hashed and non-hashed entry objects, since they
     represent keys and key types the same way.
 
-    @ivar keyType: The type of the key; either ssh-dss or ssh-rsa.
+    @ivar keyType: The type of the key; ssh-dss, ssh-rsa, ssh-ed25519 or
+        ecdsa-sha2-nistp256, -nistp384 or -nistp521.
     @type keyType: L{str}
 
-    @ivar publicKey: The server public key indicated by this line.
+    @ivar publicKey: The server public key indicated by this line.  Entries
+        loaded by L{KnownHostsFile.fromPath} only parse it when it is first
+        used, which raises L{DecodeError} or L{BadKeyError} if the line holds
+        no valid key; L{KnownHostsFile} replaces such entries with
+        L{UnparsedEntry}s when a lookup finds them.
     @type publicKey: L{twisted.conch.ssh.keys.Key}
 
     @ivar comment: Trailing garbage after the key line.
     @type comment: L{str}
+
+    @ivar _encodedKey: the base64-encoded key this entry was loaded with, if
+        it has not been parsed into C{publicKey} yet.
     """
 
+    _encodedKey = None
+
     def __init__(self, keyType, publicKey, comment):
         self.keyType = keyType
         self.publicKey = publicKey
         self.comment = comment
 
 
+    def _getPublicKey(self):
+        if self._encodedKey is not None:
+            self._publicKey = Key.fromString(self._encodedKey.decode('base64'))
+            self._encodedKey = None
+        return self._publicKey
+
+
+    def _setPublicKey(self, publicKey):
+        self._publicKey = publicKey
+        self._encodedKey = None
+
+    publicKey = property(_getPublicKey, _setPublicKey)
+
+
+    def _getEncodedKey(self):
+        """
+        Return the base64 encoding of this entry's key, without parsing it if
+        it has not been parsed yet.
+        """
+        if self._encodedKey is not None:
+            return self._encodedKey
+        return _b64encode(self.publicKey.blob())
+
+
     def matchesKey(self, keyObject):
         """
         Check to see if this entry matches a given key object.
@@ -158,7 +209,7 @@ class PlainEntry(_BaseEntry):
         """
         fields = [','.join(self._hostnames),
                   self.keyType,
-                  _b64encode(self.publicKey.blob())]
+                  self._getEncodedKey()]
         if self.comment is not None:
             fields.append(self.comment)
         return ' '.join(fields)
@@ -278,22 +329,149 @@ class HashedEntry(_BaseEntry):
         fields = [self.MAGIC + '|'.join([_b64encode(self._hostSalt),
                                          _b64encode(self._hostHash)]),
                   self.keyType,
-                  _b64encode(self.publicKey.blob())]
+                  self._getEncodedKey()]
         if self.comment is not None:
             fields.append(self.comment)
         return ' '.join(fields)
 
 
 
+# The starts of the SSH-encoded blobs of the key types keys.Key supports.
+_blobPrefixes = ('\x00\x00\x00\x07ssh-', '\x00\x00\x00\x0bssh-ed25519',
+                 '\x00\x00\x00\x13ecdsa-sha2-nistp')
+
+
+
+def _fileSignature(f):
+    """
+    Return the identity of the contents of the open file C{f}: its inode,
+    modification time and size.
+    """
+    st = os.fstat(f.fileno())
+    return (st.st_ino, st.st_mtime, st.st_size)
+
+
+
+def _recordFromLine(line):
+    """
+    Split a line of a known_hosts file into a record from which
+    L{_entryFromRecord} can create its entry, without parsing its key.
+
+    Records are tuples of strings, so that L{KnownHostsFile} can store them
+    in its index file.
+    """
+    try:
+        hostnames, keyType, keyString, comment = _splitCommon(line)
+        # Decoding the key is cheap, unlike parsing it; Key.fromString
+        # rejects anything not starting like a key blob.
+        blob = keyString.decode('base64')
+        if not [prefix for prefix in _blobPrefixes
+                if blob.startswith(prefix)]:
+            return ('unparsed', line)
+        if line.startswith(HashedEntry.MAGIC):
+            saltAndHash = hostnames[len(HashedEntry.MAGIC):].split("|")
+            if len(saltAndHash) != 2:
+                raise InvalidEntry()
+            hostSalt, hostHash = saltAndHash
+            return ('hashed', hostSalt.decode("base64"),
+                    hostHash.decode("base64"), keyType, keyString, comment)
+        return ('plain', hostnames, keyType, keyString, comment)
+    except (DecodeError, InvalidEntry):
+        return ('unparsed', line)
+
+
+
+def _recordFromEntry(entry):
+    """
+    Return the record of an L{IKnownHostEntry} provider, as
+    L{_recordFromLine} would for the line it saves as.
+    """
+    if isinstance(entry, HashedEntry):
+        return ('hashed', entry._hostSalt, entry._hostHash, entry.keyType,
+                entry._getEncodedKey(), entry.comment)
+    elif isinstance(entry, PlainEntry):
+        return ('plain', ','.join(entry._hostnames), entry.keyType,
+                entry._getEncodedKey(), entry.comment)
+    return _recordFromLine(entry.toString())
+
+
+
+def _entryFromRecord(record):
+    """
+    Create the entry described by a record from L{_recordFromLine}, leaving
+    its key to be parsed when it is first used.
+    """
+    kind = record[0]
+    if kind == 'hashed':
+        hostSalt, hostHash, keyType, keyString, comment = record[1:]
+        entry = HashedEntry(hostSalt, hostHash, keyType, None, comment)
+    elif kind == 'plain':
+        hostnames, keyType, keyString, comment = record[1:]
+        entry = PlainEntry(hostnames.split(","), keyType, None, comment)
+    else:
+        return UnparsedEntry(record[1])
+    entry._encodedKey = keyString
+    return entry
+
+
+
 class KnownHostsFile(object):
     """
     A structured representation of an OpenSSH-format ~/.ssh/known_hosts file.
 
+    Entries are indexed so that looking a host up does not scan the file:
+    plain entries by each of their hostnames, and hashed entries by their
+    salt and then their hash, so a lookup computes one HMAC for each distinct
+    salt rather than one for each entry.  Keys are only parsed for the
+    entries a lookup finds.
+
     @ivar _entries: a list of L{IKnownHostEntry} providers.
 
     @ivar _savePath: the L{FilePath} to save new entries to.
+
+    @ivar _indexPath: the L{FilePath} of the index file kept alongside
+        C{_savePath}, or C{None}.
+
+    @ivar _hostIndex: a C{dict} mapping hostnames to the positions in
+        C{_entries} of the plain entries listing them.
+
+    @ivar _saltIndex: a C{dict} mapping salts to C{dict}s mapping host hashes
+        to the positions in C{_entries} of the hashed entries using them.
+
+    @ivar _unindexed: the positions in C{_entries} of entries of other types,
+        which are asked whether they match each host looked up.
+
+    @ivar _matches: an C{OrderedDict} mapping the hostnames looked up to the
+        positions in C{_entries} of the entries matching them.  It is cleared
+        whenever an entry is added, and holds at most C{maxMatches} hosts,
+        forgetting the ones looked up first.
+
+    @ivar _unsaved: whether entries have been added since the file was
+        loaded or saved.
+
+    @ivar _loadedSignature: the identity of the contents of C{_savePath} when
+        they were last read or written, or C{None} if it did not exist.  The
+        index file is only used, and written, for these contents.
+
+    @ivar _savedMatches: like C{_matches}, but loaded from the match file
+        kept alongside the index file, and keyed by the HMAC of the hostname
+        with C{_matchSalt} rather than by the hostname itself, so that the
+        match file does not give away hashed hostnames any more than a
+        known_hosts file whose entries share one salt does.  It is bounded
+        like C{_matches}, and written to the match file by L{save}.
+
+    @ivar _matchesChanged: whether C{_savedMatches} has changed since it was
+        loaded or written.
     """
 
+    # The format of the index files written by save and fromPath; index
+    # files of other versions are ignored.
+    _indexVersion = 3
+
+    # The most hosts whose matches are remembered, in memory and in the
+    # match file.
+    maxMatches = 1024
+
     def __init__(self, savePath):
         """
         Create a new, empty KnownHostsFile.
@@ -302,6 +480,116 @@ class KnownHostsFile(object):
         """
         self._entries = []
         self._savePath = savePath
+        self._indexPath = None
+        self._hostIndex = {}
+        self._saltIndex = {}
+        self._unindexed = []
+        self._matches = OrderedDict()
+        self._matchSalt = None
+        self._savedMatches = OrderedDict()
+        self._matchesChanged = False
+        self._unsaved = False
+        self._loadedSignature = None
+
+
+    def _addEntry(self, entry):
+        """
+        Append C{entry} to C{_entries} and index it.
+        """
+        if self._matches or self._savedMatches:
+            self._matches.clear()
+            self._savedMatches.clear()
+        self._unsaved = True
+        position = len(self._entries)
+        self._entries.append(entry)
+        if isinstance(entry, HashedEntry):
+            hashes = self._saltIndex.setdefault(entry._hostSalt, {})
+            hashes.setdefault(entry._hostHash, []).append(position)
+        elif isinstance(entry, PlainEntry):
+            for hostname in entry._hostnames:
+                self._hostIndex.setdefault(hostname, []).append(position)
+        elif not isinstance(entry, UnparsedEntry):
+            self._unindexed.append(position)
+
+
+    def _matchingPositions(self, hostname):
+        """
+        Return the positions in C{_entries} of the entries matching
+        C{hostname}, in order, remembering them for later lookups.
+        """
+        positions = self._matches.get(hostname)
+        if positions is not None:
+            return positions
+        if self._matchSalt is not None:
+            positions = self._savedMatches.get(
+                _hmacedString(self._matchSalt, hostname))
+            if positions is not None:
+                self._remember(self._matches, hostname, positions)
+                return positions
+        positions = self._findPositions(hostname)
+        self._remember(self._matches, hostname, positions)
+        # Positions of entries which have not been saved yet must not be
+        # saved either: they do not exist in the file the matches are for.
+        if self._matchSalt is not None and not self._unsaved:
+            self._remember(self._savedMatches,
+                           _hmacedString(self._matchSalt, hostname), positions)
+            self._matchesChanged = True
+            self._newMatches()
+        return positions
+
+
+    def _remember(self, matches, key, positions):
+        """
+        Add C{positions} to C{matches} under C{key}, forgetting the oldest
+        matches if there are more than C{maxMatches}.
+        """
+        matches[key] = positions
+        while len(matches) > self.maxMatches:
+            matches.popitem(last=False)
+
+
+    def _newMatches(self):
+        """
+        Called when matches which are not in the match file have been added
+        to C{_savedMatches}.  They are written by the next L{save}.
+        """
+
+
+    def _findPositions(self, hostname):
+        """
+        Search the indexes for the entries matching C{hostname}.
+        """
+        positions = list(self._hostIndex.get(hostname, ()))
+        for salt, hashes in self._saltIndex.iteritems():
+            found = hashes.get(_hmacedString(salt, hostname))
+            if found is not None:
+                positions.extend(found)
+        for position in self._unindexed:
+            if self._entries[position].matchesHost(hostname):
+                positions.append(position)
+        positions.sort()
+        return [position for position in positions
+                if self._hasValidKey(position)]
+
+
+    def _hasValidKey(self, position):
+        """
+        Parse the key of the entry at C{position} in C{_entries}, replacing
+        the entry with an L{UnparsedEntry} if it holds no valid key, as such
+        lines were when keys were parsed up front.
+
+        @return: whether the entry can be matched against keys.
+        """
+        entry = self._entries[position]
+        if isinstance(entry, UnparsedEntry):
+            return False
+        if isinstance(entry, _BaseEntry):
+            try:
+                entry.publicKey
+            except (DecodeError, BadKeyError):
+                self._entries[position] = UnparsedEntry(entry.toString())
+                return False
+        return True
 
 
     def hasHostKey(self, hostname, key):
@@ -311,18 +599,46 @@ class KnownHostsFile(object):
 
         @rtype: L{bool}
 
+        Entries for keys of other types than C{key} are ignored, as OpenSSH
+        does, so that a host listed only with, say, its Ed25519 key is not
+        taken to have changed when it offers its RSA key.
+
         @raise HostKeyChanged: if the host key found for the given hostname
         does not match the given key.
         """
-        for lineidx, entry in enumerate(self._entries):
-            if entry.matchesHost(hostname):
-                if entry.matchesKey(key):
-                    return True
-                else:
-                    raise HostKeyChanged(entry, self._savePath, lineidx + 1)
+        keyType = key.sshType()
+        for lineidx in self._matchingPositions(hostname):
+            entry = self._entries[lineidx]
+            if getattr(entry, 'keyType', None) != keyType:
+                continue
+            if entry.matchesKey(key):
+                return True
+            else:
+                raise HostKeyChanged(entry, self._savePath, lineidx + 1)
         return False
 
 
+    def _hostKeyStatus(self, hostname, key):
+        """
+        Look C{key} up among the keys of its type listed for C{hostname},
+        ignoring the keys of other types, for
+        L{twisted.conch.client.default.isInKnownHosts}.
+
+        @return: C{1} if one of them is C{key}, C{2} if there are some but
+            none of them is C{key}, or C{0} if there are none.
+        """
+        keyType = key.sshType()
+        status = 0
+        for lineidx in self._matchingPositions(hostname):
+            entry = self._entries[lineidx]
+            if getattr(entry, 'keyType', None) != keyType:
+                continue
+            if entry.matchesKey(key):
+                return 1
+            status = 2
+        return status
+
+
     def verifyHostKey(self, ui, hostname, ip, key):
         """
         Verify the given host key for the given IP and host, asking for
@@ -382,50 +698,392 @@ class KnownHostsFile(object):
         @return: the L{HashedEntry} that was added.
         """
         salt = secureRandom(20)
-        keyType = "ssh-" + key.type().lower()
+        keyType = key.sshType()
         entry = HashedEntry(salt, _hmacedString(salt, hostname),
                             keyType, key, None)
-        self._entries.append(entry)
+        self._addEntry(entry)
         return entry
 
 
     def save(self):
         """
-        Save this L{KnownHostsFile} to the path it was loaded from.
+        Save this L{KnownHostsFile} to the path it was loaded from, and
+        update its index file if it has one.
         """
         p = self._savePath.parent()
         if not p.isdir():
             p.makedirs()
-        self._savePath.setContent('\n'.join(
+        self._loadedSignature = self._writeContent('\n'.join(
                 [entry.toString() for entry in self._entries]) + "\n")
+        self._unsaved = False
+        if self._indexPath is not None:
+            if self._matchSalt is None:
+                self._matchSalt = secureRandom(20)
+            self._saveIndex(
+                [_recordFromEntry(entry) for entry in self._entries])
+            for hostname, positions in self._matches.iteritems():
+                self._remember(self._savedMatches,
+                               _hmacedString(self._matchSalt, hostname),
+                               positions)
+            self._saveMatches()
+
+
+    def _writeContent(self, content):
+        """
+        Replace the contents of C{_savePath} with C{content} as
+        L{FilePath.setContent} does.
 
+        @return: the identity of the contents written, taken from the new
+            file before it replaces the old one, so that it cannot describe
+            a file written by someone else in the meantime.
+        """
+        temporary = self._savePath.temporarySibling('.new')
+        f = temporary.open('w')
+        try:
+            f.write(content)
+            f.flush()
+            signature = _fileSignature(f)
+        finally:
+            f.close()
+        if platform.isWindows() and self._savePath.exists():
+            os.unlink(self._savePath.path)
+        os.rename(temporary.path, self._savePath.path)
+        return signature
+
+
+    def _signature(self):
+        """
+        Return the identity of the current contents of C{_savePath}.
+        """
+        self._savePath.restat()
+        st = self._savePath.statinfo
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+
+    def _loadIndex(self):
+        """
+        Return the records stored in our index file, or C{None} if it is
+        missing, unreadable, or does not match C{_loadedSignature}.
+        """
+        try:
+            version, signature, records = marshal.loads(
+                self._indexPath.getContent())
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if (version != self._indexVersion or
+            signature != self._loadedSignature):
+            return None
+        return records
 
-    def fromPath(cls, path):
+
+    def _saveIndex(self, records):
+        """
+        Store C{records}, from the contents of C{_savePath} identified by
+        C{_loadedSignature}, in our index file.  Failing to write it is
+        logged and otherwise ignored.
+        """
+        try:
+            self._indexPath.setContent(marshal.dumps(
+                (self._indexVersion, self._loadedSignature, records)))
+        except (IOError, OSError):
+            log.err(None, "Could not save known hosts index %s"
+                    % (self._indexPath.path,))
+
+
+    def _matchesPath(self):
+        """
+        Return the L{FilePath} of the file remembering the matches of hosts
+        looked up, next to our index file.
+        """
+        return self._indexPath.siblingExtension('.matches')
+
+
+    def _loadMatches(self):
+        """
+        Load the matches saved by L{_saveMatches}, if they were saved for
+        the contents identified by C{_loadedSignature}.
+        """
+        try:
+            version, signature, salt, matches = marshal.loads(
+                self._matchesPath().getContent())
+        except (IOError, EOFError, ValueError, TypeError):
+            return
+        if (version == self._indexVersion and
+            signature == self._loadedSignature):
+            self._matchSalt = salt
+            self._savedMatches.clear()
+            for key, positions in matches:
+                self._remember(self._savedMatches, key, positions)
+            self._matchesChanged = False
+
+
+    def _saveMatches(self):
+        """
+        Save C{_savedMatches}, oldest first, tagged with
+        C{_loadedSignature}.  Failing to write them is logged and otherwise
+        ignored.
+        """
+        self._matchesChanged = False
+        try:
+            self._matchesPath().setContent(marshal.dumps(
+                (self._indexVersion, self._loadedSignature, self._matchSalt,
+                 self._savedMatches.items())))
+        except (IOError, OSError):
+            log.err(None, "Could not save known hosts matches %s"
+                    % (self._matchesPath().path,))
+
+
+    def fromPath(cls, path, indexPath=None):
         """
         @param path: A path object to use for both reading contents from and
         later saving to.
 
         @type path: L{FilePath}
+
+        @param indexPath: A path to keep an index of C{path} at.  The index
+        is used instead of parsing C{path} while C{path} is unchanged, and
+        rewritten when it is not, and on L{save}.  The entries matching each
+        host looked up are also remembered in a file next to the index.
+
+        @type indexPath: L{FilePath} or C{None}
         """
         self = cls(path)
+        self._indexPath = indexPath
         try:
             fp = path.open()
         except IOError:
             return self
-        for line in fp:
-            try:
-                if line.startswith(HashedEntry.MAGIC):
-                    entry = HashedEntry.fromString(line)
-                else:
-                    entry = PlainEntry.fromString(line)
-            except (DecodeError, InvalidEntry, BadKeyError):
-                entry = UnparsedEntry(line)
-            self._entries.append(entry)
+        if indexPath is not None:
+            self._matchSalt = secureRandom(20)
+        try:
+            # The signature is taken from the file being read, before reading
+            # it, so that it cannot describe a later version of the file and
+            # changes made while reading make the index stale.
+            self._loadedSignature = _fileSignature(fp)
+            records = None
+            if indexPath is not None:
+                records = self._loadIndex()
+            if records is None:
+                records = [_recordFromLine(line) for line in fp]
+                if indexPath is not None:
+                    self._saveIndex(records)
+        finally:
+            fp.close()
+        for record in records:
+            self._addEntry(_entryFromRecord(record))
+        self._unsaved = False
+        if indexPath is not None:
+            self._loadMatches()
         return self
 
     fromPath = classmethod(fromPath)
 
 
+class _SharedKnownHostsFile(KnownHostsFile):
+    """
+    A L{KnownHostsFile} shared by all the connections of a process which
+    verify host keys against the same file; see L{getSharedKnownHostsFile}.
+
+    Saves are batched: the first save writes the file at once, and saves
+    following it within C{saveInterval} seconds are written together at the
+    end of that interval, so accepting many new hosts at once does not
+    rewrite the file for each of them.  If the file was changed by someone
+    else in the meantime, it is read again and the new entries are added to
+    its current contents rather than overwriting them.
+
+    The matches of the hosts looked up are written to the match file in the
+    same way, at the end of the C{saveInterval} in which they were found.
+
+    @ivar clock: the provider of C{callLater} and C{seconds} used to delay
+        saves, or C{None} for the global reactor.
+    @ivar _pending: the entries added since the file was last written.
+    @ivar _delayedMatches: the delayed call writing new matches, or C{None}.
+    """
+
+    saveInterval = 1.0
+    clock = None
+
+    def __init__(self, savePath, indexPath=None):
+        KnownHostsFile.__init__(self, savePath)
+        self._indexPath = indexPath
+        self._pending = []
+        self._lastSave = None
+        self._delayedSave = None
+        self._delayedMatches = None
+        self._shutdownTrigger = None
+
+
+    def _getClock(self):
+        """
+        Return C{clock}, or the global reactor if it is C{None}.
+        """
+        if self.clock is None:
+            from twisted.internet import reactor
+            return reactor
+        return self.clock
+
+
+    def _currentSignature(self):
+        """
+        Return the identity of the current contents of the file, or C{None}
+        if it does not exist.
+        """
+        try:
+            return self._signature()
+        except OSError:
+            return None
+
+
+    def _reload(self):
+        """
+        Read the file again, keeping the entries which have not been written
+        to it yet.
+        """
+        fresh = KnownHostsFile.fromPath(self._savePath, self._indexPath)
+        self._entries = []
+        self._hostIndex = {}
+        self._saltIndex = {}
+        self._unindexed = []
+        self._matches.clear()
+        for entry in fresh._entries + self._pending:
+            self._addEntry(entry)
+        self._unsaved = bool(self._pending)
+        self._loadedSignature = fresh._loadedSignature
+        self._matchSalt = fresh._matchSalt
+        if not self._pending:
+            # The saved matches only describe the entries of the file.
+            self._savedMatches = fresh._savedMatches
+        self._matchesChanged = False
+
+
+    def _changed(self):
+        """
+        Return whether the file has been changed since it was last read or
+        written.
+        """
+        return self._currentSignature() != self._loadedSignature
+
+
+    def addHostKey(self, hostname, key):
+        entry = KnownHostsFile.addHostKey(self, hostname, key)
+        self._pending.append(entry)
+        return entry
+
+
+    def save(self):
+        """
+        Write the file now, or at the end of the current C{saveInterval} if
+        it was written less than C{saveInterval} seconds ago.
+        """
+        if self._delayedSave is not None:
+            return
+        now = self._getClock().seconds()
+        if self._lastSave is None or now - self._lastSave >= self.saveInterval:
+            self.flush()
+            return
+        self._delayedSave = self._getClock().callLater(
+            self._lastSave + self.saveInterval - now, self.flush)
+        self._addShutdownTrigger()
+
+
+    def _newMatches(self):
+        """
+        Write the new matches at the end of C{saveInterval}, along with the
+        others found by then.
+        """
+        if self._delayedMatches is None:
+            self._delayedMatches = self._getClock().callLater(
+                self.saveInterval, self._flushMatches)
+            self._addShutdownTrigger()
+
+
+    def _flushMatches(self):
+        """
+        Write the matches which are not in the match file yet.  If the file
+        has been changed since it was read or written, the matches describe
+        entries it may no longer have, so it is read again instead.
+        """
+        if self._delayedMatches is not None:
+            if self._delayedMatches.active():
+                self._delayedMatches.cancel()
+            self._delayedMatches = None
+        if not self._matchesChanged:
+            return
+        if not self._changed():
+            self._saveMatches()
+        elif not self._pending:
+            self._reload()
+
+
+    def _addShutdownTrigger(self):
+        """
+        Make sure that delayed writes are done before the reactor stops.
+        """
+        if self._shutdownTrigger is None:
+            from twisted.internet import reactor
+            self._shutdownTrigger = reactor.addSystemEventTrigger(
+                'before', 'shutdown', self._flushDelayed)
+
+
+    def _flushDelayed(self):
+        """
+        Write a save or matches still waiting for the end of their interval.
+        """
+        if self._delayedSave is not None:
+            self.flush()
+        if self._delayedMatches is not None:
+            self._flushMatches()
+
+
+    def flush(self):
+        """
+        Write the file now, merging our new entries into its current contents
+        if it has been changed by someone else.
+        """
+        if self._delayedSave is not None:
+            if self._delayedSave.active():
+                self._delayedSave.cancel()
+            self._delayedSave = None
+        if self._changed():
+            self._reload()
+        KnownHostsFile.save(self)
+        self._pending = []
+        self._lastSave = self._getClock().seconds()
+
+
+
+# The _SharedKnownHostsFile for each path, by path name.
+_sharedFiles = {}
+
+def getSharedKnownHostsFile(path, indexPath=None):
+    """
+    Return the L{KnownHostsFile} for C{path} shared by the whole process,
+    reading C{path} again first if it has changed since it was last read.
+
+    Connections verifying host keys against the same file share its parsed
+    entries, its indexes and the matches it remembers, and the entries they
+    add are written in batches.
+
+    @type path: L{FilePath}
+
+    @param indexPath: the index file to keep, as for
+        L{KnownHostsFile.fromPath}, when the file is first read by this
+        process.
+    @type indexPath: L{FilePath} or C{None}
+
+    @rtype: L{KnownHostsFile}
+    """
+    shared = _sharedFiles.get(path.path)
+    if shared is None:
+        shared = _sharedFiles[path.path] = _SharedKnownHostsFile(
+            path, indexPath)
+        shared._reload()
+    elif not shared._pending and shared._changed():
+        shared._reload()
+    return shared
+
+
+
 class ConsoleUI(object):
     """
     A UI object that can ask true/false questions and post notifications on the
@@ -0,0 +1,576 @@
+# -*- test-case-name: twisted.conch.test.test_memory -*-
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+An SFTP backend which keeps its files in memory.
+
+L{MemoryFilesystem} holds a tree of directories, files and symbolic links,
+with optional limits on the number of bytes and of entries it may hold, and
+L{MemorySFTPServer} serves it over SFTP.  Nothing touches the disk and no
+credentials are switched, so it suits ephemeral upload areas and measuring
+the overhead of the protocol itself.  L{MemorySFTPRealm} gives every user an
+avatar serving the same filesystem.
+
+Permissions, owners and times are stored and reported but not enforced.
+"""
+
+import posixpath, stat
+from collections import namedtuple
+
+from zope.interface import implements
+
+from twisted.cred import portal
+from twisted.python import components
+from twisted.conch.avatar import ConchUser
+from twisted.conch.interfaces import IConchUser, ISFTPServer, ISFTPFile
+from twisted.conch.ls import lsLine
+from twisted.conch.ssh import session, filetransfer
+from twisted.conch.ssh.filetransfer import SFTPError
+from twisted.conch.ssh.filetransfer import (
+    FXF_WRITE, FXF_APPEND, FXF_CREAT, FXF_TRUNC, FXF_EXCL,
+    FX_NO_SUCH_FILE, FX_FAILURE, FX_FILE_ALREADY_EXISTS)
+
+
+_StatResult = namedtuple('_StatResult', ['st_mode', 'st_nlink', 'st_uid',
+                                         'st_gid', 'st_size', 'st_mtime'])
+
+_StatVFSResult = namedtuple('_StatVFSResult', [
+        'f_bsize', 'f_frsize', 'f_blocks', 'f_bfree', 'f_bavail', 'f_files',
+        'f_ffree', 'f_favail', 'f_flag', 'f_namemax'])
+
+
+
+class _Node(object):
+    """
+    An entry in a L{MemoryFilesystem}.
+
+    @ivar permissions: the file mode, including the type bits.
+    @ivar links: the number of directories the node is an entry of.
+    """
+
+    __slots__ = ('permissions', 'uid', 'gid', 'atime', 'mtime', 'links')
+
+    def __init__(self, permissions, now):
+        self.permissions = permissions
+        self.uid = 0
+        self.gid = 0
+        self.atime = self.mtime = now
+        self.links = 0
+
+
+    def size(self):
+        return 0
+
+
+    def getAttrs(self):
+        return {'size': self.size(), 'uid': self.uid, 'gid': self.gid,
+                'permissions': self.permissions, 'atime': int(self.atime),
+                'mtime': int(self.mtime)}
+
+
+    def stat(self):
+        return _StatResult(self.permissions, self.links, self.uid, self.gid,
+                           self.size(), self.mtime)
+
+
+
+class _File(_Node):
+    """
+    A regular file, whose contents are a C{bytearray}.
+
+    @ivar opens: the number of L{MemorySFTPFile}s open on the file.
+    """
+
+    __slots__ = ('data', 'opens')
+
+    def __init__(self, permissions, now):
+        _Node.__init__(self, stat.S_IFREG | (permissions & 07777), now)
+        self.data = bytearray()
+        self.opens = 0
+
+
+    def size(self):
+        return len(self.data)
+
+
+
+class _Directory(_Node):
+    """
+    A directory, mapping names to nodes.
+    """
+
+    __slots__ = ('children',)
+
+    def __init__(self, permissions, now):
+        _Node.__init__(self, stat.S_IFDIR | (permissions & 07777), now)
+        self.children = {}
+
+
+
+class _Link(_Node):
+    """
+    A symbolic link to C{target}.
+    """
+
+    __slots__ = ('target',)
+
+    def __init__(self, target, now):
+        _Node.__init__(self, stat.S_IFLNK | 0777, now)
+        self.target = target
+
+
+    def size(self):
+        return len(self.target)
+
+
+
+class MemoryFilesystem(object):
+    """
+    A tree of files held in memory, which may be shared by any number of
+    sessions.
+
+    Files take the space of their contents, and every file, directory and
+    link counts as an entry.  A file removed while it is open keeps its
+    space until it is closed.
+
+    @ivar quota: the number of bytes the files may hold in total, or C{None}
+        for no limit.
+    @ivar maxEntries: the number of entries the filesystem may hold, not
+        counting the root directory, or C{None} for no limit.
+    @ivar used: the number of bytes held.
+    @ivar entries: the number of entries held.
+    @ivar clock: the L{IReactorTime} provider used to time changes.
+    """
+
+    maxLinks = 32
+
+    def __init__(self, quota=None, maxEntries=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.quota = quota
+        self.maxEntries = maxEntries
+        self.clock = clock
+        self.used = 0
+        self.entries = 0
+        self.root = _Directory(0755, clock.seconds())
+        self.root.links = 1
+
+
+    def reserve(self, size):
+        """
+        Account for C{size} more bytes of file contents.
+
+        @raise SFTPError: if that would exceed the quota.
+        """
+        if self.quota is not None and self.used + size > self.quota:
+            raise SFTPError(FX_FAILURE, 'disk quota exceeded')
+        self.used += size
+
+
+    def release(self, size):
+        """
+        Give back C{size} bytes of file contents.
+        """
+        self.used -= size
+
+
+    def _addEntry(self, directory, name, node):
+        if self.maxEntries is not None and self.entries >= self.maxEntries:
+            raise SFTPError(FX_FAILURE, 'too many files')
+        self.entries += 1
+        directory.children[name] = node
+        node.links += 1
+        directory.mtime = self.clock.seconds()
+
+
+    def _removeEntry(self, directory, name, forget=True):
+        node = directory.children.pop(name)
+        self.entries -= 1
+        node.links -= 1
+        directory.mtime = self.clock.seconds()
+        if forget:
+            self._forget(node)
+        return node
+
+
+    def _forget(self, node):
+        """
+        Release the space of C{node} if it is a file which is neither linked
+        nor open.
+        """
+        if isinstance(node, _File) and not node.links and not node.opens:
+            self.release(len(node.data))
+            node.data = bytearray()
+
+
+    def _resolve(self, path, followLinks=True, parent=False, depth=0):
+        """
+        Find the node for the absolute, normalized C{path}.
+
+        @param followLinks: whether to follow a link at the end of C{path};
+            links before the end are always followed.
+        @param parent: if true, return the directory holding the last
+            component of C{path} and that component's name instead.
+        @raise SFTPError: if the path does not exist, or goes through
+            something which is not a directory.
+        """
+        names = [name for name in path.split('/') if name]
+        if parent:
+            if not names:
+                raise SFTPError(FX_FAILURE, 'invalid path')
+            last = names.pop()
+        node = self.root
+        current = '/'
+        for index, name in enumerate(names):
+            if not isinstance(node, _Directory):
+                raise SFTPError(FX_FAILURE, 'not a directory')
+            try:
+                node = node.children[name]
+            except KeyError:
+                raise SFTPError(FX_NO_SUCH_FILE, 'No such file')
+            current = posixpath.join(current, name)
+            if isinstance(node, _Link) and (followLinks or parent or
+                                            index < len(names) - 1):
+                node, current = self._followLink(node, current, depth)
+        if parent:
+            if not isinstance(node, _Directory):
+                raise SFTPError(FX_FAILURE, 'not a directory')
+            return node, last, posixpath.join(current, last)
+        return node, current
+
+
+    def _followLink(self, link, path, depth):
+        if depth >= self.maxLinks:
+            raise SFTPError(FX_FAILURE, 'too many levels of symbolic links')
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(path),
+                                                   link.target))
+        return self._resolve(target, True, False, depth + 1)
+
+
+    def statVFS(self):
+        """
+        Describe the filesystem's limits like C{os.statvfs}, with 1 byte
+        blocks.
+
+        @raise NotImplementedError: if there is no quota.
+        """
+        if self.quota is None:
+            raise NotImplementedError('no quota to report')
+        free = max(0, self.quota - self.used)
+        if self.maxEntries is None:
+            files = freeFiles = 0
+        else:
+            files = self.maxEntries
+            freeFiles = max(0, self.maxEntries - self.entries)
+        return _StatVFSResult(1, 1, self.quota, free, free, files, freeFiles,
+                              freeFiles, 0, 255)
+
+
+
+class MemorySFTPFile(object):
+    """
+    An open file of a L{MemoryFilesystem}.
+    """
+
+    implements(ISFTPFile)
+
+    def __init__(self, filesystem, node, append):
+        self.filesystem = filesystem
+        self.node = node
+        self.append = append
+        node.opens += 1
+
+
+    def close(self):
+        if self.node is not None:
+            node, self.node = self.node, None
+            node.opens -= 1
+            self.filesystem._forget(node)
+
+
+    def readChunk(self, offset, length):
+        self.node.atime = self.filesystem.clock.seconds()
+        return str(self.node.data[offset:offset + length])
+
+
+    def writeChunk(self, offset, data):
+        contents = self.node.data
+        if self.append:
+            offset = len(contents)
+        end = offset + len(data)
+        if end > len(contents):
+            self.filesystem.reserve(end - len(contents))
+            if offset > len(contents):
+                contents.extend('\0' * (offset - len(contents)))
+        contents[offset:end] = data
+        self.node.mtime = self.filesystem.clock.seconds()
+
+
+    def getAttrs(self):
+        return self.node.getAttrs()
+
+
+    def setAttrs(self, attrs):
+        _setAttrs(self.filesystem, self.node, attrs)
+
+
+
+def _setAttrs(filesystem, node, attrs):
+    """
+    Set the attributes C{attrs}, in the format of L{ISFTPServer.openFile},
+    of C{node}.
+    """
+    if 'size' in attrs:
+        if not isinstance(node, _File):
+            raise SFTPError(FX_FAILURE, 'not a regular file')
+        size = attrs['size']
+        current = len(node.data)
+        if size > current:
+            filesystem.reserve(size - current)
+            node.data.extend('\0' * (size - current))
+        else:
+            del node.data[size:]
+            filesystem.release(current - size)
+        node.mtime = filesystem.clock.seconds()
+    if 'uid' in attrs and 'gid' in attrs:
+        node.uid, node.gid = attrs['uid'], attrs['gid']
+    if 'permissions' in attrs:
+        node.permissions = (stat.S_IFMT(node.permissions) |
+                            (attrs['permissions'] & 07777))
+    if 'atime' in attrs and 'mtime' in attrs:
+        node.atime, node.mtime = attrs['atime'], attrs['mtime']
+
+
+
+class MemorySFTPDirectory(object):
+    """
+    An iterator over the entries a directory of a L{MemoryFilesystem} had
+    when it was opened.
+    """
+
+    def __init__(self, directory):
+        self._names = sorted(directory.children, reverse=True)
+        self._directory = directory
+
+
+    def __iter__(self):
+        return self
+
+
+    def next(self):
+        while self._names:
+            name = self._names.pop()
+            node = self._directory.children.get(name)
+            if node is not None:
+                return (name, lsLine(name, node.stat()), node.getAttrs())
+        raise StopIteration()
+
+
+    def close(self):
+        self._names = []
+
+
+
+class MemorySFTPServer(object):
+    """
+    Serve a L{MemoryFilesystem} over SFTP.
+
+    Paths are resolved from the root of the filesystem, which is also the
+    user's home directory.
+    """
+
+    implements(ISFTPServer)
+
+    def __init__(self, filesystem, avatar=None):
+        self.filesystem = filesystem
+        self.avatar = avatar
+
+
+    def _path(self, path):
+        return posixpath.normpath(posixpath.join('/', path))
+
+
+    def _parent(self, path):
+        return self.filesystem._resolve(self._path(path), parent=True)
+
+
+    def gotVersion(self, otherVersion, extData):
+        return {}
+
+
+    def openFile(self, filename, flags, attrs):
+        fs = self.filesystem
+        directory, name, path = self._parent(filename)
+        node = directory.children.get(name)
+        if isinstance(node, _Link):
+            node, path = fs._followLink(node, path, 0)
+        if node is None:
+            if not flags & FXF_CREAT:
+                raise SFTPError(FX_NO_SUCH_FILE, 'No such file')
+            node = _File(attrs.get('permissions', 0644), fs.clock.seconds())
+            fs._addEntry(directory, name, node)
+        elif flags & FXF_CREAT and flags & FXF_EXCL:
+            raise SFTPError(FX_FILE_ALREADY_EXISTS, 'File exists')
+        if not isinstance(node, _File):
+            raise SFTPError(FX_FAILURE, 'not a regular file')
+        if flags & FXF_TRUNC and flags & FXF_WRITE and node.data:
+            fs.release(len(node.data))
+            node.data = bytearray()
+            node.mtime = fs.clock.seconds()
+        attrs = dict(attrs)
+        attrs.pop('permissions', None)
+        # As with the Unix backend, only SETSTAT changes the size.
+        attrs.pop('size', None)
+        if attrs:
+            _setAttrs(fs, node, attrs)
+        return MemorySFTPFile(fs, node, bool(flags & FXF_APPEND))
+
+
+    def removeFile(self, filename):
+        directory, name, path = self._parent(filename)
+        node = directory.children.get(name)
+        if node is None:
+            raise SFTPError(FX_NO_SUCH_FILE, 'No such file')
+        if isinstance(node, _Directory):
+            raise SFTPError(FX_FAILURE, 'is a directory')
+        self.filesystem._removeEntry(directory, name)
+
+
+    def renameFile(self, oldpath, newpath):
+        fs = self.filesystem
+        oldDirectory, oldName, oldpath = self._parent(oldpath)
+        newDirectory, newName, newpath = self._parent(newpath)
+        node = oldDirectory.children.get(oldName)
+        if node is None:
+            raise SFTPError(FX_NO_SUCH_FILE, 'No such file')
+        if isinstance(node, _Directory) and (
+            newpath == oldpath or newpath.startswith(oldpath + '/')):
+            raise SFTPError(FX_FAILURE, 'cannot move a directory into itself')
+        existing = newDirectory.children.get(newName)
+        if existing is node:
+            return
+        if existing is not None:
+            if isinstance(existing, _Directory) and (
+                not isinstance(node, _Directory) or existing.children):
+                raise SFTPError(FX_FAILURE, 'cannot replace a directory')
+            fs._removeEntry(newDirectory, newName)
+        fs._removeEntry(oldDirectory, oldName, forget=False)
+        fs._addEntry(newDirectory, newName, node)
+
+
+    def makeDirectory(self, path, attrs):
+        fs = self.filesystem
+        directory, name, path = self._parent(path)
+        if name in directory.children:
+            raise SFTPError(FX_FILE_ALREADY_EXISTS, 'File exists')
+        node = _Directory(attrs.get('permissions', 0755), fs.clock.seconds())
+        fs._addEntry(directory, name, node)
+        attrs = dict(attrs)
+        attrs.pop('permissions', None)
+        attrs.pop('size', None)
+        _setAttrs(fs, node, attrs)
+
+
+    def removeDirectory(self, path):
+        directory, name, path = self._parent(path)
+        node = directory.children.get(name)
+        if node is None:
+            raise SFTPError(FX_NO_SUCH_FILE, 'No such file')
+        if not isinstance(node, _Directory):
+            raise SFTPError(FX_FAILURE, 'not a directory')
+        if node.children:
+            raise SFTPError(FX_FAILURE, 'directory not empty')
+        self.filesystem._removeEntry(directory, name)
+
+
+    def openDirectory(self, path):
+        node, path = self.filesystem._resolve(self._path(path))
+        if not isinstance(node, _Directory):
+            raise SFTPError(FX_FAILURE, 'not a directory')
+        return MemorySFTPDirectory(node)
+
+
+    def getAttrs(self, path, followLinks):
+        node, path = self.filesystem._resolve(self._path(path), followLinks)
+        return node.getAttrs()
+
+
+    def setAttrs(self, path, attrs):
+        node, path = self.filesystem._resolve(self._path(path))
+        _setAttrs(self.filesystem, node, attrs)
+
+
+    def readLink(self, path):
+        node, path = self.filesystem._resolve(self._path(path), False)
+        if not isinstance(node, _Link):
+            raise SFTPError(FX_FAILURE, 'not a symbolic link')
+        return node.target
+
+
+    def makeLink(self, linkPath, targetPath):
+        fs = self.filesystem
+        directory, name, path = self._parent(linkPath)
+        if name in directory.children:
+            raise SFTPError(FX_FILE_ALREADY_EXISTS, 'File exists')
+        fs._addEntry(directory, name, _Link(targetPath, fs.clock.seconds()))
+
+
+    def realPath(self, path):
+        node, path = self.filesystem._resolve(self._path(path))
+        return path
+
+
+    def statVFS(self, path):
+        self.filesystem._resolve(self._path(path))
+        return self.filesystem.statVFS()
+
+
+    def extendedRequest(self, extName, extData):
+        raise NotImplementedError
+
+
+
+class MemoryConchUser(ConchUser):
+    """
+    An avatar which can only use the I{sftp} subsystem, served from
+    C{filesystem}.
+    """
+
+    def __init__(self, username, filesystem):
+        ConchUser.__init__(self)
+        self.username = username
+        self.filesystem = filesystem
+        self.channelLookup['session'] = session.SSHSession
+        self.subsystemLookup['sftp'] = filetransfer.FileTransferServer
+
+
+    def logout(self):
+        pass
+
+
+
+def _serverForUser(avatar):
+    return MemorySFTPServer(avatar.filesystem, avatar)
+
+components.registerAdapter(_serverForUser, MemoryConchUser, ISFTPServer)
+
+
+
+class MemorySFTPRealm(object):
+    """
+    A realm giving every user a L{MemoryConchUser} for the same
+    L{MemoryFilesystem}.
+    """
+
+    implements(portal.IRealm)
+
+    def __init__(self, filesystem):
+        self.filesystem = filesystem
+
+
+    def requestAvatar(self, avatarId, mind, *interfaces):
+        if IConchUser not in interfaces:
+            raise NotImplementedError()
+        user = MemoryConchUser(avatarId, self.filesystem)
+        return IConchUser, user, user.logout
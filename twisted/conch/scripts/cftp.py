@@ -6,7 +6,7 @@
 Implementation module for the I{cftp} command.
 """
 
-import os, sys, getpass, struct, tty, fcntl, stat
+import os, sys, getpass, struct, tty, fcntl, stat, errno
 import fnmatch, pwd, glob
 
 from twisted.conch.client import connect, default, options
@@ -29,6 +29,7 @@ class ClientOptions(options.ConchOptions):
                     ['buffersize', 'B', 32768, 'Size of the buffer to use for sending/receiving.'],
                     ['batchfile', 'b', None, 'File to read commands from, or \'-\' for stdin.'],
                     ['requests', 'R', 5, 'Number of requests to make before waiting for a reply.'],
+                    ['parallel', 'P', 4, 'Number of files to transfer at once.'],
                     ['subsystem', 's', 'sftp', 'Subsystem/server program to connect to.']]
 
     compData = usage.Completions(
@@ -124,6 +125,124 @@ class FileWrapper:
     def __getattr__(self, attr):
         return getattr(self.f, attr)
 
+class TransferStatus:
+    """
+    The progress of a single file transfer, for display in a progress bar.
+
+    @ivar name: the name of the file being transferred.
+    @ivar size: the number of bytes to transfer.
+    @ivar total: the number of bytes transferred so far.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.size = 0
+        self.total = 0.0
+
+class TransferProgress:
+    """
+    The combined progress of several file transfers.
+
+    @ivar files: the number of files transferred.
+    @ivar bytes: the number of bytes in the files transferred.
+    @ivar errors: the number of transfers which failed.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.startTime = clock.seconds()
+        self.files = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def fileDone(self, size):
+        """
+        Record that a file of C{size} bytes has been transferred.
+        """
+        self.files += 1
+        self.bytes += size
+
+    def elapsed(self):
+        return self.clock.seconds() - self.startTime
+
+    def filesPerSecond(self):
+        elapsed = self.elapsed()
+        if not elapsed:
+            return 0.0
+        return self.files / elapsed
+
+    def bytesPerSecond(self):
+        elapsed = self.elapsed()
+        if not elapsed:
+            return 0.0
+        return self.bytes / elapsed
+
+class TransferQueue:
+    """
+    File transfers run by a L{StdioClient}, up to its configured number at
+    once, as they are added.
+
+    Transfers can be added while a remote listing is still arriving;
+    L{ready} lets the listing wait while too many are queued, so that the
+    queue does not grow with the size of the listing.
+
+    @ivar progress: the L{TransferProgress} of the transfers.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.parallel = client._getParallelTransfers()
+        self.semaphore = defer.DeferredSemaphore(self.parallel)
+        self.progress = TransferProgress(client.reactor)
+        self._outstanding = 0
+        self._waiting = []
+
+    def add(self, function, args, size):
+        """
+        Start a transfer, or queue it until one finishes.
+
+        @param function: the transfer function.  It is passed C{args} and
+            C{showProgress} as a keyword argument, and must return a
+            L{Deferred} which fires with a description of the result.
+        @param size: the number of bytes it will transfer.
+        """
+        self._outstanding += 1
+        d = self.semaphore.run(function, showProgress=(self.parallel == 1),
+                               *args)
+        d.addBoth(self.client._cbTransferManyResult, self.progress, size)
+        d.addBoth(self._transferDone)
+
+    def _transferDone(self, ignored):
+        self._outstanding -= 1
+        waiting = self._waiting
+        self._waiting = []
+        for d in waiting:
+            d.callback(None)
+
+    def ready(self):
+        """
+        Return a L{Deferred} which fires once few enough transfers are
+        queued for more to be added.
+        """
+        if self._outstanding < self.parallel * 2:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        d.addCallback(lambda ignored: self.ready())
+        return d
+
+    def finish(self):
+        """
+        Return a L{Deferred} which fires with a summary of the transfers once
+        all of them have finished.
+        """
+        if not self._outstanding:
+            return defer.succeed(self.client._describeProgress(self.progress))
+        d = defer.Deferred()
+        self._waiting.append(d)
+        d.addCallback(lambda ignored: self.finish())
+        return d
+
 class StdioClient(basic.LineReceiver):
 
     _pwd = pwd
@@ -275,7 +394,16 @@ class StdioClient(basic.LineReceiver):
         return d
 
     def cmd_GET(self, rest):
+        flags, rest = self._getFlags(rest, 'rad')
+        resume, delta = 'a' in flags, 'd' in flags
         remote, rest = self._getFilename(rest)
+        if 'r' in flags:
+            if rest:
+                local, rest = self._getFilename(rest)
+            else:
+                local = os.path.split(remote.rstrip('/'))[1]
+            return self._getTree(os.path.join(self.currentDirectory, remote),
+                                 local, resume, delta)
         if '*' in remote or '?' in remote: # wildcard
             if rest:
                 local, rest = self._getFilename(rest)
@@ -283,214 +411,383 @@ class StdioClient(basic.LineReceiver):
                     return "Wildcard get with non-directory target."
             else:
                 local = ''
-            d = self._remoteGlob(remote)
-            d.addCallback(self._cbGetMultiple, local)
+            fullPath = os.path.join(self.currentDirectory, remote)
+            transfers = TransferQueue(self)
+            d = self._remoteGlob(fullPath, self._getMultiple, transfers,
+                                 os.path.split(fullPath)[0], local, resume,
+                                 delta)
+            d.addCallback(lambda ignored: transfers.finish())
             return d
         if rest:
             local, rest = self._getFilename(rest)
         else:
             local = os.path.split(remote)[1]
         log.msg((remote, local))
-        lf = file(local, 'w', 0)
-        path = os.path.join(self.currentDirectory, remote)
-        d = self.client.openFile(path, filetransfer.FXF_READ, {})
-        d.addCallback(self._cbGetOpenFile, lf)
-        d.addErrback(self._ebCloseLf, lf)
-        return d
+        return self._getFile(os.path.join(self.currentDirectory, remote),
+                             local, None, resume, delta)
 
-    def _cbGetMultiple(self, files, local):
-        #if self._useProgressBar: # one at a time
-        # XXX this can be optimized for times w/o progress bar
-        return self._cbGetMultipleNext(None, files, local)
-
-    def _cbGetMultipleNext(self, res, files, local):
-        if isinstance(res, failure.Failure):
-            self._printFailure(res)
-        elif res:
-            self.transport.write(res)
-            if not res.endswith('\n'):
-                self.transport.write('\n')
-        if not files:
-            return
-        f = files.pop(0)[0]
-        lf = file(os.path.join(local, os.path.split(f)[1]), 'w', 0)
-        path = os.path.join(self.currentDirectory, f)
-        d = self.client.openFile(path, filetransfer.FXF_READ, {})
-        d.addCallback(self._cbGetOpenFile, lf)
-        d.addErrback(self._ebCloseLf, lf)
-        d.addBoth(self._cbGetMultipleNext, files, local)
+    def cmd_REGET(self, rest):
+        return self.cmd_GET('-a ' + rest)
+
+    def _getFile(self, remote, local, attrs=None, resume=False, delta=False,
+                 showProgress=True):
+        """
+        Download a single remote file.
+
+        @param remote: the full path of the remote file.
+        @param local: the path of the local file to write.
+        @param attrs: the attributes of the remote file if they are already
+            known, saving a round trip to fetch them.
+        @param resume: whether to keep what an earlier download of the file
+            left in C{local}.
+        @param delta: whether to compare C{local} with the remote file and
+            only fetch the blocks which differ.
+        @param showProgress: whether to display a progress bar for this file,
+            if progress bars are enabled.
+
+        @return: a L{Deferred} which fires with a description of the result.
+        """
+        if resume or delta:
+            return self._resumeTransfer(filetransfer.resumeGet, remote, local,
+                                        delta, showProgress)
+        d = self.client.openFile(remote, filetransfer.FXF_READ, {})
+        if attrs is None or stat.S_ISLNK(attrs['permissions']):
+            # Listings describe symbolic links themselves, so ask the open
+            # file what the link leads to.
+            d.addCallback(self._cbGetOpenFile, local, showProgress)
+        else:
+            d.addCallback(
+                lambda rf: self._cbGetFileSize(attrs, rf, local, showProgress))
         return d
 
+    def _getMultiple(self, files, transfers, remoteDirectory, local,
+                     resume=False, delta=False):
+        """
+        Queue downloads of a batch of entries from a remote directory
+        listing.
+
+        @return: a L{Deferred} which fires when C{transfers} is ready for
+            more.
+        """
+        for (filename, longname, attrs) in files:
+            transfers.add(self._getFile,
+                          (os.path.join(remoteDirectory, filename),
+                           os.path.join(local, filename), attrs, resume,
+                           delta),
+                          attrs.get('size', 0))
+        return transfers.ready()
+
     def _ebCloseLf(self, f, lf):
         lf.close()
         return f
 
-    def _cbGetOpenFile(self, rf, lf):
-        return rf.getAttrs().addCallback(self._cbGetFileSize, rf, lf)
+    def _cbGetOpenFile(self, rf, local, showProgress=True):
+        d = rf.getAttrs()
+        d.addCallback(self._cbGetFileSize, rf, local, showProgress)
+        return d
 
-    def _cbGetFileSize(self, attrs, rf, lf):
+    def _cbGetFileSize(self, attrs, rf, local, showProgress=True):
+        """
+        Download the open remote file C{rf} with attributes C{attrs} to the
+        local path C{local}, which is only opened, and truncated, once the
+        remote file is known to be a regular file.
+        """
         if not stat.S_ISREG(attrs['permissions']):
             rf.close()
-            lf.close()
             return "Can't get non-regular file: %s" % rf.name
+        lf = file(local, 'w', 0)
         rf.size = attrs['size']
-        bufferSize = self.client.transport.conn.options['buffersize']
-        numRequests = self.client.transport.conn.options['requests']
         rf.total = 0.0
-        dList = []
-        chunks = []
-        startTime = self.reactor.seconds()
-        for i in range(numRequests):
-            d = self._cbGetRead('', rf, lf, chunks, 0, bufferSize, startTime)
-            dList.append(d)
-        dl = defer.DeferredList(dList, fireOnOneErrback=1)
-        dl.addCallback(self._cbGetDone, rf, lf)
-        return dl
-
-    def _getNextChunk(self, chunks):
-        end = 0
-        for chunk in chunks:
-            if end == 'eof':
-                return # nothing more to get
-            if end != chunk[0]:
-                i = chunks.index(chunk)
-                chunks.insert(i, (end, chunk[0]))
-                return (end, chunk[0] - end)
-            end = chunk[1]
-        bufSize = int(self.client.transport.conn.options['buffersize'])
-        chunks.append((end, end + bufSize))
-        return (end, bufSize)
-
-    def _cbGetRead(self, data, rf, lf, chunks, start, size, startTime):
-        if data and isinstance(data, failure.Failure):
-            log.msg('get read err: %s' % data)
-            reason = data
-            reason.trap(EOFError)
-            i = chunks.index((start, start + size))
-            del chunks[i]
-            chunks.insert(i, (start, 'eof'))
-        elif data:
-            log.msg('get read data: %i' % len(data))
-            lf.seek(start)
-            lf.write(data)
-            if len(data) != size:
-                log.msg('got less than we asked for: %i < %i' %
-                        (len(data), size))
-                i = chunks.index((start, start + size))
-                del chunks[i]
-                chunks.insert(i, (start, start + len(data)))
-            rf.total += len(data)
-        if self.useProgressBar:
-            self._printProgressBar(rf, startTime)
-        chunk = self._getNextChunk(chunks)
-        if not chunk:
-            return
-        else:
-            start, length = chunk
-        log.msg('asking for %i -> %i' % (start, start+length))
-        d = rf.readChunk(start, length)
-        d.addBoth(self._cbGetRead, rf, lf, chunks, start, length, startTime)
+        transfer = filetransfer.PipelinedGet(
+            rf, lf, self.client.transport.conn.options['buffersize'],
+            self.client.transport.conn.options['requests'],
+            self._getProgressReporter(rf, showProgress), self.reactor)
+        d = transfer.start()
+        d.addCallback(self._cbGetDone, rf, lf, showProgress)
+        d.addErrback(self._ebCloseLf, lf)
         return d
 
-    def _cbGetDone(self, ignored, rf, lf):
+    def _getProgressReporter(self, f, showProgress=True):
+        """
+        Return a callable for the C{progress} argument of a pipelined
+        transfer which updates the progress bar, if it is enabled.
+
+        @param f: the file whose progress is displayed.
+        @param showProgress: if false, never display a progress bar.
+        """
+        def progress(transfer):
+            if showProgress and self.useProgressBar:
+                if transfer.size is not None:
+                    f.size = transfer.size - transfer.skipped
+                f.total = transfer.bytesTransferred
+                if f.size:
+                    self._printProgressBar(f, transfer.startTime)
+        return progress
+
+    def _resumeTransfer(self, function, source, target, delta, showProgress):
+        """
+        Continue a transfer with L{filetransfer.resumeGet} or
+        L{filetransfer.resumePut}.
+
+        @return: a L{Deferred} which fires with a description of the result.
+        """
+        status = TransferStatus(source)
+        options = self.client.transport.conn.options
+        d = function(self.client, source, target, delta,
+                     bufferSize=options['buffersize'],
+                     requests=options['requests'],
+                     progress=self._getProgressReporter(status, showProgress),
+                     clock=self.reactor)
+        d.addCallback(self._cbResumeTransfer, source, target, showProgress)
+        return d
+
+    def _cbResumeTransfer(self, transfer, source, target, showProgress):
+        if showProgress and self.useProgressBar and transfer.bytesTransferred:
+            self.transport.write('\n')
+        return "Transferred %s to %s (%s already present)" % (
+            source, target, self._abbrevSize(transfer.skipped))
+
+    def _cbGetDone(self, ignored, rf, lf, showProgress=True):
         log.msg('get done')
         rf.close()
         lf.close()
-        if self.useProgressBar:
+        if showProgress and self.useProgressBar:
             self.transport.write('\n')
         return "Transferred %s to %s" % (rf.name, lf.name)
 
+    def _getTree(self, remote, local, resume=False, delta=False):
+        """
+        Download the remote directory C{remote} and everything below it to
+        the local directory C{local}.  Files are downloaded as the listing
+        arrives; each local directory is created as soon as it is listed in
+        its parent, before anything in it is fetched.
+        """
+        if not os.path.isdir(local):
+            os.makedirs(local)
+        transfers = TransferQueue(self)
+        def visit(relative, entries):
+            for (name, longname, attrs) in entries:
+                if name in ('.', '..'):
+                    continue
+                path = os.path.join(relative, name)
+                if stat.S_ISDIR(attrs['permissions']):
+                    if not os.path.isdir(os.path.join(local, path)):
+                        os.makedirs(os.path.join(local, path))
+                elif (stat.S_ISREG(attrs['permissions']) or
+                      stat.S_ISLNK(attrs['permissions'])):
+                    transfers.add(self._getFile,
+                                  (os.path.join(remote, path),
+                                   os.path.join(local, path), attrs, resume,
+                                   delta),
+                                  attrs.get('size', 0))
+            return transfers.ready()
+        d = self.client.walk(remote, visit, onError=self._ebWalk)
+        d.addCallback(lambda ignored: transfers.finish())
+        return d
+
+    def _ebWalk(self, relative, reason):
+        """
+        Report a directory below the top of a walk which could not be
+        listed, and carry on.  A failure to list the top fails the walk.
+        """
+        if not relative:
+            return reason
+        self._printFailure(reason)
+
+    def _getParallelTransfers(self):
+        """
+        Return the number of files to transfer at once.
+        """
+        return max(1, int(self.client.transport.conn.options.get(
+            'parallel', 1)))
+
+    def _transferMany(self, jobs):
+        """
+        Run several file transfers, with up to the configured number in
+        flight at once, writing the result of each as it completes.
+
+        @param jobs: a list of arguments for L{TransferQueue.add}.
+
+        @return: a L{Deferred} which fires with a summary of the transfers.
+        """
+        transfers = TransferQueue(self)
+        for job in jobs:
+            transfers.add(*job)
+        return transfers.finish()
+
+    def _cbTransferManyResult(self, result, progress, size):
+        if isinstance(result, failure.Failure):
+            progress.errors += 1
+            self._printFailure(result)
+            return
+        progress.fileDone(size)
+        if result:
+            self.transport.write(result)
+            if not result.endswith('\n'):
+                self.transport.write('\n')
+
+    def _describeProgress(self, progress):
+        """
+        Return a description of the progress of a multiple file transfer.
+
+        @type progress: L{TransferProgress}
+        """
+        description = "Transferred %i files, %s in %s (%.1f files/s, %sps)" % (
+            progress.files, self._abbrevSize(progress.bytes),
+            self._abbrevTime(progress.elapsed()),
+            progress.filesPerSecond(),
+            self._abbrevSize(progress.bytesPerSecond()))
+        if progress.errors:
+            description += ", %i failed" % (progress.errors,)
+        return description
+
     def cmd_PUT(self, rest):
+        flags, rest = self._getFlags(rest, 'rad')
+        resume, delta = 'a' in flags, 'd' in flags
         local, rest = self._getFilename(rest)
+        if 'r' in flags:
+            if rest:
+                remote, rest = self._getFilename(rest)
+            else:
+                remote = os.path.split(local.rstrip('/'))[1]
+            return self._putTree(local,
+                                 os.path.join(self.currentDirectory, remote),
+                                 resume, delta)
         if '*' in local or '?' in local: # wildcard
             if rest:
                 remote, rest = self._getFilename(rest)
                 path = os.path.join(self.currentDirectory, remote)
                 d = self.client.getAttrs(path)
-                d.addCallback(self._cbPutTargetAttrs, remote, local)
+                d.addCallback(self._cbPutTargetAttrs, path, local, resume,
+                              delta)
                 return d
             else:
-                remote = ''
-                files = glob.glob(local)
-                return self._cbPutMultipleNext(None, files, remote)
+                return self._putMultiple(glob.glob(local),
+                                         self.currentDirectory, resume, delta)
         if rest:
             remote, rest = self._getFilename(rest)
         else:
             remote = os.path.split(local)[1]
+        return self._putFile(local, os.path.join(self.currentDirectory, remote),
+                             resume, delta)
+
+    def cmd_REPUT(self, rest):
+        return self.cmd_PUT('-a ' + rest)
+
+    def _putFile(self, local, remote, resume=False, delta=False,
+                 showProgress=True):
+        """
+        Upload a single local file, replacing the remote file if it exists.
+
+        @param local: the path of the local file.
+        @param remote: the full path of the remote file.
+        @param resume: whether to keep what an earlier upload of the file
+            left in C{remote}.
+        @param delta: whether to compare C{remote} with the local file and
+            only send the blocks which differ.
+        @param showProgress: whether to display a progress bar for this file,
+            if progress bars are enabled.
+
+        @return: a L{Deferred} which fires with a description of the result.
+        """
+        if resume or delta:
+            return self._resumeTransfer(filetransfer.resumePut, local, remote,
+                                        delta, showProgress)
         lf = file(local, 'r')
-        path = os.path.join(self.currentDirectory, remote)
         flags = filetransfer.FXF_WRITE|filetransfer.FXF_CREAT|filetransfer.FXF_TRUNC
-        d = self.client.openFile(path, flags, {})
-        d.addCallback(self._cbPutOpenFile, lf)
+        d = self.client.openFile(remote, flags, {})
+        d.addCallback(self._cbPutOpenFile, lf, showProgress)
         d.addErrback(self._ebCloseLf, lf)
         return d
 
-    def _cbPutTargetAttrs(self, attrs, path, local):
+    def _cbPutTargetAttrs(self, attrs, path, local, resume=False,
+                          delta=False):
         if not stat.S_ISDIR(attrs['permissions']):
             return "Wildcard put with non-directory target."
-        return self._cbPutMultipleNext(None, files, path)
-
-    def _cbPutMultipleNext(self, res, files, path):
-        if isinstance(res, failure.Failure):
-            self._printFailure(res)
-        elif res:
-            self.transport.write(res)
-            if not res.endswith('\n'):
-                self.transport.write('\n')
-        f = None
-        while files and not f:
+        return self._putMultiple(glob.glob(local), path, resume, delta)
+
+    def _putMultiple(self, files, path, resume=False, delta=False):
+        jobs = []
+        for f in files:
             try:
-                f = files.pop(0)
-                lf = file(f, 'r')
-            except:
+                size = os.path.getsize(f)
+            except OSError:
                 self._printFailure(failure.Failure())
-                f = None
-        if not f:
-            return
-        name = os.path.split(f)[1]
-        remote = os.path.join(self.currentDirectory, path, name)
-        log.msg((name, remote, path))
-        flags = filetransfer.FXF_WRITE|filetransfer.FXF_CREAT|filetransfer.FXF_TRUNC
-        d = self.client.openFile(remote, flags, {})
-        d.addCallback(self._cbPutOpenFile, lf)
-        d.addErrback(self._ebCloseLf, lf)
-        d.addBoth(self._cbPutMultipleNext, files, path)
+                continue
+            remote = os.path.join(path, os.path.split(f)[1])
+            jobs.append((self._putFile, (f, remote, resume, delta), size))
+        return self._transferMany(jobs)
+
+    def _putTree(self, local, remote, resume=False, delta=False):
+        """
+        Upload the local directory C{local} and everything below it to the
+        remote directory C{remote}.  Remote directories are created, a level
+        of the tree at a time, before any file is transferred.
+        """
+        levels = []
+        jobs = []
+        for (dirpath, dirnames, filenames) in os.walk(local):
+            relative = os.path.relpath(dirpath, local)
+            if relative == os.curdir:
+                relative = ''
+                depth = 0
+            else:
+                depth = relative.count(os.sep) + 1
+            while len(levels) <= depth:
+                levels.append([])
+            levels[depth].append(os.path.join(remote, relative))
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if not os.path.isfile(path):
+                    continue
+                jobs.append((self._putFile,
+                             (path, os.path.join(remote, relative, name),
+                              resume, delta),
+                             os.path.getsize(path)))
+        if not levels:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+        d = defer.succeed(None)
+        for directories in levels:
+            d.addCallback(self._makeRemoteDirectories, directories)
+        d.addCallback(lambda ignored: self._transferMany(jobs))
         return d
 
-    def _cbPutOpenFile(self, rf, lf):
-        numRequests = self.client.transport.conn.options['requests']
-        if self.useProgressBar:
+    def _makeRemoteDirectories(self, ignored, directories):
+        """
+        Create all of C{directories} at once, ignoring those which already
+        exist.
+        """
+        dl = []
+        for directory in directories:
+            d = self.client.makeDirectory(directory, {})
+            d.addErrback(self._ebMakeRemoteDirectory, directory)
+            dl.append(d)
+        return defer.gatherResults(dl)
+
+    def _ebMakeRemoteDirectory(self, reason, directory):
+        reason.trap(filetransfer.SFTPError)
+        d = self.client.getAttrs(directory)
+        def _cbCheckDirectory(attrs):
+            if not stat.S_ISDIR(attrs['permissions']):
+                return reason
+        d.addCallback(_cbCheckDirectory)
+        return d
+
+    def _cbPutOpenFile(self, rf, lf, showProgress=True):
+        if showProgress and self.useProgressBar:
             lf = FileWrapper(lf)
-        dList = []
-        chunks = []
-        startTime = self.reactor.seconds()
-        for i in range(numRequests):
-            d = self._cbPutWrite(None, rf, lf, chunks, startTime)
-            if d:
-                dList.append(d)
-        dl = defer.DeferredList(dList, fireOnOneErrback=1)
-        dl.addCallback(self._cbPutDone, rf, lf)
-        return dl
-
-    def _cbPutWrite(self, ignored, rf, lf, chunks, startTime):
-        chunk = self._getNextChunk(chunks)
-        start, size = chunk
-        lf.seek(start)
-        data = lf.read(size)
-        if self.useProgressBar:
-            lf.total += len(data)
-            self._printProgressBar(lf, startTime)
-        if data:
-            d = rf.writeChunk(start, data)
-            d.addCallback(self._cbPutWrite, rf, lf, chunks, startTime)
-            return d
-        else:
-            return
+        transfer = filetransfer.PipelinedPut(
+            rf, lf, self.client.transport.conn.options['buffersize'],
+            self.client.transport.conn.options['requests'],
+            self._getProgressReporter(lf, showProgress), self.reactor)
+        d = transfer.start()
+        d.addCallback(self._cbPutDone, rf, lf, showProgress)
+        return d
 
-    def _cbPutDone(self, ignored, rf, lf):
+    def _cbPutDone(self, ignored, rf, lf, showProgress=True):
         lf.close()
         rf.close()
-        if self.useProgressBar:
+        if showProgress and self.useProgressBar:
             self.transport.write('\n')
         return 'Transferred %s to %s' % (lf.name, rf.name)
 
@@ -526,22 +823,45 @@ class StdioClient(basic.LineReceiver):
             fullPath = self.currentDirectory + '/'
         else:
             fullPath = os.path.join(self.currentDirectory, path)
-        d = self._remoteGlob(fullPath)
-        d.addCallback(self._cbDisplayFiles, options)
+        # The listing is written a READDIR batch at a time, as it arrives,
+        # so that large directories start showing at once and are never held
+        # in memory whole.  Only the first batch is held back: if it turns
+        # out to be the whole listing, it is written sorted by name;
+        # otherwise every batch is written in the order the server sent it.
+        held = []
+        streaming = []
+        def visit(files):
+            if streaming:
+                self._displayFiles(files, options, False)
+            elif held:
+                streaming.append(True)
+                self._displayFiles(held.pop(), options, False)
+                self._displayFiles(files, options, False)
+            else:
+                held.append(files)
+        def finish(ignored):
+            if held:
+                self._displayFiles(held.pop(), options)
+        d = self._remoteGlob(fullPath, visit)
+        d.addCallback(finish)
+        d.addCallback(_ignore)
         return d
 
-    def _cbDisplayFiles(self, files, options):
-        files.sort()
+    def _displayFiles(self, files, options, sort=True):
+        """
+        Write a batch of entries from a directory listing, sorted by name
+        unless C{sort} is false.
+        """
+        if sort:
+            files.sort()
         if 'all' not in options:
             files = [f for f in files if not f[0].startswith('.')]
         if 'verbose' in options:
             lines = [f[1] for f in files]
         else:
             lines = [f[0] for f in files]
-        if not lines:
-            return None
-        else:
-            return '\n'.join(lines)
+        if lines:
+            self.transport.write('\n'.join(lines) + '\n')
 
     def cmd_MKDIR(self, path):
         path, rest = self._getFilename(path)
@@ -559,8 +879,51 @@ class StdioClient(basic.LineReceiver):
     def cmd_RM(self, path):
         path, rest = self._getFilename(path)
         path = os.path.join(self.currentDirectory, path)
+        if '*' in path or '?' in path: # wildcard
+            d = self._remoteGlob(path, self._removeMultiple,
+                                 os.path.split(path)[0])
+            return d.addCallback(_ignore)
         return self.client.removeFile(path).addCallback(_ignore)
 
+    def _removeMultiple(self, files, directory):
+        """
+        Remove a batch of entries from a remote directory listing, reporting
+        any which cannot be removed.
+        """
+        dl = []
+        for (filename, longname, attrs) in files:
+            if stat.S_ISDIR(attrs.get('permissions', 0)):
+                continue
+            d = self.client.removeFile(os.path.join(directory, filename))
+            d.addErrback(self._printFailure)
+            dl.append(d)
+        return defer.DeferredList(dl)
+
+    def cmd_FIND(self, rest):
+        path, rest = self._getFilename(rest)
+        pattern = None
+        if path == '-name':
+            path = ''
+            rest = '-name ' + rest
+        if rest:
+            option, rest = self._getFilename(rest)
+            if option != '-name':
+                return "Usage: find [path] [-name pattern]"
+            pattern, rest = self._getFilename(rest)
+        fullPath = os.path.join(self.currentDirectory, path)
+        def visit(relative, entries):
+            lines = []
+            for (name, longname, attrs) in entries:
+                if name in ('.', '..'):
+                    continue
+                if pattern is None or fnmatch.fnmatch(name, pattern):
+                    lines.append(os.path.join(path or '.', relative, name))
+            if lines:
+                lines.sort()
+                self.transport.write('\n'.join(lines) + '\n')
+        d = self.client.walk(fullPath, visit, onError=self._ebWalk)
+        return d.addCallback(_ignore)
+
     def cmd_LLS(self, rest):
         os.system("ls %s" % rest)
 
@@ -587,7 +950,12 @@ chgrp gid path                  Change gid of 'path' to 'gid'.
 chmod mode path                 Change mode of 'path' to 'mode'.
 chown uid path                  Change uid of 'path' to 'uid'.
 exit                            Disconnect from the server.
-get remote-path [local-path]    Get remote file.
+find [path] [-name pattern]     List remote files below path, or those
+                                matching pattern.
+get [-rad] remote-path [local-path]
+                                Get remote file, or directory tree with -r.
+                                -a continues an interrupted download, -d
+                                only fetches the blocks which differ.
 help                            Get a list of available commands.
 lcd path                        Change local directory to 'path'.
 lls [ls-options] [path]         Display local directory listing.
@@ -597,12 +965,17 @@ lpwd                            Print the local working directory.
 ls [-l] [path]                  Display remote directory listing.
 mkdir path                      Create remote directory.
 progress                        Toggle progress bar.
-put local-path [remote-path]    Put local file.
+put [-rad] local-path [remote-path]
+                                Put local file, or directory tree with -r.
+                                -a continues an interrupted upload, -d only
+                                sends the blocks which differ.
 pwd                             Print the remote working directory.
 quit                            Disconnect from the server.
+reget remote-path [local-path]  Synonym for 'get -a'.
 rename oldpath newpath          Rename remote file.
+reput local-path [remote-path]  Synonym for 'put -a'.
 rmdir path                      Remove remote directory.
-rm path                         Remove remote file.
+rm path                         Remove remote file, or files matching a glob.
 version                         Print the SFTP version.
 ?                               Synonym for 'help'.
 """
@@ -633,48 +1006,51 @@ version                         Print the SFTP version.
 
     # accessory functions
 
-    def _remoteGlob(self, fullPath):
+    def _remoteGlob(self, fullPath, visit, *args):
+        """
+        Stream the remote entries matching C{fullPath} to C{visit}, a batch
+        at a time, as they arrive.
+
+        C{fullPath} may name a directory, whose entries all match; a file; or
+        a glob in its last component.
+
+        @param visit: a callable taking a list of C{(filename, longname,
+            attrs)} tuples and C{args}.  It may return a L{Deferred} to delay
+            the next batch.
+
+        @return: a L{Deferred} which fires once every batch has been visited.
+        """
         log.msg('looking up %s' % fullPath)
         head, tail = os.path.split(fullPath)
         if '*' in tail or '?' in tail:
-            glob = 1
+            glob = tail
         else:
-            glob = 0
+            glob = None
         if tail and not glob: # could be file or directory
             # try directory first
             d = self.client.openDirectory(fullPath)
-            d.addCallback(self._cbOpenList, '')
-            d.addErrback(self._ebNotADirectory, head, tail)
+            d.addCallbacks(self._listDirectory, self._ebNotADirectory,
+                           callbackArgs=(None, visit, args),
+                           errbackArgs=(head, tail, visit, args))
         else:
             d = self.client.openDirectory(head)
-            d.addCallback(self._cbOpenList, tail)
+            d.addCallback(self._listDirectory, glob, visit, args)
         return d
 
-    def _cbOpenList(self, directory, glob):
-        files = []
-        d = directory.read()
-        d.addBoth(self._cbReadFile, files, directory, glob)
-        return d
-
-    def _ebNotADirectory(self, reason, path, glob):
+    def _ebNotADirectory(self, reason, path, name, visit, args):
         d = self.client.openDirectory(path)
-        d.addCallback(self._cbOpenList, glob)
+        d.addCallback(self._listDirectory, name, visit, args, True)
         return d
 
-    def _cbReadFile(self, files, l, directory, glob):
-        if not isinstance(files, failure.Failure):
-            if glob:
-                l.extend([f for f in files if fnmatch.fnmatch(f[0], glob)])
-            else:
-                l.extend(files)
-            d = directory.read()
-            d.addBoth(self._cbReadFile, l, directory, glob)
-            return d
-        else:
-            reason = files
-            reason.trap(EOFError)
-            directory.close()
-            return l
+    def _listDirectory(self, directory, glob, visit, args, exact=False):
+        def visitBatch(files):
+            if exact:
+                files = [f for f in files if f[0] == glob]
+            elif glob:
+                files = [f for f in files if fnmatch.fnmatch(f[0], glob)]
+            if files:
+                return visit(files, *args)
+        return directory.readBatches(visitBatch)
 
     def _abbrevSize(self, size):
         # from http://mail.python.org/pipermail/python-list/1999-December/018395.html
@@ -742,6 +1118,28 @@ version                         Print the SFTP version.
         self.transport.write('\r%s%s%s' % (front, spaces, back))
 
 
+    def _getFlags(self, line, allowed):
+        """
+        Strip leading single letter options, such as C{-r} or C{-ad}, from
+        C{line}.
+
+        @param allowed: a string of the option letters the command accepts.
+            A word made of other letters is left in place, as it is probably
+            a filename.
+
+        @return: a tuple of a string of the options given, and the rest of
+            the line.
+        """
+        flags = ''
+        line = line.lstrip()
+        while line.startswith('-'):
+            word = line.split(None, 1)[0]
+            if len(word) < 2 or [c for c in word[1:] if c not in allowed]:
+                break
+            flags += word[1:]
+            line = line[len(word):].lstrip()
+        return flags, line
+
     def _getFilename(self, line):
         line.lstrip()
         if not line:
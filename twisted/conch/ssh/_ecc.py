@@ -0,0 +1,634 @@
+# -*- test-case-name: twisted.conch.test.test_keys -*-
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+Elliptic curve key objects for L{twisted.conch.ssh.keys}: ECDSA over the NIST
+P-256, P-384 and P-521 curves (RFC 5656) and Ed25519 (RFC 8032).
+
+PyCrypto has no elliptic curves, so the arithmetic is done here on Python
+longs.  None of it runs in constant time, so it is only ever used on public
+values: keys can be parsed, including private ones, and can verify
+signatures, but cannot sign.  Multiplying the base point of a curve goes
+through a table of its multiples built the first time the curve is used, so
+that it takes additions only.  Public keys get such a table of their own once
+they have verified a few signatures, since the keys of known hosts and
+authorized users are used over and over.
+"""
+
+import hashlib
+
+from Crypto.Util.number import bytes_to_long, long_to_bytes
+
+
+# The number of signatures a public key verifies before it builds a table of
+# multiples of its point to verify the next ones faster.
+_tableThreshold = 4
+
+
+
+def _bitLength(n):
+    """
+    Return the number of bits of the non-negative integer C{n}, as
+    C{int.bit_length} does from Python 2.7 on.
+    """
+    if not n:
+        return 0
+    return len(bin(n)) - 2
+
+
+
+def _invertAll(values, p):
+    """
+    Return the inverses modulo the prime C{p} of C{values}, which must all be
+    non-zero, for the cost of a single exponentiation.
+    """
+    products = []
+    accumulated = 1
+    for value in values:
+        products.append(accumulated)
+        accumulated = accumulated * value % p
+    inverse = pow(accumulated, p - 2, p)
+    result = [None] * len(values)
+    for i in xrange(len(values) - 1, -1, -1):
+        result[i] = products[i] * inverse % p
+        inverse = inverse * values[i] % p
+    return result
+
+
+
+class _Curve(object):
+    """
+    A NIST prime curve M{y^2 = x^3 - 3x + b} over the integers modulo C{p},
+    whose base point has the prime order C{n}.
+
+    Points are affine C{(x, y)} tuples outside of this class; inside it they
+    are Jacobian C{(X, Y, Z)} tuples, with C{None} as the point at infinity.
+
+    @ivar name: the name of the curve in SSH, like C{'nistp256'}.
+    @ivar sshType: the SSH key type of ECDSA keys on this curve.
+    @ivar hash: the hash function ECDSA signatures on this curve use.
+    @ivar bits: the size of C{n} in bits.
+    @ivar size: the size of a coordinate in bytes.
+    """
+
+    def __init__(self, name, p, n, b, gx, gy, hash):
+        self.name = name
+        self.sshType = 'ecdsa-sha2-' + name
+        self.p = p
+        self.n = n
+        self.b = b
+        self.generator = (gx, gy)
+        self.hash = hash
+        self.bits = _bitLength(n)
+        self.size = (_bitLength(p) + 7) // 8
+        self._table = None
+
+
+    def contains(self, point):
+        """
+        Return whether the affine C{point} lies on the curve.
+        """
+        x, y = point
+        p = self.p
+        return (0 <= x < p and 0 <= y < p and
+                (y * y - x * x * x + 3 * x - self.b) % p == 0)
+
+
+    def encodePoint(self, point):
+        """
+        Return the uncompressed SEC 1 encoding of the affine C{point}.
+        """
+        return ('\x04' + long_to_bytes(point[0], self.size) +
+                long_to_bytes(point[1], self.size))
+
+
+    def decodePoint(self, data):
+        """
+        Return the affine point of an uncompressed SEC 1 encoding.
+
+        @raise ValueError: if C{data} does not encode a point on the curve.
+        """
+        if len(data) != 1 + 2 * self.size or data[0] != '\x04':
+            raise ValueError('bad encoding of a point on %s' % (self.name,))
+        point = (bytes_to_long(data[1:1 + self.size]),
+                 bytes_to_long(data[1 + self.size:]))
+        if not self.contains(point):
+            raise ValueError('point not on %s' % (self.name,))
+        return point
+
+
+    def _double(self, P):
+        if P is None or not P[1]:
+            return None
+        p = self.p
+        X, Y, Z = P
+        delta = Z * Z % p
+        gamma = Y * Y % p
+        beta = X * gamma % p
+        alpha = 3 * (X - delta) * (X + delta) % p
+        X3 = (alpha * alpha - 8 * beta) % p
+        Z3 = ((Y + Z) * (Y + Z) - gamma - delta) % p
+        Y3 = (alpha * (4 * beta - X3) - 8 * gamma * gamma) % p
+        return (X3, Y3, Z3)
+
+
+    def _add(self, P, Q):
+        if P is None:
+            return Q
+        if Q is None:
+            return P
+        p = self.p
+        X1, Y1, Z1 = P
+        X2, Y2, Z2 = Q
+        Z1Z1 = Z1 * Z1 % p
+        Z2Z2 = Z2 * Z2 % p
+        U1 = X1 * Z2Z2 % p
+        S1 = Y1 * Z2 * Z2Z2 % p
+        H = (X2 * Z1Z1 - U1) % p
+        R = (Y2 * Z1 * Z1Z1 - S1) % p
+        if not H:
+            if not R:
+                return self._double(P)
+            return None
+        HH = H * H % p
+        HHH = H * HH % p
+        V = U1 * HH % p
+        X3 = (R * R - HHH - 2 * V) % p
+        Y3 = (R * (V - X3) - S1 * HHH) % p
+        return (X3, Y3, Z1 * Z2 * H % p)
+
+
+    def _addAffine(self, P, q):
+        if P is None:
+            return (q[0], q[1], 1)
+        p = self.p
+        X1, Y1, Z1 = P
+        Z1Z1 = Z1 * Z1 % p
+        H = (q[0] * Z1Z1 - X1) % p
+        R = (q[1] * Z1 * Z1Z1 - Y1) % p
+        if not H:
+            if not R:
+                return self._double(P)
+            return None
+        HH = H * H % p
+        HHH = H * HH % p
+        V = X1 * HH % p
+        X3 = (R * R - HHH - 2 * V) % p
+        Y3 = (R * (V - X3) - Y1 * HHH) % p
+        return (X3, Y3, Z1 * H % p)
+
+
+    def _toAffine(self, P):
+        if P is None:
+            return None
+        p = self.p
+        X, Y, Z = P
+        inverse = pow(Z, p - 2, p)
+        inverse2 = inverse * inverse % p
+        return (X * inverse2 % p, Y * inverse2 * inverse % p)
+
+
+    def table(self, point):
+        """
+        Return, for each 4-bit window of a scalar, the affine multiples
+        C{j * 16 ** window * point} of the affine C{point} for C{j} from 1 to
+        15.
+        """
+        windows = (self.bits + 3) // 4
+        base = (point[0], point[1], 1)
+        points = []
+        for window in xrange(windows):
+            multiple = base
+            points.append(multiple)
+            for j in xrange(14):
+                multiple = self._add(multiple, base)
+                points.append(multiple)
+            for i in xrange(4):
+                base = self._double(base)
+        p = self.p
+        inverses = _invertAll([P[2] for P in points], p)
+        affine = []
+        for (X, Y, Z), inverse in zip(points, inverses):
+            inverse2 = inverse * inverse % p
+            affine.append((X * inverse2 % p, Y * inverse2 * inverse % p))
+        return [affine[window * 15:window * 15 + 15]
+                for window in xrange(windows)]
+
+
+    def multiplyTable(self, k, table):
+        """
+        Return C{k} times the point C{table} was built for, in Jacobian
+        coordinates.
+        """
+        k %= self.n
+        result = None
+        for row in table:
+            digit = k & 15
+            if digit:
+                result = self._addAffine(result, row[digit - 1])
+            k >>= 4
+        return result
+
+
+    def multiplyGenerator(self, k):
+        """
+        Return C{k} times the base point, in Jacobian coordinates.
+        """
+        if self._table is None:
+            self._table = self.table(self.generator)
+        return self.multiplyTable(k, self._table)
+
+
+    def multiply(self, k, point):
+        """
+        Return C{k} times the affine C{point}, in Jacobian coordinates.
+        """
+        k %= self.n
+        multiples = [None, (point[0], point[1], 1)]
+        for i in xrange(14):
+            multiples.append(self._addAffine(multiples[-1], point))
+        result = None
+        for shift in xrange((_bitLength(k) + 3) // 4 * 4 - 4, -4, -4):
+            for i in xrange(4):
+                result = self._double(result)
+            digit = (k >> shift) & 15
+            if digit:
+                result = self._add(result, multiples[digit])
+        return result
+
+
+    def _hashToInteger(self, data):
+        """
+        Return the hash of C{data} and the integer ECDSA signs for it.
+        """
+        digest = self.hash(data).digest()
+        return digest, self._bitsToInteger(digest)
+
+
+    def _bitsToInteger(self, data):
+        value = bytes_to_long(data)
+        excess = len(data) * 8 - self.bits
+        if excess > 0:
+            value >>= excess
+        return value
+
+
+    def verify(self, point, data, r, s, table=None):
+        """
+        Return whether C{(r, s)} is an ECDSA signature of C{data} by the
+        owner of the affine public C{point}, using the L{table} of the point
+        if one is given.
+        """
+        n = self.n
+        if not (0 < r < n and 0 < s < n):
+            return False
+        e = self._hashToInteger(data)[1]
+        w = pow(s, n - 2, n)
+        if table is None:
+            pointMultiple = self.multiply(r * w % n, point)
+        else:
+            pointMultiple = self.multiplyTable(r * w % n, table)
+        result = self._add(self.multiplyGenerator(e * w % n), pointMultiple)
+        if result is None:
+            return False
+        return self._toAffine(result)[0] % n == r
+
+
+
+def _hex(digits):
+    return long(digits, 16)
+
+
+
+curves = {}
+for _curve in [
+    _Curve('nistp256', 2 ** 256 - 2 ** 224 + 2 ** 192 + 2 ** 96 - 1,
+           _hex('ffffffff00000000ffffffffffffffffbce6faada7179e84f3b9cac2'
+                'fc632551'),
+           _hex('5ac635d8aa3a93e7b3ebbd55769886bc651d06b0cc53b0f63bce3c3e'
+                '27d2604b'),
+           _hex('6b17d1f2e12c4247f8bce6e563a440f277037d812deb33a0f4a13945'
+                'd898c296'),
+           _hex('4fe342e2fe1a7f9b8ee7eb4a7c0f9e162bce33576b315ececbb64068'
+                '37bf51f5'),
+           hashlib.sha256),
+    _Curve('nistp384', 2 ** 384 - 2 ** 128 - 2 ** 96 + 2 ** 32 - 1,
+           _hex('ffffffffffffffffffffffffffffffffffffffffffffffffc7634d81'
+                'f4372ddf581a0db248b0a77aecec196accc52973'),
+           _hex('b3312fa7e23ee7e4988e056be3f82d19181d9c6efe8141120314088f'
+                '5013875ac656398d8a2ed19d2a85c8edd3ec2aef'),
+           _hex('aa87ca22be8b05378eb1c71ef320ad746e1d3b628ba79b9859f741e0'
+                '82542a385502f25dbf55296c3a545e3872760ab7'),
+           _hex('3617de4a96262c6f5d9e98bf9292dc29f8f41dbd289a147ce9da3113'
+                'b5f0b8c00a60b1ce1d7e819d7a431d7c90ea0e5f'),
+           hashlib.sha384),
+    _Curve('nistp521', 2 ** 521 - 1,
+           _hex('01ffffffffffffffffffffffffffffffffffffffffffffffffffffff'
+                'fffffffffffa51868783bf2f966b7fcc0148f709a5d03bb5c9b8899c'
+                '47aebb6fb71e91386409'),
+           _hex('0051953eb9618e1c9a1f929a21a0b68540eea2da725b99b315f3b8b4'
+                '89918ef109e156193951ec7e937b1652c0bd3bb1bf073573df883d2c'
+                '34f1ef451fd46b503f00'),
+           _hex('00c6858e06b70404e9cd9e3ecb662395b4429c648139053fb521f828'
+                'af606b4d3dbaa14b5e77efe75928fe1dc127a2ffa8de3348b3c1856a'
+                '429bf97e7e31c2e5bd66'),
+           _hex('011839296a789a3bc0045c8a5fb42c7d1bd998f54449579b446817af'
+                'bd17273e662c97ee72995ef42640c550b9013fad0761353c7086a272'
+                'c24088be94769fd16650'),
+           hashlib.sha512)]:
+    curves[_curve.name] = _curve
+del _curve
+
+
+
+class ECKey(object):
+    """
+    An ECDSA key, public or private.  Private keys only carry their private
+    value along; they cannot sign.
+
+    @ivar parameters: the L{_Curve} of the key.
+    @ivar curve: the SSH key type of the key, like C{'ecdsa-sha2-nistp256'}.
+    @ivar x: the x coordinate of the public point.
+    @ivar y: the y coordinate of the public point.
+    @ivar privateValue: the private scalar, or C{None} for a public key.
+    """
+
+    keydata = ['x', 'y', 'curve', 'privateValue']
+
+    def __init__(self, parameters, x, y, privateValue=None):
+        self.parameters = parameters
+        self.curve = parameters.sshType
+        self.x = x
+        self.y = y
+        self.privateValue = privateValue
+        self._verified = 0
+        self._table = None
+
+
+    def fromEncodedPoint(Class, name, data, privateValue=None):
+        """
+        Build a key from the name of its curve and its encoded public point.
+
+        @raise ValueError: if the curve is unknown, the point is not on it,
+            or C{privateValue} is out of range.  Whether C{privateValue}
+            belongs to the point is not checked, as that would take
+            arithmetic on it.
+        """
+        parameters = curves.get(name)
+        if parameters is None:
+            raise ValueError('unknown curve: %s' % (name,))
+        x, y = parameters.decodePoint(data)
+        if privateValue is not None and not 0 < privateValue < parameters.n:
+            raise ValueError('private value out of range')
+        return Class(parameters, x, y, privateValue)
+    fromEncodedPoint = classmethod(fromEncodedPoint)
+
+
+    def encodedPoint(self):
+        return self.parameters.encodePoint((self.x, self.y))
+
+
+    def has_private(self):
+        return self.privateValue is not None
+
+
+    def publickey(self):
+        return ECKey(self.parameters, self.x, self.y)
+
+
+    def size(self):
+        return self.parameters.bits
+
+
+    def verify(self, data, signature):
+        """
+        Return whether the C{(r, s)} C{signature} of C{data} is valid.
+        """
+        r, s = signature
+        self._verified += 1
+        if self._table is None and self._verified > _tableThreshold:
+            self._table = self.parameters.table((self.x, self.y))
+        return self.parameters.verify(
+            (self.x, self.y), data, r, s, self._table)
+
+
+
+_edP = 2 ** 255 - 19
+_edL = 2 ** 252 + 27742317777372353535851937790883648493
+_edD = -121665 * pow(121666, _edP - 2, _edP) % _edP
+_edD2 = 2 * _edD % _edP
+_edSqrtM1 = pow(2, (_edP - 1) // 4, _edP)
+_edIdentity = (0, 1, 1, 0)
+
+
+
+def _edRecoverX(y, sign):
+    p = _edP
+    if y >= p:
+        raise ValueError('bad Ed25519 point encoding')
+    x2 = (y * y - 1) * pow(_edD * y * y + 1, p - 2, p) % p
+    if not x2:
+        if sign:
+            raise ValueError('bad Ed25519 point encoding')
+        return 0
+    x = pow(x2, (p + 3) // 8, p)
+    if (x * x - x2) % p:
+        x = x * _edSqrtM1 % p
+    if (x * x - x2) % p:
+        raise ValueError('bad Ed25519 point encoding')
+    if x & 1 != sign:
+        x = p - x
+    return x
+
+
+
+def _edAdd(P, Q):
+    """
+    Add two points of the Ed25519 curve in extended coordinates.
+    """
+    p = _edP
+    X1, Y1, Z1, T1 = P
+    X2, Y2, Z2, T2 = Q
+    A = (Y1 - X1) * (Y2 - X2) % p
+    B = (Y1 + X1) * (Y2 + X2) % p
+    C = T1 * _edD2 * T2 % p
+    D = 2 * Z1 * Z2 % p
+    E, F, G, H = B - A, D - C, D + C, B + A
+    return (E * F % p, G * H % p, F * G % p, E * H % p)
+
+
+
+def _edDouble(P):
+    p = _edP
+    X1, Y1, Z1, T1 = P
+    A = X1 * X1 % p
+    B = Y1 * Y1 % p
+    C = 2 * Z1 * Z1 % p
+    H = A + B
+    E = H - (X1 + Y1) * (X1 + Y1)
+    G = A - B
+    F = C + G
+    return (E * F % p, G * H % p, F * G % p, E * H % p)
+
+
+
+def _edEqual(P, Q):
+    p = _edP
+    return ((P[0] * Q[2] - Q[0] * P[2]) % p == 0 and
+            (P[1] * Q[2] - Q[1] * P[2]) % p == 0)
+
+
+
+def _edEncode(P):
+    p = _edP
+    inverse = pow(P[2], p - 2, p)
+    x = P[0] * inverse % p
+    y = P[1] * inverse % p
+    return long_to_bytes(y | ((x & 1) << 255), 32)[::-1]
+
+
+
+def _edDecode(data):
+    if len(data) != 32:
+        raise ValueError('bad Ed25519 point encoding')
+    y = bytes_to_long(data[::-1])
+    sign = y >> 255
+    y &= (1 << 255) - 1
+    x = _edRecoverX(y, sign)
+    return (x, y, 1, x * y % _edP)
+
+
+
+_edBy = 4 * pow(5, _edP - 2, _edP) % _edP
+_edBx = _edRecoverX(_edBy, 0)
+_edBase = (_edBx, _edBy, 1, _edBx * _edBy % _edP)
+_edBaseTable = []
+
+
+
+def _edTable(P):
+    """
+    Return, for each 4-bit window of a scalar, the multiples
+    C{j * 16 ** window * P} of the Ed25519 point C{P} for C{j} from 1 to 15,
+    with their Z coordinates made 1.
+    """
+    p = _edP
+    base = P
+    points = []
+    for window in xrange(64):
+        multiple = base
+        points.append(multiple)
+        for j in xrange(14):
+            multiple = _edAdd(multiple, base)
+            points.append(multiple)
+        for i in xrange(4):
+            base = _edDouble(base)
+    inverses = _invertAll([Q[2] for Q in points], p)
+    affine = []
+    for (X, Y, Z, T), inverse in zip(points, inverses):
+        x, y = X * inverse % p, Y * inverse % p
+        affine.append((x, y, 1, x * y % p))
+    return [affine[window * 15:window * 15 + 15] for window in xrange(64)]
+
+
+
+def _edMultiplyTable(k, table):
+    k %= _edL
+    result = _edIdentity
+    for row in table:
+        digit = k & 15
+        if digit:
+            result = _edAdd(result, row[digit - 1])
+        k >>= 4
+    return result
+
+
+
+def _edMultiplyBase(k):
+    """
+    Return C{k} times the Ed25519 base point, using a table of its multiples
+    built on first use.
+    """
+    if not _edBaseTable:
+        _edBaseTable.extend(_edTable(_edBase))
+    return _edMultiplyTable(k, _edBaseTable)
+
+
+
+def _edMultiply(k, P):
+    multiples = [_edIdentity, P]
+    for i in xrange(14):
+        multiples.append(_edAdd(multiples[-1], P))
+    result = _edIdentity
+    for shift in xrange((_bitLength(k) + 3) // 4 * 4 - 4, -4, -4):
+        for i in xrange(4):
+            result = _edDouble(result)
+        digit = (k >> shift) & 15
+        if digit:
+            result = _edAdd(result, multiples[digit])
+    return result
+
+
+
+def _edHashToInteger(data):
+    return bytes_to_long(hashlib.sha512(data).digest()[::-1])
+
+
+
+class Ed25519Key(object):
+    """
+    An Ed25519 key, public or private.  Private keys only carry their seed
+    along; they cannot sign.
+
+    @ivar a: the encoded public point, 32 bytes.
+    @ivar k: the private seed, 32 bytes, or C{None} for a public key.
+    """
+
+    keydata = ['a', 'k']
+
+    def __init__(self, a, k=None):
+        self._point = _edDecode(a)
+        self.a = a
+        self.k = k
+        self._verified = 0
+        self._table = None
+        if k is not None and len(k) != 32:
+            raise ValueError('bad Ed25519 private seed')
+
+
+    def has_private(self):
+        return self.k is not None
+
+
+    def publickey(self):
+        return Ed25519Key(self.a)
+
+
+    def size(self):
+        return 256
+
+
+    def verify(self, data, signature):
+        """
+        Return whether C{signature} is a valid signature of C{data}.
+        """
+        if len(signature) != 64:
+            return False
+        try:
+            R = _edDecode(signature[:32])
+        except ValueError:
+            return False
+        s = bytes_to_long(signature[32:][::-1])
+        if s >= _edL:
+            return False
+        h = _edHashToInteger(signature[:32] + self.a + data) % _edL
+        self._verified += 1
+        if self._table is None and self._verified > _tableThreshold:
+            self._table = _edTable(self._point)
+        if self._table is None:
+            pointMultiple = _edMultiply(h, self._point)
+        else:
+            pointMultiple = _edMultiplyTable(h, self._table)
+        return _edEqual(_edMultiplyBase(s), _edAdd(R, pointMultiple))
+
@@ -11,7 +11,7 @@ Maintainer: Paul Swartz
 
 import struct
 
-from twisted.conch.ssh.common import NS, getNS, getMP
+from twisted.conch.ssh.common import NS, getNS
 from twisted.conch.error import ConchError, MissingKeyStoreError
 from twisted.conch.ssh import keys
 from twisted.internet import defer, protocol
@@ -205,22 +205,16 @@ class SSHAgentServer(protocol.Protocol):
         """
         Adds a private key to the agent's collection of identities.  On
         subsequent interactions, the private key can be accessed using only the
-        corresponding public key.
+        corresponding public key.  Keys which cannot sign, such as ECDSA and
+        Ed25519 keys, are refused with AGENT_FAILURE.
         """
 
-        # need to pre-read the key data so we can get past it to the comment string
-        keyType, rest = getNS(data)
-        if keyType == 'ssh-rsa':
-            nmp = 6
-        elif keyType == 'ssh-dss':
-            nmp = 5
-        else:
-            raise keys.BadKeyError('unknown blob type: %s' % keyType)
-
-        rest = getMP(rest, nmp)[-1] # ignore the key data for now, we just want the comment
-        comment, rest = getNS(rest) # the comment, tacked onto the end of the key blob
-
-        k = keys.Key.fromString(data, type='private_blob') # not wrapped in NS here
+        # the key blob is not wrapped in an NS, and the comment is tacked
+        # onto its end
+        k, rest = keys.Key._parsePrivateBlob(data)
+        comment, rest = getNS(rest)
+        if not k.canSign():
+            return self.sendResponse(AGENT_FAILURE, '')
         self.factory.keys[k.blob()] = (k, comment)
         self.sendResponse(AGENT_SUCCESS, '')
 
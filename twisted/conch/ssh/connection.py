@@ -466,9 +466,9 @@ class SSHConnection(service.SSHService):
         """
         if channel.localClosed:
             return # we're already closed
-        self.transport.sendPacket(MSG_CHANNEL_DATA, struct.pack('>L',
-                                    self.channelsToRemoteChannel[channel]) +
-                                   common.NS(data))
+        self.transport.sendPacket(MSG_CHANNEL_DATA, struct.pack('>2L',
+                                    self.channelsToRemoteChannel[channel],
+                                    len(data)) + data)
 
     def sendExtendedData(self, channel, dataType, data):
         """
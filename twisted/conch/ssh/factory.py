@@ -29,6 +29,23 @@ class SSHFactory(protocol.Factory):
         'ssh-userauth':userauth.SSHUserAuthServer,
         'ssh-connection':connection.SSHConnection
     }
+
+    # The twisted.conch.ssh.filetransfer.HandlePool shared by the SFTP
+    # sessions of this factory; created when the first session starts.
+    sftpHandlePool = None
+
+    # The twisted.conch.ssh.keys.KeyCache of public keys offered to the
+    # userauth services of this factory; created when first needed.
+    publicKeyCache = None
+
+    # A twisted.conch.ssh.throttle.AuthenticationRateLimiter applied to the
+    # connections and authentication attempts of this factory, or None.
+    authRateLimiter = None
+
+    # The twisted.conch.ssh.throttle.TimerWheel running the login timeouts
+    # and failure delays of the userauth services; created when first needed.
+    authTimerWheel = None
+
     def startFactory(self):
         """
         Check for public and private keys.
@@ -70,10 +87,24 @@ class SSHFactory(protocol.Factory):
         @param addr: The address at which the server will listen.
 
         @rtype: L{twisted.conch.ssh.SSHServerTransport}
-        @return: The built transport.
+        @return: The built transport, or C{None} to refuse the connection if
+            C{authRateLimiter} has run out of attempts for its host.
         """
+        host = getattr(addr, 'host', None)
+        if (self.authRateLimiter is not None and
+            not self.authRateLimiter.allowConnection(host)):
+            log.msg('refusing connection from %s: too many failed logins'
+                    % (host,))
+            return None
         t = protocol.Factory.buildProtocol(self, addr)
-        t.supportedPublicKeys = self.privateKeys.keys()
+        # Elliptic curve host keys can be loaded but cannot sign, so they are
+        # not offered.
+        t.supportedPublicKeys = [keyType for keyType, key
+                                 in self.privateKeys.items()
+                                 if key.canSign()]
+        if 'ssh-rsa' in t.supportedPublicKeys:
+            # An RSA host key can also sign with SHA-2, which clients prefer.
+            t.supportedPublicKeys[:0] = ['rsa-sha2-512', 'rsa-sha2-256']
         if not self.primes:
             log.msg('disabling diffie-hellman-group-exchange because we '
                     'cannot find moduli file')
@@ -4,13 +4,17 @@
 # See LICENSE for details.
 
 
-import struct, errno
+import os, struct, errno, bisect, hashlib
+from UserDict import DictMixin
+from collections import deque
+from stat import S_ISDIR
 
-from twisted.internet import defer, protocol
+from twisted.internet import defer, protocol, threads, task
 from twisted.python import failure, log
 
 from common import NS, getNS
 from twisted.conch.interfaces import ISFTPServer, ISFTPFile
+from twisted.conch._compat import OrderedDict
 
 from zope import interface
 
@@ -58,70 +62,364 @@ class FileTransferBase(protocol.Protocol):
                 self._ebStatus(failure.Failure(e), reqId)
 
     def _parseAttributes(self, data):
-        flags ,= struct.unpack('!L', data[:4])
-        attrs = {}
-        data = data[4:]
-        if flags & FILEXFER_ATTR_SIZE == FILEXFER_ATTR_SIZE:
-            size ,= struct.unpack('!Q', data[:8])
-            attrs['size'] = size
-            data = data[8:]
-        if flags & FILEXFER_ATTR_OWNERGROUP == FILEXFER_ATTR_OWNERGROUP:
-            uid, gid = struct.unpack('!2L', data[:8])
-            attrs['uid'] = uid
-            attrs['gid'] = gid
-            data = data[8:]
-        if flags & FILEXFER_ATTR_PERMISSIONS == FILEXFER_ATTR_PERMISSIONS:
-            perms ,= struct.unpack('!L', data[:4])
-            attrs['permissions'] = perms
-            data = data[4:]
-        if flags & FILEXFER_ATTR_ACMODTIME == FILEXFER_ATTR_ACMODTIME:
-            atime, mtime = struct.unpack('!2L', data[:8])
-            attrs['atime'] = atime
-            attrs['mtime'] = mtime
-            data = data[8:]
-        if flags & FILEXFER_ATTR_EXTENDED == FILEXFER_ATTR_EXTENDED:
-            extended_count ,= struct.unpack('!L', data[:4])
-            data = data[4:]
-            for i in xrange(extended_count):
-                extended_type, data = getNS(data)
-                extended_data, data = getNS(data)
-                attrs['ext_%s' % extended_type] = extended_data
-        return attrs, data
+        attrs, offset = _parseAttributesAt(data, 0)
+        return attrs, data[offset:]
 
     def _packAttributes(self, attrs):
-        flags = 0
-        data = ''
-        if 'size' in attrs:
-            data += struct.pack('!Q', attrs['size'])
-            flags |= FILEXFER_ATTR_SIZE
-        if 'uid' in attrs and 'gid' in attrs:
-            data += struct.pack('!2L', attrs['uid'], attrs['gid'])
-            flags |= FILEXFER_ATTR_OWNERGROUP
-        if 'permissions' in attrs:
-            data += struct.pack('!L', attrs['permissions'])
-            flags |= FILEXFER_ATTR_PERMISSIONS
-        if 'atime' in attrs and 'mtime' in attrs:
-            data += struct.pack('!2L', attrs['atime'], attrs['mtime'])
-            flags |= FILEXFER_ATTR_ACMODTIME
-        extended = []
-        for k in attrs:
-            if k.startswith('ext_'):
-                ext_type = NS(k[4:])
-                ext_data = NS(attrs[k])
-                extended.append(ext_type+ext_data)
-        if extended:
-            data += struct.pack('!L', len(extended))
-            data += ''.join(extended)
-            flags |= FILEXFER_ATTR_EXTENDED
-        return struct.pack('!L', flags) + data
+        return _packAttributes(attrs)
+
+class HandlePool:
+    """
+    Accounting of the handles, and so of the file descriptors, held open by
+    all of the L{FileTransferServer}s of one factory, so that a single
+    session cannot use up every descriptor the process has.
+
+    @ivar limit: the number of handles which may be open at once, or C{None}
+        if there is no limit.
+    @ivar inUse: the number of handles open now.
+    @ivar refused: the number of handles refused because the pool was full.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.inUse = 0
+        self.refused = 0
+
+
+    def fromResourceLimit(cls, fraction=0.5):
+        """
+        Create a pool allowing C{fraction} of the process's soft limit on
+        open file descriptors, or an unlimited pool if the platform has no
+        such limit.
+        """
+        try:
+            import resource
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        except (ImportError, AttributeError, ValueError):
+            return cls()
+        if soft == resource.RLIM_INFINITY or soft <= 0:
+            return cls()
+        return cls(max(1, int(soft * fraction)))
+    fromResourceLimit = classmethod(fromResourceLimit)
+
+
+    def acquire(self):
+        """
+        Take a handle from the pool.
+
+        @return: C{True} if a handle was taken, C{False} if the pool is full.
+        """
+        if self.limit is not None and self.inUse >= self.limit:
+            self.refused += 1
+            return False
+        self.inUse += 1
+        return True
+
+
+    def release(self):
+        """
+        Return a handle taken with L{acquire} to the pool.
+        """
+        self.inUse -= 1
+
+
+
+class HandleTable:
+    """
+    The files and directories a L{FileTransferServer} has open, keyed by the
+    handles sent to its client.
+
+    Handles are short strings made from a counter, so they are cheap to make
+    and a handle is never reused for another object during a session.  The
+    table remembers the order in which handles were last used: when it is
+    full the least recently used handle is closed to make room if it has
+    been idle for at least C{evictionAge} seconds, and if C{idleTimeout} is
+    set, handles left idle that long are closed by a timed reaper.
+
+    @ivar files: a dict mapping handles to open L{ISFTPFile}s.
+    @ivar directories: a dict mapping handles to lists of an open directory
+        and the iterator over its entries.
+    @ivar maxHandles: the number of handles which may be open at once, or 0
+        if there is no limit besides C{pool}.
+    @ivar idleTimeout: the number of seconds a handle may be unused before it
+        is closed, or C{None} to keep idle handles open.
+    @ivar evictionAge: the number of seconds a handle must have been unused
+        before it is closed to make room for a new one, or C{None} to refuse
+        new handles when the table is full.
+    @ivar pool: the L{HandlePool} shared with other sessions, or C{None}.
+    @ivar clock: the L{IReactorTime} provider used to time idle handles.
+    @ivar evicted: the number of handles closed to make room for others.
+    @ivar reaped: the number of handles closed for being idle.
+    """
+
+    def __init__(self, maxHandles=0, idleTimeout=None, evictionAge=None,
+                 pool=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.files = {}
+        self.directories = {}
+        self.maxHandles = maxHandles
+        self.idleTimeout = idleTimeout
+        self.evictionAge = evictionAge
+        self.pool = pool
+        self.clock = clock
+        self.evicted = 0
+        self.reaped = 0
+        self._counter = 0
+        self._lastUsed = OrderedDict()
+        self._reaper = None
+
+
+    def __len__(self):
+        return len(self._lastUsed)
+
+
+    def __contains__(self, handle):
+        return handle in self._lastUsed
+
+
+    def addFile(self, fileObj):
+        """
+        Open a handle for C{fileObj}.
+
+        @raise SFTPError: if there is no room for another handle.
+        @return: the new handle.
+        """
+        handle = self._newHandle()
+        self.files[handle] = fileObj
+        return handle
+
+
+    def addDirectory(self, dirObj):
+        """
+        Open a handle for C{dirObj}.
+
+        @raise SFTPError: if there is no room for another handle.
+        @return: the new handle.
+        """
+        handle = self._newHandle()
+        self.directories[handle] = [dirObj, iter(dirObj)]
+        return handle
+
+
+    def getFile(self, handle):
+        """
+        Return the file opened as C{handle}, marking the handle as used.
+
+        @raise KeyError: if C{handle} is not an open file.
+        """
+        fileObj = self.files[handle]
+        self._touch(handle)
+        return fileObj
+
+
+    def getDirectory(self, handle):
+        """
+        Return the directory and the iterator over its entries opened as
+        C{handle}, marking the handle as used.
+
+        @raise KeyError: if C{handle} is not an open directory.
+        """
+        entry = self.directories[handle]
+        self._touch(handle)
+        return entry
+
+
+    def remove(self, handle):
+        """
+        Forget C{handle} without closing what it refers to.  Removing a
+        handle which is not open, for instance one closed by the reaper while
+        the client was closing it, does nothing.
+        """
+        if self._lastUsed.pop(handle, None) is None:
+            return
+        self.files.pop(handle, None)
+        self.directories.pop(handle, None)
+        if self.pool is not None:
+            self.pool.release()
+
+
+    def close(self, handle):
+        """
+        Close the file or directory opened as C{handle} and forget it.
+
+        @return: a L{Deferred} which fires when the object is closed.
+        """
+        if handle in self.files:
+            obj = self.files[handle]
+        else:
+            obj = self.directories[handle][0]
+        self.remove(handle)
+        d = defer.maybeDeferred(obj.close)
+        d.addErrback(log.err, 'Error closing SFTP handle')
+        return d
+
+
+    def closeAll(self):
+        """
+        Close every open handle and stop the reaper.
+        """
+        for handle in list(self._lastUsed):
+            self.close(handle)
+        if self._reaper is not None and self._reaper.active():
+            self._reaper.cancel()
+        self._reaper = None
+
+
+    def _newHandle(self):
+        """
+        Reserve a handle, closing the least recently used one if the table is
+        full and it has been idle long enough.
+        """
+        if self.maxHandles and len(self._lastUsed) >= self.maxHandles:
+            if not self._evict():
+                raise SFTPError(FX_FAILURE, 'too many open handles')
+        if self.pool is not None and not self.pool.acquire():
+            if not (self._evict() and self.pool.acquire()):
+                raise SFTPError(FX_FAILURE,
+                                'too many open handles on the server')
+        self._counter += 1
+        handle = '%x' % (self._counter,)
+        self._lastUsed[handle] = self.clock.seconds()
+        self._scheduleReaper()
+        return handle
+
+
+    def _touch(self, handle):
+        del self._lastUsed[handle]
+        self._lastUsed[handle] = self.clock.seconds()
+
+
+    def _evict(self):
+        """
+        Close the least recently used handle if it has been idle for at least
+        C{evictionAge} seconds.
+
+        @return: whether a handle was closed.
+        """
+        if self.evictionAge is None or not self._lastUsed:
+            return False
+        handle, lastUsed = next(self._lastUsed.iteritems())
+        if self.clock.seconds() - lastUsed < self.evictionAge:
+            return False
+        self.evicted += 1
+        self.close(handle)
+        return True
+
+
+    def _scheduleReaper(self):
+        if (self.idleTimeout is None or self._reaper is not None
+            or not self._lastUsed):
+            return
+        lastUsed = next(self._lastUsed.itervalues())
+        delay = max(0, lastUsed + self.idleTimeout - self.clock.seconds())
+        self._reaper = self.clock.callLater(delay, self._reap)
+
+
+    def _reap(self):
+        """
+        Close the handles which have been idle for C{idleTimeout} seconds.
+        Since the handles are kept in the order they were last used, only the
+        expired ones and the first live one are looked at.
+        """
+        self._reaper = None
+        deadline = self.clock.seconds() - self.idleTimeout
+        while self._lastUsed:
+            handle, lastUsed = next(self._lastUsed.iteritems())
+            if lastUsed > deadline:
+                break
+            self.reaped += 1
+            self.close(handle)
+        self._scheduleReaper()
+
+
 
 class FileTransferServer(FileTransferBase):
+    """
+    The server side of the SFTP protocol, which translates requests into
+    calls on an L{ISFTPServer}.
+
+    Besides forwarding unknown extended requests to
+    L{ISFTPServer.extendedRequest}, this implements a few widely used
+    extensions itself, listed in C{extensions}.
+
+    @cvar extensions: a dict mapping the name of each built-in extension to
+        a tuple of the data advertised for it in FXP_VERSION and the name of
+        the method which handles it.
+    @cvar checkFileAlgorithms: the hash algorithms, in order of preference,
+        supported by the I{check-file} extensions.
+    @cvar maxPacketLength: the largest packet accepted, as advertised by
+        I{limits@openssh.com}.
+    @cvar maxReadLength: the largest read length advertised by
+        I{limits@openssh.com}, also used to size I{copy-data} and
+        I{check-file} reads.
+    @cvar maxWriteLength: the largest write length advertised by
+        I{limits@openssh.com}.
+    @cvar maxOpenHandles: the number of handles a client may have open, as
+        advertised by I{limits@openssh.com}, or 0 if there is no limit.
+    @cvar handleIdleTimeout: the number of seconds a handle may be unused
+        before the server closes it, or C{None} to keep idle handles open.
+    @cvar handleEvictionAge: the number of seconds a handle must have been
+        unused before it is closed to make room for a new one when the client
+        has C{maxOpenHandles} open, or C{None} to refuse new handles instead.
+    @cvar clock: the L{IReactorTime} provider used to time idle handles, or
+        C{None} for the global reactor.
+
+    @ivar handles: the L{HandleTable} of the files and directories open on
+        this session.
+    @ivar openFiles: the dict of open files of C{handles}.
+    @ivar openDirs: the dict of open directories of C{handles}.
+    """
+
+    extensions = {
+        'copy-data': ('1', '_extendedCopyData'),
+        'check-file': ('md5,sha1,sha224,sha256,sha384,sha512', None),
+        'check-file-handle': ('1', '_extendedCheckFileHandle'),
+        'check-file-name': ('1', '_extendedCheckFileName'),
+        'limits@openssh.com': ('1', '_extendedLimits'),
+        'fsync@openssh.com': ('1', '_extendedFsync'),
+        'statvfs@openssh.com': ('2', '_extendedStatVFS'),
+        }
+
+    checkFileAlgorithms = ('md5', 'sha1', 'sha224', 'sha256', 'sha384',
+                           'sha512')
+
+    maxPacketLength = 256 * 1024
+    maxReadLength = 255 * 1024
+    maxWriteLength = 255 * 1024
+    maxOpenHandles = 1024
+    handleIdleTimeout = None
+    handleEvictionAge = 300
+    clock = None
+
+    _deferToThread = staticmethod(threads.deferToThread)
+    _cooperate = staticmethod(task.cooperate)
 
     def __init__(self, data=None, avatar=None):
         FileTransferBase.__init__(self)
         self.client = ISFTPServer(avatar) # yay interfaces
-        self.openFiles = {}
-        self.openDirs = {}
+        self.handles = HandleTable(self.maxOpenHandles,
+                                   self.handleIdleTimeout,
+                                   self.handleEvictionAge,
+                                   self._getHandlePool(avatar), self.clock)
+        self.openFiles = self.handles.files
+        self.openDirs = self.handles.directories
+
+    def _getHandlePool(self, avatar):
+        """
+        Return the L{HandlePool} shared by the sessions of the factory
+        C{avatar} connected to, creating it from the process's descriptor
+        limit if the factory has none yet, or C{None} if the avatar is not
+        connected to a factory.
+        """
+        transport = getattr(getattr(avatar, 'conn', None), 'transport', None)
+        factory = getattr(transport, 'factory', None)
+        if factory is None:
+            return None
+        pool = getattr(factory, 'sftpHandlePool', None)
+        if pool is None:
+            pool = factory.sftpHandlePool = HandlePool.fromResourceLimit()
+        return pool
 
     def packet_INIT(self, data):
         version ,= struct.unpack('!L', data[:4])
@@ -132,7 +430,13 @@ class FileTransferServer(FileTransferBase):
             ext_name, data = getNS(data)
             ext_data, data = getNS(data)
             ext[ext_name] = ext_data
-        our_ext = self.client.gotVersion(version, ext)
+        our_ext = {}
+        for (name, (extData, methodName)) in self.extensions.items():
+            if name == 'statvfs@openssh.com' and not hasattr(self.client,
+                                                             'statVFS'):
+                continue
+            our_ext[name] = extData
+        our_ext.update(self.client.gotVersion(version, ext))
         our_ext_data = ""
         for (k,v) in our_ext.items():
             our_ext_data += NS(k) + NS(v)
@@ -152,11 +456,12 @@ class FileTransferServer(FileTransferBase):
         d.addErrback(self._ebStatus, requestId, "open failed")
 
     def _cbOpenFile(self, fileObj, requestId):
-        fileId = str(hash(fileObj))
-        if fileId in self.openFiles:
-            raise KeyError, 'id already open'
-        self.openFiles[fileId] = fileObj
-        self.sendPacket(FXP_HANDLE, requestId + NS(fileId))
+        try:
+            handle = self.handles.addFile(fileObj)
+        except SFTPError:
+            fileObj.close()
+            raise
+        self.sendPacket(FXP_HANDLE, requestId + NS(handle))
 
     def packet_CLOSE(self, data):
         requestId = data[:4]
@@ -164,12 +469,12 @@ class FileTransferServer(FileTransferBase):
         handle, data = getNS(data)
         assert data == '', 'still have data in CLOSE: %s' % repr(data)
         if handle in self.openFiles:
-            fileObj = self.openFiles[handle]
+            fileObj = self.handles.getFile(handle)
             d = defer.maybeDeferred(fileObj.close)
             d.addCallback(self._cbClose, handle, requestId)
             d.addErrback(self._ebStatus, requestId, "close failed")
         elif handle in self.openDirs:
-            dirObj = self.openDirs[handle][0]
+            dirObj = self.handles.getDirectory(handle)[0]
             d = defer.maybeDeferred(dirObj.close)
             d.addCallback(self._cbClose, handle, requestId, 1)
             d.addErrback(self._ebStatus, requestId, "close failed")
@@ -177,10 +482,7 @@ class FileTransferServer(FileTransferBase):
             self._ebClose(failure.Failure(KeyError()), requestId)
 
     def _cbClose(self, result, handle, requestId, isDir = 0):
-        if isDir:
-            del self.openDirs[handle]
-        else:
-            del self.openFiles[handle]
+        self.handles.remove(handle)
         self._sendStatus(requestId, FX_OK, 'file closed')
 
     def packet_READ(self, data):
@@ -192,7 +494,7 @@ class FileTransferServer(FileTransferBase):
         if handle not in self.openFiles:
             self._ebRead(failure.Failure(KeyError()), requestId)
         else:
-            fileObj = self.openFiles[handle]
+            fileObj = self.handles.getFile(handle)
             d = defer.maybeDeferred(fileObj.readChunk, offset, length)
             d.addCallback(self._cbRead, requestId)
             d.addErrback(self._ebStatus, requestId, "read failed")
@@ -200,7 +502,12 @@ class FileTransferServer(FileTransferBase):
     def _cbRead(self, result, requestId):
         if result == '': # python's read will return this for EOF
             raise EOFError()
-        self.sendPacket(FXP_DATA, requestId + NS(result))
+        # Send the header and the chunk as separate fragments rather than
+        # going through sendPacket, so the chunk is not copied into two
+        # intermediate strings on its way to the channel.
+        self.transport.writeSequence([
+            struct.pack('!LB', len(result) + 9, FXP_DATA), requestId,
+            struct.pack('!L', len(result)), result])
 
     def packet_WRITE(self, data):
         requestId = data[:4]
@@ -213,7 +520,7 @@ class FileTransferServer(FileTransferBase):
         if handle not in self.openFiles:
             self._ebWrite(failure.Failure(KeyError()), requestId)
         else:
-            fileObj = self.openFiles[handle]
+            fileObj = self.handles.getFile(handle)
             d = defer.maybeDeferred(fileObj.writeChunk, offset, writeData)
             d.addCallback(self._cbStatus, requestId, "write succeeded")
             d.addErrback(self._ebStatus, requestId, "write failed")
@@ -266,10 +573,11 @@ class FileTransferServer(FileTransferBase):
         d.addErrback(self._ebStatus, requestId, "opendir failed")
 
     def _cbOpenDirectory(self, dirObj, requestId):
-        handle = str(hash(dirObj))
-        if handle in self.openDirs:
-            raise KeyError, "already opened this directory"
-        self.openDirs[handle] = [dirObj, iter(dirObj)]
+        try:
+            handle = self.handles.addDirectory(dirObj)
+        except SFTPError:
+            dirObj.close()
+            raise
         self.sendPacket(FXP_HANDLE, requestId + NS(handle))
 
     def packet_READDIR(self, data):
@@ -280,7 +588,7 @@ class FileTransferServer(FileTransferBase):
         if handle not in self.openDirs:
             self._ebStatus(failure.Failure(KeyError()), requestId)
         else:
-            dirObj, dirIter = self.openDirs[handle]
+            dirObj, dirIter = self.handles.getDirectory(handle)
             d = defer.maybeDeferred(self._scanDirectory, dirIter, [])
             d.addCallback(self._cbSendDirectory, requestId)
             d.addErrback(self._ebStatus, requestId, "scan directory failed")
@@ -305,13 +613,12 @@ class FileTransferServer(FileTransferBase):
         return self._scanDirectory(dirIter, f)
 
     def _cbSendDirectory(self, result, requestId):
-        data = ''
+        data = [requestId, struct.pack('!L', len(result))]
         for (filename, longname, attrs) in result:
-            data += NS(filename)
-            data += NS(longname)
-            data += self._packAttributes(attrs)
-        self.sendPacket(FXP_NAME, requestId +
-                        struct.pack('!L', len(result))+data)
+            data.append(NS(filename))
+            data.append(NS(longname))
+            data.append(_packAttributes(attrs))
+        self.sendPacket(FXP_NAME, ''.join(data))
 
     def packet_STAT(self, data, followLinks = 1):
         requestId = data[:4]
@@ -334,7 +641,7 @@ class FileTransferServer(FileTransferBase):
             self._ebStatus(failure.Failure(KeyError('%s not in self.openFiles'
                                         % handle)), requestId)
         else:
-            fileObj = self.openFiles[handle]
+            fileObj = self.handles.getFile(handle)
             d = defer.maybeDeferred(fileObj.getAttrs)
             d.addCallback(self._cbStat, requestId)
             d.addErrback(self._ebStatus, requestId, 'fstat failed')
@@ -363,7 +670,7 @@ class FileTransferServer(FileTransferBase):
         if handle not in self.openFiles:
             self._ebStatus(failure.Failure(KeyError()), requestId)
         else:
-            fileObj = self.openFiles[handle]
+            fileObj = self.handles.getFile(handle)
             d = defer.maybeDeferred(fileObj.setAttrs, attrs)
             d.addCallback(self._cbStatus, requestId, 'fsetstat succeeded')
             d.addErrback(self._ebStatus, requestId, 'fsetstat failed')
@@ -402,12 +709,187 @@ class FileTransferServer(FileTransferBase):
         requestId = data[:4]
         data = data[4:]
         extName, extData = getNS(data)
-        d = defer.maybeDeferred(self.client.extendedRequest, extName, extData)
+        methodName = self.extensions.get(extName, (None, None))[1]
+        if methodName is not None:
+            d = defer.maybeDeferred(getattr(self, methodName), extData)
+        else:
+            d = defer.maybeDeferred(self.client.extendedRequest, extName,
+                                    extData)
         d.addCallback(self._cbExtended, requestId)
         d.addErrback(self._ebStatus, requestId, 'extended %s failed' % extName)
 
     def _cbExtended(self, data, requestId):
-        self.sendPacket(FXP_EXTENDED_REPLY, requestId + data)
+        if data is None:
+            self._sendStatus(requestId, FX_OK, 'extended request succeeded')
+        else:
+            self.sendPacket(FXP_EXTENDED_REPLY, requestId + data)
+
+    def _getOpenFile(self, handle):
+        """
+        Return the open file for C{handle}, or raise L{SFTPError} if there is
+        none.
+        """
+        try:
+            return self.handles.getFile(handle)
+        except KeyError:
+            raise SFTPError(FX_FAILURE, 'invalid handle')
+
+    def _extendedCopyData(self, data):
+        """
+        Handle I{copy-data}: copy a range of one open file into another
+        without sending the data over the connection.
+        """
+        readHandle, data = getNS(data)
+        readOffset, length = struct.unpack('!QQ', data[:16])
+        writeHandle, data = getNS(data[16:])
+        writeOffset, = struct.unpack('!Q', data[:8])
+        return self._copyData(self._getOpenFile(readHandle), readOffset,
+                              length, self._getOpenFile(writeHandle),
+                              writeOffset)
+
+    def _copyData(self, readFile, readOffset, length, writeFile, writeOffset):
+        """
+        Copy C{length} bytes, or everything up to the end of the file if
+        C{length} is 0, from C{readFile} to C{writeFile}.
+
+        The chunks are copied by a cooperative task, so that a large copy
+        with a backend whose reads and writes do not wait does not keep the
+        reactor from serving other connections until it is done.
+        """
+        progress = [0, False] # bytes copied, end of file reached
+        def write(chunk):
+            if not chunk:
+                progress[1] = True
+                return
+            d = defer.maybeDeferred(writeFile.writeChunk,
+                                    writeOffset + progress[0], chunk)
+            progress[0] += len(chunk)
+            return d
+        def eof(reason):
+            reason.trap(EOFError)
+            progress[1] = True
+        def copy():
+            while not progress[1] and (not length or progress[0] < length):
+                toRead = self.maxReadLength
+                if length:
+                    toRead = min(toRead, length - progress[0])
+                d = defer.maybeDeferred(readFile.readChunk,
+                                        readOffset + progress[0], toRead)
+                yield d.addCallbacks(write, eof)
+        d = self._cooperate(copy()).whenDone()
+        return d.addCallback(lambda ignored: None)
+
+    def _extendedCheckFileHandle(self, data):
+        """
+        Handle I{check-file-handle}: hash ranges of an open file.
+        """
+        handle, data = getNS(data)
+        return self._checkFile(self._getOpenFile(handle), data)
+
+    def _extendedCheckFileName(self, data):
+        """
+        Handle I{check-file-name}: hash ranges of the named file.
+        """
+        filename, data = getNS(data)
+        d = defer.maybeDeferred(self.client.openFile, filename, FXF_READ, {})
+        def _cbOpened(fileObj):
+            d = self._checkFile(fileObj, data)
+            d.addBoth(_close, fileObj)
+            return d
+        def _close(result, fileObj):
+            d = defer.maybeDeferred(fileObj.close)
+            d.addCallback(lambda ignored: result)
+            return d
+        return d.addCallback(_cbOpened)
+
+    def _checkFile(self, fileObj, data):
+        """
+        Hash C{fileObj} as described by the body of a I{check-file} request
+        following the handle or name.  The hashing itself is done in a thread
+        so that large ranges do not block the reactor.
+        """
+        algorithms, data = getNS(data)
+        offset, length, blockSize = struct.unpack('!QQL', data[:20])
+        for algorithm in algorithms.split(','):
+            if algorithm in self.checkFileAlgorithms:
+                break
+        else:
+            raise NotImplementedError(
+                'no supported hash algorithm in %r' % (algorithms,))
+        if blockSize and blockSize < 256:
+            raise SFTPError(FX_FAILURE, 'block size too small')
+        def check():
+            digests = []
+            current = hashlib.new(algorithm)
+            blockLeft = blockSize
+            position = offset
+            end = length and offset + length or None
+            while end is None or position < end:
+                toRead = self.maxReadLength
+                if end is not None:
+                    toRead = min(toRead, end - position)
+                if blockSize:
+                    toRead = min(toRead, blockLeft)
+                try:
+                    chunk = yield fileObj.readChunk(position, toRead)
+                except EOFError:
+                    break
+                if not chunk:
+                    break
+                yield self._deferToThread(current.update, chunk)
+                position += len(chunk)
+                if blockSize:
+                    blockLeft -= len(chunk)
+                    if not blockLeft:
+                        digests.append(current.digest())
+                        current = hashlib.new(algorithm)
+                        blockLeft = blockSize
+            if not blockSize or blockLeft != blockSize:
+                digests.append(current.digest())
+            defer.returnValue(
+                NS('check-file') + NS(algorithm) + ''.join(digests))
+        return defer.inlineCallbacks(check)()
+
+    def _extendedLimits(self, data):
+        """
+        Handle I{limits@openssh.com}: tell the client how large its requests
+        may be.
+        """
+        return struct.pack('!4Q', self.maxPacketLength, self.maxReadLength,
+                           self.maxWriteLength, self.maxOpenHandles)
+
+    def _extendedFsync(self, data):
+        """
+        Handle I{fsync@openssh.com}: flush an open file to disk, if the file
+        object has an C{fsync} method.
+        """
+        handle, data = getNS(data)
+        fileObj = self._getOpenFile(handle)
+        if getattr(fileObj, 'fsync', None) is None:
+            raise NotImplementedError('fsync not supported')
+        d = defer.maybeDeferred(fileObj.fsync)
+        d.addCallback(lambda ignored: None)
+        return d
+
+    def _extendedStatVFS(self, data):
+        """
+        Handle I{statvfs@openssh.com}: return file system statistics for a
+        path, if the L{ISFTPServer} has a C{statVFS} method returning an
+        object like the result of C{os.statvfs}.
+        """
+        path, data = getNS(data)
+        if getattr(self.client, 'statVFS', None) is None:
+            raise NotImplementedError('statvfs not supported')
+        d = defer.maybeDeferred(self.client.statVFS, path)
+        d.addCallback(self._cbStatVFS)
+        return d
+
+    def _cbStatVFS(self, result):
+        return struct.pack(
+            '!11Q', result.f_bsize, result.f_frsize, result.f_blocks,
+            result.f_bfree, result.f_bavail, result.f_files, result.f_ffree,
+            result.f_favail, getattr(result, 'f_fsid', 0), result.f_flag,
+            result.f_namemax)
 
     def _cbStatus(self, result, requestId, msg = "request succeeded"):
         self._sendStatus(requestId, FX_OK, msg)
@@ -455,16 +937,82 @@ class FileTransferServer(FileTransferBase):
         """
         Clean all opened files and directories.
         """
-        for fileObj in self.openFiles.values():
-            fileObj.close()
-        self.openFiles = {}
-        for (dirObj, dirIter) in self.openDirs.values():
-            dirObj.close()
-        self.openDirs = {}
+        self.handles.closeAll()
+
+
+
+class LatencyHistogram:
+    """
+    A histogram of the time taken to answer one type of request.
+
+    @ivar buckets: the upper bounds, in seconds, of each bucket.
+    @ivar counts: the number of requests which fell in each bucket, with an
+        extra bucket at the end for those slower than the last bound.
+    @ivar count: the number of requests recorded.
+    @ivar total: the sum of their latencies.
+    @ivar maximum: the longest latency recorded.
+    """
+
+    buckets = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5,
+               10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+
+    def record(self, latency):
+        """
+        Record a request which took C{latency} seconds.
+        """
+        self.counts[bisect.bisect_left(self.buckets, latency)] += 1
+        self.count += 1
+        self.total += latency
+        if latency > self.maximum:
+            self.maximum = latency
+
+
+    def mean(self):
+        """
+        Return the mean latency, or 0 if nothing has been recorded.
+        """
+        if not self.count:
+            return 0.0
+        return self.total / self.count
 
 
 
 class FileTransferClient(FileTransferBase):
+    """
+    The client side of the SFTP protocol.
+
+    Each request returns a L{Deferred}.  Cancelling it, or letting it time out,
+    forgets the request; the server's reply is dropped when it arrives.
+
+    @ivar requestTimeout: if not C{None}, the number of seconds after which an
+        unanswered request fails with L{defer.TimeoutError}.
+    @ivar maxOutstandingRequests: if not C{None}, the most requests sent to
+        the server and not yet answered.  Further requests are queued until
+        one is answered.
+    @ivar clock: the L{IReactorTime} provider used to time requests.
+
+    @ivar openRequests: a dictionary mapping the IDs of requests which have
+        been sent to their L{Deferred}s.
+    @ivar queuedRequests: the number of requests waiting to be sent.
+    @ivar sentRequests: the number of requests sent so far.
+    @ivar timedOutRequests: the number of requests which timed out.
+    @ivar cancelledRequests: the number of requests cancelled.
+    @ivar droppedReplies: the number of replies to timed out or cancelled
+        requests which were ignored.
+    @ivar latencies: a dictionary mapping the names of request types, such as
+        C{'READ'}, to a L{LatencyHistogram} of the replies to them.
+    """
+
+    requestTimeout = None
+    maxOutstandingRequests = None
+    clock = None
 
     def __init__(self, extData = {}):
         """
@@ -473,9 +1021,21 @@ class FileTransferClient(FileTransferBase):
         """
         FileTransferBase.__init__(self)
         self.extData = {}
+        self.serverExtensions = {}
         self.counter = 0
         self.openRequests = {} # id -> Deferred
-        self.wasAFile = {} # Deferred -> 1 TERRIBLE HACK
+        if self.clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+        self._requests = {} # id -> (type, start time, timeout call)
+        self._abandoned = {} # id -> type, of timed out or cancelled requests
+        self._queue = OrderedDict() # Deferred -> (type, data), oldest first
+        self._requestIds = {} # Deferred -> id, of the requests sent
+        self.sentRequests = 0
+        self.timedOutRequests = 0
+        self.cancelledRequests = 0
+        self.droppedReplies = 0
+        self.latencies = {}
 
     def connectionMade(self):
         data = struct.pack('!L', max(self.versions))
@@ -483,20 +1043,135 @@ class FileTransferClient(FileTransferBase):
             data += NS(k) + NS(v)
         self.sendPacket(FXP_INIT, data)
 
+    def queuedRequests(self):
+        return len(self._queue)
+    queuedRequests = property(queuedRequests)
+
+
     def _sendRequest(self, msg, data):
-        data = struct.pack('!L', self.counter) + data
-        d = defer.Deferred()
-        self.openRequests[self.counter] = d
+        d = defer.Deferred(self._cancelRequest)
+        if (self.maxOutstandingRequests is not None and
+            len(self.openRequests) >= self.maxOutstandingRequests):
+            self._queue[d] = (msg, data)
+        else:
+            self._send(msg, data, d)
+        return d
+
+    def _send(self, msg, data, d):
+        requestId = self.counter
         self.counter += 1
-        self.sendPacket(msg, data)
+        self.openRequests[requestId] = d
+        self._requestIds[d] = requestId
+        timeoutCall = None
+        if self.requestTimeout is not None:
+            timeoutCall = self.clock.callLater(
+                self.requestTimeout, self._timeoutRequest, requestId)
+        self._requests[requestId] = (msg, self.clock.seconds(), timeoutCall)
+        self.sentRequests += 1
+        self.sendPacket(msg, struct.pack('!L', requestId) + data)
+
+    def _sendQueued(self):
+        while self._queue and (
+            self.maxOutstandingRequests is None or
+            len(self.openRequests) < self.maxOutstandingRequests):
+            d, (msg, data) = self._queue.popitem(last=False)
+            self._send(msg, data, d)
+
+    def _forgetRequest(self, requestId):
+        """
+        Stop waiting for the reply to a request, and send the next queued
+        request in its place.
+        """
+        d = self.openRequests.pop(requestId)
+        del self._requestIds[d]
+        msg, start, timeoutCall = self._requests.pop(requestId)
+        if timeoutCall is not None and timeoutCall.active():
+            timeoutCall.cancel()
+        self._sendQueued()
         return d
 
+    def _cancelRequest(self, d):
+        """
+        Cancel the request whose L{Deferred} is C{d}: drop it from the queue
+        if it has not been sent yet, or else abandon it, ignoring its reply
+        when it comes.
+        """
+        if self._queue.pop(d, None) is not None:
+            self.cancelledRequests += 1
+            return
+        requestId = self._requestIds.get(d)
+        if requestId is not None:
+            self._abandon(requestId)
+            self.cancelledRequests += 1
+
+    def _abandon(self, requestId):
+        """
+        Forget a request which timed out or was cancelled, remembering its
+        type until its reply arrives.
+        """
+        self._abandoned[requestId] = self._requests[requestId][0]
+        return self._forgetRequest(requestId)
+
+    def _timeoutRequest(self, requestId):
+        d = self._abandon(requestId)
+        self.timedOutRequests += 1
+        d.errback(defer.TimeoutError(
+            'no reply to SFTP request %i after %s seconds' % (
+                requestId, self.requestTimeout)))
+
     def _parseRequest(self, data):
         (id,) = struct.unpack('!L', data[:4])
-        d = self.openRequests[id]
-        del self.openRequests[id]
+        if id in self._abandoned:
+            # The request timed out or was cancelled; nothing is waiting for
+            # this reply.  A handle opened regardless is closed again, so
+            # that it does not stay open on the server.
+            msg = self._abandoned.pop(id)
+            self.droppedReplies += 1
+            d = defer.Deferred()
+            if msg in (FXP_OPEN, FXP_OPENDIR):
+                d.addCallback(self._closeAbandonedHandle)
+            d.addErrback(lambda ignored: None)
+            return d, data[4:]
+        if id in self._requests:
+            msg, start, timeoutCall = self._requests[id]
+            name = self.packetTypes.get(msg, msg)
+            histogram = self.latencies.get(name)
+            if histogram is None:
+                histogram = self.latencies[name] = LatencyHistogram()
+            histogram.record(self.clock.seconds() - start)
+            d = self._forgetRequest(id)
+        else:
+            d = self.openRequests.pop(id)
+            self._requestIds.pop(d, None)
         return d, data[4:]
 
+    def _closeAbandonedHandle(self, handle):
+        """
+        Close a handle the server opened for a request which was abandoned.
+        """
+        d = self._sendRequest(FXP_CLOSE, NS(handle))
+        d.addErrback(lambda ignored: None)
+
+    def connectionLost(self, reason):
+        """
+        Fail every request which is still waiting for a reply, or to be sent.
+
+        Everything is forgotten, and every timeout cancelled, before any
+        request is failed, so nothing is sent over the lost connection.
+        """
+        for msg, start, timeoutCall in self._requests.itervalues():
+            if timeoutCall is not None and timeoutCall.active():
+                timeoutCall.cancel()
+        requests = self.openRequests.values()
+        requests.extend(self._queue)
+        self._requests.clear()
+        self.openRequests.clear()
+        self._requestIds.clear()
+        self._abandoned.clear()
+        self._queue.clear()
+        for d in requests:
+            d.errback(reason)
+
     def openFile(self, filename, flags, attrs):
         """
         Open a file.
@@ -527,9 +1202,17 @@ class FileTransferClient(FileTransferBase):
         """
         data = NS(filename) + struct.pack('!L', flags) + self._packAttributes(attrs)
         d = self._sendRequest(FXP_OPEN, data)
-        self.wasAFile[d] = (1, filename) # HACK
+        d.addCallback(self._cbOpenHandle, ClientFile, filename)
         return d
 
+    def _cbOpenHandle(self, handle, handleClass, name):
+        """
+        Wrap the handle from a successful OPEN or OPENDIR request.
+        """
+        cb = handleClass(self, handle)
+        cb.name = name
+        return cb
+
     def removeFile(self, filename):
         """
         Remove the given file.
@@ -608,9 +1291,73 @@ class FileTransferClient(FileTransferBase):
         @param path: the directory to open.
         """
         d = self._sendRequest(FXP_OPENDIR, NS(path))
-        self.wasAFile[d] = (0, path)
+        d.addCallback(self._cbOpenHandle, ClientDirectory, path)
         return d
 
+    def listDirectory(self, path, visit, prefetch=2):
+        """
+        Stream the entries of a directory, a batch at a time.
+
+        C{visit} is called with each list of C{(filename, longname, attrs)}
+        tuples as it arrives, so only one batch need be held in memory at
+        once.  If it returns a L{Deferred}, the next batch is not passed to
+        it until that fires, although up to C{prefetch} READDIR requests
+        stay in flight.
+
+        @param path: the directory to list.
+        @param visit: a callable taking a list of entries.
+        @param prefetch: the number of READDIR requests to keep in flight.
+
+        @return: a L{Deferred} which fires with C{None} once every entry has
+            been visited and the directory closed, or with the first error.
+        """
+        d = self.openDirectory(path)
+        d.addCallback(lambda directory: directory.readBatches(visit, prefetch))
+        return d
+
+    def walk(self, top, visit, prefetch=2, onError=None):
+        """
+        Stream the entries of a directory and every directory below it.
+
+        Directories are listed one at a time, depth first, with
+        L{listDirectory}; symbolic links to directories are not followed.
+
+        @param top: the directory to start from.
+        @param visit: a callable taking the path of a directory, relative to
+            C{top} (C{''} for C{top} itself), and a list of entries from it.
+            It may return a L{Deferred} to delay the next batch.
+        @param onError: if not C{None}, a callable taking the relative path
+            of a directory which could not be listed and the L{Failure}, and
+            the walk carries on with the other directories.  Otherwise the
+            first error ends the walk.
+
+        @return: a L{Deferred} which fires with C{None} once every directory
+            has been listed.
+        """
+        directories = ['']
+        def listNext(ignored=None):
+            if not directories:
+                return None
+            relative = directories.pop()
+            subdirectories = []
+            def visitBatch(batch):
+                for (filename, longname, attrs) in batch:
+                    if (filename not in ('.', '..') and
+                        S_ISDIR(attrs.get('permissions', 0))):
+                        subdirectories.append(
+                            relative and relative + '/' + filename or filename)
+                return visit(relative, batch)
+            d = self.listDirectory(top.rstrip('/') + '/' + relative,
+                                   visitBatch, prefetch)
+            if onError is not None:
+                d.addErrback(lambda reason: onError(relative, reason))
+            def listed(ignored):
+                subdirectories.reverse()
+                directories.extend(subdirectories)
+                return listNext()
+            return d.addCallback(listed)
+        return listNext()
+
     def getAttrs(self, path, followLinks=0):
         """
         Return the attributes for the given path.
@@ -693,6 +1440,99 @@ class FileTransferClient(FileTransferBase):
         """
         return self._sendRequest(FXP_EXTENDED, NS(request) + data)
 
+    def copyData(self, readFile, readOffset, length, writeFile, writeOffset):
+        """
+        Copy data between two open files on the server, using the
+        I{copy-data} extension.
+
+        This method returns a Deferred that is called back when the copy is
+        complete.
+
+        @param readFile: the L{ClientFile} to copy from.
+        @param readOffset: the offset in C{readFile} to start copying from.
+        @param length: the number of bytes to copy, or 0 to copy up to the
+        end of C{readFile}.
+        @param writeFile: the L{ClientFile} to copy to.
+        @param writeOffset: the offset in C{writeFile} to copy to.
+        """
+        data = (readFile.handle + struct.pack('!QQ', readOffset, length) +
+                writeFile.handle + struct.pack('!Q', writeOffset))
+        return self.extendedRequest('copy-data', data)
+
+    def checkFile(self, fileOrPath, algorithms, offset=0, length=0,
+                  blockSize=0):
+        """
+        Have the server hash a file, using the I{check-file-handle} or
+        I{check-file-name} extension.
+
+        This method returns a Deferred that is called back with a tuple of
+        the name of the algorithm the server used and a list of digests, one
+        for each block.
+
+        @param fileOrPath: a L{ClientFile}, or the path of the file as a
+        string.
+        @param algorithms: a list of hash algorithm names, in order of
+        preference.
+        @param offset: the offset to start hashing at.
+        @param length: the number of bytes to hash, or 0 to hash up to the
+        end of the file.
+        @param blockSize: the number of bytes covered by each digest, or 0 to
+        return a single digest for the whole range.
+        """
+        if isinstance(fileOrPath, ClientFile):
+            request, data = 'check-file-handle', fileOrPath.handle
+        else:
+            request, data = 'check-file-name', NS(fileOrPath)
+        data += NS(','.join(algorithms)) + struct.pack(
+            '!QQL', offset, length, blockSize)
+        d = self.extendedRequest(request, data)
+        d.addCallback(self._cbCheckFile)
+        return d
+
+    def _cbCheckFile(self, data):
+        name, algorithm, data = getNS(data, 2)
+        size = hashlib.new(algorithm).digest_size
+        return algorithm, [data[i:i + size]
+                           for i in range(0, len(data), size)]
+
+    def getLimits(self):
+        """
+        Ask the server for its request size limits, using the
+        I{limits@openssh.com} extension.
+
+        This method returns a Deferred that is called back with a dictionary
+        with the keys C{'maxPacketLength'}, C{'maxReadLength'},
+        C{'maxWriteLength'} and C{'maxOpenHandles'}.  A value of 0 means the
+        server does not impose that limit.
+        """
+        d = self.extendedRequest('limits@openssh.com', '')
+        d.addCallback(self._cbGetLimits)
+        return d
+
+    def _cbGetLimits(self, data):
+        return dict(zip(('maxPacketLength', 'maxReadLength', 'maxWriteLength',
+                         'maxOpenHandles'), struct.unpack('!4Q', data[:32])))
+
+    def statVFS(self, path):
+        """
+        Return file system statistics for a path, using the
+        I{statvfs@openssh.com} extension.
+
+        This method returns a Deferred that is called back with a dictionary
+        keyed on the names of the fields of the result of C{os.statvfs}.
+
+        @param path: the path to return statistics for as a string.
+        """
+        d = self.extendedRequest('statvfs@openssh.com', NS(path))
+        d.addCallback(self._cbStatVFS)
+        return d
+
+    def _cbStatVFS(self, data):
+        return dict(zip(('f_bsize', 'f_frsize', 'f_blocks', 'f_bfree',
+                         'f_bavail', 'f_files', 'f_ffree', 'f_favail',
+                         'f_fsid', 'f_flag', 'f_namemax'),
+                        struct.unpack('!11Q', data[:88])))
+
     def packet_VERSION(self, data):
         version, = struct.unpack('!L', data[:4])
         data = data[4:]
@@ -702,6 +1542,7 @@ class FileTransferClient(FileTransferBase):
             v, data = getNS(data)
             d[k]=v
         self.version = version
+        self.serverExtensions = d
         self.gotServerVersion(version, d)
 
     def packet_STATUS(self, data):
@@ -728,13 +1569,7 @@ class FileTransferClient(FileTransferBase):
 
     def packet_HANDLE(self, data):
         d, data = self._parseRequest(data)
-        isFile, name = self.wasAFile.pop(d)
-        if isFile:
-            cb = ClientFile(self, getNS(data)[0])
-        else:
-            cb = ClientDirectory(self, getNS(data)[0])
-        cb.name = name
-        d.callback(cb)
+        d.callback(getNS(data)[0])
 
     def packet_DATA(self, data):
         d, data = self._parseRequest(data)
@@ -742,13 +1577,19 @@ class FileTransferClient(FileTransferBase):
 
     def packet_NAME(self, data):
         d, data = self._parseRequest(data)
-        count, = struct.unpack('!L', data[:4])
-        data = data[4:]
+        count, = _uint32.unpack_from(data, 0)
+        offset = 4
         files = []
-        for i in range(count):
-            filename, data = getNS(data)
-            longname, data = getNS(data)
-            attrs, data = self._parseAttributes(data)
+        unpack = _uint32.unpack_from
+        for i in xrange(count):
+            length, = unpack(data, offset)
+            offset += 4
+            filename = data[offset:offset + length]
+            offset += length
+            length, = unpack(data, offset)
+            offset += 4
+            longname = data[offset:offset + length]
+            attrs, offset = _parseAttributesAt(data, offset + length)
             files.append((filename, longname, attrs))
         d.callback(files)
 
@@ -796,6 +1637,13 @@ class ClientFile:
         data = self.handle + self.parent._packAttributes(attrs)
         return self.parent._sendRequest(FXP_FSTAT, data)
 
+    def fsync(self):
+        """
+        Flush the file to disk on the server, using the I{fsync@openssh.com}
+        extension.
+        """
+        return self.parent.extendedRequest('fsync@openssh.com', self.handle)
+
 class ClientDirectory:
 
     def __init__(self, parent, handle):
@@ -832,6 +1680,941 @@ class ClientDirectory:
         self.next = _
         return reason
 
+    def readBatches(self, visit, prefetch=2):
+        """
+        Pass each batch of entries in this directory to C{visit} as it
+        arrives, then close the directory.
+
+        See L{FileTransferClient.listDirectory}, which opens the directory
+        and calls this.
+
+        @return: a L{Deferred} which fires with C{None} once every entry has
+            been visited and the directory closed, or with the first error.
+        """
+        batches = self.batches(prefetch)
+        def read():
+            try:
+                d = batches.next()
+            except StopIteration:
+                return defer.succeed(None)
+            d.addCallbacks(visitBatch, ebBatch)
+            return d
+        def visitBatch(batch):
+            d = defer.maybeDeferred(visit, batch)
+            d.addCallback(lambda ignored: read())
+            return d
+        def ebBatch(reason):
+            reason.trap(EOFError)
+        def close(result):
+            batches.stop()
+            d = self.close()
+            d.addBoth(lambda ignored: result)
+            return d
+        return read().addBoth(close)
+
+    def batches(self, prefetch=2):
+        """
+        Return an iterator over the batches of entries in this directory, as
+        the server sends them in reply to READDIR requests.
+
+        Each call to C{next} returns a L{Deferred} which fires with a list of
+        C{(filename, longname, attrs)} tuples, or fails with L{EOFError} at
+        the end of the directory, after which C{next} raises
+        L{StopIteration}.  Up to C{prefetch} READDIR requests are kept in
+        flight, so the next batch is usually on its way while the last one
+        is being handled.
+
+        @rtype: L{DirectoryBatches}
+        """
+        return DirectoryBatches(self, prefetch)
+
+
+class DirectoryBatches:
+    """
+    An iterator over the batches of entries in a L{ClientDirectory}.  See
+    L{ClientDirectory.batches}.
+    """
+
+    def __init__(self, directory, prefetch=2):
+        self.directory = directory
+        self.prefetch = max(1, prefetch)
+        self._pending = deque()
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._done:
+            raise StopIteration
+        while len(self._pending) < self.prefetch:
+            self._pending.append(self.directory.read())
+        d = self._pending.popleft()
+        d.addErrback(self._ebRead)
+        return d
+
+    def _ebRead(self, reason):
+        if reason.check(EOFError):
+            self._done = True
+            # Every READDIR sent after the one which reached the end of the
+            # directory also fails with EOFError.
+            self.stop()
+        return reason
+
+    def stop(self):
+        """
+        Stop reading, and cancel any READDIR requests still in flight.
+        """
+        self._done = True
+        while self._pending:
+            d = self._pending.popleft()
+            d.addErrback(lambda reason: None)
+            d.cancel()
+
+
+class _Holes:
+    """
+    A set of disjoint, half-open byte ranges, kept sorted by offset.
+
+    L{PipelinedGet} uses this to remember the parts of a file which still
+    have to be requested after a server returned less data than was asked
+    for.  Ranges are found with L{bisect} and adjacent ranges are merged, so
+    a transfer with many short reads does not degrade into linear scans.
+    """
+
+    def __init__(self):
+        self._starts = []
+        self._ends = {}
+
+
+    def __len__(self):
+        return len(self._starts)
+
+
+    def add(self, start, end):
+        """
+        Add the range C{[start, end)}, merging it with any range it touches.
+        """
+        if start >= end:
+            return
+        i = bisect.bisect_left(self._starts, start)
+        if i and self._ends[self._starts[i - 1]] >= start:
+            i -= 1
+            start = self._starts.pop(i)
+            end = max(end, self._ends.pop(start))
+        while i < len(self._starts) and self._starts[i] <= end:
+            end = max(end, self._ends.pop(self._starts.pop(i)))
+        self._starts.insert(i, start)
+        self._ends[start] = end
+
+
+    def pop(self, maxLength):
+        """
+        Remove at most C{maxLength} bytes from the front of the lowest range.
+
+        @return: a tuple of C{(offset, length)}.
+        """
+        start = self._starts.pop(0)
+        end = self._ends.pop(start)
+        if end - start > maxLength:
+            self._starts.insert(0, start + maxLength)
+            self._ends[start + maxLength] = end
+            end = start + maxLength
+        return start, end - start
+
+
+    def truncate(self, offset):
+        """
+        Forget every byte at or beyond C{offset}.
+        """
+        i = bisect.bisect_left(self._starts, offset)
+        for start in self._starts[i:]:
+            del self._ends[start]
+        del self._starts[i:]
+        if i and self._ends[self._starts[i - 1]] > offset:
+            self._ends[self._starts[i - 1]] = offset
+
+
+
+class _PipelinedTransfer:
+    """
+    Base class for transfers which keep several requests outstanding on a
+    single L{ClientFile}.
+
+    @ivar bytesTransferred: the number of bytes read or written so far.
+    @ivar startTime: the time, according to C{clock}, the transfer started.
+    @ivar stopTime: the time the transfer finished, or C{None}.
+    @ivar size: the size of the file being copied, if it is known.
+    @ivar skipped: the number of bytes of the file which did not need to be
+        copied because the destination already had them.
+    """
+
+    size = None
+    skipped = 0
+
+    def __init__(self, remoteFile, localFile, bufferSize=32768, requests=5,
+                 progress=None, clock=None, offset=0, ranges=None):
+        """
+        @param remoteFile: the L{ISFTPFile} to transfer to or from, usually a
+            L{ClientFile}.
+        @param localFile: a local file object supporting C{seek}, C{read} and
+            C{write}.
+        @param bufferSize: the number of bytes to ask for in each request.
+        @param requests: the number of requests to keep in flight at once.
+        @param progress: if not C{None}, a callable which is called with the
+            transfer each time a request completes.
+        @param clock: the L{IReactorTime} provider used to time the transfer.
+        @param offset: the offset to start copying from.
+        @param ranges: if not C{None}, a list of C{(offset, length)} tuples
+            giving the only parts of the file to copy.  C{offset} is ignored.
+        """
+        self.remoteFile = remoteFile
+        self.localFile = localFile
+        self.bufferSize = int(bufferSize)
+        self.requests = max(1, int(requests))
+        self.progress = progress
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.bytesTransferred = 0
+        self.startTime = None
+        self.stopTime = None
+        self._offset = offset
+        self._holes = None
+        if ranges is not None:
+            self._holes = _Holes()
+            for (start, length) in ranges:
+                self._holes.add(start, start + length)
+        self._outstanding = 0
+        self._filling = False
+        self._failure = None
+        self._finished = None
+        self._pending = set()
+
+
+    def start(self):
+        """
+        Start the transfer.
+
+        @return: a L{Deferred} which fires with this transfer once every
+            request has completed, or fails with the first error.  Cancelling
+            it cancels the transfer.
+        """
+        self.startTime = self.clock.seconds()
+        self._finished = defer.Deferred(lambda d: self.cancel())
+        d = self._finished
+        self._fill()
+        return d
+
+
+    def cancel(self):
+        """
+        Stop the transfer and cancel every outstanding request, so that a
+        L{FileTransferClient} forgets them.  The L{Deferred} returned by
+        L{start} fails with L{defer.CancelledError}.
+        """
+        if self._failure is None:
+            self._failure = failure.Failure(defer.CancelledError())
+        for d in list(self._pending):
+            d.cancel()
+
+
+    def _track(self, d):
+        """
+        Remember C{d}, the L{Deferred} of an outstanding request, until it
+        fires.
+        """
+        self._pending.add(d)
+        def _untrack(result):
+            self._pending.discard(d)
+            return result
+        return d.addBoth(_untrack)
+
+
+    def elapsed(self):
+        """
+        Return the number of seconds the transfer has been (or was) running.
+        """
+        if self.startTime is None:
+            return 0.0
+        stopTime = self.stopTime
+        if stopTime is None:
+            stopTime = self.clock.seconds()
+        return stopTime - self.startTime
+
+
+    def throughput(self):
+        """
+        Return the average transfer rate so far, in bytes per second.
+        """
+        elapsed = self.elapsed()
+        if not elapsed:
+            return 0.0
+        return self.bytesTransferred / elapsed
+
+
+    def _issue(self):
+        """
+        Send the next request, if there is one.
+
+        @return: C{True} if a request was sent, C{False} otherwise.
+        """
+        raise NotImplementedError()
+
+
+    def _fill(self):
+        """
+        Send requests until C{self.requests} are outstanding, and finish the
+        transfer once nothing is left in flight.
+        """
+        if self._filling:
+            # A request completed synchronously; the outer call will carry on
+            # filling the pipeline.
+            return
+        self._filling = True
+        try:
+            while self._failure is None and self._outstanding < self.requests:
+                try:
+                    if not self._issue():
+                        break
+                except:
+                    self._failure = failure.Failure()
+        finally:
+            self._filling = False
+        if not self._outstanding and self._finished is not None:
+            self.stopTime = self.clock.seconds()
+            d, self._finished = self._finished, None
+            if self._failure is not None:
+                d.errback(self._failure)
+            else:
+                d.callback(self)
+
+
+    def _requestDone(self, size):
+        self._outstanding -= 1
+        self.bytesTransferred += size
+        if self.progress is not None:
+            try:
+                self.progress(self)
+            except:
+                log.err()
+        self._fill()
+
+
+    def _ebRequest(self, reason):
+        self._outstanding -= 1
+        if self._failure is None:
+            self._failure = reason
+        self._fill()
+
+
+
+class PipelinedGet(_PipelinedTransfer):
+    """
+    Download a remote file with several READ requests outstanding at once.
+
+    Data is written to the local file at the offset it was read from, so
+    replies may arrive in any order.  Short reads leave a hole which is
+    requested again, and the first FX_EOF status marks the end of the file.
+    """
+
+    def __init__(self, *args, **kw):
+        _PipelinedTransfer.__init__(self, *args, **kw)
+        self._sequential = self._holes is None
+        if self._sequential:
+            self._holes = _Holes()
+        self._eof = None
+
+
+    def _issue(self):
+        if self._holes:
+            offset, length = self._holes.pop(self.bufferSize)
+        elif self._sequential and self._eof is None:
+            offset, length = self._offset, self.bufferSize
+            self._offset += length
+        else:
+            return False
+        self._outstanding += 1
+        d = self._track(self.remoteFile.readChunk(offset, length))
+        d.addCallbacks(self._cbRead, self._ebRead,
+                       callbackArgs=(offset, length), errbackArgs=(offset,))
+        d.addErrback(self._ebRequest)
+        return True
+
+
+    def _cbRead(self, data, offset, length):
+        if not data:
+            return self._ebRead(failure.Failure(EOFError()), offset)
+        self.localFile.seek(offset)
+        self.localFile.write(data)
+        if len(data) < length:
+            self._holes.add(offset + len(data), offset + length)
+        self._requestDone(len(data))
+
+
+    def _ebRead(self, reason, offset):
+        if not reason.check(EOFError):
+            return reason
+        if self._eof is None or offset < self._eof:
+            self._eof = offset
+            self._holes.truncate(offset)
+        self._requestDone(0)
+
+
+
+class PipelinedPut(_PipelinedTransfer):
+    """
+    Upload a local file with several WRITE requests outstanding at once.
+    """
+
+    _eof = False
+
+    def _issue(self):
+        if self._holes is not None:
+            if not self._holes:
+                return False
+            offset, length = self._holes.pop(self.bufferSize)
+        elif self._eof:
+            return False
+        else:
+            offset, length = self._offset, self.bufferSize
+        self.localFile.seek(offset)
+        data = self.localFile.read(length)
+        if not data:
+            self._eof = True
+            if self._holes is not None:
+                self._holes.truncate(offset)
+            return False
+        if self._holes is None:
+            self._offset += len(data)
+        self._outstanding += 1
+        d = self._track(self.remoteFile.writeChunk(offset, data))
+        d.addCallbacks(self._cbWrite, self._ebRequest,
+                       callbackArgs=(len(data),))
+        return True
+
+
+    def _cbWrite(self, ignored, size):
+        self._requestDone(size)
+
+
+
+def resumeOffset(source, target):
+    """
+    Work out where a copy of a file can be continued from.
+
+    A partial copy can be continued if it is no longer than the source and
+    was modified no earlier than the source was; otherwise the source has
+    changed since the copy was started.  Modification times are compared
+    as they are, so clocks which disagree may cause a needless restart.
+
+    @param source: the attributes of the file being copied, as a dictionary
+        with the keys C{'size'} and, optionally, C{'mtime'}.
+    @param target: the attributes of the existing copy, or C{None} if there
+        is none.
+
+    @return: the number of bytes of the existing copy to keep.
+    """
+    if not target or 'size' not in target or 'size' not in source:
+        return 0
+    if target['size'] > source['size']:
+        return 0
+    if target.get('mtime', 0) < source.get('mtime', 0):
+        return 0
+    return target['size']
+
+
+
+def _mergeBlocks(blocks):
+    """
+    Merge adjacent C{(offset, length)} tuples from a sorted list.
+    """
+    merged = []
+    for (offset, length) in blocks:
+        if merged and merged[-1][0] + merged[-1][1] == offset:
+            merged[-1] = (merged[-1][0], merged[-1][1] + length)
+        else:
+            merged.append((offset, length))
+    return merged
+
+
+
+class _BlockComparer:
+    """
+    A write-only file which compares what is written to it with a local file
+    instead of storing it, so that L{PipelinedGet} can find the blocks of a
+    remote file which differ from a local one.
+    """
+
+    def __init__(self, localFile, blockSize):
+        self.localFile = localFile
+        self.blockSize = blockSize
+        self.changed = set()
+        self._offset = 0
+
+
+    def seek(self, offset):
+        self._offset = offset
+
+
+    def write(self, data):
+        offset = self._offset
+        self.localFile.seek(offset)
+        local = self.localFile.read(len(data))
+        if local != data:
+            end = offset + len(data)
+            block = offset // self.blockSize
+            while block * self.blockSize < end:
+                start = max(block * self.blockSize, offset)
+                stop = min((block + 1) * self.blockSize, end)
+                if (local[start - offset:stop - offset] !=
+                    data[start - offset:stop - offset]):
+                    self.changed.add(block)
+                block += 1
+        self._offset += len(data)
+
+
+
+_checkFilePreference = ('sha256', 'sha1', 'md5')
+
+# The most digests asked for in one check-file request, which keeps the
+# reply well under the usual 256k limit on packet size.
+_maxCheckFileBlocks = 4096
+
+def changedBlocks(client, remoteFile, localFile, length, blockSize=65536,
+                  bufferSize=32768, requests=5, clock=None):
+    """
+    Find the blocks of the first C{length} bytes of a remote file which
+    differ from a local file.
+
+    If the server supports the I{check-file} extension it hashes its blocks
+    and only the digests are sent.  Otherwise the remote blocks are read and
+    compared locally, which only saves the cost of writing the blocks which
+    have not changed.
+
+    @param client: the L{FileTransferClient} C{remoteFile} was opened with.
+    @param remoteFile: the remote L{ClientFile}.
+    @param localFile: a local file object supporting C{seek} and C{read}.
+    @param length: the number of bytes to compare.
+    @param blockSize: the smallest block to compare.  Larger blocks are
+        used if comparing a large file would take too many digests.
+
+    @return: a L{Deferred} which fires with a sorted list of
+        C{(offset, length)} tuples covering the blocks which differ.
+    """
+    if length <= 0:
+        return defer.succeed([])
+    blockSize = max(blockSize, -(-length // _maxCheckFileBlocks))
+    offsets = range(0, length, blockSize)
+    advertised = client.serverExtensions.get('check-file')
+    if advertised is None:
+        return _compareByReading(remoteFile, localFile, length, blockSize,
+                                 offsets, bufferSize, requests, clock)
+    advertised = advertised.split(',')
+    algorithms = [a for a in _checkFilePreference if a in advertised]
+    d = client.checkFile(remoteFile, algorithms or advertised, 0, length,
+                         blockSize)
+    def _cbDigests((algorithm, digests)):
+        changed = []
+        for i, offset in enumerate(offsets):
+            size = min(blockSize, length - offset)
+            localFile.seek(offset)
+            digest = hashlib.new(algorithm, localFile.read(size)).digest()
+            if i >= len(digests) or digests[i] != digest:
+                changed.append((offset, size))
+        return _mergeBlocks(changed)
+    def _ebDigests(reason):
+        reason.trap(SFTPError)
+        return _compareByReading(remoteFile, localFile, length, blockSize,
+                                 offsets, bufferSize, requests, clock)
+    return d.addCallbacks(_cbDigests, _ebDigests)
+
+
+
+def _compareByReading(remoteFile, localFile, length, blockSize, offsets,
+                      bufferSize, requests, clock):
+    comparer = _BlockComparer(localFile, blockSize)
+    transfer = PipelinedGet(remoteFile, comparer, bufferSize, requests,
+                            clock=clock, ranges=[(0, length)])
+    def _cbCompared(ignored):
+        return _mergeBlocks([
+                (offset, min(blockSize, length - offset))
+                for (i, offset) in enumerate(offsets)
+                if i in comparer.changed])
+    return transfer.start().addCallback(_cbCompared)
+
+
+
+def _localAttrs(path):
+    """
+    Return the size and modification time of a local file, or C{None} if it
+    does not exist.
+    """
+    try:
+        s = os.stat(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    return {'size': s.st_size, 'mtime': int(s.st_mtime)}
+
+
+
+def _closeAfter(d, *files):
+    """
+    Close C{files} once C{d} has fired, passing its result through.  Errors
+    closing the files are logged.
+    """
+    def _close(result):
+        dl = defer.DeferredList([defer.maybeDeferred(f.close) for f in files],
+                                consumeErrors=True)
+        dl.addCallback(_closed, result)
+        return dl
+    def _closed(results, result):
+        for (success, value) in results:
+            if not success:
+                log.err(value, "Error closing file after transfer")
+        return result
+    return d.addBoth(_close)
+
+
+
+@defer.inlineCallbacks
+def resumeGet(client, remotePath, localPath, delta=False, blockSize=65536,
+              bufferSize=32768, requests=5, progress=None, clock=None):
+    """
+    Download a file, keeping what an earlier, interrupted download already
+    wrote to C{localPath}.
+
+    By default the download continues from the end of the local file, unless
+    L{resumeOffset} decides it is not a partial copy of the remote file.
+    With C{delta}, the blocks of the local file are compared with the remote
+    file using L{changedBlocks} and only those which differ are fetched; this
+    is only attempted if the server supports I{check-file}, as comparing
+    blocks by reading them costs as much as downloading them.
+
+    @param client: a connected L{FileTransferClient}.
+    @param remotePath: the path of the remote file.
+    @param localPath: the path of the local file.
+    @param delta: whether to compare blocks instead of only appending.
+
+    The other arguments are passed to L{PipelinedGet}.
+
+    @return: a L{Deferred} which fires with the finished L{PipelinedGet}.
+    """
+    remoteFile = yield client.openFile(remotePath, FXF_READ, {})
+    try:
+        remoteAttrs = yield remoteFile.getAttrs()
+        localAttrs = _localAttrs(localPath)
+        if localAttrs is None:
+            localFile = open(localPath, 'wb')
+        else:
+            localFile = open(localPath, 'r+b')
+    except:
+        yield remoteFile.close()
+        raise
+    size = remoteAttrs['size']
+    offset = resumeOffset(remoteAttrs, localAttrs)
+    d = defer.succeed(None)
+    if (delta and localAttrs is not None and
+        'check-file' in client.serverExtensions):
+        common = min(size, localAttrs['size'])
+        d = changedBlocks(client, remoteFile, localFile, common, blockSize,
+                          bufferSize, requests, clock)
+    def _cbChanged(changed):
+        if changed is None:
+            localFile.truncate(offset)
+            transfer = PipelinedGet(remoteFile, localFile, bufferSize,
+                                    requests, progress, clock, offset=offset)
+            transfer.skipped = offset
+        else:
+            common = min(size, localAttrs['size'])
+            localFile.truncate(size)
+            if common < size:
+                changed.append((common, size - common))
+            transfer = PipelinedGet(remoteFile, localFile, bufferSize,
+                                    requests, progress, clock, ranges=changed)
+            transfer.skipped = size - sum([l for (o, l) in changed])
+        transfer.size = size
+        return transfer.start()
+    d.addCallback(_cbChanged)
+    transfer = yield _closeAfter(d, remoteFile, localFile)
+    defer.returnValue(transfer)
+
+
+
+@defer.inlineCallbacks
+def resumePut(client, localPath, remotePath, delta=False, blockSize=65536,
+              bufferSize=32768, requests=5, progress=None, clock=None):
+    """
+    Upload a file, keeping what an earlier, interrupted upload already wrote
+    to C{remotePath}.
+
+    By default the upload continues from the end of the remote file, unless
+    L{resumeOffset} decides it is not a partial copy of the local file.  With
+    C{delta}, the blocks of the remote file are compared with the local file
+    using L{changedBlocks} and only those which differ are sent.  The remote
+    file is shortened with a I{SETSTAT} request if needed; if the server
+    refuses, the whole file is sent again.
+
+    @param client: a connected L{FileTransferClient}.
+    @param localPath: the path of the local file.
+    @param remotePath: the path of the remote file.
+    @param delta: whether to compare blocks instead of only appending.
+
+    The other arguments are passed to L{PipelinedPut}.
+
+    @return: a L{Deferred} which fires with the finished L{PipelinedPut}.
+    """
+    localAttrs = _localAttrs(localPath)
+    if localAttrs is None:
+        raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), localPath)
+    try:
+        remoteAttrs = yield client.getAttrs(remotePath, 1)
+    except SFTPError, e:
+        if e.code != FX_NO_SUCH_FILE:
+            raise
+        remoteAttrs = None
+    size = localAttrs['size']
+    offset = resumeOffset(localAttrs, remoteAttrs)
+    if delta and remoteAttrs is not None and remoteAttrs['size'] > size:
+        try:
+            yield client.setAttrs(remotePath, {'size': size})
+        except SFTPError:
+            remoteAttrs = None
+        else:
+            remoteAttrs['size'] = size
+    flags = FXF_WRITE | FXF_CREAT
+    if delta and remoteAttrs is not None:
+        # The server has to read the file to compare it.
+        flags |= FXF_READ
+    elif not offset:
+        flags |= FXF_TRUNC
+    localFile = open(localPath, 'rb')
+    try:
+        remoteFile = yield client.openFile(remotePath, flags, {})
+    except:
+        localFile.close()
+        raise
+    d = defer.succeed(None)
+    if delta and remoteAttrs is not None:
+        d = changedBlocks(client, remoteFile, localFile,
+                          min(size, remoteAttrs['size']), blockSize,
+                          bufferSize, requests, clock)
+    def _cbChanged(changed):
+        if changed is None:
+            transfer = PipelinedPut(remoteFile, localFile, bufferSize,
+                                    requests, progress, clock, offset=offset)
+            transfer.skipped = offset
+        else:
+            common = remoteAttrs['size']
+            if common < size:
+                changed.append((common, size - common))
+            transfer = PipelinedPut(remoteFile, localFile, bufferSize,
+                                    requests, progress, clock, ranges=changed)
+            transfer.skipped = size - sum([l for (o, l) in changed])
+        transfer.size = size
+        return transfer.start()
+    d.addCallback(_cbChanged)
+    transfer = yield _closeAfter(d, remoteFile, localFile)
+    defer.returnValue(transfer)
+
+
+
+class SFTPAttrs(object, DictMixin):
+    """
+    The attributes of a file, as carried by an SFTP I{ATTRS} structure.
+
+    This behaves like the dictionaries of attributes used throughout this
+    module, with the keys C{'size'}, C{'uid'}, C{'gid'}, C{'permissions'},
+    C{'atime'}, C{'mtime'} and C{'ext_*'} for extended attributes, but keeps
+    the standard attributes in slots so that a large directory listing does
+    not cost a dictionary per entry.  An attribute which is not present is
+    an unset slot.
+    """
+
+    __slots__ = ('size', 'uid', 'gid', 'permissions', 'atime', 'mtime',
+                 '_other')
+    _fields = __slots__[:-1]
+    _fieldSet = frozenset(_fields)
+    __hash__ = None
+
+    def __init__(self, attrs=(), **kw):
+        self._other = None
+        self.update(attrs, **kw)
+
+
+    def __getitem__(self, key):
+        if key in self._fieldSet:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._other is None:
+            raise KeyError(key)
+        return self._other[key]
+
+
+    def __setitem__(self, key, value):
+        if key in self._fieldSet:
+            setattr(self, key, value)
+        else:
+            if self._other is None:
+                self._other = {}
+            self._other[key] = value
+
+
+    def __delitem__(self, key):
+        if key in self._fieldSet:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._other is None:
+            raise KeyError(key)
+        else:
+            del self._other[key]
+
+
+    def __contains__(self, key):
+        if key in self._fieldSet:
+            return hasattr(self, key)
+        return self._other is not None and key in self._other
+
+
+    has_key = __contains__
+
+
+    def get(self, key, default=None):
+        if key in self._fieldSet:
+            return getattr(self, key, default)
+        if self._other is None:
+            return default
+        return self._other.get(key, default)
+
+
+    def keys(self):
+        keys = [key for key in self._fields if hasattr(self, key)]
+        if self._other:
+            keys.extend(self._other)
+        return keys
+
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+    def __len__(self):
+        return len(self.keys())
+
+
+    def __eq__(self, other):
+        if not isinstance(other, (dict, SFTPAttrs)):
+            return NotImplemented
+        return dict(self.iteritems()) == dict(other.iteritems())
+
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+
+    def __repr__(self):
+        return 'SFTPAttrs(%r)' % (dict(self.iteritems()),)
+
+
+    def copy(self):
+        return SFTPAttrs(self)
+
+
+
+_uint32 = struct.Struct('!L')
+
+# For each combination of the fixed-size attribute flags, a struct which
+# parses those fields, one which packs them after the flags, and the names
+# of the fields in wire order.  Filled in at the end of this module, once the
+# flag values are defined.
+_attributeStructs = {}
+
+def _buildAttributeStructs():
+    fields = [(FILEXFER_ATTR_SIZE, 'Q', ('size',)),
+              (FILEXFER_ATTR_UIDGID, '2L', ('uid', 'gid')),
+              (FILEXFER_ATTR_PERMISSIONS, 'L', ('permissions',)),
+              (FILEXFER_ATTR_ACMODTIME, '2L', ('atime', 'mtime'))]
+    for flags in range(16):
+        format = '!'
+        names = ()
+        for (flag, code, fieldNames) in fields:
+            if flags & flag:
+                format += code
+                names += fieldNames
+        _attributeStructs[flags] = (struct.Struct(format),
+                                    struct.Struct('!L' + format[1:]), names)
+
+
+
+def _parseAttributesAt(data, offset):
+    """
+    Parse an I{ATTRS} structure starting at C{offset} in C{data}.
+
+    @return: a tuple of the L{SFTPAttrs} and the offset just past them.
+    """
+    flags, = _uint32.unpack_from(data, offset)
+    offset += 4
+    fixed, ignored, names = _attributeStructs[flags & 0xf]
+    attrs = SFTPAttrs.__new__(SFTPAttrs)
+    attrs._other = None
+    if names:
+        for name, value in zip(names, fixed.unpack_from(data, offset)):
+            setattr(attrs, name, value)
+        offset += fixed.size
+    if flags & FILEXFER_ATTR_EXTENDED:
+        count, = _uint32.unpack_from(data, offset)
+        offset += 4
+        other = attrs._other = {}
+        for i in xrange(count):
+            length, = _uint32.unpack_from(data, offset)
+            offset += 4
+            extendedType = data[offset:offset + length]
+            offset += length
+            length, = _uint32.unpack_from(data, offset)
+            offset += 4
+            other['ext_' + extendedType] = data[offset:offset + length]
+            offset += length
+    return attrs, offset
+
+
+
+def _packAttributes(attrs):
+    """
+    Pack a dictionary or L{SFTPAttrs} of attributes as an I{ATTRS}
+    structure.
+    """
+    flags = 0
+    if 'size' in attrs:
+        flags |= FILEXFER_ATTR_SIZE
+    if 'uid' in attrs and 'gid' in attrs:
+        flags |= FILEXFER_ATTR_UIDGID
+    if 'permissions' in attrs:
+        flags |= FILEXFER_ATTR_PERMISSIONS
+    if 'atime' in attrs and 'mtime' in attrs:
+        flags |= FILEXFER_ATTR_ACMODTIME
+    ignored, packer, names = _attributeStructs[flags]
+    if isinstance(attrs, SFTPAttrs):
+        other = attrs._other or ()
+    else:
+        other = attrs
+    extended = [NS(key[4:]) + NS(other[key])
+                for key in other if key.startswith('ext_')]
+    if not extended:
+        return packer.pack(flags, *[attrs[name] for name in names])
+    flags |= FILEXFER_ATTR_EXTENDED
+    return ''.join([packer.pack(flags, *[attrs[name] for name in names]),
+                    _uint32.pack(len(extended))] + extended)
+
+
 
 class SFTPError(Exception):
 
@@ -925,6 +2708,8 @@ FX_NOT_A_DIRECTORY             = FX_FAILURE
 FX_FILE_IS_A_DIRECTORY         = FX_FAILURE
 
 
+_buildAttributeStructs()
+
 # initialize FileTransferBase.packetTypes:
 g = globals()
 for name in g.keys():
@@ -0,0 +1,237 @@
+# -*- test-case-name: twisted.conch.test.test_throttle -*-
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+Rate limiting of authentication attempts, and coarse timers for the delays
+and timeouts of authentication, shared by all the connections of an SSH
+factory.
+"""
+
+import heapq, math
+
+from twisted.internet import reactor
+from twisted.conch._compat import OrderedDict
+
+
+
+class _WheelCall(object):
+    """
+    A call scheduled on a L{TimerWheel}; it can be cancelled like a
+    L{twisted.internet.base.DelayedCall}.
+    """
+
+    def __init__(self, wheel, tick, f, args, kw):
+        self.wheel = wheel
+        self.tick = tick
+        self.f = f
+        self.args = args
+        self.kw = kw
+        self.called = self.cancelled = False
+
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+
+    def cancel(self):
+        if not self.active():
+            raise ValueError("call already %s" % (
+                self.called and "called" or "cancelled",))
+        self.cancelled = True
+        self.wheel._remove(self)
+
+
+
+class TimerWheel(object):
+    """
+    Run calls with a granularity of C{resolution} seconds, using a single
+    L{twisted.internet.base.DelayedCall} however many calls are scheduled.
+
+    Calls are grouped in slots of C{resolution} seconds and run when their
+    slot comes due, which is at most C{resolution} seconds late.  This suits
+    timeouts and tarpit delays, which are scheduled for every connection but
+    need not be precise.
+
+    @ivar clock: the provider of C{callLater} and C{seconds} the wheel runs on.
+    @ivar resolution: the width of a slot, in seconds.
+    """
+
+    resolution = 1.0
+
+    def __init__(self, clock=None, resolution=None):
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        if resolution is not None:
+            self.resolution = resolution
+        self._slots = {}
+        self._ticks = []
+        self._delayedCall = None
+        self._dueTick = None
+
+
+    def __len__(self):
+        return sum([len(calls) for calls in self._slots.itervalues()])
+
+
+    def callLater(self, delay, f, *args, **kw):
+        """
+        Call C{f(*args, **kw)} once at least C{delay} seconds have passed.
+
+        @return: an object with C{active} and C{cancel} methods.
+        """
+        tick = int(math.ceil(
+            (self.clock.seconds() + delay) / self.resolution))
+        call = _WheelCall(self, tick, f, args, kw)
+        calls = self._slots.get(tick)
+        if calls is None:
+            calls = self._slots[tick] = []
+            heapq.heappush(self._ticks, tick)
+        calls.append(call)
+        if self._dueTick is None or tick < self._dueTick:
+            self._schedule(tick)
+        return call
+
+
+    def _remove(self, call):
+        """
+        Forget a cancelled call, stopping the wheel if nothing is left.
+        """
+        calls = self._slots.get(call.tick)
+        if calls is None:
+            # The slot is being run.
+            return
+        calls.remove(call)
+        if not calls:
+            del self._slots[call.tick]
+            if not self._slots and self._delayedCall is not None:
+                self._delayedCall.cancel()
+                self._delayedCall = self._dueTick = None
+                self._ticks = []
+
+
+    def _schedule(self, tick):
+        delay = max(0, tick * self.resolution - self.clock.seconds())
+        if self._delayedCall is not None:
+            self._delayedCall.cancel()
+        self._dueTick = tick
+        self._delayedCall = self.clock.callLater(delay, self._advance)
+
+
+    def _advance(self):
+        """
+        Run the calls of every slot which has come due, then wait for the
+        next occupied slot.
+        """
+        self._delayedCall = self._dueTick = None
+        now = self.clock.seconds()
+        while self._ticks and self._ticks[0] * self.resolution <= now:
+            tick = heapq.heappop(self._ticks)
+            for call in self._slots.pop(tick, ()):
+                if call.cancelled:
+                    continue
+                call.called = True
+                call.f(*call.args, **call.kw)
+        while self._ticks and self._ticks[0] not in self._slots:
+            heapq.heappop(self._ticks)
+        if self._ticks:
+            self._schedule(self._ticks[0])
+
+
+
+class AuthenticationRateLimiter(object):
+    """
+    Token buckets limiting the failed authentication attempts of each client
+    host and each username.
+
+    Every failed attempt takes a token from the buckets of its host and of
+    the username it tried; the buckets fill back up at C{sourceRate} and
+    C{userRate} tokens a second, to at most C{sourceBurst} and C{userBurst}
+    tokens.  Attempts made while either bucket is empty are rejected without
+    being checked, and new connections from a host whose bucket is empty are
+    refused before key exchange.  Buckets are refilled when they are looked
+    at rather than by timers, and at most C{maxBuckets} of each kind are
+    kept, the least recently used being forgotten first.
+
+    @ivar accepted: the number of attempts allowed to be checked.
+    @ivar rejected: the number of attempts rejected unchecked.
+    @ivar refusedConnections: the number of connections refused.
+    """
+
+    def __init__(self, sourceRate=0.2, sourceBurst=20, userRate=0.1,
+                 userBurst=10, maxBuckets=10000, clock=None):
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        self.sourceRate = sourceRate
+        self.sourceBurst = sourceBurst
+        self.userRate = userRate
+        self.userBurst = userBurst
+        self.maxBuckets = maxBuckets
+        self._sources = OrderedDict()
+        self._users = OrderedDict()
+        self.accepted = self.rejected = self.refusedConnections = 0
+
+
+    def _tokens(self, buckets, key, rate, burst):
+        """
+        Return the tokens in the bucket for C{key}, refilled up to now, and
+        mark it as the most recently used.
+        """
+        now = self.clock.seconds()
+        bucket = buckets.pop(key, None)
+        if bucket is None:
+            bucket = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        buckets[key] = bucket
+        while len(buckets) > self.maxBuckets:
+            buckets.popitem(last=False)
+        return bucket
+
+
+    def allowConnection(self, host):
+        """
+        Return whether a new connection from C{host} should be accepted.
+        """
+        if host is None:
+            return True
+        bucket = self._tokens(
+            self._sources, host, self.sourceRate, self.sourceBurst)
+        if bucket[0] < 1:
+            self.refusedConnections += 1
+            return False
+        return True
+
+
+    def allowAttempt(self, host, user):
+        """
+        Return whether an attempt by C{host} to authenticate as C{user}
+        should be checked.
+        """
+        allowed = self._tokens(
+            self._users, user, self.userRate, self.userBurst)[0] >= 1
+        if host is not None:
+            bucket = self._tokens(
+                self._sources, host, self.sourceRate, self.sourceBurst)
+            allowed = allowed and bucket[0] >= 1
+        if allowed:
+            self.accepted += 1
+        else:
+            self.rejected += 1
+        return allowed
+
+
+    def failed(self, host, user):
+        """
+        Record a failed attempt by C{host} to authenticate as C{user}.
+        """
+        bucket = self._tokens(
+            self._users, user, self.userRate, self.userBurst)
+        bucket[0] = max(0, bucket[0] - 1)
+        if host is not None:
+            bucket = self._tokens(
+                self._sources, host, self.sourceRate, self.sourceBurst)
+            bucket[0] = max(0, bucket[0] - 1)
@@ -197,7 +197,8 @@ class SSHTransportBase(protocol.Protocol):
     #   SSHTransportBase.supportedCiphers.append('none')
     supportedKeyExchanges = ['diffie-hellman-group-exchange-sha1',
                              'diffie-hellman-group1-sha1']
-    supportedPublicKeys = ['ssh-rsa', 'ssh-dss']
+    supportedPublicKeys = ['rsa-sha2-512', 'rsa-sha2-256', 'ssh-rsa',
+                           'ssh-dss']
     supportedCompressions = ['none', 'zlib']
     supportedLanguages = ()
     supportedVersions = ('1.99', '2.0')
@@ -320,19 +321,24 @@ class SSHTransportBase(protocol.Protocol):
                 self._blockedByKeyExchange.append((messageType, payload))
                 return
 
-        payload = chr(messageType) + payload
         if self.outgoingCompression:
-            payload = (self.outgoingCompression.compress(payload)
-                       + self.outgoingCompression.flush(2))
+            payload = (self.outgoingCompression.compress(
+                           chr(messageType) + payload) +
+                       self.outgoingCompression.flush(2))
+            prefix = ''
+        else:
+            # Prepend the message type with the packet header below instead
+            # of copying the payload just to add a byte.
+            prefix = chr(messageType)
         bs = self.currentEncryptions.encBlockSize
         # 4 for the packet length and 1 for the padding length
-        totalSize = 5 + len(payload)
+        totalSize = 5 + len(prefix) + len(payload)
         lenPad = bs - (totalSize % bs)
         if lenPad < 4:
             lenPad = lenPad + bs
-        packet = (struct.pack('!LB',
-                              totalSize + lenPad - 4, lenPad) +
-                  payload + randbytes.secureRandom(lenPad))
+        packet = ''.join([
+            struct.pack('!LB', totalSize + lenPad - 4, lenPad), prefix,
+            payload, randbytes.secureRandom(lenPad)])
         encPacket = (
             self.currentEncryptions.encrypt(packet) +
             self.currentEncryptions.makeMAC(
@@ -857,6 +863,22 @@ class SSHServerTransport(SSHTransportBase):
                 self.ignoreNextPacket = True # guess was wrong
 
 
+    def _hostKey(self, private=False):
+        """
+        Return the factory's host key for the agreed-upon public key
+        algorithm: its public key, or its private key if C{private} is true.
+
+        The C{rsa-sha2-256} and C{rsa-sha2-512} algorithms sign with the
+        C{ssh-rsa} key (RFC 8332).
+        """
+        if private:
+            hostKeys = self.factory.privateKeys
+        else:
+            hostKeys = self.factory.publicKeys
+        return hostKeys[_publicKeyAlgorithmKeyTypes.get(self.keyAlg,
+                                                        self.keyAlg)]
+
+
     def _ssh_KEXDH_INIT(self, packet):
         """
         Called to handle the beginning of a diffie-hellman-group1-sha1 key
@@ -882,16 +904,16 @@ class SSHServerTransport(SSHTransportBase):
         h.update(NS(self.ourVersionString))
         h.update(NS(self.otherKexInitPayload))
         h.update(NS(self.ourKexInitPayload))
-        h.update(NS(self.factory.publicKeys[self.keyAlg].blob()))
+        h.update(NS(self._hostKey().blob()))
         h.update(MP(clientDHpublicKey))
         h.update(serverDHpublicKey)
         h.update(sharedSecret)
         exchangeHash = h.digest()
         self.sendPacket(
             MSG_KEXDH_REPLY,
-            NS(self.factory.publicKeys[self.keyAlg].blob()) +
+            NS(self._hostKey().blob()) +
             serverDHpublicKey +
-            NS(self.factory.privateKeys[self.keyAlg].sign(exchangeHash)))
+            NS(self._hostKey(True).sign(exchangeHash, self.keyAlg)))
         self._keySetup(sharedSecret, exchangeHash)
 
 
@@ -977,7 +999,7 @@ class SSHServerTransport(SSHTransportBase):
         h.update(NS(self.ourVersionString))
         h.update(NS(self.otherKexInitPayload))
         h.update(NS(self.ourKexInitPayload))
-        h.update(NS(self.factory.publicKeys[self.keyAlg].blob()))
+        h.update(NS(self._hostKey().blob()))
         h.update(self.dhGexRequest)
         h.update(MP(self.p))
         h.update(MP(self.g))
@@ -987,9 +1009,9 @@ class SSHServerTransport(SSHTransportBase):
         exchangeHash = h.digest()
         self.sendPacket(
             MSG_KEX_DH_GEX_REPLY,
-            NS(self.factory.publicKeys[self.keyAlg].blob()) +
+            NS(self._hostKey().blob()) +
             serverDHpublicKey +
-            NS(self.factory.privateKeys[self.keyAlg].sign(exchangeHash)))
+            NS(self._hostKey(True).sign(exchangeHash, self.keyAlg)))
         self._keySetup(sharedSecret, exchangeHash)
 
 
@@ -1048,6 +1070,11 @@ class SSHClientTransport(SSHTransportBase):
     @ivar instance: the SSHService object we are requesting.
     """
     isClient = True
+    # ECDSA and Ed25519 keys can verify but not sign, so only clients, which
+    # just verify the server's host key, accept them.
+    supportedPublicKeys = SSHTransportBase.supportedPublicKeys + [
+        'ecdsa-sha2-nistp256', 'ecdsa-sha2-nistp384', 'ecdsa-sha2-nistp521',
+        'ssh-ed25519']
 
     def connectionMade(self):
         """
@@ -1134,6 +1161,15 @@ class SSHClientTransport(SSHTransportBase):
             self.sendPacket(MSG_KEX_DH_GEX_INIT, self.e)
 
 
+    def _verifyHostKeySignature(self, serverKey, signature, exchangeHash):
+        """
+        Return whether C{signature} is a signature of C{exchangeHash} by
+        C{serverKey}, made with the agreed-upon public key algorithm.
+        """
+        return (getNS(signature)[0] == self.keyAlg and
+                serverKey.verify(signature, exchangeHash))
+
+
     def _continueKEXDH_REPLY(self, ignored, pubKey, f, signature):
         """
         The host key has been verified, so we generate the keys.
@@ -1158,7 +1194,8 @@ class SSHClientTransport(SSHTransportBase):
         h.update(MP(f))
         h.update(sharedSecret)
         exchangeHash = h.digest()
-        if not serverKey.verify(signature, exchangeHash):
+        if not self._verifyHostKeySignature(serverKey, signature,
+                                            exchangeHash):
             self.sendDisconnect(DISCONNECT_KEY_EXCHANGE_FAILED,
                                 'bad signature')
             return
@@ -1214,7 +1251,8 @@ class SSHClientTransport(SSHTransportBase):
         h.update(MP(f))
         h.update(sharedSecret)
         exchangeHash = h.digest()
-        if not serverKey.verify(signature, exchangeHash):
+        if not self._verifyHostKeySignature(serverKey, signature,
+                                            exchangeHash):
             self.sendDisconnect(DISCONNECT_KEY_EXCHANGE_FAILED,
                                 'bad signature')
             return
@@ -1534,6 +1572,11 @@ class _Counter:
 
 
 
+# The host key type each public key algorithm which is not itself a key type
+# signs with [RFC 8332]
+_publicKeyAlgorithmKeyTypes = {'rsa-sha2-256': 'ssh-rsa',
+                               'rsa-sha2-512': 'ssh-rsa'}
+
 # Diffie-Hellman primes from Oakley Group 2 [RFC 2409]
 DH_PRIME = long('17976931348623159077083915679378745319786029604875601170644'
 '442368419718021615851936894783379586492554150218056548598050364644054819923'
@@ -11,7 +11,7 @@ Maintainer: Paul Swartz
 
 import struct, warnings
 from twisted.conch import error, interfaces
-from twisted.conch.ssh import keys, transport, service
+from twisted.conch.ssh import keys, transport, service, throttle
 from twisted.conch.ssh.common import NS, getNS
 from twisted.cred import credentials
 from twisted.cred.error import UnauthorizedLogin
@@ -61,6 +61,9 @@ class SSHUserAuthServer(service.SSHService):
         authentication
     @type portal: L{twisted.cred.portal.Portal}
     @ivar clock: an object with a callLater method.  Stubbed out for testing.
+        The login timeout and password delays are run on a
+        L{throttle.TimerWheel} over this clock, shared with the other
+        connections of the factory.
     """
 
 
@@ -85,6 +88,8 @@ class SSHUserAuthServer(service.SSHService):
         authentication (only allow if the outgoing connection is encrypted) and
         set up a login timeout.
         """
+        self._rateLimiter = getattr(self.transport.factory, 'authRateLimiter',
+                                    None)
         self.authenticatedWith = []
         self.loginAttempts = 0
         self.user = None
@@ -103,7 +108,7 @@ class SSHUserAuthServer(service.SSHService):
                 self.supportedAuthentications.remove('password')
             if 'keyboard-interactive' in self.supportedAuthentications:
                 self.supportedAuthentications.remove('keyboard-interactive')
-        self._cancelLoginTimeout = self.clock.callLater(
+        self._cancelLoginTimeout = self._getTimerWheel().callLater(
             self.loginTimeout,
             self.timeoutAuthentication)
 
@@ -177,7 +182,12 @@ class SSHUserAuthServer(service.SSHService):
         self.user = user
         self.nextService = nextService
         self.method = method
-        d = self.tryAuth(method, user, rest)
+        if (method != 'none' and self._rateLimiter is not None and
+            not self._rateLimiter.allowAttempt(self._getPeerHost(), user)):
+            d = self._delayFailure(failure.Failure(
+                UnauthorizedLogin('too many failed attempts')))
+        else:
+            d = self.tryAuth(method, user, rest)
         if not d:
             self._ebBadAuth(
                 failure.Failure(error.ConchError('auth returned none')))
@@ -240,6 +250,8 @@ class SSHUserAuthServer(service.SSHService):
             else:
                 log.msg(reason.getTraceback())
             self.loginAttempts += 1
+            if self._rateLimiter is not None:
+                self._rateLimiter.failed(self._getPeerHost(), self.user)
             if self.loginAttempts > self.attemptsBeforeDisconnect:
                 self.transport.sendDisconnect(
                         transport.DISCONNECT_NO_MORE_AUTH_METHODS_AVAILABLE,
@@ -258,26 +270,70 @@ class SSHUserAuthServer(service.SSHService):
             string key blob
             [string signature] (if has signature is True)
 
-        Create a SSHPublicKey credential and verify it using our portal.
+        Create a SSHPublicKey credential and verify it using our portal.  The
+        key is parsed through our factory's L{keys.KeyCache} and attached to
+        the credentials as C{publicKey}, so checkers need not parse it again.
+        A signature made with another algorithm than the one named in the
+        request is refused (RFC 8332 section 3.2).
         """
         hasSig = ord(packet[0])
         algName, blob, rest = getNS(packet[1:], 2)
-        pubKey = keys.Key.fromString(blob)
+        pubKey = self._getPublicKeyCache().fromBlob(blob)
         signature = hasSig and getNS(rest)[0] or None
+        if hasSig and not signature.startswith(NS(algName)):
+            return defer.fail(UnauthorizedLogin(
+                'signature algorithm does not match %s' % (algName,)))
         if hasSig:
             b = (NS(self.transport.sessionID) + chr(MSG_USERAUTH_REQUEST) +
                 NS(self.user) + NS(self.nextService) + NS('publickey') +
-                chr(hasSig) +  NS(pubKey.sshType()) + NS(blob))
+                chr(hasSig) + NS(algName) + NS(blob))
             c = credentials.SSHPrivateKey(self.user, algName, blob, b,
                     signature)
+            c.publicKey = pubKey
             return self.portal.login(c, None, interfaces.IConchUser)
         else:
             c = credentials.SSHPrivateKey(self.user, algName, blob, None, None)
+            c.publicKey = pubKey
             return self.portal.login(c, None,
                     interfaces.IConchUser).addErrback(self._ebCheckKey,
                             packet[1:])
 
 
+    def _getTimerWheel(self):
+        """
+        Return the L{throttle.TimerWheel} over our clock shared by the userauth
+        services of our factory, creating it if there is none yet.
+        """
+        factory = self.transport.factory
+        wheel = getattr(factory, 'authTimerWheel', None)
+        if wheel is None or wheel.clock is not self.clock:
+            wheel = factory.authTimerWheel = throttle.TimerWheel(self.clock)
+        return wheel
+
+
+    def _getPeerHost(self):
+        """
+        Return the host the client is connecting from, or C{None} if its
+        address has no host.
+        """
+        try:
+            return self.transport.transport.getPeer().host
+        except AttributeError:
+            return None
+
+
+    def _getPublicKeyCache(self):
+        """
+        Return the L{keys.KeyCache} shared by the userauth services of our
+        factory, creating it if the factory has none yet.
+        """
+        factory = self.transport.factory
+        cache = getattr(factory, 'publicKeyCache', None)
+        if cache is None:
+            cache = factory.publicKeyCache = keys.KeyCache()
+        return cache
+
+
     def _ebCheckKey(self, reason, packet):
         """
         Called back if the user did not sent a signature.  If reason is
@@ -295,10 +351,13 @@ class SSHUserAuthServer(service.SSHService):
         Password authentication.  Payload::
             string password
 
-        Make a UsernamePassword credential and verify it with our portal.
+        Make a UsernamePassword credential and verify it with our portal.  The
+        host the client connects from is attached as C{peerHost}, so checkers
+        can limit the logins of each client.
         """
         password = getNS(packet[1:])[0]
         c = credentials.UsernamePassword(self.user, password)
+        c.peerHost = self._getPeerHost()
         return self.portal.login(c, None, interfaces.IConchUser).addErrback(
                                                         self._ebPassword)
 
@@ -308,8 +367,16 @@ class SSHUserAuthServer(service.SSHService):
         If the password is invalid, wait before sending the failure in order
         to delay brute-force password guessing.
         """
+        return self._delayFailure(f)
+
+
+    def _delayFailure(self, f):
+        """
+        Return a L{defer.Deferred} which fails with C{f} after
+        C{passwordDelay} seconds.
+        """
         d = defer.Deferred()
-        self.clock.callLater(self.passwordDelay, d.callback, f)
+        self._getTimerWheel().callLater(self.passwordDelay, d.errback, f)
         return d
 
 
@@ -30,7 +30,10 @@ class Options(usage.Options, strcred.AuthOptionMixin):
         ["port", "p", "tcp:22", "Port on which to listen"],
         ["data", "d", "/etc", "directory to look for host keys in"],
         ["moduli", "", None, "directory to look for moduli in "
-            "(if different from --data)"]
+            "(if different from --data)"],
+        ["password-threads", "", 0, "number of threads the default UNIX "
+            "password checker hashes passwords in (0 checks them in the "
+            "reactor thread)", int]
     ]
     compData = usage.Completions(
         optActions={"data": usage.CompleteDirs(descr="data directory"),
@@ -46,7 +49,8 @@ class Options(usage.Options, strcred.AuthOptionMixin):
         # be used if no --auth option is provided - note that conch's
         # UNIXPasswordDatabase is used, instead of twisted.plugins.cred_unix's
         # checker
-        super(Options, self).addChecker(conch_checkers.UNIXPasswordDatabase())
+        self._passwordChecker = conch_checkers.UNIXPasswordDatabase()
+        super(Options, self).addChecker(self._passwordChecker)
         super(Options, self).addChecker(conch_checkers.SSHPublicKeyDatabase())
         if pamauth is not None:
             super(Options, self).addChecker(
@@ -62,6 +66,28 @@ class Options(usage.Options, strcred.AuthOptionMixin):
         super(Options, self).addChecker(checker)
 
 
+    def postOptions(self):
+        """
+        If C{--password-threads} is given and the default UNIX password
+        checker is in use, replace it with one which checks passwords in that
+        many threads.
+        """
+        maxThreads = self['password-threads']
+        if maxThreads < 0:
+            raise usage.UsageError("--password-threads must not be negative")
+        checkers = self['credCheckers']
+        if maxThreads and self._passwordChecker in checkers:
+            threaded = conch_checkers.UNIXPasswordDatabase(
+                maxThreads=maxThreads)
+            checkers[checkers.index(self._passwordChecker)] = threaded
+            interfaces = self['credInterfaces']
+            for interface in threaded.credentialInterfaces:
+                interfaces[interface] = [
+                    threaded if checker is self._passwordChecker else checker
+                    for checker in interfaces[interface]]
+            self._passwordChecker = threaded
+
+
 
 def makeService(config):
     """
@@ -261,6 +261,24 @@ class TestAgentKeyAddition(AgentTestBase):
 
 
 
+    def test_addEllipticCurveIdentities(self):
+        """
+        The agent refuses ECDSA and Ed25519 private keys, which cannot sign,
+        with AGENT_FAILURE, and does not store them.
+        """
+        for private in [keydata.privateECDSA_openssh,
+                        keydata.privateEd25519_openssh]:
+            key = keys.Key.fromString(private)
+            failures = []
+            d = self.client.addIdentity(key.privateBlob(), comment='key')
+            d.addErrback(failures.append)
+            self.pump.flush()
+            self.assertEqual(len(failures), 1)
+            failures[0].trap(ConchError)
+            self.assertNotIn(key.blob(), self.server.factory.keys)
+
+
+
 class TestAgentClientFailure(AgentTestBase):
     def test_agentFailure(self):
         """
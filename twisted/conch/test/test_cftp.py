@@ -318,6 +318,134 @@ class StdioClientTests(TestCase):
                           "\rsample  0% 0.0B 0.0Bps 00:00 ")
 
 
+    def test_getFlags(self):
+        """
+        L{StdioClient._getFlags} strips leading options which only use the
+        given letters from a command line, and leaves other words alone.
+        """
+        self.assertEqual(self.client._getFlags(' -r foo bar', 'ra'),
+                         ('r', 'foo bar'))
+        self.assertEqual(self.client._getFlags('-r -a', 'ra'), ('ra', ''))
+        self.assertEqual(self.client._getFlags('-ar foo', 'ra'),
+                         ('ar', 'foo'))
+        self.assertEqual(self.client._getFlags('-rfoo bar', 'ra'),
+                         ('', '-rfoo bar'))
+
+
+    def test_describeProgress(self):
+        """
+        L{StdioClient._describeProgress} summarizes the number of files and
+        bytes transferred by a L{TransferProgress}, the rates of transfer
+        and the number of failures.
+        """
+        clock = Clock()
+        progress = cftp.TransferProgress(clock)
+        progress.fileDone(2048)
+        progress.fileDone(2048)
+        clock.advance(2.0)
+        self.assertEqual(
+            self.client._describeProgress(progress),
+            "Transferred 2 files, 4.0kB in 00:02 (1.0 files/s, 2.0kBps)")
+        progress.errors += 1
+        self.assertEqual(
+            self.client._describeProgress(progress),
+            "Transferred 2 files, 4.0kB in 00:02 (1.0 files/s, 2.0kBps), "
+            "1 failed")
+
+
+    def test_transferManyLimitsConcurrency(self):
+        """
+        L{StdioClient._transferMany} runs no more than the configured number
+        of transfers at once, and disables per-file progress bars when
+        running more than one.
+        """
+        self.client.client = FakeFileTransferClient({'parallel': 2})
+        self.client.reactor = Clock()
+        running = []
+        calls = []
+        def transfer(name, showProgress):
+            calls.append(showProgress)
+            d = defer.Deferred()
+            running.append((name, d))
+            return d
+        result = []
+        self.client._transferMany(
+            [(transfer, (str(i),), 10) for i in range(3)]).addCallback(
+                result.append)
+        self.assertEqual([name for (name, d) in running], ['0', '1'])
+        self.assertEqual(calls, [False, False])
+        running[0][1].callback("Transferred 0")
+        self.assertEqual([name for (name, d) in running], ['0', '1', '2'])
+        running[1][1].callback("Transferred 1")
+        running[2][1].errback(OSError(2, "No such file"))
+        self.assertEqual(
+            self.client.transport.value(),
+            "Transferred 0\nTransferred 1\nlocal error 2: No such file\n")
+        self.assertEqual(
+            result, ["Transferred 2 files, 20.0B in 00:00 "
+                     "(0.0 files/s, 0.0Bps), 1 failed"])
+
+
+
+    def _listBatches(self, batches):
+        """
+        Run I{ls} over a listing arriving in C{batches} of names, and return
+        what was written after each batch and once the listing ended.
+        """
+        listings = []
+        def remoteGlob(path, visit):
+            listings.append(visit)
+            return listing
+        listing = defer.Deferred()
+        self.patch(self.client, '_remoteGlob', remoteGlob)
+        self.client.currentDirectory = '/'
+        self.client.cmd_LS('')
+        written = []
+        for names in batches:
+            listings[0]([(name, name + ' long', {}) for name in names])
+            written.append(self.client.transport.value())
+        listing.callback(None)
+        written.append(self.client.transport.value())
+        return written
+
+
+    def test_listOneBatchSorted(self):
+        """
+        I{ls} writes a listing which arrives in one batch once it has ended,
+        sorted by name.
+        """
+        self.assertEqual(self._listBatches([['b', 'a', 'c']]),
+                         ['', 'a\nb\nc\n'])
+
+
+    def test_listStreamsBatches(self):
+        """
+        I{ls} writes a listing which arrives in several batches as they
+        arrive, holding back only the first one, in the order the server
+        sent them.
+        """
+        self.assertEqual(
+            self._listBatches([['b', 'a'], ['d', 'c'], ['e']]),
+            ['', 'b\na\nd\nc\n', 'b\na\nd\nc\ne\n',
+             'b\na\nd\nc\ne\n'])
+
+
+
+class FakeFileTransferClient:
+    """
+    Just enough of a L{filetransfer.FileTransferClient} to provide options
+    to L{cftp.StdioClient}.
+    """
+    def __init__(self, options):
+        class Connection:
+            pass
+        class Transport:
+            pass
+        self.transport = Transport()
+        self.transport.conn = Connection()
+        self.transport.conn.options = options
+
+
 
 class FileTransferTestRealm:
     def __init__(self, testDir):
@@ -599,6 +727,21 @@ class TestOurServerCmdLineClient(CFTPClientTestBase):
         return d.addCallback(_check)
 
 
+    def test_listLargeDirectory(self):
+        """
+        I{ls} lists every entry of a directory too large for one READDIR
+        reply.
+        """
+        os.mkdir(os.path.join(self.testDir, 'many'))
+        names = ['f%03d' % (i,) for i in range(600)]
+        for name in reversed(names):
+            file(os.path.join(self.testDir, 'many', name), 'w').close()
+        d = self.runCommand('ls many')
+        d.addCallback(lambda result: self.assertEqual(
+                sorted(result.split('\n')), names))
+        return d
+
+
     def testHelp(self):
         """
         Check that running the '?' command returns help.
@@ -747,6 +890,133 @@ class TestOurServerCmdLineClient(CFTPClientTestBase):
         return d
 
 
+    def test_recursiveGet(self):
+        """
+        I{get -r} downloads a remote directory tree, creating the local
+        directories.
+        """
+        os.makedirs(os.path.join(self.testDir, 'tree', 'sub', 'deeper'))
+        for path, data in [('a', 'a' * 100), ('sub/b', 'b'),
+                           ('sub/deeper/c', 'c' * 40000)]:
+            f = file(os.path.join(self.testDir, 'tree', path), 'w')
+            f.write(data)
+            f.close()
+        local = self.mktemp()
+        def _check(result):
+            self.assertIn("Transferred 3 files", result)
+            for path in ['a', 'sub/b', 'sub/deeper/c']:
+                self.assertFilesEqual(os.path.join(self.testDir, 'tree', path),
+                                      os.path.join(local, path))
+        d = self.runCommand('get -r tree %s' % (local,))
+        return d.addCallback(_check)
+
+
+    def test_wildcardGetSymlink(self):
+        """
+        A wildcard I{get} downloads what a matching symbolic link to a
+        regular file leads to, although the listing describes the link.
+        """
+        os.symlink('testfile1', os.path.join(self.testDir, 'linkToFile'))
+        local = self.mktemp()
+        os.mkdir(local)
+        def _check(result):
+            self.assertFilesEqual(os.path.join(self.testDir, 'testfile1'),
+                                  os.path.join(local, 'linkToFile'))
+        d = self.runCommand('get linkTo* %s' % (os.path.abspath(local),))
+        return d.addCallback(_check)
+
+
+    def test_getNonRegularKeepsLocalFile(self):
+        """
+        I{get} of something which is not a regular file leaves the local file
+        it would have written untouched.
+        """
+        local = os.path.abspath(self.mktemp())
+        f = file(local, 'w')
+        f.write('keep me')
+        f.close()
+        def _check(result):
+            self.assertIn("Can't get non-regular file", result)
+            self.assertEqual(file(local).read(), 'keep me')
+        d = self.runCommand('get testDirectory %s' % (local,))
+        return d.addCallback(_check)
+
+
+    def test_reget(self):
+        """
+        I{reget} keeps what an earlier download left in the local file and
+        fetches the rest.
+        """
+        local = self.mktemp()
+        content = file(os.path.join(self.testDir, 'testfile1')).read()
+        f = file(local, 'w')
+        f.write(content[:1000])
+        f.close()
+        def _check(result):
+            self.assertIn("(1000.0B already present)", result)
+            self.assertFilesEqual(os.path.join(self.testDir, 'testfile1'),
+                                  local)
+        d = self.runCommand('reget testfile1 %s' % (os.path.abspath(local),))
+        return d.addCallback(_check)
+
+
+    def test_find(self):
+        """
+        I{find} lists every entry below a remote directory, or only those
+        whose names match the I{-name} pattern.
+        """
+        os.makedirs(os.path.join(self.testDir, 'tree', 'sub'))
+        for path in ['tree/a.txt', 'tree/sub/b.txt', 'tree/sub/c']:
+            file(os.path.join(self.testDir, path), 'w').close()
+        def _check(results):
+            self.assertEqual(sorted(results[0].split('\n')),
+                             ['tree/a.txt', 'tree/sub', 'tree/sub/b.txt',
+                              'tree/sub/c'])
+            self.assertEqual(sorted(results[1].split('\n')),
+                             ['tree/a.txt', 'tree/sub/b.txt'])
+        d = self.runScript('find tree', 'find tree -name *.txt')
+        return d.addCallback(_check)
+
+
+    def test_removeGlob(self):
+        """
+        I{rm} with a glob removes every matching remote file.
+        """
+        for name in ['one.tmp', 'two.tmp', 'keep']:
+            file(os.path.join(self.testDir, name), 'w').close()
+        def _check(result):
+            self.assertEqual(result, '')
+            self.assertFalse(os.path.exists(
+                os.path.join(self.testDir, 'one.tmp')))
+            self.assertFalse(os.path.exists(
+                os.path.join(self.testDir, 'two.tmp')))
+            self.assertTrue(os.path.exists(os.path.join(self.testDir, 'keep')))
+        return self.runCommand('rm *.tmp').addCallback(_check)
+
+
+    def test_recursivePut(self):
+        """
+        I{put -r} uploads a local directory tree, creating the remote
+        directories.
+        """
+        local = self.mktemp()
+        os.makedirs(os.path.join(local, 'sub', 'empty'))
+        for path, data in [('a', 'a' * 100), ('sub/b', 'b' * 40000)]:
+            f = file(os.path.join(local, path), 'w')
+            f.write(data)
+            f.close()
+        def _check(result):
+            self.assertIn("Transferred 2 files", result)
+            for path in ['a', 'sub/b']:
+                self.assertFilesEqual(
+                    os.path.join(local, path),
+                    os.path.join(self.testDir, 'uploaded', path))
+            self.assertTrue(os.path.isdir(
+                os.path.join(self.testDir, 'uploaded', 'sub', 'empty')))
+        d = self.runCommand('put -r %s uploaded' % (local,))
+        return d.addCallback(_check)
+
+
     def testLink(self):
         """
         Test that 'ln' creates a file which appears as a link in the output of
@@ -14,6 +14,7 @@ else:
 
 import os, base64
 
+from twisted.internet import defer
 from twisted.python import util
 from twisted.python.failure import Failure
 from twisted.trial.unittest import TestCase
@@ -128,7 +129,6 @@ class HelperTests(TestCase):
 
         self.mockos.euid = 2345
         self.mockos.egid = 1234
-        self.patch(checkers, 'os', self.mockos)
         self.patch(util, 'os', self.mockos)
 
         self.assertEquals(
@@ -147,7 +147,6 @@ class HelperTests(TestCase):
         userdb.addUser('bob', 'passphrase', 1, 2, 3, 4, 5, 6, 7)
         self.patch(checkers, 'spwd', None)
         self.patch(checkers, 'shadow', userdb)
-        self.patch(checkers, 'os', self.mockos)
         self.patch(util, 'os', self.mockos)
 
         self.mockos.euid = 2345
@@ -166,7 +165,7 @@ class HelperTests(TestCase):
         """
         self.patch(checkers, 'spwd', None)
         self.patch(checkers, 'shadow', None)
-        self.patch(checkers, 'os', self.mockos)
+        self.patch(util, 'os', self.mockos)
 
         self.assertIdentical(checkers._shadowGetByName('bob'), None)
         self.assertEquals(self.mockos.seteuidCalls, [])
@@ -189,7 +188,6 @@ class SSHPublicKeyDatabaseTestCase(TestCase):
         self.mockos = MockOS()
         self.mockos.path = FilePath(self.mktemp())
         self.mockos.path.makedirs()
-        self.patch(checkers, 'os', self.mockos)
         self.patch(util, 'os', self.mockos)
         self.sshDir = self.mockos.path.child('.ssh')
         self.sshDir.makedirs()
@@ -199,6 +197,7 @@ class SSHPublicKeyDatabaseTestCase(TestCase):
             'user', 'password', 1, 2, 'first last',
             self.mockos.path.path, '/bin/shell')
         self.checker._userdb = userdb
+        self.checker.authorizedKeysCache = checkers.AuthorizedKeysCache()
 
 
     def _testCheckKey(self, filename):
@@ -250,7 +249,6 @@ class SSHPublicKeyDatabaseTestCase(TestCase):
         self.mockos.euid = 2345
         self.mockos.egid = 1234
         self.patch(self.mockos, "seteuid", seteuid)
-        self.patch(checkers, 'os', self.mockos)
         self.patch(util, 'os', self.mockos)
         user = UsernamePassword("user", "password")
         user.blob = "foobar"
@@ -259,6 +257,70 @@ class SSHPublicKeyDatabaseTestCase(TestCase):
         self.assertEqual(self.mockos.setegidCalls, [2, 1234])
 
 
+    def test_checkKeyCached(self):
+        """
+        L{SSHPublicKeyDatabase.checkKey} only reads an I{authorized_keys} file
+        once while it is unchanged.
+        """
+        self._testCheckKey("authorized_keys")
+        cache = self.checker.authorizedKeysCache
+        # One miss for each file the first time, hits afterwards; the missing
+        # authorized_keys2 is never cached.
+        self.assertEqual((cache.misses, cache.hits, cache.reloads), (1, 2, 0))
+        self.assertEqual(len(cache), 1)
+
+
+    def test_checkKeyReloadsChangedFile(self):
+        """
+        L{SSHPublicKeyDatabase.checkKey} notices when an I{authorized_keys}
+        file is changed and uses its new contents.
+        """
+        self._testCheckKey("authorized_keys")
+        self.sshDir.child("authorized_keys").setContent(
+            "t3 %s new\n" % (base64.encodestring("notallowed"),))
+        user = UsernamePassword("user", "password")
+        user.blob = "notallowed"
+        self.assertTrue(self.checker.checkKey(user))
+        user.blob = "foobar"
+        self.assertFalse(self.checker.checkKey(user))
+        self.assertEqual(self.checker.authorizedKeysCache.reloads, 1)
+
+
+    def test_checkKeyRemovedFile(self):
+        """
+        Keys listed in an I{authorized_keys} file which has been removed are
+        no longer accepted, and the file is dropped from the cache.
+        """
+        self._testCheckKey("authorized_keys")
+        self.sshDir.child("authorized_keys").remove()
+        user = UsernamePassword("user", "password")
+        user.blob = "foobar"
+        self.assertFalse(self.checker.checkKey(user))
+        self.assertEqual(len(self.checker.authorizedKeysCache), 0)
+
+
+    def test_authorizedKeysCacheEviction(self):
+        """
+        L{AuthorizedKeysCache} keeps at most C{maxFiles} files, forgetting the
+        least recently used one first.
+        """
+        cache = checkers.AuthorizedKeysCache(maxFiles=2)
+        files = []
+        for name in "abc":
+            f = self.sshDir.child(name)
+            f.setContent("t1 %s\n" % (base64.encodestring(name),))
+            files.append(f)
+        self.assertEqual(cache.getKeys(files[0], 1, 2).keys(), ["a"])
+        cache.getKeys(files[1], 1, 2)
+        cache.getKeys(files[0], 1, 2)
+        cache.getKeys(files[2], 1, 2)
+        self.assertEqual((len(cache), cache.evictions), (2, 1))
+        cache.getKeys(files[0], 1, 2)
+        self.assertEqual(cache.hits, 2)
+        cache.getKeys(files[1], 1, 2)
+        self.assertEqual(cache.misses, 4)
+
+
     def test_requestAvatarId(self):
         """
         L{SSHPublicKeyDatabase.requestAvatarId} should return the avatar id
@@ -276,6 +338,25 @@ class SSHPublicKeyDatabaseTestCase(TestCase):
         return d.addCallback(_verify)
 
 
+    def test_requestAvatarIdUsesParsedKey(self):
+        """
+        L{SSHPublicKeyDatabase.requestAvatarId} verifies the signature with
+        the key already parsed into the C{publicKey} attribute of the
+        credentials, if there is one, instead of parsing the blob again.
+        """
+        self.patch(self.checker, 'checkKey', lambda ignored: True)
+        credentials = SSHPrivateKey(
+            'test', 'ssh-rsa', keydata.publicRSA_openssh, 'foo',
+            keys.Key.fromString(keydata.privateRSA_openssh).sign('foo'))
+        credentials.publicKey = keys.Key.fromString(keydata.publicRSA_openssh)
+        def fromString(*args, **kwargs):
+            self.fail("Key parsed again")
+        self.patch(keys.Key, 'fromString', fromString)
+        d = self.checker.requestAvatarId(credentials)
+        d.addCallback(self.assertEqual, 'test')
+        return d
+
+
     def test_requestAvatarIdWithoutSignature(self):
         """
         L{SSHPublicKeyDatabase.requestAvatarId} should raise L{ValidPublicKey}
@@ -320,6 +401,20 @@ class SSHPublicKeyDatabaseTestCase(TestCase):
         return self.assertFailure(d, UnauthorizedLogin)
 
 
+    def test_requestAvatarIdSignatureAlgorithmMismatch(self):
+        """
+        L{SSHPublicKeyDatabase.requestAvatarId} fails with
+        L{UnauthorizedLogin} if the signature is valid but was made with
+        another algorithm than the one the credentials name.
+        """
+        self.patch(self.checker, 'checkKey', lambda ignored: True)
+        credentials = SSHPrivateKey(
+            'test', 'rsa-sha2-256', keydata.publicRSA_openssh, 'foo',
+            keys.Key.fromString(keydata.privateRSA_openssh).sign('foo'))
+        d = self.checker.requestAvatarId(credentials)
+        return self.assertFailure(d, UnauthorizedLogin)
+
+
     def test_requestAvatarIdNormalizeException(self):
         """
         Exceptions raised while verifying the key should be normalized into an
@@ -478,7 +573,6 @@ class UNIXPasswordDatabaseTests(TestCase):
         self.patch(checkers, 'spwd', spwd)
 
         mockos = MockOS()
-        self.patch(checkers, 'os', mockos)
         self.patch(util, 'os', mockos)
 
         mockos.euid = 2345
@@ -607,3 +701,124 @@ class UNIXPasswordDatabaseTests(TestCase):
 
         cred = UsernamePassword('carol', '*')
         self.assertUnauthorizedLogin(checker.requestAvatarId(cred))
+
+
+
+class ThreadedUNIXPasswordDatabaseTests(TestCase):
+    """
+    Tests for L{UNIXPasswordDatabase} checking passwords in threads.
+    """
+    skip = cryptSkip or dependencySkip
+
+    def setUp(self):
+        self.calls = []
+        self.userdb = UserDatabase()
+        self.userdb.addUser('alice', crypt.crypt('secret', 'ab'),
+                            1, 2, 'foo', '/foo', '/bin/sh')
+        self.patch(checkers, 'pwd', self.userdb)
+
+
+    def deferToThread(self, f, *args):
+        """
+        Record a call made to the thread pool, to be run by L{runThreads}.
+        """
+        d = defer.Deferred()
+        self.calls.append((d, f, args))
+        return d
+
+
+    def runThreads(self):
+        """
+        Run the calls made to the thread pool until there are none left.
+        """
+        while self.calls:
+            d, f, args = self.calls.pop(0)
+            d.callback(f(*args))
+
+
+    def makeChecker(self, **kwargs):
+        checker = checkers.UNIXPasswordDatabase(
+            [checkers._pwdGetByName], **kwargs)
+        checker._deferToThread = self.deferToThread
+        return checker
+
+
+    def login(self, checker, password='secret', peerHost=None):
+        credentials = UsernamePassword('alice', password)
+        credentials.peerHost = peerHost
+        result = []
+        checker.requestAvatarId(credentials).addBoth(result.append)
+        return result
+
+
+    def test_verifyInThread(self):
+        """
+        With C{maxThreads}, the lookup and the hashing of the password are run
+        in threads and the result is delivered once they are done.
+        """
+        checker = self.makeChecker(maxThreads=2)
+        result = self.login(checker)
+        self.assertEqual(result, [])
+        self.assertEqual(self.calls[0][1:], (checkers._pwdGetByName, ('alice',)))
+        self.assertEqual(checker.active, 1)
+        self.runThreads()
+        self.assertEqual(result, ['alice'])
+        self.assertEqual((checker.active, checker.verified), (0, 1))
+
+
+    def test_badPasswordInThread(self):
+        """
+        A wrong password checked in a thread fails the login with
+        L{UnauthorizedLogin}.
+        """
+        checker = self.makeChecker(maxThreads=1)
+        result = self.login(checker, 'wrong')
+        self.runThreads()
+        result[0].trap(UnauthorizedLogin)
+
+
+    def test_unthreadedLookup(self):
+        """
+        Lookup functions which are not in C{threadedLookups} are called on the
+        calling thread; only the password is hashed in a thread.
+        """
+        checker = self.makeChecker(maxThreads=1)
+        checker.threadedLookups = ()
+        self.login(checker)
+        self.assertEqual([f for (d, f, args) in self.calls],
+                         [checkers.verifyCryptedPassword])
+
+
+    def test_queueLimit(self):
+        """
+        Once C{maxThreads} checks are running, further logins wait for one of
+        them to finish, and logins beyond C{maxQueued} are refused.
+        """
+        checker = self.makeChecker(maxThreads=1, maxQueued=1)
+        first = self.login(checker)
+        second = self.login(checker)
+        third = self.login(checker)
+        self.assertEqual((checker.active, checker.queued), (1, 1))
+        third[0].trap(UnauthorizedLogin)
+        self.assertEqual(checker.refused, 1)
+        self.assertEqual(len(self.calls), 1)
+        self.runThreads()
+        self.assertEqual((first, second), (['alice'], ['alice']))
+        self.assertEqual((checker.queued, checker.verified), (0, 2))
+
+
+    def test_perSourceLimit(self):
+        """
+        Logins from a host with C{maxPerSource} logins in progress are
+        refused until one of those finishes; other hosts are not affected.
+        """
+        checker = self.makeChecker(maxThreads=4, maxPerSource=1)
+        first = self.login(checker, peerHost='10.0.0.1')
+        refused = self.login(checker, peerHost='10.0.0.1')
+        other = self.login(checker, peerHost='10.0.0.2')
+        refused[0].trap(UnauthorizedLogin)
+        self.runThreads()
+        self.assertEqual((first, other), (['alice'], ['alice']))
+        self.assertEqual(self.login(checker, peerHost='10.0.0.1'), [])
+        self.runThreads()
+        self.assertEqual(checker._sources, {})
@@ -0,0 +1,91 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+Tests for L{twisted.conch._compat}.
+"""
+
+from twisted.conch import _compat
+from twisted.trial import unittest
+
+
+
+class OrderedDictTests(unittest.TestCase):
+    """
+    Tests for L{_compat._OrderedDict}, the C{collections.OrderedDict}
+    replacement used on Python 2.6.
+    """
+
+    def setUp(self):
+        self.d = _compat._OrderedDict()
+        for key in 'cab':
+            self.d[key] = key.upper()
+
+
+    def test_insertionOrder(self):
+        """
+        Keys, values and items are iterated in the order the keys were first
+        inserted, which setting an existing key does not change.
+        """
+        self.d['a'] = 'A2'
+        self.assertEqual(list(self.d), ['c', 'a', 'b'])
+        self.assertEqual(self.d.keys(), ['c', 'a', 'b'])
+        self.assertEqual(list(self.d.itervalues()), ['C', 'A2', 'B'])
+        self.assertEqual(self.d.items(),
+                         [('c', 'C'), ('a', 'A2'), ('b', 'B')])
+
+
+    def test_reinsertMovesToEnd(self):
+        """
+        A key which is deleted and set again moves to the end.
+        """
+        del self.d['c']
+        self.d['c'] = 'C'
+        self.assertEqual(self.d.keys(), ['a', 'b', 'c'])
+        self.assertEqual(self.d.pop('a'), 'A')
+        self.d['a'] = 'A'
+        self.assertEqual(self.d.keys(), ['b', 'c', 'a'])
+
+
+    def test_pop(self):
+        """
+        C{pop} returns and removes the value of a key, or returns the default
+        or raises C{KeyError} if the key is missing.
+        """
+        self.assertEqual(self.d.pop('a'), 'A')
+        self.assertEqual(self.d.pop('a', None), None)
+        self.assertRaises(KeyError, self.d.pop, 'a')
+        self.assertEqual(self.d.keys(), ['c', 'b'])
+
+
+    def test_popitem(self):
+        """
+        C{popitem} removes the last key, or the first if C{last} is false,
+        and raises C{KeyError} once the dictionary is empty.
+        """
+        self.assertEqual(self.d.popitem(), ('b', 'B'))
+        self.assertEqual(self.d.popitem(last=False), ('c', 'C'))
+        self.assertEqual(self.d.popitem(), ('a', 'A'))
+        self.assertRaises(KeyError, self.d.popitem)
+
+
+    def test_clear(self):
+        """
+        C{clear} forgets every key, and the order starts again.
+        """
+        self.d.clear()
+        self.assertEqual(len(self.d), 0)
+        self.assertEqual(list(self.d), [])
+        self.d['z'] = 'Z'
+        self.assertEqual(self.d.items(), [('z', 'Z')])
+
+
+    def test_setdefaultAndUpdate(self):
+        """
+        Keys added by C{setdefault} and C{update} are ordered too.
+        """
+        self.assertEqual(self.d.setdefault('d', 'D'), 'D')
+        self.assertEqual(self.d.setdefault('d', 'X'), 'D')
+        self.d.update([('e', 'E'), ('a', 'A2')])
+        self.assertEqual(self.d.keys(), ['c', 'a', 'b', 'd', 'e'])
+        self.assertEqual(self.d['a'], 'A2')
@@ -3,10 +3,14 @@
 # See LICENSE file for details.
 
 
+import errno
 import os
 import re
+import hashlib
+import stat
 import struct
 import sys
+from StringIO import StringIO
 
 from twisted.trial import unittest
 try:
@@ -23,9 +27,10 @@ except ImportError:
 
 from twisted.conch import avatar
 from twisted.conch.ssh import common, connection, filetransfer, session
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.protocols import loopback
-from twisted.python import components
+from twisted.python import components, failure
+from twisted.test.proto_helpers import StringTransport
 
 
 class TestAvatar(avatar.ConchUser):
@@ -104,7 +109,11 @@ class SFTPTestBase(unittest.TestCase):
         file(os.path.join(self.testDir, '.testHiddenFile'), 'w').write('a')
 
 
-class TestOurServerOurClient(SFTPTestBase):
+class OurServerOurClientTestBase(SFTPTestBase):
+    """
+    Base class for tests which connect a L{filetransfer.FileTransferClient}
+    to a L{filetransfer.FileTransferServer} over a loopback relay.
+    """
 
     if not unix:
         skip = "can't run on non-posix computers"
@@ -146,9 +155,16 @@ class TestOurServerOurClient(SFTPTestBase):
         self.clientTransport.clearBuffer()
 
 
+
+class TestOurServerOurClient(OurServerOurClientTestBase):
+
     def testServerVersion(self):
         self.assertEqual(self._serverVersion, 3)
-        self.assertEqual(self._extData, {'conchTest' : 'ext data'})
+        expected = {'conchTest' : 'ext data'}
+        for name, (extData, methodName) in self.server.extensions.items():
+            expected[name] = extData
+        self.assertEqual(self._extData, expected)
+        self.assertEqual(self.client.serverExtensions, expected)
 
 
     def test_openedFileClosedWithConnection(self):
@@ -231,6 +247,21 @@ class TestOurServerOurClient(SFTPTestBase):
         d.addCallback(_fileOpened)
         return d
 
+    def test_readReplyFraming(self):
+        """
+        The FXP_DATA reply to an FXP_READ request carries the request ID and
+        the chunk as a single, correctly framed packet.
+        """
+        transport = StringTransport()
+        server = filetransfer.FileTransferServer(avatar=self.avatar)
+        server.makeConnection(transport)
+        server._cbRead('chunk', '\x00\x00\x00\x07')
+        self.assertEqual(
+            transport.value(),
+            struct.pack('!LB', 14, filetransfer.FXP_DATA) +
+            '\x00\x00\x00\x07' + common.NS('chunk'))
+
+
     def testClosedFileGetAttrs(self):
         d = self.client.openFile("testfile1", filetransfer.FXF_READ |
                                  filetransfer.FXF_WRITE, {})
@@ -466,300 +497,2186 @@ class TestOurServerOurClient(SFTPTestBase):
         return self.assertFailure(d, NotImplementedError)
 
 
-class FakeConn:
-    def sendClose(self, channel):
-        pass
-
-
-class TestFileTransferClose(unittest.TestCase):
-
-    if not unix:
-        skip = "can't run on non-posix computers"
+class BuiltinExtensionTests(OurServerOurClientTestBase):
+    """
+    Tests for the extensions implemented by L{filetransfer.FileTransferServer}
+    itself, and the L{filetransfer.FileTransferClient} methods which use them.
+    """
 
     def setUp(self):
-        self.avatar = TestAvatar()
+        OurServerOurClientTestBase.setUp(self)
+        self.server._deferToThread = defer.maybeDeferred
+        # Copies take one step each time the clock is advanced.
+        self.clock = task.Clock()
+        cooperator = task.Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=lambda step: self.clock.callLater(1, step))
+        self.server._cooperate = cooperator.cooperate
+        self.content = file(os.path.join(self.testDir, 'testfile1')).read()
+
+
+    def _openFile(self, name, flags):
+        d = self.client.openFile(name, flags, {})
+        self._emptyBuffers()
+        return d
 
-    def buildServerConnection(self):
-        # make a server connection
-        conn = connection.SSHConnection()
-        # server connections have a 'self.transport.avatar'.
-        class DummyTransport:
-            def __init__(self):
-                self.transport = self
-            def sendPacket(self, kind, data):
-                pass
-            def logPrefix(self):
-                return 'dummy transport'
-        conn.transport = DummyTransport()
-        conn.transport.avatar = self.avatar
-        return conn
 
-    def interceptConnectionLost(self, sftpServer):
-        self.connectionLostFired = False
-        origConnectionLost = sftpServer.connectionLost
-        def connectionLost(reason):
-            self.connectionLostFired = True
-            origConnectionLost(reason)
-        sftpServer.connectionLost = connectionLost
+    def test_copyData(self):
+        """
+        I{copy-data} copies a range of one open file into another.
+        """
+        files = []
+        d = self._openFile('testfile1', filetransfer.FXF_READ)
+        d.addCallback(files.append)
+        d.addCallback(lambda ignored: self._openFile(
+            'copied', filetransfer.FXF_WRITE | filetransfer.FXF_CREAT))
+        d.addCallback(files.append)
+        def copy(ignored):
+            d = self.client.copyData(files[0], 10, 0, files[1], 5)
+            self._runCopies()
+            return d
+        def close(ignored):
+            d = defer.gatherResults([f.close() for f in files])
+            self._emptyBuffers()
+            return d
+        def check(ignored):
+            copied = file(os.path.join(self.testDir, 'copied')).read()
+            self.assertEqual(copied, '\0' * 5 + self.content[10:])
+        d.addCallback(copy)
+        d.addCallback(close)
+        return d.addCallback(check)
 
-    def assertSFTPConnectionLost(self):
-        self.assertTrue(self.connectionLostFired,
-            "sftpServer's connectionLost was not called")
 
-    def test_sessionClose(self):
+    def _runCopies(self):
         """
-        Closing a session should notify an SFTP subsystem launched by that
-        session.
+        Deliver requests and replies and step the server's copies until
+        there is nothing left to do.
         """
-        # make a session
-        testSession = session.SSHSession(conn=FakeConn(), avatar=self.avatar)
-
-        # start an SFTP subsystem on the session
-        testSession.request_subsystem(common.NS('sftp'))
-        sftpServer = testSession.client.transport.proto
+        self._emptyBuffers()
+        while self.clock.getDelayedCalls():
+            self.clock.advance(1)
+            self._emptyBuffers()
 
-        # intercept connectionLost so we can check that it's called
-        self.interceptConnectionLost(sftpServer)
 
-        # close session
-        testSession.closeReceived()
+    def test_copyDataCooperates(self):
+        """
+        I{copy-data} copies one chunk at a time in a cooperative task, so a
+        long copy gives the reactor back between chunks.
+        """
+        self.server.maxReadLength = 1000
+        files = []
+        d = self._openFile('testfile1', filetransfer.FXF_READ)
+        d.addCallback(files.append)
+        d.addCallback(lambda ignored: self._openFile(
+            'copied', filetransfer.FXF_WRITE | filetransfer.FXF_CREAT))
+        d.addCallback(files.append)
+        def copy(ignored):
+            results = []
+            d = self.client.copyData(files[0], 0, 3500, files[1], 0)
+            d.addCallback(results.append)
+            self._emptyBuffers()
+            steps = 0
+            while not results:
+                self.assertTrue(self.clock.getDelayedCalls())
+                self.clock.advance(1)
+                self._emptyBuffers()
+                steps += 1
+            # Four chunks, then the step which finds the copy is done.
+            self.assertEqual(steps, 5)
+            d = defer.gatherResults([f.close() for f in files])
+            self._emptyBuffers()
+            return d
+        def check(ignored):
+            copied = file(os.path.join(self.testDir, 'copied')).read()
+            self.assertEqual(copied, self.content[:3500])
+        d.addCallback(copy)
+        return d.addCallback(check)
 
-        self.assertSFTPConnectionLost()
 
-    def test_clientClosesChannelOnConnnection(self):
+    def test_checkFileName(self):
         """
-        A client sending CHANNEL_CLOSE should trigger closeReceived on the
-        associated channel instance.
+        I{check-file-name} returns one digest per block of the named file,
+        using the first algorithm the server supports.
         """
-        conn = self.buildServerConnection()
-
-        # somehow get a session
-        packet = common.NS('session') + struct.pack('>L', 0) * 3
-        conn.ssh_CHANNEL_OPEN(packet)
-        sessionChannel = conn.channels[0]
+        d = self.client.checkFile('testfile1', ['whirlpool', 'sha256'],
+                                  offset=100, length=3000, blockSize=1024)
+        self._emptyBuffers()
+        data = self.content[100:3100]
+        d.addCallback(self.assertEqual, (
+                'sha256', [hashlib.sha256(data[i:i + 1024]).digest()
+                           for i in range(0, 3000, 1024)]))
+        return d
 
-        sessionChannel.request_subsystem(common.NS('sftp'))
-        sftpServer = sessionChannel.client.transport.proto
-        self.interceptConnectionLost(sftpServer)
 
-        # intercept closeReceived
-        self.interceptConnectionLost(sftpServer)
+    def test_checkFileHandle(self):
+        """
+        I{check-file-handle} with a length and block size of 0 returns a
+        single digest of an open file from the offset to its end.
+        """
+        d = self._openFile('testfile1', filetransfer.FXF_READ)
+        def check(openFile):
+            d = self.client.checkFile(openFile, ['md5'], offset=20)
+            self._emptyBuffers()
+            d.addCallback(self.assertEqual,
+                          ('md5', [hashlib.md5(self.content[20:]).digest()]))
+            return d
+        return d.addCallback(check)
 
-        # close the connection
-        conn.ssh_CHANNEL_CLOSE(struct.pack('>L', 0))
 
-        self.assertSFTPConnectionLost()
+    def test_checkFileUnsupportedAlgorithm(self):
+        """
+        I{check-file} fails with L{NotImplementedError} if none of the
+        requested algorithms is supported.
+        """
+        d = self.client.checkFile('testfile1', ['whirlpool'])
+        self._emptyBuffers()
+        return self.assertFailure(d, NotImplementedError)
 
 
-    def test_stopConnectionServiceClosesChannel(self):
+    def test_getLimits(self):
         """
-        Closing an SSH connection should close all sessions within it.
+        I{limits@openssh.com} reports the limits set on the server.
         """
-        conn = self.buildServerConnection()
+        d = self.client.getLimits()
+        self._emptyBuffers()
+        d.addCallback(self.assertEqual, {
+                'maxPacketLength': self.server.maxPacketLength,
+                'maxReadLength': self.server.maxReadLength,
+                'maxWriteLength': self.server.maxWriteLength,
+                'maxOpenHandles': self.server.maxOpenHandles})
+        return d
 
-        # somehow get a session
-        packet = common.NS('session') + struct.pack('>L', 0) * 3
-        conn.ssh_CHANNEL_OPEN(packet)
-        sessionChannel = conn.channels[0]
 
-        sessionChannel.request_subsystem(common.NS('sftp'))
-        sftpServer = sessionChannel.client.transport.proto
-        self.interceptConnectionLost(sftpServer)
+    def test_fsync(self):
+        """
+        I{fsync@openssh.com} calls C{os.fsync} on the open file.
+        """
+        synced = []
+        self.patch(os, 'fsync', synced.append)
+        d = self._openFile('testfile1', filetransfer.FXF_WRITE)
+        def fsync(openFile):
+            d = openFile.fsync()
+            self._emptyBuffers()
+            d.addCallback(lambda ignored: self.assertEqual(
+                    synced, [self.server.openFiles[openFile.handle[4:]].fd]))
+            return d
+        return d.addCallback(fsync)
 
-        # close the connection
-        conn.serviceStopped()
 
-        self.assertSFTPConnectionLost()
+    def test_statVFS(self):
+        """
+        I{statvfs@openssh.com} returns the result of C{os.statvfs} for the
+        path.
+        """
+        d = self.client.statVFS('.')
+        self._emptyBuffers()
+        def check(result):
+            expected = os.statvfs(self.testDir)
+            self.assertEqual(result['f_bsize'], expected.f_bsize)
+            self.assertEqual(result['f_namemax'], expected.f_namemax)
+            self.assertEqual(result['f_flag'], expected.f_flag)
+        return d.addCallback(check)
 
 
 
-class TestConstants(unittest.TestCase):
+class MappedFileTests(SFTPTestBase):
     """
-    Tests for the constants used by the SFTP protocol implementation.
-
-    @ivar filexferSpecExcerpts: Excerpts from the
-        draft-ietf-secsh-filexfer-02.txt (draft) specification of the SFTP
-        protocol.  There are more recent drafts of the specification, but this
-        one describes version 3, which is what conch (and OpenSSH) implements.
+    Tests for L{unix.MappedUnixSFTPFile} and its selection by
+    L{unix.SFTPServerForUnixConchUser.openFile}.
     """
 
+    if not unix:
+        skip = "can't run on non-posix computers"
 
-    filexferSpecExcerpts = [
-        """
-           The following values are defined for packet types.
+    def setUp(self):
+        SFTPTestBase.setUp(self)
+        self.server = FileTransferForTestAvatar(
+            FileTransferTestAvatar(self.testDir))
+        self.server.mmapThreshold = 1024
+        self.patch(unix.MappedUnixSFTPFile, 'mappings',
+                   unix._MappingCache(2))
+        self.expected = file(os.path.join(self.testDir, 'testfile1')).read()
 
-                #define SSH_FXP_INIT                1
-                #define SSH_FXP_VERSION             2
-                #define SSH_FXP_OPEN                3
-                #define SSH_FXP_CLOSE               4
-                #define SSH_FXP_READ                5
-                #define SSH_FXP_WRITE               6
-                #define SSH_FXP_LSTAT               7
-                #define SSH_FXP_FSTAT               8
-                #define SSH_FXP_SETSTAT             9
-                #define SSH_FXP_FSETSTAT           10
-                #define SSH_FXP_OPENDIR            11
-                #define SSH_FXP_READDIR            12
-                #define SSH_FXP_REMOVE             13
-                #define SSH_FXP_MKDIR              14
-                #define SSH_FXP_RMDIR              15
-                #define SSH_FXP_REALPATH           16
-                #define SSH_FXP_STAT               17
-                #define SSH_FXP_RENAME             18
-                #define SSH_FXP_READLINK           19
-                #define SSH_FXP_SYMLINK            20
-                #define SSH_FXP_STATUS            101
-                #define SSH_FXP_HANDLE            102
-                #define SSH_FXP_DATA              103
-                #define SSH_FXP_NAME              104
-                #define SSH_FXP_ATTRS             105
-                #define SSH_FXP_EXTENDED          200
-                #define SSH_FXP_EXTENDED_REPLY    201
 
-           Additional packet types should only be defined if the protocol
-           version number (see Section ``Protocol Initialization'') is
-           incremented, and their use MUST be negotiated using the version
-           number.  However, the SSH_FXP_EXTENDED and SSH_FXP_EXTENDED_REPLY
-           packets can be used to implement vendor-specific extensions.  See
-           Section ``Vendor-Specific-Extensions'' for more details.
-        """,
+    def test_readOnlyOpenIsMapped(self):
         """
-            The flags bits are defined to have the following values:
+        A read-only open of a file larger than the threshold is served from
+        a mapping which returns the same data as the file.
+        """
+        f = self.server.openFile('testfile1', filetransfer.FXF_READ, {})
+        self.addCleanup(f.close)
+        self.assertIsInstance(f, unix.MappedUnixSFTPFile)
+        self.assertEqual(f.readChunk(0, 20), 'a' * 10 + 'b' * 10)
+        self.assertEqual(f.readChunk(1000, 5000), self.expected[1000:6000])
+        self.assertEqual(f.readChunk(len(self.expected) - 10, 100),
+                         self.expected[-10:])
+        self.assertEqual(f.readChunk(len(self.expected), 100), '')
 
-                #define SSH_FILEXFER_ATTR_SIZE          0x00000001
-                #define SSH_FILEXFER_ATTR_UIDGID        0x00000002
-                #define SSH_FILEXFER_ATTR_PERMISSIONS   0x00000004
-                #define SSH_FILEXFER_ATTR_ACMODTIME     0x00000008
-                #define SSH_FILEXFER_ATTR_EXTENDED      0x80000000
 
-        """,
+    def test_writableOpenIsNotMapped(self):
         """
-            The `pflags' field is a bitmask.  The following bits have been
-           defined.
-
-                #define SSH_FXF_READ            0x00000001
-                #define SSH_FXF_WRITE           0x00000002
-                #define SSH_FXF_APPEND          0x00000004
-                #define SSH_FXF_CREAT           0x00000008
-                #define SSH_FXF_TRUNC           0x00000010
-                #define SSH_FXF_EXCL            0x00000020
-        """,
+        Opens which can write to the file use the regular implementation.
         """
-            Currently, the following values are defined (other values may be
-           defined by future versions of this protocol):
+        f = self.server.openFile(
+            'testfile1', filetransfer.FXF_READ | filetransfer.FXF_WRITE, {})
+        self.addCleanup(f.close)
+        self.assertNotIsInstance(f, unix.MappedUnixSFTPFile)
 
-                #define SSH_FX_OK                            0
-                #define SSH_FX_EOF                           1
-                #define SSH_FX_NO_SUCH_FILE                  2
-                #define SSH_FX_PERMISSION_DENIED             3
-                #define SSH_FX_FAILURE                       4
-                #define SSH_FX_BAD_MESSAGE                   5
-                #define SSH_FX_NO_CONNECTION                 6
-                #define SSH_FX_CONNECTION_LOST               7
-                #define SSH_FX_OP_UNSUPPORTED                8
-        """]
+
+    def test_smallFileIsNotMapped(self):
+        """
+        Files smaller than the threshold are read with C{os.read}.
+        """
+        f = self.server.openFile('testRemoveFile', filetransfer.FXF_READ, {})
+        self.addCleanup(f.close)
+        self.assertEqual(f.readChunk(0, 10), 'a')
+        self.assertEqual(len(f.mappings), 0)
 
 
-    def test_constantsAgainstSpec(self):
+    def test_mappingsAreSharedAndBounded(self):
         """
-        The constants used by the SFTP protocol implementation match those
-        found by searching through the spec.
+        Handles on the same file share one mapping, and the least recently
+        used mapping is unmapped when the limit is reached.
         """
-        constants = {}
-        for excerpt in self.filexferSpecExcerpts:
-            for line in excerpt.splitlines():
-                m = re.match('^\s*#define SSH_([A-Z_]+)\s+([0-9x]*)\s*$', line)
-                if m:
-                    constants[m.group(1)] = long(m.group(2), 0)
-        self.assertTrue(
-            len(constants) > 0, "No constants found (the test must be buggy).")
-        for k, v in constants.items():
-            self.assertEqual(v, getattr(filetransfer, k))
+        for name in ('second', 'third'):
+            file(os.path.join(self.testDir, name), 'w').write(name * 1024)
+        first = self.server.openFile('testfile1', filetransfer.FXF_READ, {})
+        again = self.server.openFile('testfile1', filetransfer.FXF_READ, {})
+        second = self.server.openFile('second', filetransfer.FXF_READ, {})
+        third = self.server.openFile('third', filetransfer.FXF_READ, {})
+        for f in (first, again, second, third):
+            self.addCleanup(f.close)
+        first.readChunk(0, 10)
+        again.readChunk(0, 10)
+        self.assertEqual(len(first.mappings), 1)
+        second.readChunk(0, 10)
+        third.readChunk(0, 10)
+        self.assertEqual(len(first.mappings), 2)
+        self.assertEqual(first.readChunk(0, 10), 'a' * 10)
+        self.assertEqual(third.readChunk(0, 5), 'third')
+
+
+    def test_mappingsEvictedLeastRecentlyUsedFirst(self):
+        """
+        L{unix._MappingCache} unmaps the mapping used least recently, a hit
+        counting as a use, when it is full.
+        """
+        cache = unix._MappingCache(2)
+        fd = os.open(os.path.join(self.testDir, 'testfile1'), os.O_RDONLY)
+        self.addCleanup(os.close, fd)
+        first = cache.get('first', fd)
+        second = cache.get('second', fd)
+        self.assertIdentical(cache.get('first', fd), first)
+        cache.get('third', fd)
+        self.assertEqual(list(cache._mappings), ['first', 'third'])
+        self.assertRaises(ValueError, second.read_byte)
+        self.assertEqual(first.read_byte(), 'a')
+
+
+    def test_fallBackWhenFileGrows(self):
+        """
+        If the file has grown when a read reaches the end of the mapping, the
+        handle falls back to regular reads and sees the new data.
+        """
+        f = self.server.openFile('testfile1', filetransfer.FXF_READ, {})
+        self.addCleanup(f.close)
+        f.readChunk(0, 10)
+        appended = file(os.path.join(self.testDir, 'testfile1'), 'a')
+        appended.write('appended')
+        appended.close()
+        self.assertEqual(f.readChunk(len(self.expected), 100), 'appended')
 
 
 
-class TestRawPacketData(unittest.TestCase):
+class AttributeCacheTests(SFTPTestBase):
     """
-    Tests for L{filetransfer.FileTransferClient} which explicitly craft certain
-    less common protocol messages to exercise their handling.
+    Tests for the attribute cache of L{unix.SFTPServerForUnixConchUser}.
     """
+
+    if not unix:
+        skip = "can't run on non-posix computers"
+
     def setUp(self):
-        self.ftc = filetransfer.FileTransferClient()
+        SFTPTestBase.setUp(self)
+        self.server = FileTransferForTestAvatar(
+            FileTransferTestAvatar(self.testDir))
+        self.clock = task.Clock()
+        self.cache = self.server.attrCache = unix._AttributeCache(
+            3, 1.0, self.clock)
 
 
-    def test_packetSTATUS(self):
+    def test_repeatedStatIsCached(self):
         """
-        A STATUS packet containing a result code, a message, and a language is
-        parsed to produce the result of an outstanding request L{Deferred}.
-
-        @see: U{section 9.1<http://tools.ietf.org/html/draft-ietf-secsh-filexfer-13#section-9.1>}
-            of the SFTP Internet-Draft.
+        Repeated C{getAttrs} calls on a path are answered from the cache
+        until the entry expires.
         """
-        d = defer.Deferred()
-        d.addCallback(self._cbTestPacketSTATUS)
-        self.ftc.openRequests[1] = d
-        data = struct.pack('!LL', 1, filetransfer.FX_OK) + common.NS('msg') + common.NS('lang')
-        self.ftc.packet_STATUS(data)
-        return d
+        stats = []
+        lstat = os.lstat
+        def recordingLstat(path):
+            stats.append(path)
+            return lstat(path)
+        self.patch(os, 'lstat', recordingLstat)
+        first = self.server.getAttrs('testfile1', False)
+        self.assertEqual(self.server.getAttrs('testfile1', False), first)
+        self.assertEqual(len(stats), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.clock.advance(1)
+        self.server.getAttrs('testfile1', False)
+        self.assertEqual(len(stats), 2)
+
+
+    def test_cachedAttributesAreCopies(self):
+        """
+        Changing the dictionary returned by C{getAttrs} does not change the
+        cached attributes.
+        """
+        self.server.getAttrs('testfile1', True)['size'] = -1
+        self.assertNotEqual(self.server.getAttrs('testfile1', True)['size'],
+                            -1)
 
 
-    def _cbTestPacketSTATUS(self, result):
+    def test_writeInvalidates(self):
         """
-        Assert that the result is a two-tuple containing the message and
-        language from the STATUS packet.
+        Writing to a file through the session invalidates its attributes.
         """
-        self.assertEqual(result[0], 'msg')
-        self.assertEqual(result[1], 'lang')
+        before = self.server.getAttrs('testfile1', True)
+        f = self.server.openFile('testfile1', filetransfer.FXF_WRITE, {})
+        self.addCleanup(f.close)
+        f.writeChunk(before['size'], 'more')
+        self.assertEqual(self.server.getAttrs('testfile1', True)['size'],
+                         before['size'] + 4)
+        self.assertEqual(self.cache.invalidations, 1)
 
 
-    def test_packetSTATUSShort(self):
+    def test_setAttrsInvalidates(self):
         """
-        A STATUS packet containing only a result code can also be parsed to
+        Setting the attributes of a path invalidates them.
+        """
+        self.server.getAttrs('testfile1', True)
+        self.server.setAttrs('testfile1', {'permissions': 0600})
+        self.assertEqual(
+            self.server.getAttrs('testfile1', True)['permissions'] & 0777,
+            0600)
+
+
+    def test_renameInvalidatesTree(self):
+        """
+        Renaming a directory invalidates everything cached below it, and
+        every resolved path.
+        """
+        file(os.path.join(self.testDir, 'testDirectory', 'f'), 'w').close()
+        self.server.getAttrs('testDirectory/f', False)
+        self.server.realPath('testDirectory')
+        self.server.renameFile('testDirectory', 'moved')
+        self.assertEqual(len(self.cache), 0)
+        self.assertRaises(OSError, self.server.getAttrs, 'testDirectory/f',
+                          False)
+
+
+    def test_removeAndMakeDirectoryInvalidate(self):
+        """
+        Removing a file and making a directory invalidate the attributes
+        cached for their path.
+        """
+        self.server.getAttrs('testRemoveFile', False)
+        self.server.removeFile('testRemoveFile')
+        self.assertRaises(OSError, self.server.getAttrs, 'testRemoveFile',
+                          False)
+        self.assertRaises(OSError, self.server.getAttrs, 'newDirectory',
+                          False)
+        self.server.makeDirectory('newDirectory', {})
+        self.server.getAttrs('newDirectory', False)
+
+
+    def test_listingPopulatesCache(self):
+        """
+        Listing a directory caches the attributes of its entries.
+        """
+        directory = self.server.openDirectory('testDirectory/..')
+        entries = dict([(name, attrs) for (name, longname, attrs)
+                        in directory])
+        directory.close()
+        self.cache.maxEntries = 10
+        self.assertEqual(self.server.getAttrs('testfile1', False),
+                         entries['testfile1'])
+
+
+    def test_entryLimit(self):
+        """
+        The cache never holds more than its maximum number of entries.
+        """
+        for name in ('testfile1', 'testRemoveFile', 'testRenameFile',
+                     '.testHiddenFile'):
+            self.server.getAttrs(name, True)
+        self.assertEqual(len(self.cache), 3)
+
+
+    def test_oldestEntryEvicted(self):
+        """
+        When the cache is full, the entry made longest ago makes room for a
+        new one, and expired entries are dropped first.
+        """
+        for key in 'abc':
+            self.cache.set(key, key)
+            self.clock.advance(0.25)
+        self.cache.set('d', 'd')
+        self.assertEqual(sorted(self.cache._entries), ['b', 'c', 'd'])
+        self.cache.set('b', 'b2')
+        self.cache.set('e', 'e')
+        self.assertEqual(sorted(self.cache._entries), ['b', 'd', 'e'])
+        self.clock.advance(0.5)
+        self.cache.set('f', 'f')
+        self.assertEqual(sorted(self.cache._entries), ['b', 'e', 'f'])
+        self.assertEqual(self.cache.get('b'), 'b2')
+
+
+    def test_replacedEntriesCompacted(self):
+        """
+        Setting the same key over and over does not grow the cache's queue
+        of entries without bound.
+        """
+        for i in range(100):
+            self.cache.set('a', i)
+        self.assertEqual(self.cache.get('a'), 99)
+        self.assertTrue(len(self.cache._order) <= 2 * self.cache.maxEntries)
+
+
+    def test_symlinkTargetNotCached(self):
+        """
+        The attributes of the target of a symbolic link are read again each
+        time, since the target may change under its own name.
+        """
+        os.symlink('testfile1', os.path.join(self.testDir, 'link'))
+        before = self.server.getAttrs('link', True)
+        f = self.server.openFile('testfile1', filetransfer.FXF_WRITE, {})
+        f.writeChunk(before['size'], 'more')
+        f.close()
+        self.assertEqual(self.server.getAttrs('link', True)['size'],
+                         before['size'] + 4)
+        self.assertTrue(stat.S_ISLNK(
+                self.server.getAttrs('link', False)['permissions']))
+
+
+
+class SizeAttributeTests(SFTPTestBase):
+    """
+    Tests for the handling of the C{size} attribute by
+    L{unix.SFTPServerForUnixConchUser}.
+    """
+
+    if not unix:
+        skip = "can't run on non-posix computers"
+
+    def setUp(self):
+        SFTPTestBase.setUp(self)
+        self.server = FileTransferForTestAvatar(
+            FileTransferTestAvatar(self.testDir))
+        self.path = os.path.join(self.testDir, 'testfile1')
+        self.size = os.path.getsize(self.path)
+
+
+    def test_setAttrsTruncates(self):
+        """
+        SETSTAT with a size truncates the file to it.
+        """
+        self.server.setAttrs('testfile1', {'size': 10})
+        self.assertEqual(os.path.getsize(self.path), 10)
+
+
+    def test_openIgnoresSize(self):
+        """
+        A size among the attributes given when a file is opened does not
+        truncate or extend it.
+        """
+        f = self.server.openFile('testfile1', filetransfer.FXF_WRITE,
+                                 {'size': 10})
+        f.close()
+        self.assertEqual(os.path.getsize(self.path), self.size)
+
+
+    def test_makeDirectoryIgnoresSize(self):
+        """
+        A size given when a directory is made is ignored.
+        """
+        self.server.makeDirectory('sized', {'size': 10})
+        self.assertTrue(os.path.isdir(os.path.join(self.testDir, 'sized')))
+
+
+
+class WriteBehindTests(SFTPTestBase):
+    """
+    Tests for the write-behind buffering of L{unix.UnixSFTPFile}.
+    """
+
+    if not unix:
+        skip = "can't run on non-posix computers"
+
+    def setUp(self):
+        SFTPTestBase.setUp(self)
+        self.server = FileTransferForTestAvatar(
+            FileTransferTestAvatar(self.testDir))
+        self.server.clock = self.clock = task.Clock()
+        self.server.writeBehindSize = 1024
+        self.writes = []
+        write = os.write
+        def recordingWrite(fd, data):
+            self.writes.append(len(data))
+            return write(fd, data)
+        self.patch(os, 'write', recordingWrite)
+        self.path = os.path.join(self.testDir, 'written')
+
+
+    def openFile(self):
+        return self.server.openFile(
+            'written', filetransfer.FXF_WRITE | filetransfer.FXF_CREAT, {})
+
+
+    def contents(self):
+        return file(self.path, 'rb').read()
+
+
+    def test_coalesce(self):
+        """
+        Adjacent writes, in either order, are written with one C{os.write}
+        when the file is closed.
+        """
+        f = self.openFile()
+        f.writeChunk(4, 'efgh')
+        f.writeChunk(8, 'ijkl')
+        f.writeChunk(0, 'abcd')
+        self.assertEqual(self.writes, [])
+        f.close()
+        self.assertEqual(self.writes, [12])
+        self.assertEqual(self.contents(), 'abcdefghijkl')
+        self.assertEqual(self.server._writers, {})
+
+
+    def test_overlapFlushes(self):
+        """
+        A write overlapping buffered data flushes the buffer first, so the
+        later write wins.
+        """
+        f = self.openFile()
+        f.writeChunk(0, 'aaaa')
+        f.writeChunk(2, 'bb')
+        f.close()
+        self.assertEqual(self.writes, [4, 2])
+        self.assertEqual(self.contents(), 'aabb')
+
+
+    def test_sizeLimit(self):
+        """
+        The buffer is flushed once it holds C{writeBehindSize} bytes.
+        """
+        f = self.openFile()
+        self.addCleanup(f.close)
+        for i in range(4):
+            f.writeChunk(i * 256, 'x' * 256)
+        self.assertEqual(self.writes, [1024])
+
+
+    def test_delay(self):
+        """
+        Buffered writes are flushed C{writeBehindDelay} seconds after the
+        first of them.
+        """
+        f = self.openFile()
+        self.addCleanup(f.close)
+        f.writeChunk(0, 'abc')
+        self.clock.advance(self.server.writeBehindDelay)
+        self.assertEqual(self.contents(), 'abc')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_flushOnAttributes(self):
+        """
+        Reading the attributes of the open file, or reading or setting those
+        of its path, flushes buffered writes.
+        """
+        f = self.openFile()
+        self.addCleanup(f.close)
+        f.writeChunk(0, 'abc')
+        self.assertEqual(f.getAttrs()['size'], 3)
+        f.writeChunk(3, 'def')
+        self.assertEqual(self.server.getAttrs('written', True)['size'], 6)
+        f.writeChunk(6, 'ghi')
+        self.server.setAttrs('written', {'size': 4})
+        self.assertEqual(self.contents(), 'abcd')
+
+
+    def test_flushOnFsync(self):
+        """
+        C{fsync} flushes buffered writes before syncing the file.
+        """
+        f = self.openFile()
+        self.addCleanup(f.close)
+        f.writeChunk(0, 'abc')
+        f.fsync()
+        self.assertEqual(self.contents(), 'abc')
+
+
+    def test_writtenDurability(self):
+        """
+        With the C{'written'} policy, each write returns a L{Deferred} which
+        fires once it is written to the file.
+        """
+        self.server.writeBehindDurability = 'written'
+        f = self.openFile()
+        self.addCleanup(f.close)
+        results = []
+        f.writeChunk(0, 'abc').addCallback(results.append)
+        f.writeChunk(3, 'def').addCallback(results.append)
+        self.assertEqual(results, [])
+        self.clock.advance(self.server.writeBehindDelay)
+        self.assertEqual(results, [None, None])
+        self.assertEqual(self.writes, [6])
+
+
+    def test_syncedDurability(self):
+        """
+        With the C{'synced'} policy, buffered writes are followed by an
+        C{fsync} before they are acknowledged.
+        """
+        self.server.writeBehindDurability = 'synced'
+        synced = []
+        self.patch(os, 'fsync', synced.append)
+        f = self.openFile()
+        self.addCleanup(f.close)
+        results = []
+        f.writeChunk(0, 'abc').addCallback(results.append)
+        self.clock.advance(self.server.writeBehindDelay)
+        self.assertEqual(synced, [f.fd])
+        self.assertEqual(results, [None])
+
+
+    def test_bufferedErrorReported(self):
+        """
+        With the C{'buffered'} policy, an error writing buffered data in the
+        background is raised by the next write.
+        """
+        f = self.openFile()
+        self.addCleanup(f.close)
+        f.writeChunk(0, 'abc')
+        def failingWrite(fd, data):
+            raise OSError(errno.ENOSPC, 'No space left on device')
+        self.patch(os, 'write', failingWrite)
+        self.clock.advance(self.server.writeBehindDelay)
+        self.assertRaises(OSError, f.writeChunk, 3, 'def')
+
+
+    def test_appendNotBuffered(self):
+        """
+        Files opened for appending are written as each request arrives.
+        """
+        f = self.server.openFile(
+            'written', filetransfer.FXF_WRITE | filetransfer.FXF_CREAT |
+            filetransfer.FXF_APPEND, {})
+        self.addCleanup(f.close)
+        f.writeChunk(0, 'abc')
+        self.assertEqual(self.writes, [3])
+
+
+
+class ReadAheadTests(SFTPTestBase):
+    """
+    Tests for the read-ahead of L{unix.UnixSFTPFile}.
+    """
+
+    if not unix:
+        skip = "can't run on non-posix computers"
+
+    def setUp(self):
+        SFTPTestBase.setUp(self)
+        self.patch(unix.SFTPServerForUnixConchUser, 'readAheadServerBudget',
+                   unix._ReadAheadBudget(1024 * 1024))
+        self.server = FileTransferForTestAvatar(
+            FileTransferTestAvatar(self.testDir))
+        self.server.readAheadMaximum = 4096
+        self.threadCalls = []
+        self.server._deferToThread = self.deferToThread
+        self.contents = file(os.path.join(self.testDir, 'testfile1'),
+                             'rb').read()
+
+
+    def deferToThread(self, f, *args):
+        d = defer.Deferred()
+        self.threadCalls.append((d, f, args))
+        return d
+
+
+    def runThreadCall(self):
+        """
+        Run the oldest function passed to C{deferToThread}, and fire its
+        L{Deferred} with the result.
+        """
+        d, f, args = self.threadCalls.pop(0)
+        d.callback(f(*args))
+
+
+    def openFile(self):
+        """
+        Open C{testfile1} for reading, to be closed, once any read-ahead has
+        finished, at the end of the test.
+        """
+        f = self.server.openFile('testfile1', filetransfer.FXF_READ, {})
+        def close():
+            d = f.close()
+            while self.threadCalls:
+                self.runThreadCall()
+            return d
+        self.addCleanup(close)
+        return f
+
+
+    def test_sequentialReadsReadAhead(self):
+        """
+        After two sequential reads the file is read ahead, in a thread, and
+        later reads are served from the buffer.
+        """
+        f = self.openFile()
+        self.assertEqual(f.readChunk(0, 256), self.contents[:256])
+        self.assertEqual(self.threadCalls, [])
+        self.assertEqual(f.readChunk(256, 256), self.contents[256:512])
+        self.assertEqual(len(self.threadCalls), 1)
+        self.assertEqual(self.threadCalls[0][2], (512, 1024))
+        self.runThreadCall()
+        reads = []
+        originalRead = os.read
+        def read(fd, length):
+            reads.append(length)
+            return originalRead(fd, length)
+        self.patch(os, 'read', read)
+        self.assertEqual(f.readChunk(512, 256), self.contents[512:768])
+        self.assertEqual(reads, [])
+        self.assertEqual((f._readAhead.hits, f._readAhead.misses), (1, 2))
+
+
+    def test_waitForReadAhead(self):
+        """
+        A read beyond the buffer while a read-ahead is in progress waits for
+        it.
+        """
+        f = self.openFile()
+        f.readChunk(0, 256)
+        f.readChunk(256, 256)
+        results = []
+        f.readChunk(512, 256).addCallback(results.append)
+        self.assertEqual(results, [])
+        self.runThreadCall()
+        self.assertEqual(results, [self.contents[512:768]])
+
+
+    def test_windowGrows(self):
+        """
+        Each time the client catches up with the buffer, the window doubles,
+        up to C{readAheadMaximum}.
+        """
+        f = self.openFile()
+        offset = 0
+        windows = []
+        while offset < 16384:
+            result = f.readChunk(offset, 256)
+            if isinstance(result, defer.Deferred):
+                self.runThreadCall()
+            offset += 256
+            windows.append(f._readAhead.window)
+        self.assertEqual(windows[1], 1024)
+        self.assertEqual(max(windows), 4096)
+        self.assertIn(2048, windows)
+
+
+    def test_randomReadsDoNotReadAhead(self):
+        """
+        Reads which do not follow each other reset the window and are not
+        read ahead.
+        """
+        f = self.openFile()
+        for offset in (0, 4096, 1024, 8192):
+            self.assertEqual(f.readChunk(offset, 256),
+                             self.contents[offset:offset + 256])
+        self.assertEqual(self.threadCalls, [])
+        self.assertEqual(f._readAhead.window, 0)
+
+
+    def test_endOfFile(self):
+        """
+        Reading ahead stops at the end of the file, and reads past it return
+        no data.
+        """
+        f = self.openFile()
+        size = len(self.contents)
+        f.readChunk(0, 256)
+        f.readChunk(256, 256)
+        self.runThreadCall()
+        for offset in (size - 1024, size - 768, size - 512):
+            f.readChunk(offset, 256)
+        self.runThreadCall()
+        self.assertEqual(f.readChunk(size - 256, 512), self.contents[-256:])
+        self.assertEqual(f.readChunk(size, 256), '')
+        self.assertEqual(self.server.readAheadBudget.used, 0)
+
+
+    def test_budget(self):
+        """
+        Read-ahead buffers are limited by the session's budget, which counts
+        against the server's, and their memory is given back on close.
+        """
+        self.server.readAheadBudget.limit = 600
+        f = self.server.openFile('testfile1', filetransfer.FXF_READ, {})
+        f.readChunk(0, 256)
+        f.readChunk(256, 256)
+        self.assertEqual(self.threadCalls[0][2], (512, 600))
+        self.assertEqual(self.server.readAheadServerBudget.used, 600)
+        self.runThreadCall()
+        f.close()
+        self.assertEqual(self.server.readAheadBudget.used, 0)
+        self.assertEqual(self.server.readAheadServerBudget.used, 0)
+
+
+    def test_closeWaitsForReadAhead(self):
+        """
+        Closing a file waits for the read-ahead in progress before closing
+        the descriptor.
+        """
+        f = self.server.openFile('testfile1', filetransfer.FXF_READ, {})
+        f.readChunk(0, 256)
+        f.readChunk(256, 256)
+        closed = []
+        f.close().addCallback(closed.append)
+        self.assertEqual(closed, [])
+        os.fstat(f.fd)
+        self.runThreadCall()
+        self.assertEqual(closed, [None])
+        self.assertRaises(OSError, os.fstat, f.fd)
+
+
+    def test_writableNotReadAhead(self):
+        """
+        Files opened for writing are not read ahead.
+        """
+        f = self.server.openFile(
+            'testfile1', filetransfer.FXF_READ | filetransfer.FXF_WRITE, {})
+        self.addCleanup(f.close)
+        self.assertIdentical(f._readAhead, None)
+
+
+
+class FakeConn:
+    def sendClose(self, channel):
+        pass
+
+
+class TestFileTransferClose(unittest.TestCase):
+
+    if not unix:
+        skip = "can't run on non-posix computers"
+
+    def setUp(self):
+        self.avatar = TestAvatar()
+
+    def buildServerConnection(self):
+        # make a server connection
+        conn = connection.SSHConnection()
+        # server connections have a 'self.transport.avatar'.
+        class DummyTransport:
+            def __init__(self):
+                self.transport = self
+            def sendPacket(self, kind, data):
+                pass
+            def logPrefix(self):
+                return 'dummy transport'
+        conn.transport = DummyTransport()
+        conn.transport.avatar = self.avatar
+        return conn
+
+    def interceptConnectionLost(self, sftpServer):
+        self.connectionLostFired = False
+        origConnectionLost = sftpServer.connectionLost
+        def connectionLost(reason):
+            self.connectionLostFired = True
+            origConnectionLost(reason)
+        sftpServer.connectionLost = connectionLost
+
+    def assertSFTPConnectionLost(self):
+        self.assertTrue(self.connectionLostFired,
+            "sftpServer's connectionLost was not called")
+
+    def test_sessionClose(self):
+        """
+        Closing a session should notify an SFTP subsystem launched by that
+        session.
+        """
+        # make a session
+        testSession = session.SSHSession(conn=FakeConn(), avatar=self.avatar)
+
+        # start an SFTP subsystem on the session
+        testSession.request_subsystem(common.NS('sftp'))
+        sftpServer = testSession.client.transport.proto
+
+        # intercept connectionLost so we can check that it's called
+        self.interceptConnectionLost(sftpServer)
+
+        # close session
+        testSession.closeReceived()
+
+        self.assertSFTPConnectionLost()
+
+    def test_clientClosesChannelOnConnnection(self):
+        """
+        A client sending CHANNEL_CLOSE should trigger closeReceived on the
+        associated channel instance.
+        """
+        conn = self.buildServerConnection()
+
+        # somehow get a session
+        packet = common.NS('session') + struct.pack('>L', 0) * 3
+        conn.ssh_CHANNEL_OPEN(packet)
+        sessionChannel = conn.channels[0]
+
+        sessionChannel.request_subsystem(common.NS('sftp'))
+        sftpServer = sessionChannel.client.transport.proto
+        self.interceptConnectionLost(sftpServer)
+
+        # intercept closeReceived
+        self.interceptConnectionLost(sftpServer)
+
+        # close the connection
+        conn.ssh_CHANNEL_CLOSE(struct.pack('>L', 0))
+
+        self.assertSFTPConnectionLost()
+
+
+    def test_stopConnectionServiceClosesChannel(self):
+        """
+        Closing an SSH connection should close all sessions within it.
+        """
+        conn = self.buildServerConnection()
+
+        # somehow get a session
+        packet = common.NS('session') + struct.pack('>L', 0) * 3
+        conn.ssh_CHANNEL_OPEN(packet)
+        sessionChannel = conn.channels[0]
+
+        sessionChannel.request_subsystem(common.NS('sftp'))
+        sftpServer = sessionChannel.client.transport.proto
+        self.interceptConnectionLost(sftpServer)
+
+        # close the connection
+        conn.serviceStopped()
+
+        self.assertSFTPConnectionLost()
+
+
+
+class TestConstants(unittest.TestCase):
+    """
+    Tests for the constants used by the SFTP protocol implementation.
+
+    @ivar filexferSpecExcerpts: Excerpts from the
+        draft-ietf-secsh-filexfer-02.txt (draft) specification of the SFTP
+        protocol.  There are more recent drafts of the specification, but this
+        one describes version 3, which is what conch (and OpenSSH) implements.
+    """
+
+
+    filexferSpecExcerpts = [
+        """
+           The following values are defined for packet types.
+
+                #define SSH_FXP_INIT                1
+                #define SSH_FXP_VERSION             2
+                #define SSH_FXP_OPEN                3
+                #define SSH_FXP_CLOSE               4
+                #define SSH_FXP_READ                5
+                #define SSH_FXP_WRITE               6
+                #define SSH_FXP_LSTAT               7
+                #define SSH_FXP_FSTAT               8
+                #define SSH_FXP_SETSTAT             9
+                #define SSH_FXP_FSETSTAT           10
+                #define SSH_FXP_OPENDIR            11
+                #define SSH_FXP_READDIR            12
+                #define SSH_FXP_REMOVE             13
+                #define SSH_FXP_MKDIR              14
+                #define SSH_FXP_RMDIR              15
+                #define SSH_FXP_REALPATH           16
+                #define SSH_FXP_STAT               17
+                #define SSH_FXP_RENAME             18
+                #define SSH_FXP_READLINK           19
+                #define SSH_FXP_SYMLINK            20
+                #define SSH_FXP_STATUS            101
+                #define SSH_FXP_HANDLE            102
+                #define SSH_FXP_DATA              103
+                #define SSH_FXP_NAME              104
+                #define SSH_FXP_ATTRS             105
+                #define SSH_FXP_EXTENDED          200
+                #define SSH_FXP_EXTENDED_REPLY    201
+
+           Additional packet types should only be defined if the protocol
+           version number (see Section ``Protocol Initialization'') is
+           incremented, and their use MUST be negotiated using the version
+           number.  However, the SSH_FXP_EXTENDED and SSH_FXP_EXTENDED_REPLY
+           packets can be used to implement vendor-specific extensions.  See
+           Section ``Vendor-Specific-Extensions'' for more details.
+        """,
+        """
+            The flags bits are defined to have the following values:
+
+                #define SSH_FILEXFER_ATTR_SIZE          0x00000001
+                #define SSH_FILEXFER_ATTR_UIDGID        0x00000002
+                #define SSH_FILEXFER_ATTR_PERMISSIONS   0x00000004
+                #define SSH_FILEXFER_ATTR_ACMODTIME     0x00000008
+                #define SSH_FILEXFER_ATTR_EXTENDED      0x80000000
+
+        """,
+        """
+            The `pflags' field is a bitmask.  The following bits have been
+           defined.
+
+                #define SSH_FXF_READ            0x00000001
+                #define SSH_FXF_WRITE           0x00000002
+                #define SSH_FXF_APPEND          0x00000004
+                #define SSH_FXF_CREAT           0x00000008
+                #define SSH_FXF_TRUNC           0x00000010
+                #define SSH_FXF_EXCL            0x00000020
+        """,
+        """
+            Currently, the following values are defined (other values may be
+           defined by future versions of this protocol):
+
+                #define SSH_FX_OK                            0
+                #define SSH_FX_EOF                           1
+                #define SSH_FX_NO_SUCH_FILE                  2
+                #define SSH_FX_PERMISSION_DENIED             3
+                #define SSH_FX_FAILURE                       4
+                #define SSH_FX_BAD_MESSAGE                   5
+                #define SSH_FX_NO_CONNECTION                 6
+                #define SSH_FX_CONNECTION_LOST               7
+                #define SSH_FX_OP_UNSUPPORTED                8
+        """]
+
+
+    def test_constantsAgainstSpec(self):
+        """
+        The constants used by the SFTP protocol implementation match those
+        found by searching through the spec.
+        """
+        constants = {}
+        for excerpt in self.filexferSpecExcerpts:
+            for line in excerpt.splitlines():
+                m = re.match('^\s*#define SSH_([A-Z_]+)\s+([0-9x]*)\s*$', line)
+                if m:
+                    constants[m.group(1)] = long(m.group(2), 0)
+        self.assertTrue(
+            len(constants) > 0, "No constants found (the test must be buggy).")
+        for k, v in constants.items():
+            self.assertEqual(v, getattr(filetransfer, k))
+
+
+
+class TestRawPacketData(unittest.TestCase):
+    """
+    Tests for L{filetransfer.FileTransferClient} which explicitly craft certain
+    less common protocol messages to exercise their handling.
+    """
+    def setUp(self):
+        self.ftc = filetransfer.FileTransferClient()
+
+
+    def test_packetSTATUS(self):
+        """
+        A STATUS packet containing a result code, a message, and a language is
+        parsed to produce the result of an outstanding request L{Deferred}.
+
+        @see: U{section 9.1<http://tools.ietf.org/html/draft-ietf-secsh-filexfer-13#section-9.1>}
+            of the SFTP Internet-Draft.
+        """
+        d = defer.Deferred()
+        d.addCallback(self._cbTestPacketSTATUS)
+        self.ftc.openRequests[1] = d
+        data = struct.pack('!LL', 1, filetransfer.FX_OK) + common.NS('msg') + common.NS('lang')
+        self.ftc.packet_STATUS(data)
+        return d
+
+
+    def _cbTestPacketSTATUS(self, result):
+        """
+        Assert that the result is a two-tuple containing the message and
+        language from the STATUS packet.
+        """
+        self.assertEqual(result[0], 'msg')
+        self.assertEqual(result[1], 'lang')
+
+
+    def test_packetSTATUSShort(self):
+        """
+        A STATUS packet containing only a result code can also be parsed to
         produce the result of an outstanding request L{Deferred}.  Such packets
         are sent by some SFTP implementations, though not strictly legal.
 
-        @see: U{section 9.1<http://tools.ietf.org/html/draft-ietf-secsh-filexfer-13#section-9.1>}
-            of the SFTP Internet-Draft.
+        @see: U{section 9.1<http://tools.ietf.org/html/draft-ietf-secsh-filexfer-13#section-9.1>}
+            of the SFTP Internet-Draft.
+        """
+        d = defer.Deferred()
+        d.addCallback(self._cbTestPacketSTATUSShort)
+        self.ftc.openRequests[1] = d
+        data = struct.pack('!LL', 1, filetransfer.FX_OK)
+        self.ftc.packet_STATUS(data)
+        return d
+
+
+    def _cbTestPacketSTATUSShort(self, result):
+        """
+        Assert that the result is a two-tuple containing empty strings, since
+        the STATUS packet had neither a message nor a language.
+        """
+        self.assertEqual(result[0], '')
+        self.assertEqual(result[1], '')
+
+
+    def test_packetSTATUSWithoutLang(self):
+        """
+        A STATUS packet containing a result code and a message but no language
+        can also be parsed to produce the result of an outstanding request
+        L{Deferred}.  Such packets are sent by some SFTP implementations, though
+        not strictly legal.
+
+        @see: U{section 9.1<http://tools.ietf.org/html/draft-ietf-secsh-filexfer-13#section-9.1>}
+            of the SFTP Internet-Draft.
+        """
+        d = defer.Deferred()
+        d.addCallback(self._cbTestPacketSTATUSWithoutLang)
+        self.ftc.openRequests[1] = d
+        data = struct.pack('!LL', 1, filetransfer.FX_OK) + common.NS('msg')
+        self.ftc.packet_STATUS(data)
+        return d
+
+
+    def _cbTestPacketSTATUSWithoutLang(self, result):
+        """
+        Assert that the result is a two-tuple containing the message from the
+        STATUS packet and an empty string, since the language was missing.
+        """
+        self.assertEqual(result[0], 'msg')
+        self.assertEqual(result[1], '')
+
+
+
+class HolesTests(unittest.TestCase):
+    """
+    Tests for L{filetransfer._Holes}.
+    """
+
+    def test_addMergesAdjacentRanges(self):
+        """
+        Ranges which touch or overlap are merged into a single range.
+        """
+        holes = filetransfer._Holes()
+        holes.add(10, 20)
+        holes.add(30, 40)
+        holes.add(20, 30)
+        self.assertEqual(len(holes), 1)
+        self.assertEqual(holes.pop(100), (10, 30))
+
+
+    def test_popSplitsLongRanges(self):
+        """
+        L{filetransfer._Holes.pop} returns at most the requested length and
+        leaves the rest of the range in place.
+        """
+        holes = filetransfer._Holes()
+        holes.add(50, 60)
+        holes.add(0, 25)
+        self.assertEqual(holes.pop(10), (0, 10))
+        self.assertEqual(holes.pop(10), (10, 10))
+        self.assertEqual(holes.pop(10), (20, 5))
+        self.assertEqual(holes.pop(10), (50, 10))
+        self.assertEqual(len(holes), 0)
+
+
+    def test_truncate(self):
+        """
+        L{filetransfer._Holes.truncate} drops ranges beyond the offset and
+        shortens a range which straddles it.
+        """
+        holes = filetransfer._Holes()
+        holes.add(0, 10)
+        holes.add(20, 30)
+        holes.add(40, 50)
+        holes.truncate(25)
+        self.assertEqual(holes.pop(100), (0, 10))
+        self.assertEqual(holes.pop(100), (20, 5))
+        self.assertEqual(len(holes), 0)
+
+
+
+class FakeRemoteFile:
+    """
+    An L{ISFTPFile} whose requests are answered explicitly by the test.
+
+    @ivar reads: a list of C{(offset, length, Deferred)} for each read.
+    @ivar writes: a list of C{(offset, data, Deferred)} for each write.
+    """
+
+    def __init__(self, data=''):
+        self.data = data
+        self.reads = []
+        self.writes = []
+
+
+    def readChunk(self, offset, length):
+        d = defer.Deferred()
+        self.reads.append((offset, length, d))
+        return d
+
+
+    def writeChunk(self, offset, data):
+        d = defer.Deferred()
+        self.writes.append((offset, data, d))
+        return d
+
+
+    def answerRead(self, index, maxLength=None):
+        """
+        Answer the read at C{index} from C{self.data}, returning at most
+        C{maxLength} bytes.
+        """
+        offset, length, d = self.reads[index]
+        if maxLength is not None:
+            length = min(length, maxLength)
+        chunk = self.data[offset:offset + length]
+        if chunk:
+            d.callback(chunk)
+        else:
+            d.errback(EOFError())
+
+
+
+class PipelinedTransferTests(unittest.TestCase):
+    """
+    Tests for L{filetransfer.PipelinedGet} and L{filetransfer.PipelinedPut}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+
+    def test_getKeepsRequestsOutstanding(self):
+        """
+        L{filetransfer.PipelinedGet} sends as many reads as requested before
+        any reply arrives, and one more for each reply.
+        """
+        remote = FakeRemoteFile('x' * 100)
+        transfer = filetransfer.PipelinedGet(
+            remote, StringIO(), 10, 3, clock=self.clock)
+        transfer.start()
+        self.assertEqual([r[:2] for r in remote.reads],
+                         [(0, 10), (10, 10), (20, 10)])
+        remote.answerRead(1)
+        self.assertEqual(remote.reads[3][:2], (30, 10))
+
+
+    def test_getOutOfOrderAndShortReads(self):
+        """
+        Replies arriving out of order are written at their offsets, the
+        remainder of a short read is requested again, and the transfer
+        finishes once the end of the file is reached.
+        """
+        data = ''.join([chr(i) for i in range(256)]) * 4
+        remote = FakeRemoteFile(data)
+        local = StringIO()
+        transfer = filetransfer.PipelinedGet(
+            remote, local, 100, 4, clock=self.clock)
+        result = []
+        transfer.start().addCallback(result.append)
+        answered = 0
+        while answered < len(remote.reads):
+            # answer the newest request first, and only half of every other
+            # one, so that replies are out of order and holes appear.
+            index = len(remote.reads) - 1
+            while remote.reads[index][2].called:
+                index -= 1
+            self.clock.advance(1)
+            remote.answerRead(index, index % 2 and 50 or None)
+            answered += 1
+        self.assertEqual(result, [transfer])
+        self.assertEqual(local.getvalue(), data)
+        self.assertEqual(transfer.bytesTransferred, len(data))
+        self.assertEqual(transfer.throughput(),
+                         len(data) / transfer.elapsed())
+
+
+    def test_getFailure(self):
+        """
+        An error other than EOF stops the transfer, which fails with that
+        error once the outstanding requests have completed.
+        """
+        remote = FakeRemoteFile('x' * 100)
+        transfer = filetransfer.PipelinedGet(
+            remote, StringIO(), 10, 2, clock=self.clock)
+        result = []
+        transfer.start().addErrback(result.append)
+        remote.reads[0][2].errback(
+            filetransfer.SFTPError(filetransfer.FX_FAILURE, 'oops'))
+        self.assertEqual(len(remote.reads), 2)
+        self.assertEqual(result, [])
+        remote.answerRead(1)
+        result[0].trap(filetransfer.SFTPError)
+
+
+    def test_cancel(self):
+        """
+        Cancelling the L{Deferred} returned by
+        L{filetransfer.PipelinedGet.start} cancels every outstanding read and
+        fails the transfer with L{defer.CancelledError}.
+        """
+        remote = FakeRemoteFile('x' * 100)
+        transfer = filetransfer.PipelinedGet(
+            remote, StringIO(), 10, 3, clock=self.clock)
+        d = transfer.start()
+        remote.answerRead(0)
+        d.cancel()
+        self.assertEqual([r[2].called for r in remote.reads],
+                         [True] * len(remote.reads))
+        self.assertEqual(len(remote.reads), 4)
+        return self.assertFailure(d, defer.CancelledError)
+
+
+    def test_put(self):
+        """
+        L{filetransfer.PipelinedPut} writes the whole local file with several
+        requests outstanding, reporting progress as each completes.
+        """
+        data = 'abcdefghij' * 10
+        remote = FakeRemoteFile()
+        progress = []
+        transfer = filetransfer.PipelinedPut(
+            remote, StringIO(data), 30, 2,
+            lambda t: progress.append(t.bytesTransferred), self.clock)
+        result = []
+        transfer.start().addCallback(result.append)
+        self.assertEqual([w[0] for w in remote.writes], [0, 30])
+        pending = [w[2] for w in remote.writes if not w[2].called]
+        while pending:
+            pending[-1].callback(None)
+            pending = [w[2] for w in remote.writes if not w[2].called]
+        self.assertEqual(result, [transfer])
+        self.assertEqual(
+            ''.join([w[1] for w in sorted(remote.writes)]), data)
+        self.assertEqual(progress[-1], len(data))
+
+
+
+class ResumeOffsetTests(unittest.TestCase):
+    """
+    Tests for L{filetransfer.resumeOffset}.
+    """
+
+    def test_noTarget(self):
+        """
+        A copy with no existing target starts from the beginning.
+        """
+        self.assertEqual(
+            filetransfer.resumeOffset({'size': 10, 'mtime': 5}, None), 0)
+
+
+    def test_partialCopy(self):
+        """
+        A target which is shorter than the source and newer than it is
+        continued from its end.
+        """
+        self.assertEqual(filetransfer.resumeOffset(
+                {'size': 10, 'mtime': 5}, {'size': 4, 'mtime': 5}), 4)
+
+
+    def test_longerTarget(self):
+        """
+        A target longer than the source is not a partial copy of it.
+        """
+        self.assertEqual(filetransfer.resumeOffset(
+                {'size': 10, 'mtime': 5}, {'size': 11, 'mtime': 6}), 0)
+
+
+    def test_olderTarget(self):
+        """
+        A target last modified before the source is not a partial copy of
+        the current source.
+        """
+        self.assertEqual(filetransfer.resumeOffset(
+                {'size': 10, 'mtime': 5}, {'size': 4, 'mtime': 4}), 0)
+
+
+
+class ResumeTests(OurServerOurClientTestBase):
+    """
+    Tests for L{filetransfer.resumeGet}, L{filetransfer.resumePut} and
+    L{filetransfer.changedBlocks}.
+    """
+
+    def setUp(self):
+        OurServerOurClientTestBase.setUp(self)
+        self.server._deferToThread = defer.maybeDeferred
+        self.content = ''.join([chr(i % 251) for i in range(8192)])
+        self.remotePath = os.path.join(self.testDir, 'remote')
+        self.localPath = os.path.join(self.testDir, 'local')
+        self.writeFile(self.remotePath, self.content)
+
+
+    def writeFile(self, path, data, mtime=None):
+        f = file(path, 'wb')
+        f.write(data)
+        f.close()
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+
+    def readFile(self, path):
+        return file(path, 'rb').read()
+
+
+    def runTransfer(self, function, *args, **kw):
+        """
+        Call C{function} with the client and C{args}, pump the loopback
+        connection and return the result.
+        """
+        result = []
+        kw.setdefault('clock', task.Clock())
+        d = function(self.client, *args, **kw)
+        d.addBoth(result.append)
+        self._emptyBuffers()
+        self.assertEqual(len(result), 1)
+        if isinstance(result[0], failure.Failure):
+            result[0].raiseException()
+        return result[0]
+
+
+    def test_getContinues(self):
+        """
+        L{filetransfer.resumeGet} keeps a partial local copy and fetches the
+        rest of the file.
+        """
+        self.writeFile(self.localPath, self.content[:3000])
+        transfer = self.runTransfer(filetransfer.resumeGet, 'remote', self.localPath)
+        self.assertEqual(self.readFile(self.localPath), self.content)
+        self.assertEqual(transfer.skipped, 3000)
+        self.assertEqual(transfer.size, len(self.content))
+        self.assertEqual(transfer.bytesTransferred, len(self.content) - 3000)
+
+
+    def test_getRestartsChangedFile(self):
+        """
+        L{filetransfer.resumeGet} downloads the whole file again if the local
+        copy is older than the remote file.
+        """
+        self.writeFile(self.localPath, 'x' * 9000, mtime=0)
+        transfer = self.runTransfer(filetransfer.resumeGet, 'remote', self.localPath)
+        self.assertEqual(self.readFile(self.localPath), self.content)
+        self.assertEqual(transfer.skipped, 0)
+        self.assertEqual(transfer.bytesTransferred, len(self.content))
+
+
+    def test_getDelta(self):
+        """
+        With C{delta}, L{filetransfer.resumeGet} only fetches the blocks of
+        the remote file which differ from the local copy, and truncates the
+        local copy to the length of the remote file.
+        """
+        local = self.content[:1024] + 'x' + self.content[1025:] + 'extra'
+        self.writeFile(self.localPath, local, mtime=0)
+        transfer = self.runTransfer(filetransfer.resumeGet, 'remote', self.localPath,
+                            True, blockSize=1024)
+        self.assertEqual(self.readFile(self.localPath), self.content)
+        self.assertEqual(transfer.bytesTransferred, 1024)
+        self.assertEqual(transfer.skipped, len(self.content) - 1024)
+
+
+    def test_putNew(self):
+        """
+        L{filetransfer.resumePut} uploads the whole file if there is no
+        remote copy.
+        """
+        self.writeFile(self.localPath, self.content)
+        transfer = self.runTransfer(filetransfer.resumePut, self.localPath, 'new')
+        self.assertEqual(
+            self.readFile(os.path.join(self.testDir, 'new')), self.content)
+        self.assertEqual(transfer.skipped, 0)
+
+
+    def test_putContinues(self):
+        """
+        L{filetransfer.resumePut} keeps a partial remote copy and sends the
+        rest of the file.
+        """
+        self.writeFile(self.localPath, self.content, mtime=0)
+        self.writeFile(self.remotePath, self.content[:5000])
+        transfer = self.runTransfer(filetransfer.resumePut, self.localPath, 'remote')
+        self.assertEqual(self.readFile(self.remotePath), self.content)
+        self.assertEqual(transfer.bytesTransferred, len(self.content) - 5000)
+
+
+    def test_putDelta(self):
+        """
+        With C{delta}, L{filetransfer.resumePut} only sends the blocks which
+        differ, and truncates a longer remote file.
+        """
+        local = self.content[:2048] + 'yy' + self.content[2050:]
+        self.writeFile(self.localPath, local)
+        self.writeFile(self.remotePath, self.content + 'extra', mtime=0)
+        transfer = self.runTransfer(filetransfer.resumePut, self.localPath, 'remote',
+                            True, blockSize=1024)
+        self.assertEqual(self.readFile(self.remotePath), local)
+        self.assertEqual(transfer.bytesTransferred, 1024)
+
+
+    def test_changedBlocksByReading(self):
+        """
+        If the server does not support I{check-file},
+        L{filetransfer.changedBlocks} reads the remote file and compares it
+        locally, merging adjacent changed blocks.
+        """
+        del self.client.serverExtensions['check-file']
+        local = list(self.content)
+        local[100] = local[1500] = local[5000] = 'z'
+        local = StringIO(''.join(local))
+        files = []
+        d = self.client.openFile('remote', filetransfer.FXF_READ, {})
+        d.addCallback(files.append)
+        self._emptyBuffers()
+        result = self.runTransfer(filetransfer.changedBlocks, files[0], local,
+                                  len(self.content), 1024)
+        self.assertEqual(result, [(0, 2048), (4096, 1024)])
+
+
+
+class SFTPAttrsTests(unittest.TestCase):
+    """
+    Tests for L{filetransfer.SFTPAttrs} and the functions which parse and
+    pack I{ATTRS} structures.
+    """
+
+    def test_dictionaryInterface(self):
+        """
+        L{filetransfer.SFTPAttrs} can be used like a dictionary of attributes,
+        for the standard attributes and any others.
+        """
+        attrs = filetransfer.SFTPAttrs({'size': 10}, ext_foo='bar')
+        attrs['permissions'] = 0644
+        self.assertEqual(attrs['size'], 10)
+        self.assertEqual(attrs.get('uid'), None)
+        self.assertRaises(KeyError, lambda: attrs['uid'])
+        self.assertTrue('ext_foo' in attrs)
+        self.assertFalse(attrs.has_key('mtime'))
+        self.assertEqual(sorted(attrs), ['ext_foo', 'permissions', 'size'])
+        self.assertEqual(len(attrs), 3)
+        del attrs['size']
+        self.assertRaises(KeyError, attrs.__delitem__, 'size')
+        self.assertEqual(attrs, {'permissions': 0644, 'ext_foo': 'bar'})
+        self.assertNotEqual(attrs, {'permissions': 0644})
+        self.assertEqual(dict(attrs.copy()), dict(attrs))
+        self.assertEqual(attrs.pop('ext_foo'), 'bar')
+        self.assertEqual(repr(attrs), "SFTPAttrs({'permissions': 420})")
+        self.assertFalse(filetransfer.SFTPAttrs())
+
+
+    def test_roundTrip(self):
+        """
+        Packing attributes and parsing the result gives back the same
+        attributes, for every combination of fields.
+        """
+        fields = [('size', 2 ** 40), ('permissions', 0100644),
+                  ('uid', 1), ('gid', 2), ('atime', 3), ('mtime', 4),
+                  ('ext_foo', 'bar'), ('ext_baz', '')]
+        for i in range(2 ** len(fields)):
+            attrs = dict([field for (j, field) in enumerate(fields)
+                          if i & (1 << j)])
+            expected = attrs.copy()
+            if 'uid' not in attrs or 'gid' not in attrs:
+                expected.pop('uid', None)
+                expected.pop('gid', None)
+            if 'atime' not in attrs or 'mtime' not in attrs:
+                expected.pop('atime', None)
+                expected.pop('mtime', None)
+            data = filetransfer._packAttributes(attrs)
+            parsed, offset = filetransfer._parseAttributesAt(
+                'xx' + data + 'rest', 2)
+            self.assertEqual(parsed, expected)
+            self.assertEqual(offset, len(data) + 2)
+            self.assertEqual(filetransfer._parseAttributesAt(
+                    filetransfer._packAttributes(parsed), 0)[0], expected)
+
+
+    def test_wireFormat(self):
+        """
+        L{filetransfer._packAttributes} lays out the fields as the SFTP
+        specification describes.
+        """
+        self.assertEqual(
+            filetransfer._packAttributes(
+                {'size': 1, 'permissions': 2, 'ext_a': 'b'}),
+            struct.pack('!LQLL', 0x80000005, 1, 2, 1) +
+            common.NS('a') + common.NS('b'))
+
+
+    def test_packetNAME(self):
+        """
+        L{filetransfer.FileTransferClient.packet_NAME} parses every entry of
+        a directory listing.
         """
+        client = filetransfer.FileTransferClient()
         d = defer.Deferred()
-        d.addCallback(self._cbTestPacketSTATUSShort)
-        self.ftc.openRequests[1] = d
-        data = struct.pack('!LL', 1, filetransfer.FX_OK)
-        self.ftc.packet_STATUS(data)
+        client.openRequests[1] = d
+        entries = [('a', 'long a', {'size': 1}),
+                   ('b', 'long b', {'permissions': 0755, 'ext_x': 'y'})]
+        client.packet_NAME(struct.pack('!LL', 1, len(entries)) + ''.join([
+                    common.NS(name) + common.NS(longname) +
+                    filetransfer._packAttributes(attrs)
+                    for (name, longname, attrs) in entries]))
+        result = []
+        d.addCallback(result.append)
+        self.assertEqual(result, [entries])
+
+
+
+class ClientRequestTests(unittest.TestCase):
+    """
+    Tests for the bookkeeping of outstanding requests in
+    L{filetransfer.FileTransferClient}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.client = filetransfer.FileTransferClient()
+        self.client.clock = self.clock
+        self.transport = StringTransport()
+        self.client.makeConnection(self.transport)
+        self.transport.clear()
+
+
+    def sentRequestIds(self):
+        """
+        Return the IDs of the requests sent since the last call.
+        """
+        data = self.transport.value()
+        self.transport.clear()
+        ids = []
+        while data:
+            length, = struct.unpack('!L', data[:4])
+            ids.append(struct.unpack('!L', data[5:9])[0])
+            data = data[4 + length:]
+        return ids
+
+
+    def answer(self, requestId):
+        """
+        Answer a request with an FX_OK status.
+        """
+        self.client.dataReceived(
+            struct.pack('!LBLL', 9, filetransfer.FXP_STATUS, requestId,
+                        filetransfer.FX_OK))
+
+
+    def test_timeout(self):
+        """
+        A request which is not answered within C{requestTimeout} seconds
+        fails with L{defer.TimeoutError}, and the late reply is dropped.
+        """
+        self.client.requestTimeout = 5
+        d = self.client.removeFile('foo')
+        [requestId] = self.sentRequestIds()
+        self.clock.advance(5)
+        self.assertFailure(d, defer.TimeoutError)
+        self.assertEqual(self.client.openRequests, {})
+        self.assertEqual(self.client.timedOutRequests, 1)
+        self.answer(requestId)
+        self.assertEqual(self.client.droppedReplies, 1)
+        self.assertEqual(self.flushLoggedErrors(), [])
         return d
 
 
-    def _cbTestPacketSTATUSShort(self, result):
+    def test_answeredBeforeTimeout(self):
         """
-        Assert that the result is a two-tuple containing empty strings, since
-        the STATUS packet had neither a message nor a language.
+        Answering a request cancels its timeout and records its latency in
+        the histogram for its request type.
         """
-        self.assertEqual(result[0], '')
-        self.assertEqual(result[1], '')
+        self.client.requestTimeout = 5
+        d = self.client.removeFile('foo')
+        [requestId] = self.sentRequestIds()
+        self.clock.advance(0.003)
+        self.answer(requestId)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        histogram = self.client.latencies['REMOVE']
+        self.assertEqual(histogram.count, 1)
+        self.assertEqual(histogram.counts[2], 1)
+        self.assertAlmostEqual(histogram.mean(), 0.003)
+        return d
 
 
-    def test_packetSTATUSWithoutLang(self):
+    def test_cancel(self):
         """
-        A STATUS packet containing a result code and a message but no language
-        can also be parsed to produce the result of an outstanding request
-        L{Deferred}.  Such packets are sent by some SFTP implementations, though
-        not strictly legal.
+        Cancelling a request fails it with L{defer.CancelledError}, and the
+        reply is dropped when it arrives.
+        """
+        d = self.client.removeFile('foo')
+        [requestId] = self.sentRequestIds()
+        d.cancel()
+        self.assertFailure(d, defer.CancelledError)
+        self.assertEqual(self.client.cancelledRequests, 1)
+        self.answer(requestId)
+        self.assertEqual(self.client.droppedReplies, 1)
+        return d
 
-        @see: U{section 9.1<http://tools.ietf.org/html/draft-ietf-secsh-filexfer-13#section-9.1>}
-            of the SFTP Internet-Draft.
+
+    def test_queue(self):
+        """
+        No more than C{maxOutstandingRequests} requests are sent at once;
+        the rest are sent, in order, as replies arrive.  A queued request
+        which is cancelled is never sent.
+        """
+        self.client.maxOutstandingRequests = 2
+        results = []
+        requests = [self.client.removeFile(str(i)) for i in range(4)]
+        for d in requests:
+            d.addBoth(results.append)
+        first = self.sentRequestIds()
+        self.assertEqual(len(first), 2)
+        self.assertEqual(self.client.queuedRequests, 2)
+        requests[2].cancel()
+        self.assertEqual(self.client.queuedRequests, 1)
+        self.answer(first[0])
+        [fourth] = self.sentRequestIds()
+        self.assertEqual(self.client.queuedRequests, 0)
+        self.answer(first[1])
+        self.answer(fourth)
+        self.assertEqual(self.sentRequestIds(), [])
+        self.assertEqual(len(results), 4)
+        results[0].trap(defer.CancelledError)
+
+
+    def test_cancelSentAmongMany(self):
+        """
+        Cancelling one of many sent requests abandons that request only; the
+        others are still answered, and nothing is left to look up once they
+        are.
+        """
+        results = []
+        requests = [self.client.removeFile(str(i)) for i in range(5)]
+        for d in requests:
+            d.addBoth(results.append)
+        sent = self.sentRequestIds()
+        requests[2].cancel()
+        self.assertEqual(len(results), 1)
+        results[0].trap(defer.CancelledError)
+        for requestId in sent:
+            self.answer(requestId)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(self.client.droppedReplies, 1)
+        self.assertEqual(self.client.openRequests, {})
+        self.assertEqual(self.client._requestIds, {})
+
+
+    def test_connectionLost(self):
+        """
+        When the connection is lost, requests which were sent or queued fail
+        with the reason.
+        """
+        self.client.maxOutstandingRequests = 1
+        requests = [self.client.removeFile(str(i)) for i in range(2)]
+        self.client.connectionLost(failure.Failure(ValueError('gone')))
+        self.assertEqual(self.client.openRequests, {})
+        return defer.gatherResults([self.assertFailure(d, ValueError)
+                                    for d in requests])
+
+
+    def test_connectionLostCancelsTimeouts(self):
         """
+        When the connection is lost, every request timeout is cancelled and
+        queued requests are failed without being sent.
+        """
+        self.client.requestTimeout = 5
+        self.client.maxOutstandingRequests = 1
+        requests = [self.client.removeFile(str(i)) for i in range(3)]
+        self.transport.clear()
+        self.client.connectionLost(failure.Failure(ValueError('gone')))
+        self.assertEqual(self.transport.value(), '')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.client.queuedRequests, 0)
+        self.clock.advance(5)
+        return defer.gatherResults([self.assertFailure(d, ValueError)
+                                    for d in requests])
+
+
+    def test_lateHandleClosed(self):
+        """
+        A handle which arrives in answer to an OPEN that was cancelled is
+        closed, so that it does not stay open on the server.
+        """
+        d = self.client.openFile('foo', filetransfer.FXF_READ, {})
+        [requestId] = self.sentRequestIds()
+        d.cancel()
+        self.assertFailure(d, defer.CancelledError)
+        self.client.dataReceived(common.NS(
+                chr(filetransfer.FXP_HANDLE) + struct.pack('!L', requestId) +
+                common.NS('handle')))
+        self.assertEqual(self.client.droppedReplies, 1)
+        data = self.transport.value()
+        self.assertEqual(ord(data[4]), filetransfer.FXP_CLOSE)
+        self.assertEqual(common.getNS(data[9:])[0], 'handle')
+        return d
+
+
+
+class FakeDirectory:
+    """
+    A L{filetransfer.ClientDirectory} whose READDIR requests are answered
+    explicitly by the test.
+
+    @ivar reads: the L{Deferred} of each READDIR request, in order.
+    """
+
+    def __init__(self):
+        self.reads = []
+
+
+    def read(self):
         d = defer.Deferred()
-        d.addCallback(self._cbTestPacketSTATUSWithoutLang)
-        self.ftc.openRequests[1] = d
-        data = struct.pack('!LL', 1, filetransfer.FX_OK) + common.NS('msg')
-        self.ftc.packet_STATUS(data)
+        self.reads.append(d)
         return d
 
 
-    def _cbTestPacketSTATUSWithoutLang(self, result):
+
+class DirectoryStreamingTests(OurServerOurClientTestBase):
+    """
+    Tests for L{filetransfer.DirectoryBatches},
+    L{filetransfer.FileTransferClient.listDirectory} and
+    L{filetransfer.FileTransferClient.walk}.
+    """
+
+    def test_prefetch(self):
         """
-        Assert that the result is a two-tuple containing the message from the
-        STATUS packet and an empty string, since the language was missing.
+        L{filetransfer.DirectoryBatches} keeps C{prefetch} READDIR requests
+        in flight, returns batches in the order they were requested and
+        cancels the rest once one reaches the end of the directory.
         """
-        self.assertEqual(result[0], 'msg')
-        self.assertEqual(result[1], '')
+        directory = FakeDirectory()
+        batches = filetransfer.DirectoryBatches(directory, 3)
+        results = []
+        batches.next().addBoth(results.append)
+        self.assertEqual(len(directory.reads), 3)
+        directory.reads[1].callback(['second'])
+        directory.reads[0].callback(['first'])
+        self.assertEqual(results, [['first']])
+        batches.next().addBoth(results.append)
+        self.assertEqual(len(directory.reads), 4)
+        self.assertEqual(results[1], ['second'])
+        batches.next().addBoth(results.append)
+        directory.reads[2].errback(EOFError())
+        results[2].trap(EOFError)
+        self.assertTrue(directory.reads[3].called)
+        self.assertRaises(StopIteration, batches.next)
+
+
+    def test_listDirectory(self):
+        """
+        L{filetransfer.FileTransferClient.listDirectory} passes each batch of
+        a large directory to the visitor as it arrives, and closes the
+        directory.
+        """
+        directory = os.path.join(self.testDir, 'big')
+        os.mkdir(directory)
+        for i in range(600):
+            file(os.path.join(directory, str(i)), 'w').close()
+        sizes = []
+        names = []
+        def visit(batch):
+            sizes.append(len(batch))
+            names.extend([entry[0] for entry in batch])
+        result = []
+        self.client.listDirectory('big', visit).addBoth(result.append)
+        self._emptyBuffers()
+        self.assertEqual(result, [None])
+        self.assertEqual(sizes, [250, 250, 100])
+        self.assertEqual(sorted(names), sorted(map(str, range(600))))
+        self.assertEqual(self.server.openDirs, {})
+
+
+    def test_walk(self):
+        """
+        L{filetransfer.FileTransferClient.walk} visits the entries of every
+        directory below the top, passing their paths relative to the top.
+        """
+        os.makedirs(os.path.join(self.testDir, 'tree', 'a', 'b'))
+        os.mkdir(os.path.join(self.testDir, 'tree', 'c'))
+        file(os.path.join(self.testDir, 'tree', 'a', 'b', 'f'), 'w').close()
+        visited = []
+        def visit(relative, batch):
+            visited.extend([(relative, entry[0]) for entry in batch])
+        result = []
+        self.client.walk('tree', visit).addBoth(result.append)
+        self._emptyBuffers()
+        self.assertEqual(result, [None])
+        self.assertEqual(sorted(visited),
+                         [('', 'a'), ('', 'c'), ('a', 'b'), ('a/b', 'f')])
+
+
+    def test_walkErrors(self):
+        """
+        With C{onError}, L{filetransfer.FileTransferClient.walk} reports
+        directories which cannot be listed and carries on.
+        """
+        os.makedirs(os.path.join(self.testDir, 'tree', 'a'))
+        os.mkdir(os.path.join(self.testDir, 'tree', 'b'))
+        file(os.path.join(self.testDir, 'tree', 'b', 'f'), 'w').close()
+        originalListDirectory = self.client.listDirectory
+        def listDirectory(path, visit, prefetch):
+            if path.endswith('/a'):
+                return defer.fail(filetransfer.SFTPError(
+                        filetransfer.FX_PERMISSION_DENIED, 'denied'))
+            return originalListDirectory(path, visit, prefetch)
+        self.client.listDirectory = listDirectory
+        errors = []
+        visited = []
+        result = []
+        self.client.walk(
+            'tree', lambda relative, batch: visited.append(relative),
+            onError=lambda relative, reason: errors.append(relative)
+            ).addBoth(result.append)
+        self._emptyBuffers()
+        self.assertEqual(result, [None])
+        self.assertEqual(errors, ['a'])
+        self.assertEqual(sorted(visited), ['', 'b'])
+
+
+
+class FakeHandleObject:
+    """
+    An object opened in a L{filetransfer.HandleTable}, which records being
+    closed.
+    """
+
+    def __init__(self):
+        self.closed = False
+
+
+    def __iter__(self):
+        return iter([])
+
+
+    def close(self):
+        self.closed = True
+
+
+
+class HandlePoolTests(unittest.TestCase):
+    """
+    Tests for L{filetransfer.HandlePool}.
+    """
+
+    def test_limit(self):
+        """
+        L{filetransfer.HandlePool.acquire} refuses handles once C{limit} are
+        in use, and L{filetransfer.HandlePool.release} makes room again.
+        """
+        pool = filetransfer.HandlePool(2)
+        self.assertTrue(pool.acquire())
+        self.assertTrue(pool.acquire())
+        self.assertFalse(pool.acquire())
+        self.assertEqual((pool.inUse, pool.refused), (2, 1))
+        pool.release()
+        self.assertTrue(pool.acquire())
+
+
+    def test_unlimited(self):
+        """
+        A L{filetransfer.HandlePool} without a limit never refuses handles.
+        """
+        pool = filetransfer.HandlePool()
+        for i in range(100):
+            self.assertTrue(pool.acquire())
+        self.assertEqual(pool.refused, 0)
+
+
+    def test_fromResourceLimit(self):
+        """
+        L{filetransfer.HandlePool.fromResourceLimit} allows a fraction of the
+        descriptor limit, if there is one.
+        """
+        try:
+            import resource
+        except ImportError:
+            raise unittest.SkipTest("No resource module")
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        pool = filetransfer.HandlePool.fromResourceLimit(0.5)
+        if soft == resource.RLIM_INFINITY:
+            self.assertIdentical(pool.limit, None)
+        else:
+            self.assertEqual(pool.limit, max(1, soft // 2))
+
+
+
+class HandleTableTests(unittest.TestCase):
+    """
+    Tests for L{filetransfer.HandleTable}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+
+    def test_counterHandles(self):
+        """
+        Handles are made from a counter, so they are never reused within a
+        table even after the object they referred to is closed.
+        """
+        table = filetransfer.HandleTable(clock=self.clock)
+        first = table.addFile(FakeHandleObject())
+        table.remove(first)
+        second = table.addDirectory(FakeHandleObject())
+        self.assertEqual((first, second), ('1', '2'))
+        self.assertNotIn(first, table)
+        self.assertIn(second, table.directories)
+
+
+    def test_limit(self):
+        """
+        Without an C{evictionAge}, a full table refuses new handles with
+        L{filetransfer.SFTPError}.
+        """
+        table = filetransfer.HandleTable(2, clock=self.clock)
+        table.addFile(FakeHandleObject())
+        table.addFile(FakeHandleObject())
+        self.assertRaises(filetransfer.SFTPError, table.addFile,
+                          FakeHandleObject())
+        self.assertEqual(len(table), 2)
+
+
+    def test_evictLeastRecentlyUsed(self):
+        """
+        A full table closes its least recently used handle to make room, if
+        it has been idle for at least C{evictionAge} seconds.
+        """
+        table = filetransfer.HandleTable(2, evictionAge=10, clock=self.clock)
+        first, second = FakeHandleObject(), FakeHandleObject()
+        firstHandle = table.addFile(first)
+        secondHandle = table.addFile(second)
+        self.clock.advance(5)
+        self.assertRaises(filetransfer.SFTPError, table.addFile,
+                          FakeHandleObject())
+        self.clock.advance(5)
+        table.getFile(firstHandle)
+        table.addFile(FakeHandleObject())
+        self.assertTrue(second.closed)
+        self.assertFalse(first.closed)
+        self.assertNotIn(secondHandle, table)
+        self.assertEqual(table.evicted, 1)
+
+
+    def test_pool(self):
+        """
+        Handles are taken from the shared L{filetransfer.HandlePool} and
+        returned to it when removed, so a full pool refuses handles from any
+        table using it.
+        """
+        pool = filetransfer.HandlePool(2)
+        first = filetransfer.HandleTable(pool=pool, clock=self.clock)
+        second = filetransfer.HandleTable(pool=pool, clock=self.clock)
+        handle = first.addFile(FakeHandleObject())
+        first.addFile(FakeHandleObject())
+        self.assertRaises(filetransfer.SFTPError, second.addFile,
+                          FakeHandleObject())
+        first.remove(handle)
+        second.addFile(FakeHandleObject())
+        self.assertEqual(pool.inUse, 2)
+        first.closeAll()
+        second.closeAll()
+        self.assertEqual(pool.inUse, 0)
+
+
+    def test_reaper(self):
+        """
+        With an C{idleTimeout}, handles which go unused that long are closed,
+        while handles which are used are kept.
+        """
+        table = filetransfer.HandleTable(idleTimeout=60, clock=self.clock)
+        idle, busy = FakeHandleObject(), FakeHandleObject()
+        table.addFile(idle)
+        busyHandle = table.addFile(busy)
+        for i in range(3):
+            self.clock.advance(30)
+            table.getFile(busyHandle)
+        self.assertTrue(idle.closed)
+        self.assertFalse(busy.closed)
+        self.assertEqual((len(table), table.reaped), (1, 1))
+        self.clock.advance(60)
+        self.assertTrue(busy.closed)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_closeAll(self):
+        """
+        L{filetransfer.HandleTable.closeAll} closes every handle and stops
+        the reaper.
+        """
+        table = filetransfer.HandleTable(idleTimeout=60, clock=self.clock)
+        objects = [FakeHandleObject(), FakeHandleObject()]
+        table.addFile(objects[0])
+        table.addDirectory(objects[1])
+        table.closeAll()
+        self.assertEqual([obj.closed for obj in objects], [True, True])
+        self.assertEqual((table.files, table.directories), ({}, {}))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+
+class FakeFactory:
+    """
+    A factory with no L{filetransfer.HandlePool} of its own yet.
+    """
+    sftpHandlePool = None
+
+
+
+class ServerHandleTests(OurServerOurClientTestBase):
+    """
+    Tests for the handle limits of L{filetransfer.FileTransferServer}.
+    """
+
+    def test_tooManyHandles(self):
+        """
+        An open which would exceed C{maxOpenHandles} fails, and the file it
+        opened is closed again.
+        """
+        self.server.handles.maxHandles = 1
+        self.server.handles.evictionAge = None
+        closed = []
+        originalClose = unix.UnixSFTPFile.close
+        def close(fileObj):
+            closed.append(os.path.basename(fileObj.filename))
+            return originalClose(fileObj)
+        self.patch(unix.UnixSFTPFile, 'close', close)
+        result = []
+        self.client.openFile('testfile1', filetransfer.FXF_READ, {}
+                             ).addCallback(result.append)
+        self.client.openFile('testRemoveFile', filetransfer.FXF_READ, {}
+                             ).addErrback(result.append)
+        self._emptyBuffers()
+        self.assertIsInstance(result[0], filetransfer.ClientFile)
+        self.assertEqual(result[1].value.code, filetransfer.FX_FAILURE)
+        self.assertEqual(closed, ['testRemoveFile'])
+        self.assertEqual(len(self.server.openFiles), 1)
+
+
+    def test_sharedPool(self):
+        """
+        Servers for avatars connected to the same factory share its
+        L{filetransfer.HandlePool}.
+        """
+        factory = FakeFactory()
+        servers = []
+        for i in range(2):
+            avatar = FileTransferTestAvatar(self.testDir)
+            avatar.conn = FakeConn()
+            avatar.conn.transport = StringTransport()
+            avatar.conn.transport.factory = factory
+            servers.append(filetransfer.FileTransferServer(avatar=avatar))
+        self.assertNotIdentical(factory.sftpHandlePool, None)
+        self.assertIdentical(servers[0].handles.pool, factory.sftpHandlePool)
+        self.assertIdentical(servers[1].handles.pool, factory.sftpHandlePool)
@@ -17,14 +17,16 @@ else:
     from twisted.conch.ssh.keys import Key, BadKeyError
     from twisted.conch.client.knownhosts import \
         PlainEntry, HashedEntry, KnownHostsFile, UnparsedEntry, ConsoleUI
-    from twisted.conch.client import default
+    from twisted.conch.client import default, knownhosts
 
 from zope.interface.verify import verifyObject
 
 from twisted.python.filepath import FilePath
 from twisted.trial.unittest import TestCase
 from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
 from twisted.conch.interfaces import IKnownHostEntry
+from twisted.conch.test import keydata
 from twisted.conch.error import HostKeyChanged, UserRejectedKey, InvalidEntry
 
 
@@ -404,6 +406,47 @@ class KnownHostsDatabaseTests(TestCase):
                          "|1|This also unparseable.")
 
 
+    def test_ellipticCurveKeys(self):
+        """
+        Entries with ECDSA and Ed25519 keys are loaded and matched like those
+        with RSA and DSA keys.
+        """
+        ecdsaKey = Key.fromString(keydata.publicECDSA_openssh)
+        ed25519Key = Key.fromString(keydata.publicEd25519_openssh)
+        hostsFile = self.loadSampleHostsFile(
+            "ecdsa.example.com %s\ned25519.example.com %s\n" % (
+                keydata.publicECDSA_openssh, keydata.publicEd25519_openssh))
+        self.assertIsInstance(hostsFile._entries[0], PlainEntry)
+        self.assertIsInstance(hostsFile._entries[1], PlainEntry)
+        self.assertEqual(True, hostsFile.hasHostKey(
+                "ecdsa.example.com", ecdsaKey))
+        self.assertEqual(True, hostsFile.hasHostKey(
+                "ed25519.example.com", ed25519Key))
+        self.assertEqual(False, hostsFile.hasHostKey(
+                "ecdsa.example.com", ed25519Key))
+
+
+    def test_hasKeyOfOtherType(self):
+        """
+        L{KnownHostsFile.hasHostKey} ignores the entries for keys of other
+        types than the given one: it returns C{False} for the RSA key of a
+        host listed only with an Ed25519 key, as OpenSSH writes, rather than
+        raising L{HostKeyChanged}, and still raises it for a different RSA
+        key once one is listed.
+        """
+        line = "example.com %s\n" % (keydata.publicEd25519_openssh,)
+        hostsFile = self.loadSampleHostsFile(line)
+        rsaKey = Key.fromString(sampleKey)
+        self.assertEqual(False, hostsFile.hasHostKey("example.com", rsaKey))
+        hostsFile = self.loadSampleHostsFile(
+            line + "example.com ssh-rsa " + sampleEncodedKey + "\n")
+        self.assertEqual(True, hostsFile.hasHostKey("example.com", rsaKey))
+        exception = self.assertRaises(
+            HostKeyChanged, hostsFile.hasHostKey,
+            "example.com", Key.fromString(otherSampleKey))
+        self.assertEqual(exception.lineno, 2)
+
+
     def test_loadNonExistent(self):
         """
         Loading a L{KnownHostsFile} from a path that does not exist should
@@ -647,6 +690,453 @@ class KnownHostsDatabaseTests(TestCase):
             ui.userWarnings)
 
 
+    def test_lazyKeyParsing(self):
+        """
+        L{KnownHostsFile.fromPath} does not parse keys; L{hasHostKey} only
+        parses the keys of the entries matching the host it looks up.
+        """
+        parsed = []
+        fromString = Key.fromString
+        def recordingFromString(data, *args, **kwargs):
+            parsed.append(data)
+            return fromString(data, *args, **kwargs)
+        self.patch(Key, 'fromString', staticmethod(recordingFromString))
+        hostsFile = self.loadSampleHostsFile()
+        self.assertEqual(parsed, [])
+        self.assertEqual(True, hostsFile.hasHostKey(
+                "divmod.com", fromString(otherSampleKey)))
+        self.assertEqual(parsed, [otherSampleKey])
+
+
+    def test_saltGroups(self):
+        """
+        Hashed entries sharing a salt are looked up with a single HMAC.
+        """
+        salt = "salt" * 5
+        lines = []
+        for hostname in ["a.example.com", "b.example.com", "c.example.com"]:
+            lines.append(HashedEntry(
+                    salt, knownhosts._hmacedString(salt, hostname),
+                    "ssh-rsa", Key.fromString(sampleKey), None).toString())
+        hostsFile = KnownHostsFile.fromPath(
+            self.pathWithContent("\n".join(lines) + "\n"))
+        hmaced = []
+        hmacedString = knownhosts._hmacedString
+        def recordingHmacedString(key, string):
+            hmaced.append(string)
+            return hmacedString(key, string)
+        self.patch(knownhosts, '_hmacedString', recordingHmacedString)
+        self.assertEqual(True, hostsFile.hasHostKey(
+                "b.example.com", Key.fromString(sampleKey)))
+        self.assertEqual(hmaced, ["b.example.com"])
+
+
+    def test_firstMatchingEntry(self):
+        """
+        When plain and hashed entries both match a host, the one which comes
+        first in the file decides whether the key matches.
+        """
+        hostsFile = self.loadSampleHostsFile(
+            sampleHashedLine + "www.twistedmatrix.com ssh-rsa " +
+            otherSampleEncodedKey + "\n")
+        exception = self.assertRaises(
+            HostKeyChanged, hostsFile.hasHostKey,
+            "www.twistedmatrix.com", Key.fromString(otherSampleKey))
+        self.assertEqual(exception.lineno, 1)
+
+
+    def test_invalidKeyMatchesNothing(self):
+        """
+        An entry whose key looks like a key blob but cannot be parsed matches
+        no host, is replaced by an L{UnparsedEntry} once a lookup finds it,
+        and is saved back unchanged.
+        """
+        badKey = b2a_base64("\x00\x00\x00\x07ssh-xyz").strip()
+        content = "www.twistedmatrix.com ssh-rsa " + badKey + "\n"
+        hostsFile = self.loadSampleHostsFile(content)
+        self.assertEqual(False, hostsFile.hasHostKey(
+                "www.twistedmatrix.com", Key.fromString(sampleKey)))
+        self.assertIsInstance(hostsFile._entries[0], UnparsedEntry)
+        self.assertEqual(False, hostsFile.hasHostKey(
+                "www.twistedmatrix.com", Key.fromString(sampleKey)))
+        hostsFile.save()
+        self.assertEqual(hostsFile._savePath.getContent(), content)
+
+
+    def test_indexFile(self):
+        """
+        L{KnownHostsFile.fromPath} given an C{indexPath} writes an index of
+        the file there, and uses it instead of parsing the file while the
+        file is unchanged.
+        """
+        path = self.pathWithContent(sampleHashedLine + otherSamplePlaintextLine)
+        indexPath = FilePath(self.mktemp())
+        KnownHostsFile.fromPath(path, indexPath)
+        self.assertTrue(indexPath.exists())
+        def recordFromLine(line):
+            self.fail("File parsed despite its index.")
+        self.patch(knownhosts, '_recordFromLine', recordFromLine)
+        hostsFile = KnownHostsFile.fromPath(path, indexPath)
+        self.assertEqual(
+            [entry.toString() for entry in hostsFile._entries],
+            [sampleHashedLine.strip(), otherSamplePlaintextLine.strip()])
+        self.assertEqual(True, hostsFile.hasHostKey(
+                "www.twistedmatrix.com", Key.fromString(sampleKey)))
+
+
+    def test_staleIndexFile(self):
+        """
+        An index file which does not match the current contents of the file
+        is ignored and rewritten.
+        """
+        path = self.pathWithContent(sampleHashedLine)
+        indexPath = FilePath(self.mktemp())
+        KnownHostsFile.fromPath(path, indexPath)
+        path.setContent(otherSamplePlaintextLine)
+        hostsFile = KnownHostsFile.fromPath(path, indexPath)
+        self.assertEqual(True, hostsFile.hasHostKey(
+                "divmod.com", Key.fromString(otherSampleKey)))
+        self.assertEqual(False, hostsFile.hasHostKey(
+                "www.twistedmatrix.com", Key.fromString(sampleKey)))
+        indexPath.setContent("garbage")
+        hostsFile = KnownHostsFile.fromPath(path, indexPath)
+        self.assertEqual(len(hostsFile._entries), 1)
+
+
+    def test_indexSignatureTakenBeforeReading(self):
+        """
+        The index is tagged with the contents the file had when it was
+        opened, so a change made while it is being read makes the index
+        stale rather than hiding the change from later loads.
+        """
+        path = self.pathWithContent(sampleHashedLine)
+        indexPath = FilePath(self.mktemp())
+        recordFromLine = knownhosts._recordFromLine
+        def appendingRecordFromLine(line):
+            self.patch(knownhosts, '_recordFromLine', recordFromLine)
+            f = path.open('a')
+            f.write(otherSamplePlaintextLine)
+            f.close()
+            return recordFromLine(line)
+        self.patch(knownhosts, '_recordFromLine', appendingRecordFromLine)
+        KnownHostsFile.fromPath(path, indexPath)
+        hostsFile = KnownHostsFile.fromPath(path, indexPath)
+        self.assertEqual(True, hostsFile.hasHostKey(
+                "divmod.com", Key.fromString(otherSampleKey)))
+
+
+    def test_saveUpdatesIndexFile(self):
+        """
+        L{KnownHostsFile.save} rewrites the index file along with the file,
+        so the next load uses the index.
+        """
+        path = self.pathWithContent(otherSamplePlaintextLine)
+        indexPath = FilePath(self.mktemp())
+        hostsFile = KnownHostsFile.fromPath(path, indexPath)
+        hostsFile.addHostKey("some.example.com", Key.fromString(thirdSampleKey))
+        hostsFile.save()
+        self.patch(knownhosts, '_recordFromLine', None)
+        reloaded = KnownHostsFile.fromPath(path, indexPath)
+        self.assertEqual(True, reloaded.hasHostKey(
+                "some.example.com", Key.fromString(thirdSampleKey)))
+
+
+    def failFindPositions(self):
+        """
+        Make L{KnownHostsFile} fail the test if it searches its indexes.
+        """
+        def findPositions(hostsFile, hostname):
+            self.fail("Searched for %s" % (hostname,))
+        self.patch(KnownHostsFile, '_findPositions', findPositions)
+
+
+    def test_matchesRemembered(self):
+        """
+        L{KnownHostsFile.hasHostKey} remembers which entries match each host
+        it looks up, including hosts without entries.
+        """
+        hostsFile = self.loadSampleHostsFile()
+        hostsFile.hasHostKey("www.twistedmatrix.com", Key.fromString(sampleKey))
+        hostsFile.hasHostKey("unknown.example.com", Key.fromString(sampleKey))
+        self.failFindPositions()
+        self.assertEqual(True, hostsFile.hasHostKey(
+                "www.twistedmatrix.com", Key.fromString(sampleKey)))
+        self.assertEqual(False, hostsFile.hasHostKey(
+                "unknown.example.com", Key.fromString(sampleKey)))
+
+
+    def test_addHostKeyForgetsMatches(self):
+        """
+        Adding an entry forgets the remembered matches, so the entry is found
+        by later lookups.
+        """
+        hostsFile = self.loadSampleHostsFile()
+        aKey = Key.fromString(thirdSampleKey)
+        self.assertEqual(False, hostsFile.hasHostKey("new.example.com", aKey))
+        hostsFile.addHostKey("new.example.com", aKey)
+        self.assertEqual(True, hostsFile.hasHostKey("new.example.com", aKey))
+
+
+    def test_savedMatches(self):
+        """
+        With an index file, the matches of the hosts looked up are saved by
+        L{KnownHostsFile.save} and used by later loads of the unchanged file,
+        without hostnames being written in the clear.
+        """
+        path = self.pathWithContent(sampleHashedLine + otherSamplePlaintextLine)
+        indexPath = FilePath(self.mktemp())
+        hostsFile = KnownHostsFile.fromPath(path, indexPath)
+        hostsFile.hasHostKey("www.twistedmatrix.com", Key.fromString(sampleKey))
+        matchesPath = indexPath.siblingExtension('.matches')
+        self.assertFalse(matchesPath.exists())
+        hostsFile.save()
+        self.assertNotIn("twistedmatrix", matchesPath.getContent())
+        self.failFindPositions()
+        reloaded = KnownHostsFile.fromPath(path, indexPath)
+        self.assertEqual(True, reloaded.hasHostKey(
+                "www.twistedmatrix.com", Key.fromString(sampleKey)))
+
+
+    def test_matchesSavedOnce(self):
+        """
+        Looking hosts up does not write the match file; L{KnownHostsFile.save}
+        writes all the new matches at once.
+        """
+        path = self.pathWithContent(sampleHashedLine + otherSamplePlaintextLine)
+        indexPath = FilePath(self.mktemp())
+        hostsFile = KnownHostsFile.fromPath(path, indexPath)
+        writes = []
+        self.patch(hostsFile, '_saveMatches', lambda: writes.append(None))
+        for i in range(10):
+            hostsFile.hasHostKey("%d.example.com" % (i,),
+                                 Key.fromString(sampleKey))
+        self.assertEqual(writes, [])
+        hostsFile.save()
+        self.assertEqual(len(writes), 1)
+
+
+    def test_matchesBounded(self):
+        """
+        At most C{maxMatches} hosts have their matches remembered; the hosts
+        looked up first are forgotten first.
+        """
+        path = self.pathWithContent(sampleHashedLine + otherSamplePlaintextLine)
+        indexPath = FilePath(self.mktemp())
+        hostsFile = KnownHostsFile.fromPath(path, indexPath)
+        hostsFile.maxMatches = 2
+        for hostname in ["a.example.com", "b.example.com", "c.example.com"]:
+            hostsFile.hasHostKey(hostname, Key.fromString(sampleKey))
+        self.assertEqual(hostsFile._matches.keys(),
+                         ["b.example.com", "c.example.com"])
+        self.assertEqual(len(hostsFile._savedMatches), 2)
+        hostsFile.save()
+        reloaded = KnownHostsFile.fromPath(path, indexPath)
+        reloaded.maxMatches = 1
+        reloaded._loadMatches()
+        self.assertEqual(len(reloaded._savedMatches), 1)
+
+
+    def test_savedMatchesIgnoredAfterChange(self):
+        """
+        Saved matches are ignored once the file has been changed.
+        """
+        path = self.pathWithContent(sampleHashedLine)
+        indexPath = FilePath(self.mktemp())
+        hostsFile = KnownHostsFile.fromPath(path, indexPath)
+        hostsFile.hasHostKey("divmod.com", Key.fromString(otherSampleKey))
+        hostsFile.save()
+        path.setContent(otherSamplePlaintextLine)
+        reloaded = KnownHostsFile.fromPath(path, indexPath)
+        self.assertEqual(True, reloaded.hasHostKey(
+                "divmod.com", Key.fromString(otherSampleKey)))
+
+
+    def test_unsavedEntriesNotSaved(self):
+        """
+        Matches found while entries have been added but not saved are not
+        saved, since they do not describe the file on disk; once the file is
+        saved, its matches are saved again.
+        """
+        path = self.pathWithContent(otherSamplePlaintextLine)
+        indexPath = FilePath(self.mktemp())
+        hostsFile = KnownHostsFile.fromPath(path, indexPath)
+        aKey = Key.fromString(thirdSampleKey)
+        hostsFile.addHostKey("new.example.com", aKey)
+        self.assertEqual(True, hostsFile.hasHostKey("new.example.com", aKey))
+        reloaded = KnownHostsFile.fromPath(path, indexPath)
+        self.assertEqual(False, reloaded.hasHostKey("new.example.com", aKey))
+        hostsFile.save()
+        hostsFile.hasHostKey("new.example.com", aKey)
+        self.failFindPositions()
+        reloaded = KnownHostsFile.fromPath(path, indexPath)
+        self.assertEqual(True, reloaded.hasHostKey("new.example.com", aKey))
+
+
+
+class SharedKnownHostsFileTests(TestCase):
+    """
+    Tests for L{knownhosts.getSharedKnownHostsFile}.
+    """
+
+    def setUp(self):
+        self.patch(knownhosts, '_sharedFiles', {})
+        self.clock = Clock()
+        self.patch(knownhosts._SharedKnownHostsFile, 'clock', self.clock)
+        self.path = FilePath(self.mktemp())
+        self.path.setContent(sampleHashedLine)
+
+
+    def test_shared(self):
+        """
+        L{getSharedKnownHostsFile} returns the same L{KnownHostsFile} for the
+        same path while the file is unchanged.
+        """
+        shared = knownhosts.getSharedKnownHostsFile(self.path)
+        self.assertIsInstance(shared, KnownHostsFile)
+        self.assertIdentical(
+            knownhosts.getSharedKnownHostsFile(FilePath(self.path.path)),
+            shared)
+        self.assertEqual(True, shared.hasHostKey(
+                "www.twistedmatrix.com", Key.fromString(sampleKey)))
+
+
+    def test_reloadOnChange(self):
+        """
+        L{getSharedKnownHostsFile} reads the file again once it has been
+        changed.
+        """
+        shared = knownhosts.getSharedKnownHostsFile(self.path)
+        self.assertEqual(False, shared.hasHostKey(
+                "divmod.com", Key.fromString(otherSampleKey)))
+        self.path.setContent(sampleHashedLine + otherSamplePlaintextLine)
+        shared = knownhosts.getSharedKnownHostsFile(self.path)
+        self.assertEqual(True, shared.hasHostKey(
+                "divmod.com", Key.fromString(otherSampleKey)))
+
+
+    def test_batchedSaves(self):
+        """
+        The first save writes the file at once; saves within C{saveInterval}
+        of it are written together at the end of the interval.
+        """
+        writes = []
+        writeContent = KnownHostsFile._writeContent
+        def recordingWriteContent(hostsFile, content):
+            writes.append(content)
+            return writeContent(hostsFile, content)
+        self.patch(KnownHostsFile, '_writeContent', recordingWriteContent)
+        shared = knownhosts.getSharedKnownHostsFile(self.path)
+        aKey = Key.fromString(thirdSampleKey)
+        shared.addHostKey("one.example.com", aKey)
+        shared.save()
+        self.assertEqual(len(writes), 1)
+        for hostname in ["two.example.com", "three.example.com"]:
+            shared.addHostKey(hostname, aKey)
+            shared.save()
+        self.assertEqual(len(writes), 1)
+        self.clock.advance(shared.saveInterval)
+        self.assertEqual(len(writes), 2)
+        reloaded = KnownHostsFile.fromPath(self.path)
+        for hostname in ["one.example.com", "three.example.com"]:
+            self.assertEqual(True, reloaded.hasHostKey(hostname, aKey))
+
+
+    def test_batchedMatches(self):
+        """
+        The matches of the hosts looked up are written together at the end
+        of C{saveInterval}, and used by later loads of the file.
+        """
+        indexPath = FilePath(self.mktemp())
+        matchesPath = indexPath.siblingExtension('.matches')
+        shared = knownhosts.getSharedKnownHostsFile(self.path, indexPath)
+        writes = []
+        saveMatches = shared._saveMatches
+        def recordingSaveMatches():
+            writes.append(None)
+            saveMatches()
+        self.patch(shared, '_saveMatches', recordingSaveMatches)
+        for hostname in ["www.twistedmatrix.com", "unknown.example.com"]:
+            shared.hasHostKey(hostname, Key.fromString(sampleKey))
+        self.assertFalse(matchesPath.exists())
+        self.clock.advance(shared.saveInterval)
+        self.assertEqual(len(writes), 1)
+        self.patch(KnownHostsFile, '_findPositions', None)
+        reloaded = KnownHostsFile.fromPath(self.path, indexPath)
+        self.assertEqual(True, reloaded.hasHostKey(
+                "www.twistedmatrix.com", Key.fromString(sampleKey)))
+
+
+    def test_matchesOfChangedFileNotWritten(self):
+        """
+        If the file has been changed by someone else by the time new matches
+        are due to be written, it is read again instead, so matches found in
+        the old file are not used for the new one.
+        """
+        indexPath = FilePath(self.mktemp())
+        shared = knownhosts.getSharedKnownHostsFile(self.path, indexPath)
+        self.path.setContent(otherSamplePlaintextLine)
+        self.assertEqual(True, shared.hasHostKey(
+                "www.twistedmatrix.com", Key.fromString(sampleKey)))
+        self.clock.advance(shared.saveInterval)
+        self.assertEqual(False, shared.hasHostKey(
+                "www.twistedmatrix.com", Key.fromString(sampleKey)))
+        reloaded = KnownHostsFile.fromPath(self.path, indexPath)
+        self.assertEqual(False, reloaded.hasHostKey(
+                "www.twistedmatrix.com", Key.fromString(sampleKey)))
+        self.assertEqual(True, reloaded.hasHostKey(
+                "divmod.com", Key.fromString(otherSampleKey)))
+
+
+    def test_reloadKeepsIndex(self):
+        """
+        The shared file keeps its index when it reads the file again after a
+        change.
+        """
+        indexPath = FilePath(self.mktemp())
+        knownhosts.getSharedKnownHostsFile(self.path, indexPath)
+        self.path.setContent(sampleHashedLine + otherSamplePlaintextLine)
+        knownhosts.getSharedKnownHostsFile(self.path, indexPath)
+        self.patch(knownhosts, '_recordFromLine', None)
+        reloaded = KnownHostsFile.fromPath(self.path, indexPath)
+        self.assertEqual(True, reloaded.hasHostKey(
+                "divmod.com", Key.fromString(otherSampleKey)))
+
+
+    def test_defaultClock(self):
+        """
+        The shared file delays its saves with the global reactor unless given
+        another C{clock}; the module does not import the reactor itself.
+        """
+        from twisted.internet import reactor
+        self.assertNotIn('reactor', vars(knownhosts))
+        shared = knownhosts.getSharedKnownHostsFile(self.path)
+        shared.clock = None
+        self.assertIdentical(shared._getClock(), reactor)
+
+
+    def test_mergeExternalChange(self):
+        """
+        Entries waiting to be saved are added to the current contents of the
+        file if it was changed in the meantime.
+        """
+        shared = knownhosts.getSharedKnownHostsFile(self.path)
+        shared.save()
+        aKey = Key.fromString(thirdSampleKey)
+        shared.addHostKey("new.example.com", aKey)
+        shared.save()
+        self.path.setContent(sampleHashedLine + otherSamplePlaintextLine)
+        self.assertIdentical(
+            knownhosts.getSharedKnownHostsFile(self.path), shared)
+        self.clock.advance(shared.saveInterval)
+        reloaded = KnownHostsFile.fromPath(self.path)
+        self.assertEqual(True, reloaded.hasHostKey("new.example.com", aKey))
+        self.assertEqual(True, reloaded.hasHostKey(
+                "divmod.com", Key.fromString(otherSampleKey)))
+        self.assertEqual(True, shared.hasHostKey(
+                "divmod.com", Key.fromString(otherSampleKey)))
+
+
+
 class FakeFile(object):
     """
     A fake file-like object that acts enough like a file for
@@ -865,6 +1355,8 @@ class DefaultAPITests(TestCase):
         """
         self.fakeFile = FakeFile()
         self.patch(default, "_open", self.patchedOpen)
+        self.patch(knownhosts, '_sharedFiles', {})
+        self.patch(knownhosts._SharedKnownHostsFile, 'clock', Clock())
         self.hostsOption = self.mktemp()
         knownHostsFile = KnownHostsFile(FilePath(self.hostsOption))
         knownHostsFile.addHostKey("exists.example.com", Key.fromString(sampleKey))
@@ -977,3 +1469,56 @@ class DefaultAPITests(TestCase):
             self.fakeTransport, "4.3.2.1", otherSampleKey,
             "Again, not required.")
         return self.assertFailure(d, HostKeyChanged)
+
+
+    def test_verifyUsesIndex(self):
+        """
+        L{default.verifyHostKey} keeps an index of the known hosts file next
+        to it.
+        """
+        default.verifyHostKey(self.fakeTransport, "4.3.2.1", sampleKey,
+                              "I don't care.")
+        self.assertTrue(
+            FilePath(self.hostsOption).siblingExtension('.index').exists())
+
+
+    def test_isInKnownHosts(self):
+        """
+        L{default.isInKnownHosts} returns C{1} for a host listed with the
+        given key, C{2} for a host listed with another key, and C{0} for a
+        host which is not listed.
+        """
+        options = {'known-hosts': self.hostsOption}
+        self.assertEqual(
+            1, default.isInKnownHosts("4.3.2.1", sampleKey, options))
+        self.assertEqual(
+            2, default.isInKnownHosts("4.3.2.1", otherSampleKey, options))
+        self.assertEqual(
+            0, default.isInKnownHosts("5.6.7.8", sampleKey, options))
+
+
+    def test_isInKnownHostsKeyType(self):
+        """
+        L{default.isInKnownHosts} only compares the given key with the keys
+        of the same type listed for the host: a host listed only with a key
+        of another type is not known, and a host listed with several keys is
+        known if any of them matches.
+        """
+        dsaKey = Key.fromString(keydata.publicDSA_openssh)
+        path = FilePath(self.hostsOption)
+        hostsFile = KnownHostsFile.fromPath(path)
+        hostsFile.addHostKey("dsa.example.com", dsaKey)
+        hostsFile.addHostKey("two.example.com", Key.fromString(otherSampleKey))
+        hostsFile.addHostKey("two.example.com", Key.fromString(sampleKey))
+        hostsFile.save()
+        options = {'known-hosts': self.hostsOption}
+        self.assertEqual(
+            0, default.isInKnownHosts("dsa.example.com", sampleKey, options))
+        self.assertEqual(
+            1, default.isInKnownHosts("dsa.example.com", dsaKey.blob(),
+                                      options))
+        self.assertEqual(
+            1, default.isInKnownHosts("two.example.com", sampleKey, options))
+        self.assertEqual(
+            2, default.isInKnownHosts("two.example.com", thirdSampleKey,
+                                      options))
@@ -0,0 +1,364 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+Tests for L{twisted.conch.memory}.
+"""
+
+import stat
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.protocols import loopback
+from twisted.conch.ssh import filetransfer
+from twisted.conch.ssh.filetransfer import (
+    FXF_READ, FXF_WRITE, FXF_APPEND, FXF_CREAT, FXF_TRUNC, FXF_EXCL,
+    FX_NO_SUCH_FILE, FX_FAILURE, FX_FILE_ALREADY_EXISTS, SFTPError)
+from twisted.conch.memory import (
+    MemoryFilesystem, MemorySFTPServer, MemoryConchUser, MemorySFTPRealm)
+from twisted.conch.interfaces import IConchUser, ISFTPServer
+
+
+class MemorySFTPServerTests(unittest.TestCase):
+    """
+    Tests for L{MemorySFTPServer} and the files and directories it opens.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.filesystem = MemoryFilesystem(clock=self.clock)
+        self.server = MemorySFTPServer(self.filesystem)
+
+
+    def writeFile(self, path, data, flags=FXF_WRITE | FXF_CREAT | FXF_TRUNC):
+        f = self.server.openFile(path, flags, {})
+        f.writeChunk(0, data)
+        f.close()
+
+
+    def readFile(self, path):
+        f = self.server.openFile(path, FXF_READ, {})
+        data = f.readChunk(0, 1024 * 1024)
+        f.close()
+        return data
+
+
+    def assertSFTPError(self, code, f, *args):
+        error = self.assertRaises(SFTPError, f, *args)
+        self.assertEqual(error.code, code)
+
+
+    def test_writeAndRead(self):
+        """
+        Data written to a file can be read back, and reads past the end of
+        the file return no data.
+        """
+        self.writeFile('file', 'hello world')
+        f = self.server.openFile('file', FXF_READ, {})
+        self.assertEqual(f.readChunk(6, 100), 'world')
+        self.assertEqual(f.readChunk(11, 100), '')
+        self.assertEqual(f.getAttrs()['size'], 11)
+        f.close()
+        self.assertEqual(self.filesystem.used, 11)
+
+
+    def test_sparseWrite(self):
+        """
+        Writing past the end of a file fills the gap with zeros.
+        """
+        f = self.server.openFile('file', FXF_WRITE | FXF_CREAT, {})
+        f.writeChunk(4, 'abc')
+        f.close()
+        self.assertEqual(self.readFile('file'), '\0\0\0\0abc')
+
+
+    def test_append(self):
+        """
+        Files opened with C{FXF_APPEND} are written at their end, whatever
+        the offset.
+        """
+        self.writeFile('file', 'abc')
+        f = self.server.openFile('file', FXF_WRITE | FXF_APPEND, {})
+        f.writeChunk(0, 'def')
+        f.close()
+        self.assertEqual(self.readFile('file'), 'abcdef')
+
+
+    def test_openFlags(self):
+        """
+        Opening a missing file without C{FXF_CREAT}, or an existing one with
+        C{FXF_CREAT} and C{FXF_EXCL}, fails; C{FXF_TRUNC} empties the file.
+        """
+        self.assertSFTPError(FX_NO_SUCH_FILE, self.server.openFile, 'file',
+                             FXF_READ, {})
+        self.writeFile('file', 'abc')
+        self.assertSFTPError(FX_FILE_ALREADY_EXISTS, self.server.openFile,
+                             'file', FXF_WRITE | FXF_CREAT | FXF_EXCL, {})
+        self.server.openFile('file', FXF_WRITE | FXF_TRUNC, {}).close()
+        self.assertEqual(self.readFile('file'), '')
+        self.assertEqual(self.filesystem.used, 0)
+
+
+    def test_openAttributes(self):
+        """
+        Files are created with the permissions they are opened with.
+        """
+        self.server.openFile('file', FXF_WRITE | FXF_CREAT,
+                             {'permissions': 0600}).close()
+        self.assertEqual(self.server.getAttrs('file', True)['permissions'],
+                         stat.S_IFREG | 0600)
+
+
+    def test_quota(self):
+        """
+        Writes which would take the filesystem over its quota fail, leaving
+        the file as it was.
+        """
+        self.filesystem.quota = 10
+        f = self.server.openFile('file', FXF_WRITE | FXF_CREAT, {})
+        f.writeChunk(0, 'a' * 8)
+        self.assertSFTPError(FX_FAILURE, f.writeChunk, 8, 'bbb')
+        f.writeChunk(0, 'c' * 10)
+        f.close()
+        self.assertEqual(self.filesystem.used, 10)
+        self.assertSFTPError(FX_FAILURE, self.server.setAttrs, 'file',
+                             {'size': 11})
+        self.server.setAttrs('file', {'size': 4})
+        self.assertEqual(self.readFile('file'), 'cccc')
+        self.assertEqual(self.filesystem.used, 4)
+
+
+    def test_openIgnoresSize(self):
+        """
+        A size among the attributes given when a file is opened does not
+        truncate or extend it, as it does when set with C{setAttrs}.
+        """
+        f = self.server.openFile('file', FXF_WRITE | FXF_CREAT, {})
+        f.writeChunk(0, 'abcdef')
+        f.close()
+        self.server.openFile('file', FXF_WRITE, {'size': 2}).close()
+        self.assertEqual(self.readFile('file'), 'abcdef')
+
+
+    def test_maxEntries(self):
+        """
+        No more than C{maxEntries} files, directories and links may be
+        created.
+        """
+        self.filesystem.maxEntries = 2
+        self.writeFile('file', '')
+        self.server.makeDirectory('directory', {})
+        self.assertSFTPError(FX_FAILURE, self.writeFile, 'other', '')
+        self.assertSFTPError(FX_FAILURE, self.server.makeLink, 'link', 'file')
+        self.server.removeFile('file')
+        self.server.makeLink('link', 'directory')
+
+
+    def test_removeOpenFile(self):
+        """
+        A file removed while it is open keeps its contents, and its space,
+        until it is closed.
+        """
+        self.writeFile('file', 'abc')
+        f = self.server.openFile('file', FXF_READ, {})
+        self.server.removeFile('file')
+        self.assertSFTPError(FX_NO_SUCH_FILE, self.server.getAttrs, 'file',
+                             True)
+        self.assertEqual(f.readChunk(0, 3), 'abc')
+        self.assertEqual(self.filesystem.used, 3)
+        f.close()
+        self.assertEqual((self.filesystem.used, self.filesystem.entries),
+                         (0, 0))
+
+
+    def test_directories(self):
+        """
+        Directories can be made, listed in order, and removed once empty.
+        """
+        self.server.makeDirectory('directory', {})
+        self.writeFile('directory/b', 'bb')
+        self.writeFile('directory/a', 'a')
+        directory = self.server.openDirectory('directory')
+        entries = list(directory)
+        directory.close()
+        self.assertEqual([name for (name, longname, attrs) in entries],
+                         ['a', 'b'])
+        self.assertEqual(entries[1][2]['size'], 2)
+        self.assertTrue(entries[1][1].startswith('-rw-r--r--'))
+        self.assertSFTPError(FX_FAILURE, self.server.removeDirectory,
+                             'directory')
+        self.assertSFTPError(FX_FILE_ALREADY_EXISTS,
+                             self.server.makeDirectory, 'directory', {})
+        self.server.removeFile('directory/a')
+        self.server.removeFile('directory/b')
+        self.server.removeDirectory('directory')
+        self.assertEqual(self.filesystem.entries, 0)
+
+
+    def test_notADirectory(self):
+        """
+        Paths which go through a file fail.
+        """
+        self.writeFile('file', '')
+        self.assertSFTPError(FX_FAILURE, self.server.getAttrs, 'file/x', True)
+        self.assertSFTPError(FX_FAILURE, self.server.openDirectory, 'file')
+        self.assertSFTPError(FX_NO_SUCH_FILE, self.server.openDirectory,
+                             'missing')
+
+
+    def test_rename(self):
+        """
+        Renaming a file replaces any file at its new path and gives back
+        that file's space; directories cannot be moved into themselves.
+        """
+        self.writeFile('old', 'abc')
+        self.writeFile('new', 'defgh')
+        self.server.renameFile('old', 'new')
+        self.assertEqual(self.readFile('new'), 'abc')
+        self.assertEqual((self.filesystem.used, self.filesystem.entries),
+                         (3, 1))
+        self.server.makeDirectory('directory', {})
+        self.server.renameFile('new', 'directory/moved')
+        self.assertEqual(self.readFile('directory/moved'), 'abc')
+        self.assertSFTPError(FX_FAILURE, self.server.renameFile, 'directory',
+                             'directory/inner')
+        self.server.renameFile('directory', 'renamed')
+        self.assertEqual(self.readFile('renamed/moved'), 'abc')
+
+
+    def test_links(self):
+        """
+        Symbolic links are followed, relative to their directory, unless
+        they are the last component of a path which asks not to.
+        """
+        self.server.makeDirectory('directory', {})
+        self.writeFile('directory/file', 'abc')
+        self.server.makeLink('directory/link', 'file')
+        self.server.makeLink('dirlink', 'directory')
+        self.assertEqual(self.server.readLink('directory/link'), 'file')
+        self.assertEqual(self.readFile('dirlink/link'), 'abc')
+        self.assertEqual(self.server.getAttrs('dirlink/link', True)['size'],
+                         3)
+        self.assertTrue(stat.S_ISLNK(
+                self.server.getAttrs('dirlink/link', False)['permissions']))
+        self.assertEqual(self.server.realPath('dirlink/link'),
+                         '/directory/file')
+
+
+    def test_linkLoop(self):
+        """
+        Following a loop of links fails.
+        """
+        self.server.makeLink('a', 'b')
+        self.server.makeLink('b', 'a')
+        self.assertSFTPError(FX_FAILURE, self.server.getAttrs, 'a', True)
+
+
+    def test_realPath(self):
+        """
+        Paths are resolved from the root of the filesystem, which cannot be
+        escaped.
+        """
+        self.assertEqual(self.server.realPath('.'), '/')
+        self.assertEqual(self.server.realPath('../..'), '/')
+
+
+    def test_times(self):
+        """
+        Writing to a file sets its modification time from the clock, and
+        C{setAttrs} sets its times and permissions.
+        """
+        self.clock.advance(100)
+        self.writeFile('file', 'abc')
+        self.assertEqual(self.server.getAttrs('file', True)['mtime'], 100)
+        self.server.setAttrs('file', {'atime': 1, 'mtime': 2,
+                                      'permissions': 0700})
+        attrs = self.server.getAttrs('file', True)
+        self.assertEqual((attrs['atime'], attrs['mtime'],
+                          attrs['permissions']), (1, 2, stat.S_IFREG | 0700))
+
+
+    def test_statVFS(self):
+        """
+        C{statVFS} reports the quota, in 1 byte blocks, and the entries left.
+        """
+        self.assertRaises(NotImplementedError, self.server.statVFS, '.')
+        self.filesystem.quota = 100
+        self.filesystem.maxEntries = 10
+        self.writeFile('file', 'abc')
+        result = self.server.statVFS('.')
+        self.assertEqual((result.f_blocks, result.f_bavail, result.f_files,
+                          result.f_ffree), (100, 97, 10, 9))
+
+
+
+class MemorySFTPRealmTests(unittest.TestCase):
+    """
+    Tests for L{MemorySFTPRealm} and L{MemoryConchUser}.
+    """
+
+    def test_avatarsShareFilesystem(self):
+        """
+        Every avatar serves the realm's filesystem.
+        """
+        filesystem = MemoryFilesystem()
+        realm = MemorySFTPRealm(filesystem)
+        interface, avatar, logout = realm.requestAvatar('alice', None,
+                                                        IConchUser)
+        self.assertIdentical(interface, IConchUser)
+        self.assertIsInstance(avatar, MemoryConchUser)
+        server = ISFTPServer(avatar)
+        self.assertIsInstance(server, MemorySFTPServer)
+        self.assertIdentical(server.filesystem, filesystem)
+
+
+
+class MemoryOverSFTPTests(unittest.TestCase):
+    """
+    Tests for serving a L{MemoryFilesystem} with
+    L{filetransfer.FileTransferServer}.
+    """
+
+    def setUp(self):
+        self.filesystem = MemoryFilesystem()
+        avatar = MemoryConchUser('alice', self.filesystem)
+        self.server = filetransfer.FileTransferServer(avatar=avatar)
+        self.client = filetransfer.FileTransferClient()
+        self.clientTransport = loopback.LoopbackRelay(self.server)
+        self.serverTransport = loopback.LoopbackRelay(self.client)
+        self.client.makeConnection(self.clientTransport)
+        self.server.makeConnection(self.serverTransport)
+        self.emptyBuffers()
+
+
+    def emptyBuffers(self):
+        while self.serverTransport.buffer or self.clientTransport.buffer:
+            self.serverTransport.clearBuffer()
+            self.clientTransport.clearBuffer()
+
+
+    def tearDown(self):
+        self.serverTransport.loseConnection()
+        self.clientTransport.loseConnection()
+        self.emptyBuffers()
+
+
+    def test_writeReadAndList(self):
+        """
+        Files written over SFTP can be read back and listed.
+        """
+        results = []
+        d = self.client.openFile('file', FXF_WRITE | FXF_CREAT, {})
+        d.addCallback(lambda f: f.writeChunk(0, 'hello').addCallback(
+                lambda ignored: f.close()))
+        d.addCallback(lambda ignored: self.client.openFile('file', FXF_READ,
+                                                           {}))
+        d.addCallback(lambda f: f.readChunk(0, 100))
+        d.addCallback(results.append)
+        self.emptyBuffers()
+        self.assertEqual(results, ['hello'])
+        listed = []
+        self.client.listDirectory('.', listed.extend)
+        self.emptyBuffers()
+        self.assertEqual([entry[0] for entry in listed], ['file'])
+        self.assertEqual(listed[0][2]['size'], 5)
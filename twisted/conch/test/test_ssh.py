@@ -17,13 +17,15 @@ try:
 except ImportError:
     pyasn1 = None
 
-from twisted.conch.ssh import common, session, forwarding
+from twisted.conch.ssh import common, session, forwarding, throttle
 from twisted.conch import avatar, error
 from twisted.conch.test.keydata import publicRSA_openssh, privateRSA_openssh
 from twisted.conch.test.keydata import publicDSA_openssh, privateDSA_openssh
+from twisted.conch.test import keydata
 from twisted.cred import portal
 from twisted.cred.error import UnauthorizedLogin
-from twisted.internet import defer, protocol, reactor
+from twisted.internet import defer, protocol, reactor, task
+from twisted.internet.address import IPv4Address
 from twisted.internet.error import ProcessTerminated
 from twisted.python import failure, log
 from twisted.trial import unittest
@@ -829,7 +831,7 @@ class TestSSHFactory(unittest.TestCase):
 
     def makeSSHFactory(self, primes=None):
         sshFactory = factory.SSHFactory()
-        gpk = lambda: {'ssh-rsa' : keys.Key(None)}
+        gpk = lambda: {'ssh-rsa' : keys.Key.fromString(privateRSA_openssh)}
         sshFactory.getPrimes = lambda: primes
         sshFactory.getPublicKeys = sshFactory.getPrivateKeys = gpk
         sshFactory.startFactory()
@@ -846,6 +848,32 @@ class TestSSHFactory(unittest.TestCase):
         self.assertIsInstance(protocol, transport.SSHServerTransport)
 
 
+    def test_buildProtocolPublicKeys(self):
+        """
+        buildProtocol() offers the types of the factory's private keys as
+        public key algorithms, preceded by the SHA-2 algorithms for an RSA
+        key.
+        """
+        protocol = self.makeSSHFactory().buildProtocol(None)
+        self.assertEqual(protocol.supportedPublicKeys,
+                         ['rsa-sha2-512', 'rsa-sha2-256', 'ssh-rsa'])
+
+
+    def test_buildProtocolSigningKeysOnly(self):
+        """
+        buildProtocol() does not offer the types of private keys which cannot
+        sign, such as ECDSA and Ed25519 keys.
+        """
+        sshFactory = self.makeSSHFactory()
+        sshFactory.privateKeys['ecdsa-sha2-nistp256'] = keys.Key.fromString(
+            keydata.privateECDSA_openssh)
+        sshFactory.privateKeys['ssh-ed25519'] = keys.Key.fromString(
+            keydata.privateEd25519_openssh)
+        protocol = sshFactory.buildProtocol(None)
+        self.assertEqual(protocol.supportedPublicKeys,
+                         ['rsa-sha2-512', 'rsa-sha2-256', 'ssh-rsa'])
+
+
     def test_buildProtocolRespectsProtocol(self):
         """
         buildProtocol() calls 'self.protocol()' to construct a protocol
@@ -861,6 +889,24 @@ class TestSSHFactory(unittest.TestCase):
         self.assertEqual([()], calls)
 
 
+    def test_buildProtocolRateLimited(self):
+        """
+        buildProtocol() returns C{None}, refusing the connection, for a host
+        which has run out of attempts in the factory's C{authRateLimiter}.
+        """
+        factory = self.makeSSHFactory()
+        limiter = throttle.AuthenticationRateLimiter(
+            sourceBurst=1, clock=task.Clock())
+        factory.authRateLimiter = limiter
+        addr = IPv4Address('TCP', '10.0.0.1', 22)
+        self.assertNotIdentical(factory.buildProtocol(addr), None)
+        limiter.failed('10.0.0.1', 'root')
+        self.assertIdentical(factory.buildProtocol(addr), None)
+        self.assertNotIdentical(
+            factory.buildProtocol(IPv4Address('TCP', '10.0.0.2', 22)), None)
+        self.assertEqual(limiter.refusedConnections, 1)
+
+
     def test_multipleFactories(self):
         f1 = self.makeSSHFactory(primes=None)
         f2 = self.makeSSHFactory(primes={1:(2,3)})
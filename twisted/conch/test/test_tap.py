@@ -25,6 +25,7 @@ if Crypto and pyasn1 and unix:
     from twisted.conch.openssh_compat.factory import OpenSSHFactory
 
 from twisted.python.compat import set
+from twisted.python import usage
 from twisted.application.internet import StreamServerEndpointService
 from twisted.cred import error
 from twisted.cred.credentials import IPluggableAuthenticationModules
@@ -171,3 +172,46 @@ class MakeServiceTest(TestCase):
         self.assertEqual(
             set(portal.checkers.keys()),
             set([ISSHPrivateKey, IUsernamePassword]))
+
+
+    def test_passwordThreadsDefault(self):
+        """
+        By default the UNIX password checker checks passwords in the reactor
+        thread.
+        """
+        self.options.parseOptions([])
+        [checker] = self.options['credInterfaces'][IUsernamePassword]
+        self.assertEqual(checker.maxThreads, 0)
+
+
+    def test_passwordThreads(self):
+        """
+        The C{--password-threads} option replaces the default UNIX password
+        checker with one which checks passwords in that many threads.
+        """
+        self.options.parseOptions(['--password-threads', '3'])
+        [checker] = self.options['credInterfaces'][IUsernamePassword]
+        self.assertEqual(checker.maxThreads, 3)
+        self.assertIn(checker, self.options['credCheckers'])
+        self.assertEqual(
+            [c for c in self.options['credCheckers']
+             if IUsernamePassword in c.credentialInterfaces], [checker])
+
+
+    def test_passwordThreadsWithAuth(self):
+        """
+        The C{--password-threads} option leaves checkers given with C{--auth}
+        alone.
+        """
+        self.options.parseOptions(['--password-threads', '3',
+                                   '--auth', 'file:' + self.filename])
+        [checker] = self.options['credCheckers']
+        self.assertFalse(hasattr(checker, 'maxThreads'))
+
+
+    def test_passwordThreadsNegative(self):
+        """
+        A negative C{--password-threads} is rejected.
+        """
+        self.assertRaises(usage.UsageError, self.options.parseOptions,
+                          ['--password-threads', '-1'])
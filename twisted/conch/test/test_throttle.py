@@ -0,0 +1,166 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+Tests for L{twisted.conch.ssh.throttle}.
+"""
+
+from twisted.conch.ssh import throttle
+from twisted.internet import task
+from twisted.trial import unittest
+
+
+
+class TimerWheelTests(unittest.TestCase):
+    """
+    Tests for L{throttle.TimerWheel}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = throttle.TimerWheel(self.clock)
+        self.called = []
+
+
+    def test_callLater(self):
+        """
+        A call runs once its delay has passed, rounded up to the wheel's
+        resolution.
+        """
+        call = self.wheel.callLater(1.5, self.called.append, 'a')
+        self.assertTrue(call.active())
+        self.clock.advance(1.5)
+        self.assertEqual(self.called, [])
+        self.clock.advance(0.5)
+        self.assertEqual(self.called, ['a'])
+        self.assertFalse(call.active())
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_singleDelayedCall(self):
+        """
+        However many calls are scheduled, the wheel keeps one delayed call
+        on its clock, for the earliest of them.
+        """
+        for i in range(100):
+            self.wheel.callLater(10 + i, self.called.append, i)
+        self.wheel.callLater(5, self.called.append, 'first')
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.assertEqual(self.clock.getDelayedCalls()[0].getTime(), 5)
+        self.clock.pump([5, 5, 1])
+        self.assertEqual(self.called, ['first', 0, 1])
+        self.assertEqual(len(self.wheel), 98)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+
+    def test_cancel(self):
+        """
+        A cancelled call does not run, and the wheel stops once nothing is
+        left to run.
+        """
+        first = self.wheel.callLater(1, self.called.append, 'a')
+        second = self.wheel.callLater(1, self.called.append, 'b')
+        first.cancel()
+        self.assertRaises(ValueError, first.cancel)
+        self.clock.advance(1)
+        self.assertEqual(self.called, ['b'])
+        self.assertFalse(first.active())
+        self.assertFalse(second.active())
+        call = self.wheel.callLater(1, self.called.append, 'c')
+        call.cancel()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(len(self.wheel), 0)
+
+
+    def test_cancelFromCall(self):
+        """
+        A call may cancel another call due in the same slot, which then does
+        not run.
+        """
+        calls = []
+        def cancel():
+            calls[1].cancel()
+        calls.append(self.wheel.callLater(1, cancel))
+        calls.append(self.wheel.callLater(1, self.called.append, 'b'))
+        self.clock.advance(1)
+        self.assertEqual(self.called, [])
+
+
+    def test_scheduleFromCall(self):
+        """
+        Calls scheduled by a running call are run when they come due.
+        """
+        self.wheel.callLater(
+            1, self.wheel.callLater, 1, self.called.append, 'b')
+        self.clock.advance(1)
+        self.assertEqual(self.called, [])
+        self.clock.advance(1)
+        self.assertEqual(self.called, ['b'])
+
+
+
+class AuthenticationRateLimiterTests(unittest.TestCase):
+    """
+    Tests for L{throttle.AuthenticationRateLimiter}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.limiter = throttle.AuthenticationRateLimiter(
+            sourceRate=1, sourceBurst=2, userRate=0.5, userBurst=3,
+            clock=self.clock)
+
+
+    def test_sourceBucket(self):
+        """
+        Once a host has used up its burst of failures, its attempts and
+        connections are refused until its bucket refills.
+        """
+        self.assertTrue(self.limiter.allowAttempt('10.0.0.1', 'alice'))
+        self.limiter.failed('10.0.0.1', 'alice')
+        self.limiter.failed('10.0.0.1', 'bob')
+        self.assertFalse(self.limiter.allowAttempt('10.0.0.1', 'carol'))
+        self.assertFalse(self.limiter.allowConnection('10.0.0.1'))
+        self.assertTrue(self.limiter.allowConnection('10.0.0.2'))
+        self.clock.advance(1)
+        self.assertTrue(self.limiter.allowAttempt('10.0.0.1', 'carol'))
+        self.assertTrue(self.limiter.allowConnection('10.0.0.1'))
+        self.assertEqual(
+            (self.limiter.accepted, self.limiter.rejected,
+             self.limiter.refusedConnections), (2, 1, 1))
+
+
+    def test_userBucket(self):
+        """
+        Failures for a username are counted across hosts.
+        """
+        for host in ['10.0.0.1', '10.0.0.2', '10.0.0.3']:
+            self.limiter.failed(host, 'root')
+        self.assertFalse(self.limiter.allowAttempt('10.0.0.4', 'root'))
+        self.assertTrue(self.limiter.allowAttempt('10.0.0.4', 'alice'))
+        self.clock.advance(2)
+        self.assertTrue(self.limiter.allowAttempt('10.0.0.4', 'root'))
+
+
+    def test_unknownHost(self):
+        """
+        Attempts without a host are only limited by username, and connections
+        without one are always accepted.
+        """
+        for i in range(3):
+            self.limiter.failed(None, 'root')
+        self.assertFalse(self.limiter.allowAttempt(None, 'root'))
+        self.assertTrue(self.limiter.allowConnection(None))
+
+
+    def test_maxBuckets(self):
+        """
+        At most C{maxBuckets} buckets of each kind are kept, the least
+        recently used being forgotten first.
+        """
+        self.limiter.maxBuckets = 2
+        for host in ['10.0.0.1', '10.0.0.2', '10.0.0.3']:
+            self.limiter.failed(host, host)
+        self.assertEqual(self.limiter._sources.keys(),
+                         ['10.0.0.2', '10.0.0.3'])
+        self.assertEqual(len(self.limiter._users), 2)
@@ -256,7 +256,11 @@ class MockFactory(factory.SSHFactory):
         """
         return {
             'ssh-rsa': keys.Key.fromString(keydata.publicRSA_openssh),
-            'ssh-dsa': keys.Key.fromString(keydata.publicDSA_openssh)}
+            'ssh-dsa': keys.Key.fromString(keydata.publicDSA_openssh),
+            'ecdsa-sha2-nistp256': keys.Key.fromString(
+                keydata.publicECDSA_openssh),
+            'ssh-ed25519': keys.Key.fromString(
+                keydata.publicEd25519_openssh)}
 
 
     def getPrivateKeys(self):
@@ -265,7 +269,11 @@ class MockFactory(factory.SSHFactory):
         """
         return {
             'ssh-rsa': keys.Key.fromString(keydata.privateRSA_openssh),
-            'ssh-dsa': keys.Key.fromString(keydata.privateDSA_openssh)}
+            'ssh-dsa': keys.Key.fromString(keydata.privateDSA_openssh),
+            'ecdsa-sha2-nistp256': keys.Key.fromString(
+                keydata.privateECDSA_openssh),
+            'ssh-ed25519': keys.Key.fromString(
+                keydata.privateEd25519_openssh)}
 
 
     def getPrimes(self):
@@ -1317,6 +1325,30 @@ class ServerSSHTransportTestCase(ServerAndClientSSHTransportBaseCase,
              (transport.MSG_NEWKEYS, '')])
 
 
+    def test_KEXDH_INITSHA2(self):
+        """
+        If C{rsa-sha2-256} is agreed upon, the KEXDH_REPLY carries the
+        C{ssh-rsa} host key and a signature of the exchange hash by it with
+        SHA-256.
+        """
+        self.proto.supportedKeyExchanges = ['diffie-hellman-group1-sha1']
+        self.proto.supportedPublicKeys = ['rsa-sha2-256']
+        self.proto.dataReceived(self.transport.value())
+        e = pow(transport.DH_GENERATOR, 5000,
+                transport.DH_PRIME)
+
+        self.proto.ssh_KEX_DH_GEX_REQUEST_OLD(common.MP(e))
+        messageType, payload = self.packets[0]
+        self.assertEqual(messageType, transport.MSG_KEXDH_REPLY)
+        blob, rest = common.getNS(payload)
+        f, rest = common.getMP(rest)
+        signature = common.getNS(rest)[0]
+        publicKey = self.proto.factory.publicKeys['ssh-rsa']
+        self.assertEqual(blob, publicKey.blob())
+        self.assertEqual(common.getNS(signature)[0], 'rsa-sha2-256')
+        self.assertTrue(publicKey.verify(signature, self.proto.sessionID))
+
+
     def test_KEX_DH_GEX_REQUEST_OLD(self):
         """
         Test that the KEX_DH_GEX_REQUEST_OLD message causes the server
@@ -1543,6 +1575,22 @@ class ClientSSHTransportTestCase(ServerAndClientSSHTransportBaseCase,
         self.assertEqual(ne.inMACType, 'hmac-sha1')
 
 
+    def test_ellipticCurveHostKeys(self):
+        """
+        Clients accept ECDSA and Ed25519 host keys, which they only verify,
+        after the RSA and DSA ones.  Servers do not offer them, since these
+        keys cannot sign.
+        """
+        ellipticCurveTypes = ['ecdsa-sha2-nistp256', 'ecdsa-sha2-nistp384',
+                              'ecdsa-sha2-nistp521', 'ssh-ed25519']
+        self.assertEqual(self.proto.supportedPublicKeys,
+                         transport.SSHTransportBase.supportedPublicKeys +
+                         ellipticCurveTypes)
+        for keyType in ellipticCurveTypes:
+            self.assertNotIn(
+                keyType, transport.SSHServerTransport.supportedPublicKeys)
+
+
     def verifyHostKey(self, pubKey, fingerprint):
         """
         Mock version of SSHClientTransport.verifyHostKey.
@@ -1631,7 +1679,7 @@ class ClientSSHTransportTestCase(ServerAndClientSSHTransportBaseCase,
             self.assertEqual(self.calledVerifyHostKey, True)
             self.assertEqual(self.proto.sessionID, exchangeHash)
 
-        signature = self.privObj.sign(exchangeHash)
+        signature = self.privObj.sign(exchangeHash, self.proto.keyAlg)
 
         d = self.proto.ssh_KEX_DH_GEX_GROUP(
             (common.NS(self.blob) + '\x00\x00\x00\x01\x02' +
@@ -1681,7 +1729,7 @@ class ClientSSHTransportTestCase(ServerAndClientSSHTransportBaseCase,
             self.assertEqual(self.calledVerifyHostKey, True)
             self.assertEqual(self.proto.sessionID, exchangeHash)
 
-        signature = self.privObj.sign(exchangeHash)
+        signature = self.privObj.sign(exchangeHash, self.proto.keyAlg)
 
         d = self.proto.ssh_KEX_DH_GEX_REPLY(
             common.NS(self.blob) +
@@ -1768,6 +1816,27 @@ class ClientSSHTransportTestCase(ServerAndClientSSHTransportBaseCase,
         self.checkDisconnected(transport.DISCONNECT_KEY_EXCHANGE_FAILED)
 
 
+    def test_disconnectKEXDH_REPLYWrongSignatureType(self):
+        """
+        KEXDH_REPLY disconnects if the signature is good but was not made with
+        the agreed-upon public key algorithm.
+        """
+        self.test_KEXINIT_group1()
+        self.assertEqual(self.proto.keyAlg, 'rsa-sha2-512')
+        sharedSecret = common._MPpow(transport.DH_GENERATOR,
+                                     self.proto.x, transport.DH_PRIME)
+        h = sha1()
+        h.update(common.NS(self.proto.ourVersionString) * 2)
+        h.update(common.NS(self.proto.ourKexInitPayload) * 2)
+        h.update(common.NS(self.blob))
+        h.update(self.proto.e)
+        h.update('\x00\x00\x00\x01\x02') # f
+        h.update(sharedSecret)
+        signature = self.privObj.sign(h.digest(), 'ssh-rsa')
+        self.proto._continueKEXDH_REPLY(None, self.blob, 2, signature)
+        self.checkDisconnected(transport.DISCONNECT_KEY_EXCHANGE_FAILED)
+
+
     def test_disconnectGEX_REPLYBadSignature(self):
         """
         Like test_disconnectKEXDH_REPLYBadSignature, but for DH_GEX_REPLY.
@@ -2053,6 +2122,20 @@ class TransportLoopbackTestCase(unittest.TestCase):
         return defer.DeferredList(deferreds, fireOnOneErrback=True)
 
 
+    def test_publicKeys(self):
+        """
+        Like test_ciphers, but for the RSA host key signing with SHA-1 or
+        SHA-2.
+        """
+        deferreds = []
+        for keyType in ['ssh-rsa', 'rsa-sha2-256', 'rsa-sha2-512']:
+            def setPublicKey(proto):
+                proto.supportedPublicKeys = [keyType]
+                return proto
+            deferreds.append(self._runClientServer(setPublicKey))
+        return defer.DeferredList(deferreds, fireOnOneErrback=True)
+
+
 class RandomNumberTestCase(unittest.TestCase):
     """
     Tests for the random number generator L{_getRandomNumber} and private
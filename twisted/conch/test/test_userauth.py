@@ -18,6 +18,7 @@ from twisted.cred.error import UnauthorizedLogin
 from twisted.cred.portal import IRealm, Portal
 from twisted.conch.error import ConchError, ValidPublicKey
 from twisted.internet import defer, task
+from twisted.internet.address import IPv4Address
 from twisted.protocols import loopback
 from twisted.trial import unittest
 
@@ -42,7 +43,7 @@ except ImportError:
 else:
     from twisted.conch.ssh.common import NS
     from twisted.conch.checkers import SSHProtocolChecker
-    from twisted.conch.ssh import keys, userauth, transport
+    from twisted.conch.ssh import keys, userauth, transport, throttle
     from twisted.conch.test import keydata
 
 
@@ -340,6 +341,25 @@ class SSHUserAuthServerTestCase(unittest.TestCase):
         return d.addCallback(check)
 
 
+    def test_passwordCredentialsPeerHost(self):
+        """
+        The credentials of a password login carry the host the client
+        connects from as C{peerHost}, or C{None} if it is not known.
+        """
+        offered = []
+        login = self.portal.login
+        def recordingLogin(credentials, mind, *interfaces):
+            offered.append(credentials)
+            return login(credentials, mind, *interfaces)
+        self.patch(self.portal, 'login', recordingLogin)
+        packet = NS('foo') + NS('none') + NS('password') + chr(0) + NS('foo')
+        self.authServer.ssh_USERAUTH_REQUEST(packet)
+        self.authServer.transport.getPeer = lambda: IPv4Address(
+            'TCP', '192.168.1.2', 5678)
+        self.authServer.ssh_USERAUTH_REQUEST(packet)
+        self.assertEqual([c.peerHost for c in offered], [None, '192.168.1.2'])
+
+
     def test_failedPasswordAuthentication(self):
         """
         When provided with invalid authentication details, the server should
@@ -377,6 +397,46 @@ class SSHUserAuthServerTestCase(unittest.TestCase):
         return d.addCallback(check)
 
 
+    def test_successfulSHA2PrivateKeyAuthentication(self):
+        """
+        Private key authentication with an RSA key also succeeds with the
+        C{rsa-sha2-256} algorithm, whose name the signed data then carries.
+        """
+        blob = keys.Key.fromString(keydata.publicRSA_openssh).blob()
+        obj = keys.Key.fromString(keydata.privateRSA_openssh)
+        packet = (NS('foo') + NS('none') + NS('publickey') + '\xff'
+                + NS('rsa-sha2-256') + NS(blob))
+        self.authServer.transport.sessionID = 'test'
+        signature = obj.sign(NS('test') + chr(userauth.MSG_USERAUTH_REQUEST)
+                + packet, 'rsa-sha2-256')
+        packet += NS(signature)
+        d = self.authServer.ssh_USERAUTH_REQUEST(packet)
+        def check(ignored):
+            self.assertEqual(self.authServer.transport.packets,
+                    [(userauth.MSG_USERAUTH_SUCCESS, '')])
+        return d.addCallback(check)
+
+
+    def test_failedPrivateKeyAuthenticationSignatureAlgorithm(self):
+        """
+        Private key authentication fails if the signature is valid but was
+        made with another algorithm than the one the request names, without
+        the checkers being asked.
+        """
+        self.patch(self.portal, 'login',
+                   lambda *args: self.fail("checkers were asked"))
+        blob = keys.Key.fromString(keydata.publicRSA_openssh).blob()
+        obj = keys.Key.fromString(keydata.privateRSA_openssh)
+        packet = (NS('foo') + NS('none') + NS('publickey') + '\xff'
+                + NS('rsa-sha2-256') + NS(blob))
+        self.authServer.transport.sessionID = 'test'
+        signature = obj.sign(NS('test') + chr(userauth.MSG_USERAUTH_REQUEST)
+                + packet, 'ssh-rsa')
+        packet += NS(signature)
+        d = self.authServer.ssh_USERAUTH_REQUEST(packet)
+        return d.addCallback(self._checkFailed)
+
+
     def test_requestRaisesConchError(self):
         """
         ssh_USERAUTH_REQUEST should raise a ConchError if tryAuth returns
@@ -444,6 +504,43 @@ class SSHUserAuthServerTestCase(unittest.TestCase):
         return d.addCallback(self._checkFailed)
 
 
+    def test_publicKeyParsedOnce(self):
+        """
+        The public key offered in a probe and again in the signed request is
+        parsed once, through the factory's L{keys.KeyCache}, and handed to the
+        checkers as the C{publicKey} attribute of the credentials.
+        """
+        offered = []
+        login = self.portal.login
+        def recordingLogin(credentials, mind, *interfaces):
+            offered.append(credentials)
+            return login(credentials, mind, *interfaces)
+        self.patch(self.portal, 'login', recordingLogin)
+
+        blob = keys.Key.fromString(keydata.publicRSA_openssh).blob()
+        obj = keys.Key.fromString(keydata.privateRSA_openssh)
+        packet = (NS('foo') + NS('none') + NS('publickey') + '\x00'
+                + NS('ssh-rsa') + NS(blob))
+        d = self.authServer.ssh_USERAUTH_REQUEST(packet)
+        def signed(ignored):
+            packet = (NS('foo') + NS('none') + NS('publickey') + '\xff'
+                    + NS(obj.sshType()) + NS(blob))
+            self.authServer.transport.sessionID = 'test'
+            signature = obj.sign(NS('test') + chr(userauth.MSG_USERAUTH_REQUEST)
+                    + packet)
+            return self.authServer.ssh_USERAUTH_REQUEST(packet + NS(signature))
+        def check(ignored):
+            cache = self.authServer.transport.factory.publicKeyCache
+            self.assertEqual((cache.misses, cache.hits), (1, 1))
+            self.assertEqual(len(offered), 2)
+            self.assertIdentical(offered[0].publicKey, offered[1].publicKey)
+            self.assertEqual(offered[0].publicKey.blob(), blob)
+            self.assertEqual(self.authServer.transport.packets[-1],
+                    (userauth.MSG_USERAUTH_SUCCESS, ''))
+        d.addCallback(signed)
+        return d.addCallback(check)
+
+
     def test_successfulPAMAuthentication(self):
         """
         Test that keyboard-interactive authentication succeeds.
@@ -667,6 +764,56 @@ class SSHUserAuthServerTestCase(unittest.TestCase):
         return d.addCallback(check)
 
 
+    def test_rateLimitedAttempts(self):
+        """
+        With an C{authRateLimiter} on the factory, failed attempts are
+        recorded against the client's host and username, and once a bucket is
+        empty attempts fail after C{passwordDelay} without being checked.
+        """
+        clock = task.Clock()
+        limiter = throttle.AuthenticationRateLimiter(
+            sourceBurst=100, userBurst=1, clock=clock)
+        self.authServer.transport.factory.authRateLimiter = limiter
+        self.authServer.serviceStopped()
+        self.authServer.clock = clock
+        self.authServer.serviceStarted()
+        self.authServer.supportedAuthentications.sort()
+        checked = []
+        self.patch(self.authServer, 'tryAuth',
+                   lambda *args: checked.append(args) or
+                                 defer.fail(UnauthorizedLogin()))
+        packet = NS('foo') + NS('none') + NS('password') + chr(0) + NS('bar')
+        self.authServer.ssh_USERAUTH_REQUEST(packet)
+        self.assertEqual(len(checked), 1)
+        d = self.authServer.ssh_USERAUTH_REQUEST(packet)
+        self.assertEqual(len(checked), 1)
+        self.assertEqual(self.authServer.transport.packets[1:], [])
+        clock.advance(self.authServer.passwordDelay)
+        self.assertEqual((limiter.accepted, limiter.rejected), (1, 1))
+        return d.addCallback(self._checkFailed)
+
+
+    def test_timerWheel(self):
+        """
+        Login timeouts and password delays of services sharing a factory are
+        run by a single L{throttle.TimerWheel}.
+        """
+        clock = task.Clock()
+        servers = []
+        for i in range(3):
+            server = userauth.SSHUserAuthServer()
+            server.clock = clock
+            server.transport = self.authServer.transport
+            server.serviceStarted()
+            servers.append(server)
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        wheel = self.authServer.transport.factory.authTimerWheel
+        self.assertEqual(len(wheel), 3)
+        for server in servers:
+            server.serviceStopped()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
     def test_failIfUnknownService(self):
         """
         If the user requests a service that we don't support, the
@@ -2,18 +2,22 @@
 # See LICENSE for details.
 
 from twisted.cred import portal
-from twisted.python import components, log
+from twisted.python import components, failure, log
+from twisted.internet import defer, threads
 from twisted.internet.error import ProcessExitedAlready
 from zope import interface
 from ssh import session, forwarding, filetransfer
 from ssh.filetransfer import FXF_READ, FXF_WRITE, FXF_APPEND, FXF_CREAT, FXF_TRUNC, FXF_EXCL
+from ssh.filetransfer import FXF_TEXT
 from twisted.conch.ls import lsLine
+from twisted.conch._compat import OrderedDict
 
 from avatar import ConchUser
 from error import ConchError
 from interfaces import ISession, ISFTPServer, ISFTPFile
 
-import struct, os, time, socket
+import struct, os, time, socket, mmap, stat
+from collections import deque
 import fcntl, tty
 import pwd, grp
 import pty
@@ -290,23 +294,233 @@ class SSHSessionForUnixConchUser:
         self.oldWrite(data)
 
 
+class _AttributeCache:
+    """
+    A bounded cache of file attributes and resolved paths which expire after
+    a fixed time.
+
+    Every entry lives for the same time, so entries expire in the order they
+    were made; they are also queued in that order, and when the cache is
+    full the entry made longest ago is dropped, whether or not it has
+    expired yet.
+
+    @ivar hits: the number of lookups answered from the cache.
+    @ivar misses: the number of lookups which were not.
+    @ivar invalidations: the number of entries dropped because the file they
+        describe was changed.
+    """
+
+    def __init__(self, maxEntries, ttl, clock=None):
+        """
+        @param maxEntries: the number of entries kept at most.
+        @param ttl: the number of seconds an entry is used for.
+        @param clock: the L{IReactorTime} provider used to expire entries.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = {}
+        # (expiry time, key) for each entry made, oldest first.  Entries
+        # which were replaced or dropped since are skipped when they come up.
+        self._order = deque()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def get(self, key):
+        """
+        Return the value cached for C{key}, or C{None}.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > self.clock.seconds():
+                self.hits += 1
+                return entry[1]
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+
+    def set(self, key, value):
+        """
+        Cache C{value} for C{key}, making room if the cache is full.
+        """
+        if self.maxEntries <= 0:
+            return
+        now = self.clock.seconds()
+        self._entries.pop(key, None)
+        order = self._order
+        while order and (order[0][0] <= now or
+                         len(self._entries) >= self.maxEntries):
+            expires, oldKey = order.popleft()
+            entry = self._entries.get(oldKey)
+            if entry is not None and entry[0] == expires:
+                del self._entries[oldKey]
+        expires = now + self.ttl
+        self._entries[key] = (expires, value)
+        order.append((expires, key))
+        if len(order) > 2 * self.maxEntries:
+            self._order = deque(sorted(
+                [(cached[0], k) for k, cached in self._entries.iteritems()]))
+
+
+    def invalidate(self, path):
+        """
+        Drop the attributes cached for C{path}.
+        """
+        if self._entries.pop(('lstat', path), None) is not None:
+            self.invalidations += 1
+
+
+    def invalidateTree(self, path):
+        """
+        Drop everything cached for C{path} and anything below it, and every
+        resolved path, since the names leading to them may have changed.
+        """
+        prefix = path.rstrip('/') + '/'
+        for key in self._entries.keys():
+            if (key[0] == 'realpath' or key[1] == path or
+                key[1].startswith(prefix)):
+                del self._entries[key]
+                self.invalidations += 1
+
+
+
+class _ReadAheadBudget:
+    """
+    A cap on the memory used by read-ahead buffers, optionally nested in a
+    larger one, so a session's budget also counts against the server's.
+
+    @ivar limit: the number of bytes which may be reserved at once.
+    @ivar used: the number of bytes reserved now.
+    @ivar parent: the enclosing L{_ReadAheadBudget}, or C{None}.
+    """
+
+    def __init__(self, limit, parent=None):
+        self.limit = limit
+        self.used = 0
+        self.parent = parent
+
+
+    def available(self):
+        """
+        Return the number of bytes which may still be reserved.
+        """
+        available = self.limit - self.used
+        if self.parent is not None:
+            available = min(available, self.parent.available())
+        return max(0, available)
+
+
+    def reserve(self, size):
+        """
+        Reserve as much as possible of C{size} bytes.
+
+        @return: the number of bytes reserved, which may be 0.
+        """
+        size = min(size, self.available())
+        self.used += size
+        if self.parent is not None:
+            self.parent.used += size
+        return size
+
+
+    def release(self, size):
+        """
+        Give back C{size} bytes reserved with L{reserve}.
+        """
+        self.used -= size
+        if self.parent is not None:
+            self.parent.release(size)
+
+
+
 class SFTPServerForUnixConchUser:
 
     interface.implements(ISFTPServer)
 
+    # The size, in bytes, from which read-only opens of regular files are
+    # served from a memory map by MappedUnixSFTPFile.  None disables mapping.
+    mmapThreshold = None
+
+    # The number of seconds the attributes of a path, and the result of
+    # resolving it, are remembered for, and the number of paths remembered.
+    # Changes made through this session invalidate the cache immediately;
+    # changes made by anything else are seen once the entry expires.
+    attrCacheTTL = 1.0
+    attrCacheSize = 1024
+
+    # The number of bytes of writes to each file which may be held back and
+    # coalesced into larger writes, or 0 to write each request as it comes.
+    # Buffered writes are flushed after writeBehindDelay seconds, and when
+    # the file is read, closed, synced or has its attributes read or set.
+    # writeBehindDurability chooses when writes are acknowledged: 'buffered'
+    # (at once; errors are reported by a later write or by the close),
+    # 'written' (once written to the file) or 'synced' (once fsync'd).
+    writeBehindSize = 0
+    writeBehindDelay = 0.1
+    writeBehindDurability = 'buffered'
+
+    # The largest number of bytes read ahead, in a thread, for each
+    # read-only file which is read sequentially, or 0 to disable read-ahead.
+    # The memory used by read-ahead buffers is limited to
+    # readAheadSessionLimit bytes for each session and, for all sessions
+    # together, by readAheadServerBudget.
+    readAheadMaximum = 0
+    readAheadSessionLimit = 8 * 1024 * 1024
+    readAheadServerBudget = _ReadAheadBudget(64 * 1024 * 1024)
+
+    # The IReactorTime provider used to schedule flushes, or None for the
+    # global reactor.
+    clock = None
+
+    _deferToThread = staticmethod(threads.deferToThread)
+
     def __init__(self, avatar):
         self.avatar = avatar
+        self.attrCache = _AttributeCache(self.attrCacheSize, self.attrCacheTTL)
+        if self.clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+        self._writers = {}
+        self.readAheadBudget = _ReadAheadBudget(self.readAheadSessionLimit,
+                                                self.readAheadServerBudget)
+
+
+    def _flushWrites(self, path):
+        """
+        Flush the writes held back by the files open on C{path}.
+        """
+        for fileObj in self._writers.get(path, ()):
+            fileObj._flushWrites()
 
 
-    def _setAttrs(self, path, attrs):
+    def _setAttrs(self, path, attrs, setSize=False):
         """
         NOTE: this function assumes it runs as the logged-in user:
         i.e. under _runAsUser()
+
+        The file is only truncated or extended to the C{size} attribute if
+        C{setSize} is true, as it is for SETSTAT; a size given when a file is
+        opened or a directory made is ignored.
         """
         if attrs.has_key("uid") and attrs.has_key("gid"):
             os.chown(path, attrs["uid"], attrs["gid"])
         if attrs.has_key("permissions"):
             os.chmod(path, attrs["permissions"])
+        if setSize and attrs.has_key("size"):
+            fd = os.open(path, os.O_WRONLY)
+            try:
+                os.ftruncate(fd, attrs["size"])
+            finally:
+                os.close(fd)
         if attrs.has_key("atime") and attrs.has_key("mtime"):
             os.utime(path, (attrs["atime"], attrs["mtime"]))
 
@@ -328,40 +542,63 @@ class SFTPServerForUnixConchUser:
         return {}
 
     def openFile(self, filename, flags, attrs):
+        if (self.mmapThreshold is not None and
+            flags & ~FXF_TEXT == FXF_READ):
+            return MappedUnixSFTPFile(self, self._absPath(filename), flags,
+                                      attrs)
         return UnixSFTPFile(self, self._absPath(filename), flags, attrs)
 
     def removeFile(self, filename):
         filename = self._absPath(filename)
+        self.attrCache.invalidateTree(filename)
         return self.avatar._runAsUser(os.remove, filename)
 
     def renameFile(self, oldpath, newpath):
         oldpath = self._absPath(oldpath)
         newpath = self._absPath(newpath)
+        self.attrCache.invalidateTree(oldpath)
+        self.attrCache.invalidateTree(newpath)
         return self.avatar._runAsUser(os.rename, oldpath, newpath)
 
     def makeDirectory(self, path, attrs):
         path = self._absPath(path)
+        self.attrCache.invalidate(path)
         return self.avatar._runAsUser([(os.mkdir, (path,)),
                                 (self._setAttrs, (path, attrs))])
 
     def removeDirectory(self, path):
         path = self._absPath(path)
+        self.attrCache.invalidateTree(path)
         self.avatar._runAsUser(os.rmdir, path)
 
     def openDirectory(self, path):
         return UnixSFTPDirectory(self, self._absPath(path))
 
     def getAttrs(self, path, followLinks):
+        """
+        Return the attributes of C{path}, or of what it links to if
+        C{followLinks} is true.
+
+        Only the attributes of the path itself are cached.  Those of a
+        symbolic link's target are read each time, since the target may be
+        changed under another name which would not invalidate the link.
+        """
         path = self._absPath(path)
-        if followLinks:
-            s = self.avatar._runAsUser(os.stat, path)
-        else:
-            s = self.avatar._runAsUser(os.lstat, path)
-        return self._getAttrs(s)
+        self._flushWrites(path)
+        key = ('lstat', path)
+        attrs = self.attrCache.get(key)
+        if attrs is None:
+            attrs = self._getAttrs(self.avatar._runAsUser(os.lstat, path))
+            self.attrCache.set(key, attrs)
+        if followLinks and stat.S_ISLNK(attrs['permissions']):
+            attrs = self._getAttrs(self.avatar._runAsUser(os.stat, path))
+        return attrs.copy()
 
     def setAttrs(self, path, attrs):
         path = self._absPath(path)
-        self.avatar._runAsUser(self._setAttrs, path, attrs)
+        self._flushWrites(path)
+        self.attrCache.invalidate(path)
+        self.avatar._runAsUser(self._setAttrs, path, attrs, True)
 
     def readLink(self, path):
         path = self._absPath(path)
@@ -370,14 +607,306 @@ class SFTPServerForUnixConchUser:
     def makeLink(self, linkPath, targetPath):
         linkPath = self._absPath(linkPath)
         targetPath = self._absPath(targetPath)
+        self.attrCache.invalidateTree(linkPath)
         return self.avatar._runAsUser(os.symlink, targetPath, linkPath)
 
     def realPath(self, path):
-        return os.path.realpath(self._absPath(path))
+        path = self._absPath(path)
+        key = ('realpath', path)
+        result = self.attrCache.get(key)
+        if result is None:
+            result = os.path.realpath(path)
+            self.attrCache.set(key, result)
+        return result
+
+    def statVFS(self, path):
+        path = self._absPath(path)
+        return self.avatar._runAsUser(os.statvfs, path)
 
     def extendedRequest(self, extName, extData):
         raise NotImplementedError
 
+class _WriteBehindBuffer:
+    """
+    The writes to one L{UnixSFTPFile} which have been accepted but not yet
+    written, kept as runs of adjacent chunks so that many small writes reach
+    the disk as a few large ones.
+
+    A run is a list of C{[offset, length, chunks]}.  Writes which extend a
+    run at either end join it; a write which overlaps buffered data flushes
+    the buffer first, so later writes always win.  The buffer is flushed
+    when it holds C{maxSize} bytes or C{maxRuns} runs, C{delay} seconds
+    after the first write into it, or when L{flush} is called.
+
+    @ivar durability: C{'buffered'} to acknowledge writes as soon as they are
+        buffered, C{'written'} to acknowledge them once they have been
+        written to the file, or C{'synced'} to acknowledge them once they
+        have also been flushed to disk with C{fsync}.  Errors writing
+        buffered data are raised by the next call to L{write} or L{flush}.
+    @ivar size: the number of bytes buffered.
+    """
+
+    maxRuns = 16
+
+    def __init__(self, fileObj, maxSize, delay, durability, clock):
+        self.fileObj = fileObj
+        self.maxSize = maxSize
+        self.delay = delay
+        self.durability = durability
+        self.clock = clock
+        self.size = 0
+        self._runs = []
+        self._waiting = []
+        self._timer = None
+        self._error = None
+
+
+    def write(self, offset, data):
+        """
+        Buffer C{data} to be written at C{offset}.
+
+        @return: C{None} if the write is acknowledged at once, or a
+            L{Deferred} which fires when it has been written as C{durability}
+            requires.
+        """
+        self._raiseError()
+        end = offset + len(data)
+        for run in self._runs:
+            if run[0] < end and offset < run[0] + run[1]:
+                self.flush()
+                break
+        for run in self._runs:
+            if run[0] + run[1] == offset:
+                run[1] += len(data)
+                run[2].append(data)
+                break
+            elif run[0] == end:
+                run[0] = offset
+                run[1] += len(data)
+                run[2].insert(0, data)
+                break
+        else:
+            self._runs.append([offset, len(data), [data]])
+        self.size += len(data)
+        d = None
+        if self.durability != 'buffered':
+            d = defer.Deferred()
+            self._waiting.append(d)
+        if self.size >= self.maxSize or len(self._runs) > self.maxRuns:
+            try:
+                self.flush()
+            except:
+                if d is None:
+                    raise
+        elif self._timer is None:
+            self._timer = self.clock.callLater(self.delay, self._timedFlush)
+        return d
+
+
+    def flush(self):
+        """
+        Write the buffered data to the file, in a single switch to the
+        user's credentials, and fire the L{Deferred}s of the writes it holds.
+        """
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        if self._runs:
+            runs, self._runs = sorted(self._runs), []
+            waiting, self._waiting = self._waiting, []
+            self.size = 0
+            try:
+                self.fileObj._writeRuns(
+                    [(offset, ''.join(chunks)) for (offset, length, chunks)
+                     in runs], self.durability == 'synced')
+            except:
+                reason = failure.Failure()
+                for d in waiting:
+                    d.errback(reason)
+                raise
+            for d in waiting:
+                d.callback(None)
+        self._raiseError()
+
+
+    def _timedFlush(self):
+        self._timer = None
+        try:
+            self.flush()
+        except:
+            if self.durability == 'buffered':
+                self._error = failure.Failure()
+
+
+    def _raiseError(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            error.raiseException()
+
+
+
+class _ReadAhead:
+    """
+    Read-ahead for a read-only L{UnixSFTPFile} which is being read
+    sequentially.
+
+    Once C{sequentialReads} reads in a row have each started where the one
+    before ended, the file is read ahead of the client in a thread, into a
+    buffer from which later reads are served.  The window read ahead starts
+    at four times the client's read length and doubles, up to C{maximum},
+    each time the client catches up with the end of the buffer; a read
+    anywhere else drops the buffer and starts over.  While a read-ahead is
+    in progress, reads which are not in the buffer wait for it, so only one
+    thread uses the file's offset at a time.  The thread only reads the
+    already open descriptor, so it does not need the user's credentials.
+
+    @ivar window: the number of bytes read ahead at a time, or 0 before the
+        reads have been found to be sequential.
+    @ivar hits: the number of reads served from the buffer.
+    @ivar misses: the number of reads made from the file.
+    """
+
+    sequentialReads = 2
+
+    def __init__(self, fileObj, maximum, budget):
+        self.fileObj = fileObj
+        self.maximum = maximum
+        self.budget = budget
+        self.window = 0
+        self.hits = 0
+        self.misses = 0
+        self._next = 0
+        self._streak = 0
+        self._start = 0
+        self._data = ''
+        self._position = 0
+        self._eof = False
+        self._pending = None
+        self._waiting = []
+
+
+    def read(self, offset, length):
+        """
+        Read C{length} bytes at C{offset}, from the buffer if they are in it.
+
+        @return: the data read, or a L{Deferred} firing with it if a
+            read-ahead is in progress.
+        """
+        sequential = offset == self._next
+        index = offset - self._start
+        end = index + length
+        hit = bool(self._data) and self._position <= index and (
+            end <= len(self._data) or self._eof)
+        if self._pending is not None and not (sequential and hit):
+            d = defer.Deferred()
+            self._waiting.append((offset, length, d))
+            return d
+        if sequential:
+            self._streak += 1
+        else:
+            self._streak = 0
+            self.window = 0
+            self._eof = False
+        self._next = offset + length
+        if hit:
+            self.hits += 1
+            result = self._data[index:end]
+            self._position = min(end, len(self._data))
+            if self._position == len(self._data):
+                if not self._eof:
+                    self.window = min(self.window * 2, self.maximum)
+                if self._pending is None:
+                    self._drop()
+        else:
+            self.misses += 1
+            self._drop()
+            result = self.fileObj._readAt(offset, length)
+        if self._streak >= self.sequentialReads and self._pending is None:
+            self._readAhead(length)
+        return result
+
+
+    def _readAhead(self, length):
+        if self._eof:
+            return
+        if not self.window:
+            self.window = min(length * 4, self.maximum)
+        if len(self._data) - self._position >= self.window // 2:
+            return
+        size = self.budget.reserve(self.window)
+        if not size:
+            return
+        if not self._data:
+            self._start = self._next
+            self._position = 0
+        offset = self._start + len(self._data)
+        d = self._pending = self.fileObj.server._deferToThread(
+            self.fileObj._readAt, offset, size)
+        d.addCallbacks(self._cbReadAhead, self._ebReadAhead,
+                       callbackArgs=(size,), errbackArgs=(size,))
+
+
+    def _cbReadAhead(self, data, size):
+        self._pending = None
+        if len(data) < size:
+            self._eof = True
+        self.budget.release(self._position + size - len(data))
+        self._data = self._data[self._position:] + data
+        self._start += self._position
+        self._position = 0
+        self._runWaiting()
+
+
+    def _ebReadAhead(self, reason, size):
+        self._pending = None
+        self.budget.release(size)
+        self._streak = 0
+        self.window = 0
+        self._runWaiting()
+
+
+    def _runWaiting(self):
+        """
+        Serve the reads which waited for a read-ahead, until they are all
+        served or one of them starts another read-ahead.
+        """
+        waiting, self._waiting = self._waiting, []
+        while waiting and self._pending is None:
+            offset, length, d = waiting.pop(0)
+            try:
+                result = self.read(offset, length)
+            except:
+                d.errback()
+            else:
+                d.callback(result)
+        self._waiting[:0] = waiting
+
+
+    def _drop(self):
+        """
+        Forget the buffered data and give its memory back to the budget.
+        """
+        self.budget.release(len(self._data))
+        self._data = ''
+        self._position = 0
+
+
+    def close(self):
+        """
+        Forget the buffered data.
+
+        @return: C{None}, or a L{Deferred} which fires once the read-ahead in
+            progress, if any, has finished with the file.
+        """
+        if self._pending is not None:
+            d = defer.Deferred()
+            self._pending.addBoth(lambda ignored: d.callback(None))
+            return d.addCallback(lambda ignored: self.close())
+        self._drop()
+
+
+
 class UnixSFTPFile:
 
     interface.implements(ISFTPFile)
@@ -404,30 +933,167 @@ class UnixSFTPFile:
             del attrs["permissions"]
         else:
             mode = 0777
+        if openFlags & (os.O_CREAT | os.O_TRUNC) or attrs:
+            server.attrCache.invalidate(filename)
         fd = server.avatar._runAsUser(os.open, filename, openFlags, mode)
         if attrs:
             server.avatar._runAsUser(server._setAttrs, filename, attrs)
         self.fd = fd
+        self.filename = filename
+        self._readAhead = None
+        if server.readAheadMaximum and flags & ~FXF_TEXT == FXF_READ:
+            self._readAhead = _ReadAhead(self, server.readAheadMaximum,
+                                         server.readAheadBudget)
+        self._writeBehind = None
+        if (server.writeBehindSize and flags & FXF_WRITE and
+            not flags & FXF_APPEND):
+            self._writeBehind = _WriteBehindBuffer(
+                self, server.writeBehindSize, server.writeBehindDelay,
+                server.writeBehindDurability, server.clock)
+            server._writers.setdefault(filename, []).append(self)
 
     def close(self):
+        if self._readAhead is not None:
+            d = self._readAhead.close()
+            if d is not None:
+                return d.addCallback(lambda ignored: self.close())
+        if self._writeBehind is not None:
+            writers = self.server._writers[self.filename]
+            writers.remove(self)
+            if not writers:
+                del self.server._writers[self.filename]
+            try:
+                self._flushWrites()
+            except:
+                self.server.avatar._runAsUser(os.close, self.fd)
+                raise
         return self.server.avatar._runAsUser(os.close, self.fd)
 
     def readChunk(self, offset, length):
+        if self._readAhead is not None:
+            return self._readAhead.read(offset, length)
+        self._flushWrites()
         return self.server.avatar._runAsUser([ (os.lseek, (self.fd, offset, 0)),
                                                (os.read, (self.fd, length)) ])
 
+    def _readAt(self, offset, length):
+        """
+        Read from the open descriptor, without switching credentials, for
+        L{_ReadAhead}.
+        """
+        os.lseek(self.fd, offset, 0)
+        return os.read(self.fd, length)
+
     def writeChunk(self, offset, data):
+        self.server.attrCache.invalidate(self.filename)
+        if self._writeBehind is not None:
+            return self._writeBehind.write(offset, data)
         return self.server.avatar._runAsUser([(os.lseek, (self.fd, offset, 0)),
                                        (os.write, (self.fd, data))])
 
+    def _writeRuns(self, runs, sync):
+        """
+        Write each C{(offset, data)} of C{runs}, and C{fsync} the file
+        afterwards if C{sync} is true.
+        """
+        calls = []
+        for (offset, data) in runs:
+            calls.append((os.lseek, (self.fd, offset, 0)))
+            calls.append((os.write, (self.fd, data)))
+        if sync:
+            calls.append((os.fsync, (self.fd,)))
+        self.server.attrCache.invalidate(self.filename)
+        self.server.avatar._runAsUser(calls)
+
+    def _flushWrites(self):
+        if self._writeBehind is not None:
+            self._writeBehind.flush()
+
     def getAttrs(self):
+        self._flushWrites()
         s = self.server.avatar._runAsUser(os.fstat, self.fd)
         return self.server._getAttrs(s)
 
+    def fsync(self):
+        self._flushWrites()
+        return self.server.avatar._runAsUser(os.fsync, self.fd)
+
     def setAttrs(self, attrs):
         raise NotImplementedError
 
 
+class _MappingCache:
+    """
+    A bounded, least-recently-used set of read-only memory maps, keyed on the
+    identity and version of the mapped file.
+
+    @ivar maxMappings: the number of mappings kept open at once.
+    """
+
+    def __init__(self, maxMappings):
+        self.maxMappings = maxMappings
+        # Ordered from the least to the most recently used.
+        self._mappings = OrderedDict()
+
+
+    def __len__(self):
+        return len(self._mappings)
+
+
+    def get(self, key, fd):
+        """
+        Return the mapping for C{key}, mapping C{fd} if there is none yet and
+        unmapping the least recently used mappings to stay within the limit.
+        """
+        mapping = self._mappings.pop(key, None)
+        if mapping is None:
+            while self._mappings and len(self._mappings) >= self.maxMappings:
+                self._mappings.popitem(last=False)[1].close()
+            mapping = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        self._mappings[key] = mapping
+        return mapping
+
+
+
+class MappedUnixSFTPFile(UnixSFTPFile):
+    """
+    A read-only L{UnixSFTPFile} which serves reads of large regular files
+    from a memory map instead of an C{lseek}/C{read} pair per request.
+
+    Mappings are shared between every handle, in every session, open on the
+    same version of a file.  When a read reaches the end of the mapping the
+    file is checked again, and if its size or modification time has changed
+    the handle falls back to the regular read path.  Files which are
+    truncated while mapped can still raise C{SIGBUS}, so only enable this,
+    with L{SFTPServerForUnixConchUser.mmapThreshold}, for files which are
+    replaced rather than rewritten in place.
+
+    @cvar mappings: the L{_MappingCache} shared by all instances.
+    """
+
+    mappings = _MappingCache(64)
+
+    def __init__(self, server, filename, flags, attrs):
+        UnixSFTPFile.__init__(self, server, filename, flags, attrs)
+        s = os.fstat(self.fd)
+        if (stat.S_ISREG(s.st_mode) and s.st_size and
+            s.st_size >= server.mmapThreshold):
+            self._key = (s.st_dev, s.st_ino, s.st_size, s.st_mtime)
+        else:
+            self._key = None
+
+
+    def readChunk(self, offset, length):
+        if self._key is not None and offset + length >= self._key[2]:
+            s = os.fstat(self.fd)
+            if (s.st_size, s.st_mtime) != self._key[2:]:
+                self._key = None
+        if self._key is None:
+            return UnixSFTPFile.readChunk(self, offset, length)
+        return self.mappings.get(self._key, self.fd)[offset:offset + length]
+
+
+
 class UnixSFTPDirectory:
 
     def __init__(self, server, directory):
@@ -444,10 +1110,13 @@ class UnixSFTPDirectory:
         except IndexError:
             raise StopIteration
         else:
-            s = self.server.avatar._runAsUser(os.lstat, os.path.join(self.dir, f))
+            path = os.path.join(self.dir, f)
+            s = self.server.avatar._runAsUser(os.lstat, path)
             longname = lsLine(f, s)
             attrs = self.server._getAttrs(s)
-            return (f, longname, attrs)
+            # Clients commonly stat every entry they have just listed.
+            self.server.attrCache.set(('lstat', path), attrs)
+            return (f, longname, attrs.copy())
 
     def close(self):
         self.files = []